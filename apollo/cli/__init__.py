@@ -1,9 +1,13 @@
 """CLI module."""
 
+from .archives import archives_cli
+from .benchmarks import benchmarks_cli
 from .messages import messages_cli
 from .users import users_cli
 
 __all__ = [
+    "archives_cli",
+    "benchmarks_cli",
     "messages_cli",
     "users_cli",
 ]
@@ -0,0 +1,33 @@
+"""Event archive CLI options."""
+
+import click
+from flask.cli import AppGroup, with_appcontext
+
+from apollo.deployments.archives import restore_archive
+from apollo.deployments.models import Deployment
+
+archives_cli = AppGroup("archives", short_help="Event archive commands.")
+
+
+@archives_cli.command("restore")
+@with_appcontext
+@click.argument("source_file", type=click.Path(exists=True, dir_okay=False))
+@click.option("-d", "--deployment", "deployment_id", type=int, help="The deployment to restore the event to.")
+def restore(source_file, deployment_id):
+    """Restores an event archive as a new event."""
+    query = Deployment.query.order_by(Deployment.id)
+    deployment = query.filter_by(id=deployment_id).first() if deployment_id else query.first()
+    if deployment is None:
+        raise click.BadParameter("No such deployment.", param_hint="--deployment")
+
+    event, archive_restore = restore_archive(source_file, deployment)
+    throughput = archive_restore.throughput()
+
+    click.echo(f"{'member':>30} {'rows':>10} {'seconds':>10} {'rows/sec':>10}")
+    for member, (rows, seconds, rate) in throughput.items():
+        click.echo(f"{member:>30} {rows:>10} {seconds:>10.2f} {rate:>10.0f}")
+
+    rows = sum(rows for rows, _, _ in throughput.values())
+    seconds = sum(seconds for _, seconds, _ in throughput.values())
+    rate = rows / seconds if seconds else 0.0
+    click.echo(f"Event {event.name} restored: {rows} rows in {seconds:.2f}s ({rate:.0f} rows/sec).")
@@ -0,0 +1,752 @@
+"""Benchmark CLI options."""
+
+import random
+import time
+import tracemalloc
+from contextlib import contextmanager
+from io import BytesIO
+from uuid import uuid4
+
+import click
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from arpeggio import visit_parse_tree
+from arpeggio.cleanpeg import ParserPEG
+from flask import current_app, g
+from flask.cli import AppGroup, with_appcontext
+from lxml import etree
+from sqlalchemy.dialects.postgresql import array_agg
+from sqlalchemy.orm import aliased
+from werkzeug.datastructures import MultiDict
+
+from apollo.core import db
+from apollo.deployments.models import Deployment, Event
+from apollo.formsframework.models import Form
+from apollo.locations.models import Location, LocationPath, LocationSet, LocationType, LocationTypePath
+from apollo.odk.utils import read_submission
+from apollo.participants.models import ParticipantSet
+from apollo.process_analysis.common import generate_field_stats, generate_grouped_field_stats
+from apollo.submissions.aggregation import (
+    _multiselect_field_processor,
+    _numeric_field_processor,
+    _select_field_processor,
+    aggregate_rows,
+    field_statistics,
+    level_statistics,
+)
+from apollo.submissions.models import Submission
+from apollo.submissions.qa import query_builder
+from apollo.submissions.utils import make_submission_dataframe
+
+benchmarks_cli = AppGroup("benchmarks", short_help="Benchmark commands.")
+
+
+@contextmanager
+def count_queries():
+    """Counts the statements sent to the database within the context."""
+    counter = {"queries": 0}
+
+    def _on_execute(*args, **kwargs):
+        counter["queries"] += 1
+
+    sa.event.listen(db.engine, "before_cursor_execute", _on_execute)
+    try:
+        yield counter
+    finally:
+        sa.event.remove(db.engine, "before_cursor_execute", _on_execute)
+
+
+def random_form_data(form, tags):
+    """Generates random values for the given form tags."""
+    data = {}
+    for tag in tags:
+        field = form.get_field_by_tag(tag)
+        if field["type"] == "integer":
+            data[tag] = random.randint(field.get("min", 0), field.get("max", 9999))
+        elif field["type"] == "select":
+            data[tag] = random.choice(list(field["options"].values()))
+
+    return data
+
+
+def report(label, timings, queries):
+    """Outputs the summary line for a benchmark run."""
+    timings = np.array(timings) * 1000
+    click.echo(
+        f"{label:>12} {np.mean(queries):>10.1f} {np.percentile(timings, 50):>10.2f} "
+        f"{np.percentile(timings, 95):>10.2f}"
+    )
+
+
+@benchmarks_cli.command("conflicts")
+@with_appcontext
+@click.option("--event", "event_id", type=int, required=True, help="The event to create submissions for.")
+@click.option("--form", "form_id", type=int, required=True, help="The checklist form to use.")
+@click.option("--repeat", type=int, default=20, show_default=True, help="Saves per sibling group size.")
+@click.option("--max-siblings", type=int, default=10, show_default=True, help="Largest sibling group size.")
+def conflicts(event_id, form_id, repeat, max_siblings):
+    """Measures the cost of resolving conflicts when saving a submission.
+
+    Synthetic sibling groups are created on the first location of the
+    event location set and are removed when the benchmark completes.
+    """
+    event = db.session.get(Event, event_id)
+    form = db.session.get(Form, form_id)
+    if event is None or form is None:
+        raise click.BadParameter("Invalid event or form.")
+
+    location = Location.query.filter_by(location_set_id=event.location_set_id).first()
+    tags = [tag for tag in form.tags if form.get_field_by_tag(tag)["type"] in ("integer", "select")]
+    created = []
+
+    click.echo(f"{'siblings':>12} {'queries':>10} {'p50 (ms)':>10} {'p95 (ms)':>10}")
+    try:
+        for group_size in range(1, max_siblings + 1):
+            params = {
+                "deployment_id": event.deployment_id,
+                "event_id": event.id,
+                "form_id": form.id,
+                "location_id": location.id,
+                "serial_no": f"benchmark-{uuid4().hex}",
+            }
+            master = Submission(submission_type="M", data={}, **params)
+            observers = [
+                Submission(submission_type="O", data=random_form_data(form, tags), **params) for _ in range(group_size)
+            ]
+            db.session.add_all([master] + observers)
+            db.session.commit()
+            created.extend([master] + observers)
+
+            timings = []
+            queries = []
+            for index in range(repeat):
+                observer = observers[index % group_size]
+                data = random_form_data(form, random.sample(tags, min(len(tags), 5)))
+                Submission.query.filter_by(id=observer.id).update({"data": dict(observer.data, **data)})
+
+                with count_queries() as counter:
+                    start = time.perf_counter()
+                    observer.update_related(data)
+                    timings.append(time.perf_counter() - start)
+                queries.append(counter["queries"])
+
+            report(str(group_size), timings, queries)
+    finally:
+        Submission.query.filter(Submission.id.in_([s.id for s in created])).delete(synchronize_session=False)
+        db.session.commit()
+
+
+@benchmarks_cli.command("export")
+@with_appcontext
+@click.option("--event", "event_id", type=int, required=True, help="The event to export submissions for.")
+@click.option("--form", "form_id", type=int, required=True, help="The form to export submissions for.")
+@click.option(
+    "--submission-type",
+    type=click.Choice(["O", "M"]),
+    default="O",
+    show_default=True,
+    help="Export observer or master submissions.",
+)
+@click.option("--qa", is_flag=True, help="Include the quality assurance columns.")
+@click.option("--chunk-size", type=int, default=1000, show_default=True, help="Rows fetched per chunk.")
+def export(event_id, form_id, submission_type, qa, chunk_size):
+    """Measures the throughput of the submission CSV export."""
+    from apollo.services import submissions  # local to avoid circular import
+
+    event = db.session.get(Event, event_id)
+    form = db.session.get(Form, form_id)
+    if event is None or form is None:
+        raise click.BadParameter("Invalid event or form.")
+
+    query = (
+        Submission.query.filter(
+            Submission.submission_type == submission_type,
+            Submission.form == form,
+            Submission.event == event,
+        )
+        .join(Submission.location)
+        .order_by(Location.code)
+    )
+
+    rows = query.count()
+    with count_queries() as counter:
+        start = time.perf_counter()
+        size = 0
+        for chunk in submissions.export_list(query, include_qa=qa, chunk_size=chunk_size):
+            size += len(chunk)
+        elapsed = time.perf_counter() - start
+
+    click.echo(f"rows: {rows}, characters: {size}, queries: {counter['queries']}")
+    click.echo(f"elapsed: {elapsed:.2f}s, rows/sec: {rows / elapsed if elapsed else 0:.1f}")
+
+
+def synthetic_process_data(rows, groups, tags):
+    """Generates a dataframe and form fields resembling checklist data."""
+    rng = np.random.default_rng(0)
+    data = {"location": rng.integers(0, groups, rows).astype(str)}
+    fields = []
+    for index in range(tags):
+        tag = f"F{index}"
+        kind = index % 4
+        if kind == 0:
+            fields.append({"tag": tag, "type": "integer", "analysis_type": "mean", "null_value": 999})
+            data[tag] = rng.integers(0, 500, rows).astype(np.float64)
+        elif kind == 1:
+            fields.append({"tag": tag, "type": "integer", "analysis_type": "count"})
+            data[tag] = rng.integers(0, 10, rows).astype(np.float64)
+        elif kind == 2:
+            fields.append(
+                {
+                    "tag": tag,
+                    "type": "select",
+                    "analysis_type": "histogram",
+                    "options": {"Yes": 1, "No": 2, "Unsure": 3},
+                    "null_value": 99,
+                }
+            )
+            data[tag] = rng.choice([1, 2, 3, 99], rows).astype(np.float64)
+        else:
+            fields.append({"tag": tag, "type": "integer", "analysis_type": "bucket", "expected": 5})
+            data[tag] = rng.integers(0, 10, rows).astype(np.float64)
+
+        # leave a tenth of the values unreported
+        data[tag][rng.random(rows) < 0.1] = np.nan
+
+    return pd.DataFrame(data), fields
+
+
+@benchmarks_cli.command("process-analysis")
+@click.option("--rows", type=int, default=100000, show_default=True, help="Rows in the synthetic dataframe.")
+@click.option("--groups", type=int, default=9000, show_default=True, help="Number of locations to group by.")
+@click.option("--tags", type=int, default=80, show_default=True, help="Number of form fields.")
+@click.option("--baseline-groups", type=int, default=500, show_default=True, help="Groups timed for the baseline.")
+def process_analysis(rows, groups, tags, baseline_groups):
+    """Compares per-group and vectorized process analysis statistics.
+
+    The baseline computes the statistics of each group separately, the way
+    they used to be computed. As that takes very long for a large number
+    of groups, it is timed on a subset of the groups and extrapolated.
+    """
+    dataframe, fields = synthetic_process_data(rows, groups, tags)
+    data_group = dataframe.groupby("location")
+
+    start = time.perf_counter()
+    generate_grouped_field_stats(fields, data_group)
+    vectorized = time.perf_counter() - start
+
+    group_names = list(data_group.groups)[:baseline_groups]
+    start = time.perf_counter()
+    for name in group_names:
+        group = data_group.get_group(name)
+        for field in fields:
+            generate_field_stats(field, group)
+    baseline = (time.perf_counter() - start) * data_group.ngroups / max(len(group_names), 1)
+
+    click.echo(f"rows: {rows}, groups: {data_group.ngroups}, tags: {tags}")
+    click.echo(f"per-group (extrapolated): {baseline:.2f}s, vectorized: {vectorized:.2f}s")
+    click.echo(f"speedup: {baseline / vectorized if vectorized else 0:.1f}x")
+
+
+def uncompiled_qa_status(submission, check):
+    """Evaluates a QA check by parsing and visiting its expression every time."""
+    expression = query_builder.build_expression(check)
+    if expression == "":
+        return None, set()
+
+    tree = ParserPEG(query_builder.GRAMMAR, "qa").parse(expression)
+    tag_visitor = query_builder.TagVisitor()
+    visit_parse_tree(tree, tag_visitor)
+    try:
+        result = visit_parse_tree(tree, query_builder.InlineQATreeVisitor(form=submission.form, submission=submission))
+    except TypeError:
+        return None, set()
+
+    return result, tag_visitor.variables.intersection(submission.form.tags)
+
+
+@benchmarks_cli.command("qa")
+@click.option("--checks", type=int, default=20, show_default=True, help="Number of quality checks.")
+@click.option("--submissions", "count", type=int, default=50, show_default=True, help="Submissions evaluated.")
+def qa(checks, count):
+    """Compares parsing QA checks for every evaluation with compiled checks.
+
+    The form, its checks and the submissions are generated in memory, the
+    way a page of the submission list evaluates every check of each row.
+    """
+    # form tags are made up of letters only
+    tags = [chr(65 + index // 26) + chr(65 + index % 26) for index in range(checks * 2)]
+    form = Form(
+        id=-1,
+        version_identifier=uuid4().hex,
+        form_type="CHECKLIST",
+        data={
+            "groups": [
+                {
+                    "name": "Benchmark",
+                    "fields": [{"tag": tag, "type": "integer", "min": 0, "max": 100} for tag in tags],
+                }
+            ]
+        },
+    )
+    form_checks = [
+        {
+            "name": f"check{index}",
+            "lvalue": f"{tags[2 * index]} + {tags[2 * index + 1]}",
+            "comparator": ">",
+            "rvalue": "50",
+        }
+        for index in range(checks)
+    ]
+    rows = [Submission(form=form, data={tag: random.randint(0, 50) for tag in tags}) for _ in range(count)]
+
+    timings = {}
+    for label, evaluate in (("uncompiled", uncompiled_qa_status), ("compiled", query_builder.get_inline_qa_status)):
+        start = time.perf_counter()
+        results = [evaluate(row, check) for row in rows for check in form_checks]
+        timings[label] = time.perf_counter() - start
+        click.echo(f"{label:>12}: {timings[label] * 1000:.1f}ms for {len(results)} evaluations")
+
+    click.echo(f"speedup: {timings['uncompiled'] / timings['compiled']:.1f}x")
+
+
+def clear_message_caches():
+    """Empties the caches used when processing text messages."""
+    from apollo.formsframework import forms  # local to avoid circular import
+    from apollo.messaging import forms as messaging_forms  # local to avoid circular import
+    from apollo.messaging import utils as messaging_utils  # local to avoid circular import
+
+    forms._questionnaire_classes.clear()
+    messaging_forms._form_index.clear()
+    messaging_utils._response_patterns.clear()
+
+
+@benchmarks_cli.command("sms")
+@with_appcontext
+@click.option("--event", "event_id", type=int, required=True, help="The event the messages are sent for.")
+@click.option("--form", "form_id", type=int, required=True, help="The form the messages are sent for.")
+@click.option("--messages", "count", type=int, default=1000, show_default=True, help="Number of messages parsed.")
+def sms(event_id, form_id, count):
+    """Measures the throughput of incoming text messages through parse_message.
+
+    The messages are sent for participant ids that don't exist, so they go
+    through parsing, form lookup and validation without saving submissions.
+    The cold run empties the message processing caches before every message.
+    """
+    from apollo.messaging.forms import KannelForm  # local to avoid circular import
+    from apollo.messaging.helpers import parse_message  # local to avoid circular import
+
+    event = db.session.get(Event, event_id)
+    form = db.session.get(Form, form_id)
+    if event is None or form is None or not form.prefix:
+        raise click.BadParameter("Invalid event or form.")
+
+    tags = [tag for tag in form.tags if form.get_field_by_tag(tag)["type"] in ("integer", "select")]
+    texts = []
+    for index in range(count):
+        data = random_form_data(form, random.sample(tags, min(len(tags), 5)))
+        responses = "".join(f"{tag}{value}" for tag, value in data.items())
+        texts.append(f"{form.prefix}{999000000 + index}{responses}")
+
+    with current_app.test_request_context():
+        g.event = event
+        g.deployment = event.deployment
+
+        timings = {}
+        for label, cold in (("cold", True), ("warm", False)):
+            clear_message_caches()
+            with count_queries() as counter:
+                start = time.perf_counter()
+                for text in texts:
+                    if cold:
+                        clear_message_caches()
+                    parse_message(KannelForm(MultiDict({"sender": "+1000000000", "text": text})))
+                timings[label] = time.perf_counter() - start
+            db.session.rollback()
+
+            click.echo(
+                f"{label:>12}: {count / timings[label]:.1f} messages/sec, "
+                f"{counter['queries'] / count:.1f} queries/message"
+            )
+
+    click.echo(f"speedup: {timings['cold'] / timings['warm']:.1f}x")
+
+
+@benchmarks_cli.command("participants")
+@with_appcontext
+@click.option("--location-set", "location_set_id", type=int, required=True, help="The location set to use.")
+@click.option("--rows", type=int, multiple=True, default=[10000, 100000], show_default=True, help="Rows imported.")
+def participants(location_set_id, rows):
+    """Measures the throughput of the participant import.
+
+    Each file is imported into a new participant set twice, first creating
+    and then updating the participants, and the set is removed afterwards.
+    """
+    from apollo.participants.tasks import update_participants  # local to avoid circular import
+
+    location_set = db.session.get(LocationSet, location_set_id)
+    if location_set is None:
+        raise click.BadParameter("Invalid location set.")
+
+    location_codes = [
+        code for (code,) in Location.query.filter_by(location_set=location_set).with_entities(Location.code)
+    ]
+    locale = location_set.deployment.locale_codes[0]
+    header_map = {
+        "id": "ID",
+        f"full_name_{locale}": "NAME",
+        "role": "ROLE",
+        "partner": "PARTNER",
+        "location": "LOCATION",
+        "supervisor": "SUPERVISOR",
+        "gender": "GENDER",
+        "phone": ["PHONE1", "PHONE2"],
+        "sample": ["SAMPLE"],
+    }
+
+    click.echo(f"{'rows':>12} {'pass':>8} {'queries':>10} {'seconds':>10} {'rows/sec':>10}")
+    for count in rows:
+        participant_ids = np.arange(100000, 100000 + count)
+        dataframe = pd.DataFrame(
+            {
+                "ID": participant_ids,
+                "NAME": [f"Participant {index}" for index in range(count)],
+                "ROLE": np.random.choice(["OBS", "SUP"], count),
+                "PARTNER": np.random.choice(["A", "B", "C"], count),
+                "LOCATION": np.random.choice(location_codes, count),
+                "SUPERVISOR": np.random.choice(participant_ids, count),
+                "GENDER": np.random.choice(["F", "M"], count),
+                "PHONE1": np.random.randint(10**9, 10**10, count),
+                "PHONE2": np.random.randint(10**9, 10**10, count),
+                "SAMPLE": np.random.randint(0, 2, count),
+            }
+        )
+
+        participant_set = ParticipantSet(
+            name=f"benchmark-{uuid4().hex}", location_set=location_set, deployment_id=location_set.deployment_id
+        )
+        db.session.add(participant_set)
+        db.session.commit()
+        try:
+            for label in ("create", "update"):
+                with count_queries() as counter:
+                    start = time.perf_counter()
+                    update_participants(dataframe, header_map, participant_set, None)
+                    elapsed = time.perf_counter() - start
+
+                click.echo(
+                    f"{count:>12} {label:>8} {counter['queries']:>10} {elapsed:>10.2f} "
+                    f"{count / elapsed if elapsed else 0:>10.1f}"
+                )
+        finally:
+            db.session.delete(participant_set)
+            db.session.commit()
+
+
+@benchmarks_cli.command("locations")
+@with_appcontext
+@click.option("--deployment", "deployment_id", type=int, required=True, help="The deployment to use.")
+@click.option("--rows", type=int, multiple=True, default=[30000], show_default=True, help="Rows imported.")
+def locations(deployment_id, rows):
+    """Measures the throughput of the location import.
+
+    Each file has a region, district and polling station on every row and
+    is imported into a new location set twice, first creating and then
+    updating the locations, and the set is removed afterwards.
+    """
+    from apollo.locations.tasks import update_locations  # local to avoid circular import
+
+    deployment = db.session.get(Deployment, deployment_id)
+    if deployment is None:
+        raise click.BadParameter("Invalid deployment.")
+
+    locale = deployment.locale_codes[0]
+
+    click.echo(f"{'rows':>12} {'pass':>8} {'queries':>10} {'seconds':>10} {'rows/sec':>10}")
+    for count in rows:
+        location_set = LocationSet(name=f"benchmark-{uuid4().hex}", deployment=deployment)
+        location_types = [
+            LocationType(name_translations={locale: name}, location_set=location_set)
+            for name in ("Region", "District", "Polling Station")
+        ]
+        location_types[-1].has_registered_voters = True
+        location_types[-1].has_coordinates = True
+        db.session.add_all(location_types)
+        db.session.flush()
+        db.session.add_all(
+            [
+                LocationTypePath(
+                    location_set=location_set,
+                    ancestor_id=ancestor.id,
+                    descendant_id=descendant.id,
+                    depth=depth - index,
+                )
+                for depth, descendant in enumerate(location_types)
+                for index, ancestor in enumerate(location_types[: depth + 1])
+            ]
+        )
+        db.session.commit()
+
+        header_mapping = {"groups": {str(location_types[-1].id): ["URBAN"]}}
+        dataframe = pd.DataFrame({"URBAN": np.random.randint(0, 2, count).astype(str)})
+        for level, (location_type, size, offset) in enumerate(
+            zip(location_types, (count // 1000 + 1, count // 100 + 1, count), (1, 10**6, 10**7))
+        ):
+            codes = np.arange(count) * size // count + offset
+            dataframe[f"CODE{level}"] = codes.astype(str)
+            dataframe[f"NAME{level}"] = [f"Location {code}" for code in codes]
+            header_mapping[f"{location_type.id}_code"] = f"CODE{level}"
+            header_mapping[f"{location_type.id}_name_{locale}"] = f"NAME{level}"
+        dataframe["RV"] = np.random.randint(100, 1000, count).astype(str)
+        dataframe["LAT"] = np.random.uniform(-10, 10, count).astype(str)
+        dataframe["LON"] = np.random.uniform(-10, 10, count).astype(str)
+        header_mapping[f"{location_types[-1].id}_rv"] = "RV"
+        header_mapping[f"{location_types[-1].id}_lat"] = "LAT"
+        header_mapping[f"{location_types[-1].id}_lon"] = "LON"
+
+        try:
+            for label in ("create", "update"):
+                with count_queries() as counter:
+                    start = time.perf_counter()
+                    with db.engine.begin() as connection:
+                        update_locations(connection, dataframe, dict(header_mapping), location_set, None)
+                    elapsed = time.perf_counter() - start
+
+                click.echo(
+                    f"{count:>12} {label:>8} {counter['queries']:>10} {elapsed:>10.2f} "
+                    f"{count / elapsed if elapsed else 0:>10.1f}"
+                )
+        finally:
+            db.session.delete(location_set)
+            db.session.commit()
+
+
+def synthetic_submission(tags):
+    """Generates an ODK submission document for the given form tags."""
+    fields = "".join(f"<{tag}>{random.randint(0, 999)}</{tag}>" for tag in tags)
+    return (
+        '<?xml version="1.0"?>'
+        f'<data xmlns:orx="http://openrosa.org/xforms" orx:version="{uuid4().hex}">'
+        f"<form_id>1</form_id>{fields}<location>9.05 7.49 0 0</location></data>"
+    ).encode("utf-8")
+
+
+def xpath_submission_fields(source, tags):
+    """Reads the fields of an ODK submission with a query per tag."""
+    document = etree.parse(BytesIO(source), etree.XMLParser(resolve_entities=False))
+    tag_finder = etree.XPath("//data/*[local-name() = $tag]")
+    return {tag: element[0].text for tag in tags if (element := tag_finder(document, tag=tag))}
+
+
+@benchmarks_cli.command("odk")
+@click.option("--fields", type=int, multiple=True, default=[50, 200, 500], show_default=True, help="Form fields.")
+@click.option("--submissions", "count", type=int, default=200, show_default=True, help="Submissions parsed.")
+def odk(fields, count):
+    """Compares reading ODK submissions with a query per field and in one pass.
+
+    The submissions are generated in memory and only the parsing done by the
+    submission view is timed, as it grows with the number of form fields.
+    """
+    click.echo(f"{'fields':>12} {'xpath ms':>10} {'single ms':>10}")
+    for field_count in fields:
+        tags = [f"F{index}" for index in range(field_count)]
+        sources = [synthetic_submission(tags) for _ in range(count)]
+
+        start = time.perf_counter()
+        for source in sources:
+            xpath_submission_fields(source, tags)
+        xpath = (time.perf_counter() - start) * 1000 / count
+
+        start = time.perf_counter()
+        for source in sources:
+            read_submission(BytesIO(source))
+        single = (time.perf_counter() - start) * 1000 / count
+
+        click.echo(f"{field_count:>12} {xpath:>10.2f} {single:>10.2f}")
+
+
+def aggregated_submission_dataframe(query, form, tags):
+    """Loads a submission dataframe with the names of the ancestors aggregated to JSON by the database."""
+    ancestor = aliased(Location, name="ancestor")
+    ancestor_type = aliased(LocationType, name="ancestor_type")
+    ancestor_path = aliased(LocationPath, name="ancestor_path")
+    own_location = aliased(Location, name="own_location")
+
+    sub_query = (
+        Submission.query.join(ancestor_path, Submission.location_id == ancestor_path.descendant_id)
+        .join(ancestor, ancestor.id == ancestor_path.ancestor_id)
+        .join(ancestor_type, ancestor.location_type_id == ancestor_type.id)
+        .with_entities(
+            sa.cast(ancestor.name, sa.String).label("ancestor_name"),
+            sa.cast(ancestor_type.name, sa.String).label("ancestor_type"),
+            Submission.id.label("submission_id"),
+        )
+        .subquery()
+    )
+    columns = [
+        sa.cast(sa.func.nullif(Submission.data[tag].astext, ""), sa.BigInteger).label(tag)
+        if tag in form.integral_tags
+        else Submission.data[tag].label(tag)
+        for tag in tags
+    ]
+    columns.append(own_location.registered_voters.label("registered_voters"))
+    columns.append(
+        sa.func.jsonb_object(array_agg(sub_query.c.ancestor_type), array_agg(sub_query.c.ancestor_name)).label(
+            "location_data"
+        )
+    )
+    dataframe_query = (
+        query.filter(Submission.location_id == own_location.id)
+        .join(sub_query, Submission.id == sub_query.c.submission_id)
+        .group_by(Submission.id, own_location.registered_voters)
+        .with_entities(*columns)
+    )
+
+    df = pd.read_sql(dataframe_query.selectable, dataframe_query.session.get_bind()).astype(
+        {tag: np.float64 for tag in tags if tag in form.integral_tags}
+    )
+    location_data = pd.json_normalize(df["location_data"]).replace('(^"|"$)', "", regex=True)
+    location_data.columns = location_data.columns.str.strip('"')
+
+    return pd.concat([df.drop("location_data", axis=1), location_data], axis=1)
+
+
+@benchmarks_cli.command("dataframe")
+@with_appcontext
+@click.option("--event", "event_id", type=int, required=True, help="The event to create submissions for.")
+@click.option("--form", "form_id", type=int, required=True, help="The checklist form to use.")
+@click.option("--submissions", "count", type=int, default=200000, show_default=True, help="Submissions loaded.")
+def dataframe(event_id, form_id, count):
+    """Compares the memory and time of loading a submission dataframe.
+
+    The synthetic submissions are created on random locations of the event
+    location set in a transaction that is rolled back once both loaders
+    have been measured.
+    """
+    event = db.session.get(Event, event_id)
+    form = db.session.get(Form, form_id)
+    if event is None or form is None:
+        raise click.BadParameter("Invalid event or form.")
+
+    location_ids = [
+        location_id
+        for (location_id,) in Location.query.filter_by(location_set_id=event.location_set_id).with_entities(Location.id)
+    ]
+    tags = [tag for tag in form.tags if form.get_field_by_tag(tag)["type"] in ("integer", "select")]
+    params = {"deployment_id": event.deployment_id, "event_id": event.id, "form_id": form.id, "submission_type": "O"}
+    serial_no = f"benchmark-{uuid4().hex}"
+
+    try:
+        for start in range(0, count, 10000):
+            db.session.execute(
+                sa.insert(Submission),
+                [
+                    dict(
+                        params,
+                        location_id=random.choice(location_ids),
+                        serial_no=serial_no,
+                        data=random_form_data(form, tags),
+                    )
+                    for _ in range(min(10000, count - start))
+                ],
+            )
+        query = Submission.query.filter_by(serial_no=serial_no)
+
+        click.echo(f"submissions: {count}, tags: {len(tags)}")
+        click.echo(f"{'loader':>12} {'seconds':>10} {'peak MB':>10} {'frame MB':>10}")
+        for label, load in (
+            ("aggregated", lambda: aggregated_submission_dataframe(query, form, tags)),
+            ("columnar", lambda: make_submission_dataframe(query, form, selected_tags=tags)),
+        ):
+            tracemalloc.start()
+            start = time.perf_counter()
+            df = load()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            size = df.memory_usage(deep=True).sum()
+            click.echo(f"{label:>12} {elapsed:>10.2f} {peak / 2**20:>10.1f} {size / 2**20:>10.1f}")
+            del df
+    finally:
+        db.session.rollback()
+
+
+def synthetic_aggregation_data(rows, tags, levels):
+    """Generates a submission dataframe with location columns and its form fields."""
+    rng = np.random.default_rng(0)
+    data = {}
+    fields = []
+    for index in range(tags):
+        tag = f"F{index}"
+        kind = index % 3
+        if kind == 0:
+            fields.append({"tag": tag, "type": "integer"})
+            data[tag] = rng.integers(0, 500, rows).astype(np.float64)
+            data[tag][rng.random(rows) < 0.1] = np.nan
+        elif kind == 1:
+            fields.append({"tag": tag, "type": "select", "options": {"Yes": 1, "No": 2, "Unsure": 3}})
+            data[tag] = rng.choice([1, 2, 3, np.nan], rows)
+        else:
+            fields.append({"tag": tag, "type": "multiselect", "options": {"A": 1, "B": 2, "C": 3, "D": 4}})
+            selected = rng.random((rows, 4)) < 0.3
+            data[tag] = [[option + 1 for option in np.flatnonzero(row)] for row in selected]
+
+    # every level has ten times the locations of the level above it
+    names = [f"Level {index}" for index in range(levels)]
+    codes = rng.integers(0, 10**levels, rows)
+    for index, name in enumerate(names):
+        data[name] = (codes // 10 ** (levels - index - 1)).astype(str)
+
+    return pd.DataFrame(data), fields, names
+
+
+@benchmarks_cli.command("aggregation")
+@click.option("--rows", type=int, default=100000, show_default=True, help="Rows in the synthetic dataframe.")
+@click.option("--tags", type=int, default=150, show_default=True, help="Number of form fields.")
+@click.option("--levels", type=int, default=3, show_default=True, help="Number of location levels.")
+@click.option("--baseline-groups", type=int, default=100, show_default=True, help="Groups timed for the baseline.")
+def aggregation(rows, tags, levels, baseline_groups):
+    """Compares per-group and vectorized aggregation of the submission fields.
+
+    The baseline processes the fields of each group separately, the way
+    the aggregated export used to. It is timed on a subset of the groups
+    of every level and extrapolated.
+    """
+    dataframe, fields, names = synthetic_aggregation_data(rows, tags, levels)
+
+    def aggregate():
+        statistics = level_statistics(dataframe, names, field_statistics(dataframe, fields))
+        return list(aggregate_rows(statistics, names, fields))
+
+    start = time.perf_counter()
+    output = aggregate()
+    vectorized = time.perf_counter() - start
+
+    # the memory is measured separately as tracing slows the aggregation down
+    tracemalloc.start()
+    aggregate()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    baseline = 0.0
+    for index in range(levels):
+        grouped = dataframe.groupby(names[: index + 1])
+        group_keys = [key if isinstance(key, tuple) else (key,) for key in list(grouped.groups)[:baseline_groups]]
+        start = time.perf_counter()
+        for key in group_keys:
+            group = grouped.get_group(key)
+            for field in fields:
+                column = group[field["tag"]]
+                if field["type"] == "integer":
+                    _numeric_field_processor(column.fillna(0))
+                elif field["type"] == "select":
+                    _select_field_processor(field["options"].values(), column)
+                else:
+                    _multiselect_field_processor(field["options"].values(), column)
+                column.count()
+        baseline += (time.perf_counter() - start) * grouped.ngroups / max(len(group_keys), 1)
+
+    click.echo(f"rows: {rows}, tags: {tags}, output rows: {len(output)}")
+    click.echo(f"per-group (extrapolated): {baseline:.2f}s, vectorized: {vectorized:.2f}s")
+    click.echo(f"speedup: {baseline / vectorized if vectorized else 0:.1f}x, peak memory: {peak / 2**20:.1f} MB")
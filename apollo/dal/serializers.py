@@ -1,5 +1,203 @@
 # -*- coding: utf-8 -*-
 import abc
+import json
+import logging
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from io import StringIO
+from itertools import islice
+
+import sqlalchemy as sa
+
+from apollo.core import db
+
+logger = logging.getLogger(__name__)
+
+# number of rows fetched at a time when writing the large archive members
+YIELD_PER = 1000
+
+# number of rows copied at a time when restoring the large archive members
+COPY_BATCH_SIZE = 10000
+
+
+def read_ndjson(zip_file, name):
+    """Yields the records of an archive member one line at a time.
+
+    A member missing from the archive has no records.
+    """
+    try:
+        member = zip_file.open(name)
+    except KeyError:
+        return
+
+    with member:
+        for line in member:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def batched(iterable, size):
+    """Yields lists of up to `size` items of an iterable."""
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def from_timestamp(value, aware=False):
+    """Returns the UTC datetime of a timestamp in an archive."""
+    if value is None:
+        return None
+
+    value = datetime.fromtimestamp(value, timezone.utc)
+    return value if aware else value.replace(tzinfo=None)
+
+
+def array_literal(values):
+    """Returns the Postgres literal of a text array."""
+    if values is None:
+        return None
+
+    items = (str(value).replace("\\", "\\\\").replace('"', '\\"') for value in values)
+    return "{" + ",".join(f'"{item}"' for item in items) + "}"
+
+
+def json_value(value):
+    """Returns the JSON text of a value, keeping nulls."""
+    return None if value is None else json.dumps(value)
+
+
+def _copy_text(value):
+    """Returns the COPY text format of a value."""
+    if value is None:
+        return "\\N"
+    if isinstance(value, bool):
+        return "t" if value else "f"
+
+    return str(value).replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+
+class ArchiveRestore:
+    """The state shared by the serializers restoring an archive.
+
+    The records in an archive refer to each other by uuid. Restored
+    records get new ids and uuids, so the id every archived uuid was
+    restored with is kept to resolve the references of the records
+    restored after it. The number of rows restored from every archive
+    member and the time it took are kept to report the throughput.
+    """
+
+    def __init__(self, deployment, progress=None):
+        """Initializer.
+
+        Args:
+            deployment: the deployment the archive is restored to.
+            progress: an optional `TaskProgress` updated for every batch.
+        """
+        self.deployment = deployment
+        self.progress = progress
+        self.event = None
+        self.ids = defaultdict(dict)
+        self.timings = {}
+
+    def remap(self, name, uuid):
+        """Returns the id the record with the archived uuid was restored with."""
+        if not uuid:
+            return None
+
+        return self.ids[name].get(uuid)
+
+    def throughput(self):
+        """Returns the rows, seconds and rows per second of every restored member."""
+        return {
+            member: (rows, seconds, rows / seconds if seconds else 0.0)
+            for member, (rows, seconds) in self.timings.items()
+        }
+
+    @contextmanager
+    def timed(self, member):
+        """Records the number of rows restored from a member and the time it took.
+
+        The context yields a dictionary the rows are counted in.
+        """
+        counter = {"rows": 0}
+        started = time.perf_counter()
+        yield counter
+        seconds = time.perf_counter() - started
+
+        rows, total = self.timings.get(member, (0, 0.0))
+        self.timings[member] = (rows + counter["rows"], total + seconds)
+        logger.info(
+            "Restored %d rows from %s in %.2fs (%.0f rows/sec)",
+            counter["rows"],
+            member,
+            seconds,
+            counter["rows"] / seconds if seconds else 0.0,
+        )
+
+        if self.progress is not None:
+            self.progress.processed_records += counter["rows"]
+            self.progress.update()
+
+    def add(self, zip_file, member, name, deserialize_one):
+        """Restores the few records of a member with the ORM.
+
+        `deserialize_one` returns the model instance of a record, and the
+        ids of the instances are kept under `name`.
+        """
+        with self.timed(member) as counter:
+            records = list(read_ndjson(zip_file, member))
+            instances = [deserialize_one(record) for record in records]
+            db.session.add_all(instances)
+            db.session.flush()
+
+            for record, instance in zip(records, instances):
+                self.ids[name][record["uuid"]] = instance.id
+            counter["rows"] = len(instances)
+
+        return instances
+
+    def load(self, zip_file, member, table, columns, deserialize_row, name=None):
+        """Restores the records of a member with COPY, a batch at a time.
+
+        `deserialize_row` returns the values of `columns` for a record and
+        the id it is restored with. When `name` is given, the ids are taken
+        from the sequence of the table before the batch is copied and kept
+        under `name`, so the rows of a batch can refer to each other.
+        """
+        with self.timed(member) as counter:
+            for batch in batched(read_ndjson(zip_file, member), COPY_BATCH_SIZE):
+                if name is None:
+                    ids = [None] * len(batch)
+                else:
+                    ids = self.allocate_ids(table, len(batch))
+                    self.ids[name].update(
+                        (record["uuid"], record_id) for record, record_id in zip(batch, ids) if record.get("uuid")
+                    )
+
+                self.copy_rows(table, columns, map(deserialize_row, batch, ids))
+                counter["rows"] += len(batch)
+
+    def allocate_ids(self, table, count):
+        """Takes ids for rows of a table from its sequence."""
+        result = db.session.execute(
+            sa.text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) FROM generate_series(1, :count)"),
+            {"table": table, "count": count},
+        )
+        return [row[0] for row in result]
+
+    def copy_rows(self, table, columns, rows):
+        """Loads rows into a table with COPY."""
+        buffer = StringIO()
+        for row in rows:
+            buffer.write("\t".join(_copy_text(value) for value in row))
+            buffer.write("\n")
+        buffer.seek(0)
+
+        cursor = db.session.connection().connection.cursor()
+        cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN", buffer)
 
 
 class ArchiveSerializer(abc.ABC):
@@ -8,5 +206,5 @@ class ArchiveSerializer(abc.ABC):
         pass
 
     @abc.abstractmethod
-    def deserialize(self, zip_file):
+    def deserialize(self, zip_file, restore):
         pass
@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""Background event archive exports.
+
+Event archives are written to zip files under the uploads storage by a
+Celery task, one archive member at a time, so that neither the archive
+nor the exported records have to be held in memory by a web worker.
+
+Archives are restored as new events by streaming their members and
+copying the records into the database in batches.
+"""
+
+import os
+import re
+from uuid import uuid4
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from apollo import settings
+from apollo.core import db, red, uploads
+from apollo.dal.serializers import ArchiveRestore
+from apollo.deployments.serializers import EventArchiveSerializer
+from apollo.messaging.models import Message
+from apollo.submissions.models import Submission
+
+ARCHIVE_FOLDER = "archives"
+ARCHIVE_KEY_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+ARCHIVE_LOCK_KEY = "archives:{}"
+ARCHIVE_TASK_KEY = "archives:tasks:{}"
+
+
+def archive_path(key):
+    """Returns the path of the file an archive is written to."""
+    return uploads.path(f"{key}.zip", folder=ARCHIVE_FOLDER)
+
+
+def get_archive(key):
+    """Returns the path of a completed archive or `None` if it doesn't exist."""
+    if not ARCHIVE_KEY_PATTERN.match(key or ""):
+        return None
+
+    path = archive_path(key)
+    return path if os.path.exists(path) else None
+
+
+def schedule_archive(event):
+    """Starts archiving an event in the background and returns the task identifier.
+
+    If the event is already being archived, the identifier of that task is
+    returned instead of starting another one.
+    """
+    from apollo.deployments.tasks import export_event_archive  # local to avoid circular import
+
+    task_id = str(uuid4())
+    while not red.set(ARCHIVE_LOCK_KEY.format(event.id), task_id, nx=True, ex=settings.EXPORT_TASK_TTL):
+        running_task_id = red.get(ARCHIVE_LOCK_KEY.format(event.id))
+        if running_task_id is not None:
+            return running_task_id.decode("utf-8")
+        # the running task completed in the meantime
+
+    # the status of the task can be looked up for as long as the archive is kept
+    red.set(ARCHIVE_TASK_KEY.format(task_id), event.id, ex=settings.EXPORT_FILE_TTL)
+    export_event_archive.apply_async(kwargs={"key": uuid4().hex, "event_id": event.id}, task_id=task_id)
+
+    return task_id
+
+
+def is_archive_task(task_id):
+    """Returns whether a task identifier was returned by `schedule_archive`."""
+    return bool(red.exists(ARCHIVE_TASK_KEY.format(task_id)))
+
+
+def release_archive(event_id):
+    """Allows a new archive task to be started for the event."""
+    red.delete(ARCHIVE_LOCK_KEY.format(event_id))
+
+
+def count_archive_records(event):
+    """Returns the number of records the progress of archiving an event is reported for."""
+    return Submission.query.filter_by(event_id=event.id).count() + Message.query.filter_by(event_id=event.id).count()
+
+
+def write_archive(key, event, progress=None):
+    """Writes the archive of an event to its file.
+
+    The archive is first written to a temporary file that is moved into
+    place once complete, so a partially written archive is never served.
+    """
+    path = archive_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = f"{path}.{uuid4().hex}.tmp"
+    try:
+        with ZipFile(temp_path, "w", ZIP_DEFLATED) as zip_file:
+            EventArchiveSerializer().serialize(event, zip_file, progress=progress)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    return path
+
+
+def restore_archive(source, deployment, progress=None):
+    """Restores an archive as a new event of a deployment.
+
+    The archive is restored in a single transaction. Returns the restored
+    event and the `ArchiveRestore`, which has the throughput of every
+    archive member.
+    """
+    restore = ArchiveRestore(deployment, progress)
+
+    try:
+        with ZipFile(source) as zip_file:
+            event = EventArchiveSerializer().deserialize(zip_file, restore)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return event, restore
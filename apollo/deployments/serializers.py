@@ -1,8 +1,10 @@
 # -*- coding: utf-8 -*-
 import calendar
 import json
+from functools import partial
 
-from apollo.dal.serializers import ArchiveSerializer
+from apollo.core import db
+from apollo.dal.serializers import ArchiveSerializer, from_timestamp, read_ndjson
 from apollo.deployments.models import Event
 from apollo.formsframework.serializers import FormSerializer
 from apollo.locations.serializers import LocationSetArchiveSerializer
@@ -14,10 +16,49 @@ from apollo.submissions.serializers import SubmissionArchiveSerializer
 class EventArchiveSerializer(ArchiveSerializer):
     __model__ = Event
 
-    def deserialize(self, zip_file):
-        return super().deserialize(zip_file)
+    def deserialize(self, zip_file, restore):
+        # the archive members are restored after the ones they refer to
+        LocationSetArchiveSerializer().deserialize(zip_file, restore)
+        ParticipantSetArchiveSerializer().deserialize(zip_file, restore)
+        forms = restore.add(
+            zip_file, 'forms.ndjson', 'form',
+            partial(self.deserialize_form, restore))
 
-    def serialize(self, event, zip_file):
+        with restore.timed('event.ndjson') as counter:
+            data = next(read_ndjson(zip_file, 'event.ndjson'))
+            event = self.deserialize_one(data, restore)
+            event.forms = forms
+            db.session.add(event)
+            db.session.flush()
+            counter['rows'] = 1
+        restore.event = event
+
+        SubmissionArchiveSerializer().deserialize(zip_file, restore)
+        MessageArchiveSerializer().deserialize(zip_file, restore)
+
+        return event
+
+    def deserialize_form(self, restore, data):
+        # restored forms get new uuids
+        kwargs = data.copy()
+        kwargs.pop('uuid')
+        form = FormSerializer().deserialize_one(kwargs)
+        form.deployment_id = restore.deployment.id
+
+        return form
+
+    def deserialize_one(self, data, restore):
+        return self.__model__(
+            name=data['name'],
+            start=from_timestamp(data['start'], aware=True),
+            end=from_timestamp(data['end'], aware=True),
+            location_set_id=restore.remap(
+                'location_set', data['location_set']),
+            participant_set_id=restore.remap(
+                'participant_set', data['participant_set']),
+            deployment_id=restore.deployment.id)
+
+    def serialize(self, event, zip_file, progress=None):
         with zip_file.open('event.ndjson', 'w') as f:
             data = self.serialize_one(event)
             line = f'{json.dumps(data)}\n'
@@ -36,9 +77,9 @@ class EventArchiveSerializer(ArchiveSerializer):
                 f.write(line.encode('utf-8'))
 
         location_set_serializer.serialize(event, zip_file)
-        message_serializer.serialize(event, zip_file)
+        message_serializer.serialize(event, zip_file, progress=progress)
         participant_set_serializer.serialize(event, zip_file)
-        submission_serializer.serialize(event, zip_file)
+        submission_serializer.serialize(event, zip_file, progress=progress)
 
     def serialize_one(self, obj):
         if not isinstance(obj, self.__model__):
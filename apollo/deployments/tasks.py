@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from celery import shared_task
+
+from apollo import helpers
+from apollo.deployments import archives
+from apollo.deployments.models import Event
+from apollo.submissions import exports
+
+
+@shared_task(bind=True)
+def export_event_archive(self, key, event_id):
+    """Write the archive of an event to a file in the uploads storage."""
+    event = Event.query.filter_by(id=event_id).first()
+
+    try:
+        if event is None:
+            return
+
+        progress = helpers.TaskProgress(self, archives.count_archive_records(event))
+        progress.update(force=True)
+
+        archives.write_archive(key, event, progress)
+        progress.processed_records = progress.total_records
+        progress.update(force=True)
+
+        exports.remove_expired_exports(archives.ARCHIVE_FOLDER)
+    finally:
+        archives.release_archive(event_id)
+
+    return {"key": key}
@@ -1,9 +1,23 @@
 # -*- coding: utf-8 -*-
+import json
 import pathlib
 from datetime import datetime, timezone
+from types import SimpleNamespace
 from unittest import mock
+from zipfile import ZipFile
 
-from apollo import services
+from apollo import services, settings
+from apollo.core import db
+from apollo.dal.serializers import ArchiveRestore, read_ndjson
+from apollo.deployments import archives
+from apollo.deployments.models import Deployment, Event
+from apollo.deployments.serializers import EventArchiveSerializer
+from apollo.formsframework.models import Form
+from apollo.locations.models import Location, LocationSet, LocationType
+from apollo.messaging.serializers import MessageArchiveSerializer
+from apollo.participants.models import Participant, ParticipantSet, Sample
+from apollo.submissions.models import Submission
+from apollo.submissions.serializers import SubmissionArchiveSerializer
 from apollo.testutils import fixtures
 
 DEFAULT_FIXTURES_PATH = pathlib.Path(__file__).parent / "fixtures"
@@ -56,3 +70,247 @@ def test_overlapping_events(app):
         assert event1 not in events
         assert event2 not in events
         assert len(events) == 1
+
+
+def test_schedule_archive(mocker):
+    """Tests that archive tasks are recorded and that a completed task doesn't block a new one."""
+    red = mocker.patch.object(archives, "red")
+    apply_async = mocker.patch("apollo.deployments.tasks.export_event_archive.apply_async")
+    event = Event(id=5, name="Event")
+
+    # the running task is reported
+    red.set.return_value = False
+    red.get.return_value = b"running"
+    assert archives.schedule_archive(event) == "running"
+    apply_async.assert_not_called()
+
+    # the running task completes between the lock and the lookup
+    red.set.side_effect = [False, True, True]
+    red.get.return_value = None
+    task_id = archives.schedule_archive(event)
+    assert apply_async.call_args.kwargs["task_id"] == task_id
+    red.set.assert_called_with(archives.ARCHIVE_TASK_KEY.format(task_id), 5, ex=settings.EXPORT_FILE_TTL)
+
+    red.exists.side_effect = lambda key: int(key == archives.ARCHIVE_TASK_KEY.format(task_id))
+    assert archives.is_archive_task(task_id)
+    assert not archives.is_archive_task("other")
+
+
+def test_event_archive_file(tmp_path, mocker):
+    """Tests that event archives are only served once completely written."""
+    path = tmp_path / "archives" / "archive.zip"
+    mocker.patch.object(archives, "archive_path", return_value=str(path))
+
+    def serialize(event, zip_file, progress=None):
+        with zip_file.open("event.ndjson", "w") as f:
+            f.write(b"{}\n")
+        assert list(tmp_path.glob("archives/*.tmp"))
+        assert not path.exists()
+
+    mocker.patch.object(EventArchiveSerializer, "serialize", side_effect=serialize)
+    archives.write_archive("0" * 32, Event(name="Event"))
+
+    with ZipFile(path) as zip_file:
+        assert zip_file.namelist() == ["event.ndjson"]
+    assert not list(tmp_path.glob("archives/*.tmp"))
+
+    assert archives.get_archive("0" * 32) == str(path)
+    assert archives.get_archive("../" + "0" * 29) is None
+
+
+def test_read_ndjson(tmp_path):
+    """Tests reading the records of archive members."""
+    with ZipFile(tmp_path / "archive.zip", "w") as zip_file:
+        zip_file.writestr("location_set.ndjson", '{"name": "Locations"}')
+        zip_file.writestr("forms.ndjson", '{"name": "A"}\n\n{"name": "B"}\n')
+
+    with ZipFile(tmp_path / "archive.zip") as zip_file:
+        assert list(read_ndjson(zip_file, "location_set.ndjson")) == [{"name": "Locations"}]
+        assert list(read_ndjson(zip_file, "forms.ndjson")) == [{"name": "A"}, {"name": "B"}]
+        assert list(read_ndjson(zip_file, "messages.ndjson")) == []
+
+
+def test_archive_restore_remapping(tmp_path, mocker):
+    """Tests that restored records refer to the ids of the records they were archived with."""
+    message = {
+        "direction": "IN",
+        "recipient": "1234",
+        "sender": "5678",
+        "text": "XA1",
+        "received": 0,
+        "delivered": None,
+        "submission": "a" * 32,
+        "participant": None,
+        "message_type": "SMS",
+        "originating_message": None,
+    }
+    records = [
+        dict(message, uuid="1" * 32),
+        dict(message, uuid="2" * 32, direction="OUT", originating_message="1" * 32),
+        # messages archived without their uuids
+        dict(message, originating_message="3" * 32),
+    ]
+    with ZipFile(tmp_path / "archive.zip", "w") as zip_file:
+        zip_file.writestr("messages.ndjson", "".join(f"{json.dumps(record)}\n" for record in records))
+
+    copied = []
+    mocker.patch.object(ArchiveRestore, "allocate_ids", side_effect=lambda table, count: list(range(10, 10 + count)))
+    mocker.patch.object(ArchiveRestore, "copy_rows", side_effect=lambda table, columns, rows: copied.append(list(rows)))
+
+    restore = ArchiveRestore(SimpleNamespace(id=1))
+    restore.event = SimpleNamespace(id=2)
+    restore.ids["submission"]["a" * 32] = 5
+
+    with ZipFile(tmp_path / "archive.zip") as zip_file:
+        MessageArchiveSerializer().deserialize(zip_file, restore)
+
+    rows = copied[0]
+    assert [row[0] for row in rows] == [10, 11, 12]
+    assert [row[2] for row in rows] == ["IN", "OUT", "IN"]
+    assert rows[0][7] == datetime(1970, 1, 1)
+    assert [row[9:] for row in rows] == [(1, 2, 5, None, None), (1, 2, 5, None, 10), (1, 2, 5, None, None)]
+    assert restore.ids["message"] == {"1" * 32: 10, "2" * 32: 11}
+    assert restore.throughput()["messages.ndjson"][0] == 3
+
+
+def test_submission_archive_restore(tmp_path, mocker):
+    """Tests that master submissions are restored and that older archives restore with defaults."""
+    submission = {
+        "uuid": "1" * 32,
+        "form": "f" * 32,
+        "participant": "p" * 32,
+        "location": "l" * 32,
+        "data": {"AA": 1},
+        "extra_data": None,
+        "submission_type": "O",
+        "created": 0,
+        "updated": None,
+        "sender_verified": True,
+        "quarantine_status": "",
+        "verification_status": "1",
+        "incident_description": None,
+        "incident_status": None,
+        "overridden_fields": [],
+    }
+    records = [
+        # an observer submission archived before the columns below were
+        submission,
+        dict(
+            submission,
+            uuid="2" * 32,
+            participant=None,
+            submission_type="M",
+            serial_no="7",
+            participant_updated=60,
+            conflicts={"AA": "1"},
+            unreachable=True,
+            verified_fields=["AA"],
+            last_phone_number="1234",
+            lat=9.5,
+            lon=7.5,
+        ),
+    ]
+    with ZipFile(tmp_path / "archive.zip", "w") as zip_file:
+        zip_file.writestr("submissions.ndjson", "".join(f"{json.dumps(record)}\n" for record in records))
+
+    copied = []
+    mocker.patch.object(ArchiveRestore, "allocate_ids", side_effect=lambda table, count: list(range(10, 10 + count)))
+    mocker.patch.object(ArchiveRestore, "copy_rows", side_effect=lambda table, columns, rows: copied.append(list(rows)))
+    restore_masters = mocker.patch.object(SubmissionArchiveSerializer, "restore_masters")
+
+    restore = ArchiveRestore(SimpleNamespace(id=1))
+    restore.event = SimpleNamespace(id=2)
+    restore.ids["form"]["f" * 32] = 3
+    restore.ids["participant"]["p" * 32] = 4
+    restore.ids["location"]["l" * 32] = 5
+
+    with ZipFile(tmp_path / "archive.zip") as zip_file:
+        SubmissionArchiveSerializer().deserialize(zip_file, restore)
+
+    observer, master = copied[0]
+    assert observer[4:7] == (3, 4, 5)
+    assert observer[18:] == (None, None, None, False, "[]", None, None)
+    assert master[4:7] == (3, None, 5)
+    assert master[9] == "M"
+    assert master[18:] == (
+        "7",
+        datetime(1970, 1, 1, 0, 1),
+        '{"AA": "1"}',
+        True,
+        '["AA"]',
+        "1234",
+        "SRID=4326;POINT(7.5 9.5)",
+    )
+    assert restore.ids["submission"] == {"1" * 32: 10, "2" * 32: 11}
+    restore_masters.assert_called_once_with(restore)
+
+
+def test_event_archive_roundtrip(app, tmp_path, mocker):
+    """Tests that an archived event is restored with its masters, supervisors and samples."""
+    mocker.patch.object(archives, "archive_path", return_value=str(tmp_path / "archive.zip"))
+    deployment = Deployment(name="Archives", hostnames=["archives"], primary_locale="en")
+    location_set = LocationSet(name="Locations", deployment=deployment)
+    location_type = LocationType(name_translations={"en": "Station"}, location_set=location_set)
+    location = Location(
+        name_translations={"en": "Station"}, code="1", location_type=location_type, location_set=location_set
+    )
+    participant_set = ParticipantSet(name="Observers", deployment=deployment, location_set=location_set)
+    sample = Sample(name="Sample", participant_set=participant_set)
+    names = {f"{name}_translations": {} for name in ("full_name", "first_name", "other_names", "last_name")}
+    supervisor = Participant(participant_id="1", participant_set=participant_set, location=location, **names)
+    observer = Participant(
+        participant_id="2",
+        participant_set=participant_set,
+        location=location,
+        supervisor=supervisor,
+        samples=[sample],
+        **names,
+    )
+    form = Form(name="Checklist", prefix="CL", form_type="CHECKLIST", deployment=deployment, data={"groups": []})
+    event = Event(
+        name="Election",
+        start=datetime(2024, 1, 1, tzinfo=timezone.utc),
+        end=datetime(2024, 1, 2, tzinfo=timezone.utc),
+        deployment=deployment,
+        location_set=location_set,
+        participant_set=participant_set,
+        forms=[form],
+    )
+    submission_params = {"deployment": deployment, "event": event, "form": form, "location": location}
+    db.session.add_all(
+        [
+            Submission(
+                participant=observer,
+                submission_type="O",
+                data={"AA": 1},
+                serial_no="7",
+                unreachable=True,
+                verified_fields=["AA"],
+                **submission_params,
+            ),
+            Submission(submission_type="M", data={"AA": 1}, **submission_params),
+        ]
+    )
+    db.session.commit()
+
+    archives.write_archive("0" * 32, event)
+    restored, _ = archives.restore_archive(str(tmp_path / "archive.zip"), deployment)
+
+    submissions = {
+        submission.submission_type.code: submission for submission in Submission.query.filter_by(event_id=restored.id)
+    }
+    assert sorted(submissions) == ["M", "O"]
+    assert submissions["M"].participant_id is None
+    assert submissions["M"].data == {"AA": 1}
+    assert submissions["O"].serial_no == "7"
+    assert submissions["O"].unreachable is True
+    assert submissions["O"].verified_fields == ["AA"]
+
+    participants = {
+        participant.participant_id: participant
+        for participant in Participant.query.filter_by(participant_set_id=restored.participant_set_id)
+    }
+    assert participants["2"].supervisor_id == participants["1"].id
+    assert [sample.name for sample in participants["2"].samples] == ["Sample"]
+    assert participants["1"].samples == []
+    assert submissions["O"].participant_id == participants["2"].id
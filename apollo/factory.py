@@ -41,6 +41,8 @@ TASK_DESCRIPTIONS = {
     "apollo.submissions.tasks.init_submissions": _("Generate Checklists"),
     "apollo.users.tasks.import_users": _("Import Users"),
     "apollo.submissions.tasks.init_survey_submissions": _("Generate Surveys"),
+    "apollo.submissions.tasks.export_submissions": _("Export Submissions"),
+    "apollo.deployments.tasks.export_event_archive": _("Export Event Archive"),
 }
 
 
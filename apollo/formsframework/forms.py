@@ -18,12 +18,16 @@ from ..deployments.models import Event
 from ..formsframework.models import Form
 from ..frontend.helpers import DictDiffer
 from ..participants.models import Participant, PhoneContact
+from ..result_analysis.models import ResultAggregate
 from ..submissions.models import Submission, SubmissionComment, SubmissionVersion
 from ..utils import current_timestamp
 from .custom_fields import IntegerSplitterField
 
 ugly_phone = re.compile("[^0-9]*")
 
+# questionnaire classes keyed by form id and version
+_questionnaire_classes = {}
+
 
 def update_submission_version(submission):
     """Version control for submissions."""
@@ -344,7 +348,10 @@ class BaseQuestionnaireForm(wtforms.Form):
                         if extra_data:
                             update_params["extra_data"] = extra_data
 
-                        services.submissions.find(id=submission.id).update(update_params, synchronize_session=False)
+                        with ResultAggregate.track([submission.id]):
+                            services.submissions.find(id=submission.id).update(
+                                update_params, synchronize_session=False
+                            )
                         db.session.refresh(submission)
 
                     # if data was changed, update conflict marker,
@@ -358,10 +365,36 @@ class BaseQuestionnaireForm(wtforms.Form):
 
 def build_questionnaire(form, data=None):
     """Builds a questionnaire for use in text parsing."""
+    form_class = questionnaire_class(form)
+
+    # the participant filter needs the form, so it is not part of the
+    # questionnaire class shared by the versions of the form
+    return form_class(data, extra_filters={"participant": [partial(filter_participants, form)]})
+
+
+def questionnaire_class(form):
+    """Returns the questionnaire class of a form.
+
+    The class is cached until the form version changes, except for forms
+    that have not been saved.
+    """
+    if form.id is None:
+        return _make_questionnaire_class(form)
+
+    key = (form.id, form.version_identifier)
+    form_class = _questionnaire_classes.get(key)
+    if form_class is None:
+        form_class = _make_questionnaire_class(form)
+        for stale_key in [k for k in _questionnaire_classes if k[0] == form.id]:
+            _questionnaire_classes.pop(stale_key, None)
+        _questionnaire_classes[key] = form_class
+
+    return form_class
+
+
+def _make_questionnaire_class(form):
     fields = {"groups": []}
-    fields["participant"] = wtforms.StringField(
-        "Participant", filters=[partial(filter_participants, form)], validators=[wtforms.validators.data_required()]
-    )
+    fields["participant"] = wtforms.StringField("Participant", validators=[wtforms.validators.data_required()])
 
     for group in form.data["groups"]:
         groupspec = (group["name"], [])
@@ -411,9 +444,7 @@ def build_questionnaire(form, data=None):
 
         fields["groups"].append(groupspec)
 
-    form_class = type("QuestionnaireForm", (BaseQuestionnaireForm,), fields)
-
-    return form_class(data)
+    return type("QuestionnaireForm", (BaseQuestionnaireForm,), fields)
 
 
 class FormForm(SecureForm):
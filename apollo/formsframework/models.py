@@ -5,6 +5,7 @@ import re
 from datetime import datetime
 from operator import itemgetter
 
+from flask_babel import get_locale
 from flask_babel import lazy_gettext as _
 from lxml import etree
 from lxml.builder import E, ElementMaker
@@ -15,7 +16,8 @@ from sqlalchemy.dialects.postgresql import ARRAY, JSONB
 from sqlalchemy_json import NestedMutableJson
 from sqlalchemy_utils import ChoiceType
 
-from apollo.core import db
+from apollo import settings
+from apollo.core import db, red
 from apollo.dal.models import Resource
 
 NSMAP = {
@@ -49,6 +51,12 @@ logger = logging.getLogger(__name__)
 gt_constraint_regex = re.compile(r"(?:.*\.\s*\>={0,1}\s*)(\d+)")
 lt_constraint_regex = re.compile(r"(?:.*\.\s*\<={0,1}\s*)(\d+)")
 
+# the rendered XForms by form id, form version and locale
+XFORM_CACHE_KEY = "odk:xform:{}:{}:{}"
+
+# the metadata of the latest version of every form, by form id
+_form_metadata = {}
+
 
 def _make_version_identifer():
     return datetime.utcnow().strftime("%Y%m%d%H%M%S%f")
@@ -101,17 +109,17 @@ class Form(Resource):
         """String representation."""
         return self.name
 
-    def _populate_field_cache(self):
-        if self.data:
-            self._field_cache = {f["tag"]: f for g in self.data.get("groups", []) for f in g.get("fields", [])}
-        else:
-            self._field_cache = {}
+    def _get_metadata(self):
+        """Returns the metadata of the current version of the form.
 
-    def _populate_group_cache(self):
-        if self.data:
-            self._group_cache = {g["name"]: g for g in self.data.get("groups", [])}
-        else:
-            self._group_cache = {}
+        Forms that have not been saved keep their metadata on the instance.
+        """
+        if self.id is None:
+            if not hasattr(self, "_metadata_cache"):
+                self._metadata_cache = FormMetadata(self)
+            return self._metadata_cache
+
+        return get_form_metadata(self)
 
     def get_form_type_display(self):
         d = dict(Form.FORM_TYPES)
@@ -119,66 +127,47 @@ class Form(Resource):
 
     @property
     def tags(self):
-        if not hasattr(self, "_field_cache"):
-            self._populate_field_cache()
-
-        return sorted(self._field_cache.keys())
+        return list(self._get_metadata().tags)
 
     @property
     def unsorted_tags(self):
-        if not hasattr(self, "_field_cache"):
-            self._populate_field_cache()
-
-        return list(self._field_cache.keys())
+        return list(self._get_metadata().fields)
 
     @property
     def response_fields(self):
-        if not hasattr(self, "_field_cache"):
-            self._populate_field_cache()
-
-        return list(self._field_cache.values())
+        return list(self._get_metadata().fields.values())
 
     @property
     def qa_tags(self):
-        QA_FIELD_TYPES = ("integer", "select", "string")
-        if not hasattr(self, "_field_cache"):
-            self._populate_field_cache()
-
-        return sorted(tag for tag, field in self._field_cache.items() if field["type"] in QA_FIELD_TYPES)
+        return list(self._get_metadata().qa_tags)
 
     @property
     def vote_tags(self):
-        if not hasattr(self, "_field_cache"):
-            self._populate_field_cache()
+        return list(self._get_metadata().vote_tags)
 
-        return sorted([key for key in self._field_cache.keys() if self._field_cache[key]["analysis_type"] == "RESULT"])
+    @property
+    def integral_tags(self):
+        return self._get_metadata().integral_tags
 
-    def get_field_by_tag(self, tag):
-        if not hasattr(self, "_field_cache"):
-            self._populate_field_cache()
+    @property
+    def multiselect_tags(self):
+        return self._get_metadata().multiselect_tags
 
-        return self._field_cache.get(tag)
+    def get_field_by_tag(self, tag):
+        return self._get_metadata().fields.get(tag)
 
     def get_image_fields(self):
-        return [tag for tag in self.tags if self.get_field_by_tag(tag)["type"] == "image"]
-
-    def get_group_tags(self, group_name, field_types=FIELD_TYPES):
-        if not hasattr(self, "_group_cache"):
-            self._populate_group_cache()
+        return list(self._get_metadata().image_tags)
 
-        grp = self._group_cache.get(group_name)
-        tags = []
+    def get_group_names(self):
+        return list(self._get_metadata().groups)
 
-        if grp and grp.get("fields"):
-            for f in grp.get("fields"):
-                if f and f.get("tag") and f.get("type") in field_types:
-                    tags.append(f.get("tag"))
-
-        return tags
+    def get_group_tags(self, group_name, field_types=FIELD_TYPES):
+        return list(self._get_metadata().get_group_tags(group_name, field_types))
 
     @property
     def has_image_fields(self):
-        return len(self.get_image_fields()) > 0
+        return len(self._get_metadata().image_tags) > 0
 
     def to_xml(self):
         root = HTML_E.html()
@@ -216,7 +205,7 @@ class Form(Resource):
         model.append(phone_number_bind)
 
         if self.form_type == "SURVEY":
-            description = _("Form Serial Number")
+            description = str(_("Form Serial Number"))
             path = "/data/form_serial"
             data.append(etree.Element("form_serial"))
             model.append(E.bind(nodeset=path, type="string"))
@@ -279,7 +268,7 @@ class Form(Resource):
                     grp_element.append(field_element)
                 body.append(grp_element)
 
-        description = _("Location")
+        description = str(_("Location"))
         path = "/data/location"
         data.append(etree.Element("location"))
         model.append(E.bind(nodeset=path, type="geopoint"))
@@ -294,22 +283,123 @@ class Form(Resource):
 
         return root
 
+    def _xform_cache_key(self):
+        return XFORM_CACHE_KEY.format(self.id, self.version_identifier, get_locale())
+
+    def odk_xform(self):
+        """Returns the serialized XForm of the form.
+
+        The XForm of a saved form is rendered once per form version and
+        locale, and is kept in Redis.
+        """
+        if self.id is None:
+            return etree.tostring(self.to_xml(), encoding="UTF-8", xml_declaration=True)
+
+        key = self._xform_cache_key()
+        xform_data = red.get(key)
+        if xform_data is None:
+            xform_data = etree.tostring(self.to_xml(), encoding="UTF-8", xml_declaration=True)
+            red.set(key, xform_data, ex=settings.XFORM_CACHE_TTL)
+
+        return xform_data
+
+    def odk_digest(self):
+        """Returns the MD5 digest of the XForm of the form."""
+        if self.id is None:
+            return hashlib.md5(self.odk_xform()).hexdigest()
+
+        key = f"{self._xform_cache_key()}:md5"
+        digest = red.get(key)
+        if digest is None:
+            digest = hashlib.md5(self.odk_xform()).hexdigest()
+            red.set(key, digest, ex=settings.XFORM_CACHE_TTL)
+        else:
+            digest = digest.decode("utf-8")
+
+        return digest
+
     def odk_hash(self):
-        xform_data = etree.tostring(self.to_xml(), encoding="UTF-8", xml_declaration=True)
-        hash_engine = hashlib.md5()
-        hash_engine.update(xform_data)
-        return f"md5: {hash_engine.hexdigest()}"
+        return f"md5: {self.odk_digest()}"
 
     def create_schema(self):
-        attrs = {tag: _get_schema_field(self.get_field_by_tag(tag)) for tag in self.tags}
+        return self._get_metadata().schema_class
+
+
+class FormMetadata(object):
+    """Metadata derived from the fields of a version of a form.
+
+    The metadata is computed once per form version and shared by every
+    instance of the form, see `get_form_metadata`.
+    """
+
+    QA_FIELD_TYPES = ("integer", "select", "string")
 
-        attrs["location"] = fields.List(fields.Float(), validate=validate.Length(min=2, max=2))
+    def __init__(self, form):
+        """Initializer."""
+        self.version_identifier = form.version_identifier
 
-        attrs["Meta"] = type("GeneratedMeta", (getattr(Schema, "Meta", object),), {"register": False})
+        groups = form.data.get("groups", []) if form.data else []
+        self.groups = {group["name"]: group for group in groups}
+        self.fields = {field["tag"]: field for group in groups for field in group.get("fields", [])}
 
-        schema_cls = type("GeneratedSchema", (Schema,), attrs)
+        self.tags = tuple(sorted(self.fields))
+        self.qa_tags = tuple(tag for tag in self.tags if self.fields[tag]["type"] in self.QA_FIELD_TYPES)
+        self.vote_tags = tuple(tag for tag in self.tags if self.fields[tag].get("analysis_type") == "RESULT")
+        self.image_tags = tuple(tag for tag in self.tags if self.fields[tag]["type"] == "image")
+        self.integral_tags = frozenset(
+            tag for tag, field in self.fields.items() if field["type"] in ("integer", "select")
+        )
+        self.multiselect_tags = frozenset(tag for tag, field in self.fields.items() if field["type"] == "multiselect")
 
-        return schema_cls
+        self._group_tags = {}
+        self._schema_class = None
+
+    def get_group_tags(self, group_name, field_types=FIELD_TYPES):
+        key = (group_name, tuple(field_types))
+        tags = self._group_tags.get(key)
+        if tags is None:
+            group = self.groups.get(group_name)
+            tags = tuple(
+                field.get("tag")
+                for field in (group.get("fields") or [] if group else [])
+                if field and field.get("tag") and field.get("type") in field_types
+            )
+            self._group_tags[key] = tags
+
+        return tags
+
+    @property
+    def schema_class(self):
+        if self._schema_class is None:
+            attrs = {tag: _get_schema_field(self.fields[tag]) for tag in self.tags}
+
+            attrs["location"] = fields.List(fields.Float(), validate=validate.Length(min=2, max=2))
+
+            attrs["Meta"] = type("GeneratedMeta", (getattr(Schema, "Meta", object),), {"register": False})
+
+            self._schema_class = type("GeneratedSchema", (Schema,), attrs)
+
+        return self._schema_class
+
+
+def get_form_metadata(form):
+    """Returns the metadata of a saved form.
+
+    The metadata is cached by form id and form version, and is computed
+    again when the form is modified.
+    """
+    metadata = _form_metadata.get(form.id)
+    if metadata is None or metadata.version_identifier != form.version_identifier:
+        metadata = _form_metadata[form.id] = FormMetadata(form)
+
+    return metadata
+
+
+def invalidate_form_metadata(form):
+    """Discards the cached metadata of a form."""
+    _form_metadata.pop(form.id, None)
+    if hasattr(form, "_metadata_cache"):
+        delattr(form, "_metadata_cache")
 
 
 def _get_schema_field(form_field):
@@ -455,13 +545,9 @@ class FormBuilderSerializer(object):
 
             current_group["fields"].append(field)
 
-            # invalidate the form cache
-            if hasattr(form, "_field_cache"):
-                delattr(form, "_field_cache")
-            if hasattr(form, "_group_cache"):
-                delattr(form, "_group_cache")
-            if hasattr(form, "_schema_cache"):
-                delattr(form, "_schema_cache")
-
         form.data = {"groups": groups}
         form.save()
+
+        # the version changes when the form is saved, but the metadata of
+        # the previous version isn't needed anymore
+        invalidate_form_metadata(form)
@@ -1,12 +1,14 @@
 # # -*- coding: utf-8 -*-
+import hashlib
 import pathlib
+from uuid import uuid4
 
 import pytest
 from werkzeug.datastructures import MultiDict
 
 from apollo import services
 from apollo.formsframework.forms import build_questionnaire, find_active_forms
-from apollo.formsframework.models import Form
+from apollo.formsframework.models import Form, invalidate_form_metadata
 from apollo.formsframework.parser import Comparator, grammar_factory
 from apollo.messaging.utils import parse_responses
 from apollo.testutils import fixtures
@@ -31,7 +33,11 @@ def checklist_form():
     form = Form(name="TCF", form_type="CHECKLIST")
     form.data = {"groups": [grp1]}
 
-    return form
+    yield form
+
+    # tests that give the form an id share the metadata registry with the
+    # forms in other tests
+    invalidate_form_metadata(form)
 
 
 @pytest.fixture()
@@ -46,7 +52,11 @@ def incident_form():
     form = Form(name="TIF", form_type="INCIDENT")
     form.data = {"groups": [grp2]}
 
-    return form
+    yield form
+
+    # tests that give the form an id share the metadata registry with the
+    # forms in other tests
+    invalidate_form_metadata(form)
 
 
 def test_checklist_parsing(checklist_form, mocker):
@@ -226,3 +236,50 @@ def test_active_form_selector(app, mocker):
     assert form4 in forms
     assert form5 in forms
     assert form6 in forms
+
+
+def test_form_metadata_cache(checklist_form):
+    """Tests that the form metadata is shared until the form version changes."""
+    checklist_form.id = 1
+    checklist_form.version_identifier = "1"
+    other_form = Form(id=1, version_identifier="1", data={"groups": []})
+
+    assert checklist_form.tags == ["AA", "AB"]
+    assert checklist_form.integral_tags == {"AA"}
+    assert checklist_form.multiselect_tags == {"AB"}
+    assert checklist_form.get_group_tags("First", ("integer",)) == ["AA"]
+    assert checklist_form.create_schema() is checklist_form.create_schema()
+    assert other_form.tags == ["AA", "AB"]
+    assert other_form.create_schema() is checklist_form.create_schema()
+
+    schema = checklist_form.create_schema()
+    checklist_form.version_identifier = "2"
+    checklist_form.data["groups"][0].fields.append(AttributeDict(tag="AC", type="image"))
+    assert checklist_form.tags == ["AA", "AB", "AC"]
+    assert checklist_form.get_image_fields() == ["AC"]
+    assert checklist_form.create_schema() is not schema
+
+
+def test_xform_cache(checklist_form, mocker):
+    """Tests that the XForm of a form version is only rendered once."""
+    cache = {}
+    red = mocker.patch("apollo.formsframework.models.red")
+    red.get.side_effect = cache.get
+    red.set.side_effect = lambda key, value, ex=None: cache.__setitem__(
+        key, value.encode("utf-8") if isinstance(value, str) else value
+    )
+    to_xml = mocker.spy(Form, "to_xml")
+
+    checklist_form.id = 1
+    checklist_form.uuid = uuid4()
+    checklist_form.version_identifier = "1"
+    xform_data = checklist_form.odk_xform()
+
+    assert checklist_form.odk_xform() == xform_data
+    assert checklist_form.odk_hash() == f"md5: {hashlib.md5(xform_data).hexdigest()}"
+    assert checklist_form.odk_digest() == hashlib.md5(xform_data).hexdigest()
+    assert to_xml.call_count == 1
+
+    checklist_form.version_identifier = "2"
+    assert checklist_form.odk_digest() != hashlib.md5(xform_data).hexdigest()
+    assert to_xml.call_count == 2
@@ -1,16 +1,19 @@
 # -*- coding: utf-8 -*-
-from collections import defaultdict
+import hashlib
+import json
 from datetime import datetime
 from logging import getLogger
 
 import pandas as pd
 from dateutil.rrule import DAILY, rrule
+from flask_babel import get_locale
 from pytz import timezone
-from sqlalchemy import and_, false, func, not_, or_
+from sqlalchemy import and_, case, func, literal, not_, null
 from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.orm import Load, aliased
 
-from apollo.core import db
+from apollo import settings
+from apollo.core import red
 from apollo.locations.models import Location, LocationPath, LocationTypePath
 from apollo.settings import TIMEZONE
 from apollo.submissions.models import Submission
@@ -18,223 +21,141 @@ from apollo.submissions.models import Submission
 logger = getLogger(__name__)
 
 
+COVERAGE_STATUSES = ("Complete", "Conflict", "Missing", "Partial", "Offline")
+
+
 def get_coverage(query, form, group=None, location_type=None):
-    """Generate data for the response rate pie charts."""
+    """Generate data for the response rate pie charts.
+
+    The coverage is cached for a short while, keyed by the form, the group,
+    the location type and the filtered submission query.
+    """
+    key = _coverage_key(query, form, group, location_type)
+    cached = red.get(key)
+    if cached is not None:
+        return json.loads(cached)
+
     if group is None and location_type is None:
-        return _get_global_coverage(query, form)
+        coverage_list = _get_global_coverage(query, form)
     else:
-        return _get_group_coverage(query, form, group, location_type)
+        coverage_list = _get_group_coverage(query, form, group, location_type)
 
+    red.set(key, json.dumps(coverage_list), ex=settings.DASHBOARD_CACHE_TTL)
+    return coverage_list
 
-def _get_coverage_results(query, depth):
-    ancestor_location = aliased(Location)
-    location_closure = aliased(LocationPath)
 
-    dataset = (
-        query.join(location_closure, location_closure.descendant_id == Submission.location_id)
-        .join(ancestor_location, ancestor_location.id == location_closure.ancestor_id)
-        .filter(location_closure.depth == depth)
-        .with_entities(ancestor_location, func.count(Submission.id))
-        .options(Load(ancestor_location).load_only(ancestor_location.id, ancestor_location.name_translations))
-        .group_by(ancestor_location.id)
-        .all()
-    )
+def _coverage_key(query, form, group, location_type):
+    statement = query.statement.compile()
+    data = {
+        "form": form.id if form else None,
+        "version": form.version_identifier if form else None,
+        "group": group["slug"] if group else None,
+        "location_type": location_type.id if location_type else None,
+        "locale": str(get_locale()),
+        "statement": str(statement),
+        "params": sorted(statement.params.items()),
+    }
 
-    return [(item[0].id, item[0].name, item[1]) for item in dataset]
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"dashboard-coverage:{digest}"
 
 
-def _get_group_coverage(query, form, group, location_type):
-    coverage_list = []
+def _coverage_status(group_tags, conflict_tags):
+    """Classifies a submission into one of the coverage statuses.
 
-    # check that we have data
-    if not (db.session.query(query.exists()).scalar() and form and location_type):  # noqa
-        return coverage_list
+    Unreachable submissions with data for all the group tags as well as
+    conflicts are not classified into any status.
+    """
+    if not group_tags:
+        return literal("Missing")
 
-    group_tags = form.get_group_tags(group["name"])
-    conflict_group_tags = []
-    if not form.untrack_data_conflicts:
-        conflict_group_tags = form.get_group_tags(group["name"], form.CONFLICT_FIELD_TYPES)
+    has_all = Submission.data.has_all(array(group_tags))
+    has_any = Submission.data.has_any(array(group_tags))
+    unreachable = Submission.unreachable.is_(True)
 
-    # get the location closure table depth
-    sample_sub = query.first()
-    sub_location_type = sample_sub.location.location_type
-    try:
-        depth_info = LocationTypePath.query.filter_by(
-            ancestor_id=location_type.id, descendant_id=sub_location_type.id
-        ).one()
-    except Exception:
-        # TODO: replace with the proper SQLA exception classes
-        return coverage_list
+    whens = [(and_(unreachable, not_(has_all)), "Offline")]
+    if conflict_tags:
+        has_conflict = and_(Submission.conflicts != None, Submission.conflicts.has_any(array(conflict_tags)))  # noqa
+        whens.extend([(and_(has_conflict, not_(unreachable)), "Conflict"), (has_conflict, null())])
+    whens.extend([(has_all, "Complete"), (has_any, "Partial")])
 
-    # get conflict submissions first
-    if conflict_group_tags:
-        conflict_query = query.filter(
-            Submission.conflicts != None,  # noqa
-            Submission.conflicts.has_any(array(conflict_group_tags)),
-            Submission.unreachable.is_(False),
-        )  # noqa
-    else:
-        conflict_query = query.filter(false())
-
-    if group_tags:
-        terms = [
-            ~Submission.data.has_any(array(group_tags)),
-            Submission.unreachable == False,  # noqa
-        ]
-        if conflict_group_tags:
-            terms.append(
-                or_(
-                    Submission.conflicts == None,  # noqa
-                    ~Submission.conflicts.has_any(array(conflict_group_tags)),
-                )
-            )
+    return case(*whens, else_="Missing")
 
-        missing_query = query.filter(*terms)
-    else:
-        missing_query = query
-
-    if group_tags:
-        terms = [Submission.data.has_all(array(group_tags))]
-        if conflict_group_tags:
-            terms.append(
-                or_(
-                    Submission.conflicts == None,  # noqa
-                    ~Submission.conflicts.has_any(array(conflict_group_tags)),
-                )
-            )
-        complete_query = query.filter(*terms)
-    else:
-        complete_query = query.filter(false())
-
-    if group_tags:
-        terms = [
-            ~Submission.data.has_all(array(group_tags)),
-            Submission.data.has_any(array(group_tags)),
-            Submission.unreachable == False,  # noqa
-        ]
-        if conflict_group_tags:
-            terms.append(
-                or_(
-                    Submission.conflicts == None,  # noqa
-                    ~Submission.conflicts.has_any(array(conflict_group_tags)),
-                )
-            )
-        partial_query = query.filter(*terms)
-    else:
-        partial_query = query.filter(false())
 
-    if group_tags:
-        offline_query = query.filter(
-            and_(
-                Submission.unreachable.is_(True),
-                not_(and_(Submission.data.has_all(array(group_tags)), Submission.unreachable.is_(True))),
-            )
-        )
-    else:
-        offline_query = query.filter(false())
+def _status_counts(column):
+    return [func.count().filter(column == status).label(status) for status in COVERAGE_STATUSES]
 
-    dataset = defaultdict(dict)
 
-    for loc_id, loc_name, count in _get_coverage_results(complete_query, depth_info.depth):
-        dataset[loc_name].update({"Complete": count, "id": loc_id, "name": loc_name})
+def _get_group_coverage(query, form, group, location_type):
+    coverage_list = []
 
-    for loc_id, loc_name, count in _get_coverage_results(conflict_query, depth_info.depth):
-        dataset[loc_name].update({"Conflict": count, "id": loc_id, "name": loc_name})
+    if not (form and location_type):
+        return coverage_list
 
-    for loc_id, loc_name, count in _get_coverage_results(missing_query, depth_info.depth):
-        dataset[loc_name].update({"Missing": count, "id": loc_id, "name": loc_name})
+    group_tags = form.get_group_tags(group["name"])
+    conflict_group_tags = []
+    if not form.untrack_data_conflicts:
+        conflict_group_tags = form.get_group_tags(group["name"], form.CONFLICT_FIELD_TYPES)
 
-    for loc_id, loc_name, count in _get_coverage_results(partial_query, depth_info.depth):
-        dataset[loc_name].update({"Partial": count, "id": loc_id, "name": loc_name})
+    ancestor_location = aliased(Location)
+    location_closure = aliased(LocationPath)
 
-    for loc_id, loc_name, count in _get_coverage_results(offline_query, depth_info.depth):
-        dataset[loc_name].update({"Offline": count, "id": loc_id, "name": loc_name})
+    # the submission locations are grouped by their ancestor of the
+    # location type and each submission is only counted for its status
+    status = _coverage_status(group_tags, conflict_group_tags).label("status")
+    subquery = query.order_by(None).with_entities(Submission.location_id, status).subquery()
+    dataset = (
+        query.session.query(ancestor_location, *_status_counts(subquery.c.status))
+        .select_from(subquery)
+        .join(location_closure, location_closure.descendant_id == subquery.c.location_id)
+        .join(ancestor_location, ancestor_location.id == location_closure.ancestor_id)
+        .filter(ancestor_location.location_type_id == location_type.id)
+        .options(Load(ancestor_location).load_only(ancestor_location.id, ancestor_location.name_translations))
+        .group_by(ancestor_location.id)
+        .all()
+    )
 
-    for name in sorted(dataset.keys()):
-        loc_data = dataset.get(name)
-        loc_data.setdefault("Complete", 0)
-        loc_data.setdefault("Conflict", 0)
-        loc_data.setdefault("Missing", 0)
-        loc_data.setdefault("Partial", 0)
-        loc_data.setdefault("Offline", 0)
+    for location, *counts in dataset:
+        if not any(counts):
+            continue
 
+        loc_data = dict(zip(COVERAGE_STATUSES, counts))
+        loc_data.update({"id": location.id, "name": location.name})
         coverage_list.append(loc_data)
 
-    return coverage_list
+    return sorted(coverage_list, key=lambda loc_data: loc_data["name"] or "")
 
 
 def _get_global_coverage(query, form):
     coverage_list = []
 
-    # check that we have data
-    if not (db.session.query(query.exists()).scalar() and form):
+    if not form:
         return coverage_list
 
     groups = form.data["groups"]
     if not groups:
         return coverage_list
 
-    for group in groups:
-        group_tags = form.get_group_tags(group["name"])
-
-        if group_tags:
-            conflict_query = query.filter(
-                Submission.conflicts != None,  # noqa
-                Submission.conflicts.has_any(array(group_tags)),
-                Submission.unreachable.is_(False),
-            )  # noqa
-        else:
-            conflict_query = query.filter(false())
-
-        if group_tags:
-            missing_query = query.filter(
-                or_(~Submission.conflicts.has_any(array(group_tags)), Submission.conflicts == None),  # noqa
-                ~Submission.data.has_any(array(group_tags)),
-                Submission.unreachable.is_(False),
-            )  # noqa
-        else:
-            missing_query = query
-
-        if group_tags:
-            complete_query = query.filter(
-                or_(
-                    Submission.conflicts == None,  # noqa
-                    ~Submission.conflicts.has_any(array(group_tags)),
-                ),
-                Submission.data.has_all(array(group_tags)),
-            )
-        else:
-            complete_query = query.filter(false())
-
-        if group_tags:
-            partial_query = query.filter(
-                or_(Submission.conflicts == None, ~Submission.conflicts.has_any(array(group_tags))),  # noqa
-                ~Submission.data.has_all(array(group_tags)),
-                Submission.data.has_any(array(group_tags)),
-                Submission.unreachable.is_(False),
-            )  # noqa
-        else:
-            partial_query = query.filter(false())
-
-        if group_tags:
-            offline_query = query.filter(
-                and_(
-                    Submission.unreachable == True,  # noqa
-                    not_(and_(Submission.data.has_all(array(group_tags)), Submission.unreachable.is_(True))),
-                )
-            )
-        else:
-            offline_query = query.filter(false())
-
-        data = {
-            "Complete": complete_query.count(),
-            "Conflict": conflict_query.count(),
-            "Missing": missing_query.count(),
-            "Partial": partial_query.count(),
-            "Offline": offline_query.count(),
-            "name": group["name"],
-            "slug": group["slug"],
-        }
+    # the status of each submission is computed once for every group
+    statuses = [
+        _coverage_status(form.get_group_tags(group["name"]), form.get_group_tags(group["name"])).label(f"group_{index}")
+        for index, group in enumerate(groups)
+    ]
+    subquery = query.order_by(None).with_entities(*statuses).subquery()
+    columns = [func.count()]
+    for status in statuses:
+        columns.extend(_status_counts(subquery.c[status.name]))
+
+    counts = list(query.session.query(*columns).select_from(subquery).one())
+
+    # check that we have data
+    if not counts.pop(0):
+        return coverage_list
+
+    for index, group in enumerate(groups):
+        group_counts = counts[index * len(COVERAGE_STATUSES) : (index + 1) * len(COVERAGE_STATUSES)]
+        data = dict(zip(COVERAGE_STATUSES, group_counts))
+        data.update({"name": group["name"], "slug": group["slug"]})
 
         coverage_list.append(data)
 
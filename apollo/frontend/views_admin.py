@@ -1,12 +1,12 @@
 # -*- coding: utf-8 -*-
 from datetime import datetime
+from http import HTTPStatus
 from io import BytesIO
 from urllib.parse import urlencode
-from zipfile import ZIP_DEFLATED, ZipFile
 
 import magic
 import pytz
-from flask import flash, g, redirect, request, send_file, session
+from flask import abort, flash, g, jsonify, redirect, request, send_file, session
 from flask_admin import BaseView, expose, form
 from flask_admin.actions import action
 from flask_admin.contrib.sqla import ModelView
@@ -28,7 +28,8 @@ from wtforms import BooleanField, PasswordField, SelectField, SelectMultipleFiel
 from apollo import models, services, settings
 from apollo.constants import LANGUAGE_CHOICES
 from apollo.core import admin, db, security
-from apollo.deployments.serializers import EventArchiveSerializer
+from apollo.deployments import archives
+from apollo.deployments.tasks import export_event_archive
 from apollo.formsframework.views_forms import (
     checklist_init,
     edit_form,
@@ -470,16 +471,46 @@ class EventAdminView(HiddenObjectMixin, BaseAdminView):
     @expose("/download/<int:event_id>")
     def download(self, event_id):
         event = services.events.find(id=event_id).first_or_404()
-        eas = EventArchiveSerializer()
+        fname = slugify(f'event archive {event.name.lower()} {datetime.utcnow().strftime("%Y %m %d %H%M%S")}')  # noqa
 
-        fp = BytesIO()
-        with ZipFile(fp, "w", ZIP_DEFLATED) as zf:
-            eas.serialize(event, zf)
+        # the archive is written by a background task
+        task_id = archives.schedule_archive(event)
+        status_url = self.get_url(".archive_status", task_id=task_id, filename=fname)
 
-        fp.seek(0)
-        fname = slugify(f'event archive {event.name.lower()} {datetime.utcnow().strftime("%Y %m %d %H%M%S")}')  # noqa
+        if request.accept_mimetypes.best == "application/json":
+            return jsonify({"id": task_id, "status_url": status_url}), HTTPStatus.ACCEPTED
+
+        return self.render("admin/event_archive.html", status_url=status_url), HTTPStatus.ACCEPTED
+
+    @expose("/archives/<task_id>")
+    def archive_status(self, task_id):
+        # only the state of the archive tasks is reported
+        if not archives.is_archive_task(task_id):
+            abort(404)
+
+        result = export_event_archive.AsyncResult(task_id)
+        data = {
+            "id": task_id,
+            "description": str(_("Event Archive")),
+            "status": result.state,
+            "progress": result.info if result.state == "PROGRESS" else {},
+        }
+
+        if result.successful() and result.result:
+            data["download_url"] = self.get_url(
+                ".archive_download", key=result.result["key"], filename=request.args.get("filename")
+            )
+
+        return jsonify(data)
+
+    @expose("/archives/<key>/download")
+    def archive_download(self, key):
+        path = archives.get_archive(key)
+        if path is None:
+            abort(404)
 
-        return send_file(fp, attachment_filename=f"{fname}.zip", as_attachment=True)
+        filename = slugify(request.args.get("filename") or key)
+        return send_file(path, mimetype="application/zip", as_attachment=True, download_name=f"{filename}.zip")
 
     def get_one(self, pk):
         model_class = self.model
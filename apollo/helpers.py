@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import importlib
 import pkgutil
+import time
 
 import magic
 import pandas as pd
@@ -9,6 +10,8 @@ from loguru import logger
 from openpyxl import Workbook
 from xlrd import Book
 
+from apollo import settings
+
 CSV_MIMETYPES = [
     "text/csv",
     "text/plain",
@@ -90,3 +93,63 @@ def load_source_file(source_file):
         df = pd.DataFrame()
 
     return df
+
+
+class TaskProgress(object):
+    """Keeps track of the progress of a background import task.
+
+    Progress is reported through the task state using the same meta as
+    the import tasks, but updates are throttled so that the state is only
+    written after `batch_size` records have been handled or `interval`
+    seconds have elapsed since the last update.
+    """
+
+    def __init__(self, task, total_records, batch_size=None, interval=None):
+        """Initializer."""
+        self.task = task
+        self.total_records = total_records
+        self.processed_records = 0
+        self.error_records = 0
+        self.warning_records = 0
+        self.error_log = []
+        self.batch_size = batch_size or settings.TASK_PROGRESS_BATCH_SIZE
+        self.interval = interval if interval is not None else settings.TASK_PROGRESS_INTERVAL
+
+        self._reported_records = 0
+        self._reported_time = time.monotonic()
+
+    @property
+    def meta(self):
+        return {
+            "total_records": self.total_records,
+            "processed_records": self.processed_records,
+            "error_records": self.error_records,
+            "warning_records": self.warning_records,
+            "error_log": self.error_log,
+        }
+
+    def error(self, message):
+        """Records an error."""
+        self.error_records += 1
+        self.error_log.append({"label": "ERROR", "message": message})
+
+    def warning(self, message):
+        """Records a warning."""
+        self.warning_records += 1
+        self.error_log.append({"label": "WARNING", "message": message})
+
+    def update(self, force=False):
+        """Reports the task progress if the batch size or interval was exceeded."""
+        if self.task is None:
+            return
+
+        handled_records = self.processed_records + self.error_records + self.warning_records
+        now = time.monotonic()
+        if (
+            force
+            or handled_records - self._reported_records >= self.batch_size
+            or now - self._reported_time >= self.interval
+        ):
+            self.task.update_state(state="PROGRESS", meta=self.meta)
+            self._reported_records = handled_records
+            self._reported_time = now
@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""In-memory index of the ancestors of the locations in a location set.
+
+Resolving the ancestors of a location through the `Location` relationships
+loads every path and every ancestor separately, which adds up to tens of
+thousands of queries when done for every row of an export or a page of
+submissions. The index maps every location in a location set to its
+ancestors and is built from `location_path` with a single query.
+
+Indexes are kept in memory and are rebuilt once locations, location types
+or location paths in the location set are changed in any of the processes,
+which is tracked with a counter in Redis.
+"""
+
+import sqlalchemy as sa
+from flask import g, has_app_context
+from flask_babel import get_locale
+from sqlalchemy.dialects.postgresql import aggregate_order_by
+from sqlalchemy.orm import Session
+
+from apollo.core import db, red
+from apollo.locations.models import Location, LocationPath, LocationType
+
+ANCESTRY_GENERATION_KEY = "locations:ancestry:{}:generation"
+
+# the ancestry index of every location set that was used, by its id
+_ancestries = {}
+
+
+def _translate(translations):
+    """Returns the translation `translation_hybrid` returns for a model instance."""
+    if not translations:
+        return None
+
+    locale = get_locale()
+    if locale is not None and str(locale) in translations:
+        return translations[str(locale)]
+
+    try:
+        default_locale = g.deployment.primary_locale or "en"
+    except AttributeError:
+        default_locale = "en"
+
+    return translations.get(default_locale, translations[sorted(translations)[0]])
+
+
+class LocationAncestry:
+    """The ancestors of every location in a location set."""
+
+    def __init__(self, location_set_id, location_types, locations, generation=None):
+        """Initializer.
+
+        Args:
+            location_set_id: the id of the location set.
+            location_types: the id and name translations of every location
+                type in the location set.
+            locations: the id, location type id, name translations and the
+                ids of the locations on the path from the root down to the
+                location of every location in the location set.
+            generation: the value of the Redis counter the index is for.
+        """
+        self.location_set_id = location_set_id
+        self.generation = generation
+        self.location_types = dict(location_types)
+
+        self.locations = {}
+        self.ancestors = {}
+        for location_id, location_type_id, name_translations, path_ids in locations:
+            self.locations[location_id] = (location_type_id, name_translations)
+            self.ancestors[location_id] = tuple(pk for pk in path_ids if pk is not None and pk != location_id)
+
+    @classmethod
+    def load(cls, location_set_id, generation=None):
+        """Builds the index of a location set from the database."""
+        location_types = LocationType.query.filter(LocationType.location_set_id == location_set_id).with_entities(
+            LocationType.id, LocationType.name_translations
+        )
+
+        # the paths are ordered from the root down to the location itself
+        locations = (
+            db.session.query(
+                Location.id,
+                Location.location_type_id,
+                Location.name_translations,
+                sa.func.array_agg(aggregate_order_by(LocationPath.ancestor_id, LocationPath.depth.desc())),
+            )
+            .outerjoin(LocationPath, LocationPath.descendant_id == Location.id)
+            .filter(Location.location_set_id == location_set_id)
+            .group_by(Location.id)
+        )
+
+        return cls(location_set_id, location_types, locations, generation)
+
+    def __contains__(self, location_id):
+        """Checks whether a location is in the index."""
+        return location_id in self.locations
+
+    def ancestor_ids(self, location_id):
+        """Returns the ids of the ancestors of a location, from the root down."""
+        return self.ancestors.get(location_id, ())
+
+    def name(self, location_id):
+        """Returns the name of a location."""
+        return _translate(self.locations[location_id][1])
+
+    def location_type_name(self, location_type_id):
+        """Returns the name of a location type."""
+        return _translate(self.location_types.get(location_type_id))
+
+    def path(self, location_id):
+        """Returns the ids of a location and its ancestors by location type id.
+
+        The path is ordered from the root down to the location itself and is
+        empty for locations that aren't in the location set.
+        """
+        if location_id not in self.locations:
+            return {}
+
+        return {
+            self.locations[pk][0]: pk for pk in self.ancestors[location_id] + (location_id,) if pk in self.locations
+        }
+
+    def paths(self, location_ids):
+        """Returns the paths of many locations at once."""
+        return {location_id: self.path(location_id) for location_id in location_ids}
+
+    def name_path(self, location_id):
+        """Returns the names of a location and its ancestors by location type name.
+
+        This is the same as `Location.make_path()` and is None for locations
+        that aren't in the location set.
+        """
+        if location_id not in self.locations:
+            return None
+
+        return {
+            self.location_type_name(location_type_id): self.name(pk)
+            for location_type_id, pk in self.path(location_id).items()
+        }
+
+    def name_paths(self, location_ids):
+        """Returns the name paths of many locations at once."""
+        return {location_id: self.name_path(location_id) for location_id in location_ids}
+
+
+def get_ancestry(location_set_id):
+    """Returns the ancestry index of a location set.
+
+    The Redis counter is only checked once per request or task.
+    """
+    checked = g.setdefault("location_ancestry_checked", {}) if has_app_context() else {}
+    generation = checked.get(location_set_id)
+    if generation is None:
+        generation = int(red.get(ANCESTRY_GENERATION_KEY.format(location_set_id)) or 0)
+        checked[location_set_id] = generation
+
+    ancestry = _ancestries.get(location_set_id)
+    if ancestry is None or ancestry.generation != generation:
+        ancestry = _ancestries[location_set_id] = LocationAncestry.load(location_set_id, generation)
+
+    return ancestry
+
+
+def invalidate_ancestry(location_set_id):
+    """Forces the ancestry index of a location set to be rebuilt in every process."""
+    red.incr(ANCESTRY_GENERATION_KEY.format(location_set_id))
+    _ancestries.pop(location_set_id, None)
+    if has_app_context():
+        g.get("location_ancestry_checked", {}).pop(location_set_id, None)
+
+
+def _location_modified(mapper, connection, target):
+    session = Session.object_session(target)
+    session.info.setdefault("invalidate_location_ancestry", set()).add(target.location_set_id)
+
+
+def _after_commit(session):
+    """Invalidates the ancestry indexes once changes to locations are committed."""
+    for location_set_id in session.info.pop("invalidate_location_ancestry", ()):
+        invalidate_ancestry(location_set_id)
+
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    sa.event.listen(Location, _event_name, _location_modified)
+    sa.event.listen(LocationPath, _event_name, _location_modified)
+    sa.event.listen(LocationType, _event_name, _location_modified)
+sa.event.listen(Session, "after_commit", _after_commit)
@@ -4,7 +4,7 @@ from geoalchemy2 import Geometry
 import networkx as nx
 from sqlalchemy import and_, false, func
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import aliased
+from sqlalchemy.orm import aliased, joinedload
 
 from apollo.core import db
 from apollo.dal.models import BaseModel, Resource, translation_hybrid
@@ -296,10 +296,24 @@ class Location(BaseModel):
         backref='ancestor_location')
 
     def ancestors(self):
-        return [
-            p.ancestor_location for p in self.ancestor_paths
-            if p.depth != 0
-        ]
+        # local to avoid circular import
+        from apollo.locations.ancestry import get_ancestry
+
+        ancestry = get_ancestry(self.location_set_id)
+        if self.id not in ancestry:
+            return [
+                p.ancestor_location for p in self.ancestor_paths
+                if p.depth != 0
+            ]
+
+        ancestor_ids = ancestry.ancestor_ids(self.id)
+        ancestors = {
+            location.id: location
+            for location in Location.query.filter(
+                Location.id.in_(ancestor_ids)).options(
+                    joinedload(Location.location_type))
+        }
+        return [ancestors[pk] for pk in ancestor_ids if pk in ancestors]
 
     def parents(self):
         return [
@@ -337,11 +351,17 @@ class Location(BaseModel):
             cls.id.in_(q), cls.location_set_id == location_set_id).first()
 
     def make_path(self):
+        # local to avoid circular import
+        from apollo.locations.ancestry import get_ancestry
+
         self._cached_path = getattr(self, '_cached_path', None)
         if not self._cached_path:
-            data = {
-                ans.location_type.name: ans.name for ans in self.ancestors()}
-            data.update({self.location_type.name: self.name})
+            data = get_ancestry(self.location_set_id).name_path(self.id)
+            if data is None:
+                data = {
+                    ans.location_type.name: ans.name
+                    for ans in self.ancestors()}
+                data.update({self.location_type.name: self.name})
 
             self._cached_path = data
 
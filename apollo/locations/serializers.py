@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import json
+from functools import partial
+from uuid import uuid4
 
 from geoalchemy2.shape import to_shape
-from apollo.dal.serializers import ArchiveSerializer
+from sqlalchemy.orm import selectinload
+
+from apollo.dal.serializers import YIELD_PER, ArchiveSerializer, json_value
 from apollo.locations.models import (
     Location, LocationDataField, LocationPath, LocationSet, LocationType,
     LocationTypePath)
@@ -192,8 +196,78 @@ class LocationTypePathSerializer(object):
 class LocationSetArchiveSerializer(ArchiveSerializer):
     __model__ = LocationSet
 
-    def deserialize(self, zip_file):
-        pass
+    def deserialize(self, zip_file, restore):
+        restore.add(
+            zip_file, 'location_set.ndjson', 'location_set',
+            partial(self.deserialize_location_set, restore))
+        restore.add(
+            zip_file, 'location_types.ndjson', 'location_type',
+            partial(self.deserialize_location_type, restore))
+        restore.load(
+            zip_file, 'location_type_paths.ndjson', 'location_type_path',
+            ('location_set_id', 'ancestor_id', 'descendant_id', 'depth'),
+            partial(self.deserialize_location_type_path, restore))
+        restore.load(
+            zip_file, 'locations.ndjson', 'location',
+            ('id', 'uuid', 'name_translations', 'code', 'registered_voters',
+             'geom', 'extra_data', 'location_set_id', 'location_type_id'),
+            partial(self.deserialize_location, restore), name='location')
+        restore.load(
+            zip_file, 'location_paths.ndjson', 'location_path',
+            ('location_set_id', 'ancestor_id', 'descendant_id', 'depth'),
+            partial(self.deserialize_location_path, restore))
+        restore.add(
+            zip_file, 'location_data_fields.ndjson', 'location_data_field',
+            partial(self.deserialize_extra_field, restore))
+
+    def deserialize_location_set(self, restore, data):
+        return LocationSet(
+            name=data['name'], slug=data['slug'],
+            deployment_id=restore.deployment.id)
+
+    def deserialize_location_type(self, restore, data):
+        return LocationType(
+            name_translations=data['name'],
+            is_administrative=data['is_administrative'],
+            is_political=data['is_political'],
+            has_registered_voters=data['has_registered_voters'],
+            slug=data['slug'],
+            location_set_id=restore.remap(
+                'location_set', data['location_set']))
+
+    def deserialize_location_type_path(self, restore, data, record_id):
+        return (
+            restore.remap('location_set', data['location_set']),
+            restore.remap('location_type', data['ancestor_location_type']),
+            restore.remap('location_type', data['descendant_location_type']),
+            data['depth'])
+
+    def deserialize_location(self, restore, data, record_id):
+        if data['lat'] is not None and data['lon'] is not None:
+            geom = f'SRID=4326;POINT({data["lon"]} {data["lat"]})'
+        else:
+            geom = None
+
+        return (
+            record_id, uuid4(), json_value(data['name']), data['code'],
+            data['registered_voters'], geom, json_value(data['extra_data']),
+            restore.remap('location_set', data['location_set']),
+            restore.remap('location_type', data['location_type']))
+
+    def deserialize_location_path(self, restore, data, record_id):
+        return (
+            restore.remap('location_set', data['location_set']),
+            restore.remap('location', data['ancestor_location']),
+            restore.remap('location', data['descendant_location']),
+            data['depth'])
+
+    def deserialize_extra_field(self, restore, data):
+        return LocationDataField(
+            name=data['name'], label=data['label'],
+            visible_in_lists=data['visible_in_lists'],
+            location_set_id=restore.remap(
+                'location_set', data['location_set']),
+            deployment_id=restore.deployment.id)
 
     def serialize(self, event, zip_file):
         location_set = event.location_set
@@ -204,9 +278,20 @@ class LocationSetArchiveSerializer(ArchiveSerializer):
                 location_set.location_types, zip_file)
             self.serialize_location_type_paths(
                 location_set.location_type_paths, zip_file)
-            self.serialize_locations(location_set.locations, zip_file)
-            self.serialize_location_paths(
-                location_set.location_paths, zip_file)
+            self.serialize_locations(
+                location_set.locations.order_by(Location.id).yield_per(
+                    YIELD_PER), zip_file)
+
+            # only the uuids of the ancestors and descendants are exported
+            location_paths = LocationPath.query.filter_by(
+                location_set_id=location_set.id).options(
+                    selectinload(LocationPath.ancestor_location).load_only(
+                        Location.uuid),
+                    selectinload(LocationPath.descendant_location).load_only(
+                        Location.uuid)).order_by(
+                            LocationPath.ancestor_id,
+                            LocationPath.descendant_id).yield_per(YIELD_PER)
+            self.serialize_location_paths(location_paths, zip_file)
             self.serialize_extra_fields(location_set.extra_fields, zip_file)
 
     def serialize_location_set(self, obj, zip_file):
@@ -1,25 +1,29 @@
 # -*- coding: utf-8 -*-
+import csv
+import json
 import logging
 import numbers
 import os
-from hashlib import sha256
+from io import StringIO
 from itertools import chain
 
-import cachetools
+import sqlalchemy as sa
 from celery import shared_task
 from flask import render_template_string
 from flask_babel import gettext
 from flask_babel import gettext as _
 from pandas import isnull, to_numeric
-from sqlalchemy import and_, exists, func
-from sqlalchemy.sql import select
+from sqlalchemy import func
 
 from apollo import helpers
 from apollo.core import db, uploads
+from apollo.helpers import TaskProgress
 from apollo.messaging.tasks import send_email
+from apollo.result_analysis.models import ResultAggregate
 
 from ..users.models import UserUpload
-from .models import Location, LocationGroup, LocationPath, LocationSet, LocationType, LocationTypePath, locations_groups
+from .ancestry import invalidate_ancestry
+from .models import LocationGroup, LocationSet, LocationType, LocationTypePath
 
 logger = logging.getLogger(__name__)
 
@@ -31,139 +35,72 @@ Your location import task has been completed.
 """
 
 
-class LocationCache:
-    def __init__(self, maxsize=50):
-        """Initializer."""
-        self.cache = cachetools.LRUCache(maxsize=maxsize)
+# the columns of the location import staging table
+STAGING_COLUMNS = {
+    "code": "VARCHAR",
+    "location_type_id": "INTEGER",
+    "name_translations": "JSONB",
+    "geom": "VARCHAR",
+    "registered_voters": "INTEGER",
+    "extra_data": "JSONB",
+    "group_ids": "JSONB",
+}
 
-    def _cache_key(self, location_code, location_type, location_name):
-        # remove smart quotes
-        location_code = (
-            str(location_code).replace("\u2018", "").replace("\u2019", "").replace("\u201c", "").replace("\u201d", "")
-        )
-        location_type = (
-            str(location_type).replace("\u2018", "").replace("\u2019", "").replace("\u201c", "").replace("\u201d", "")
-        )
-        location_name = (
-            str(location_name).replace("\u2018", "").replace("\u2019", "").replace("\u201c", "").replace("\u201d", "")
-        )
-
-        plain_key = f"{location_code}:{location_type}:{location_name}"
-        return sha256(plain_key.encode("utf-8")).hexdigest()
-
-    def get(self, location_code, location_type, location_name):
-        cache_key = self._cache_key(location_code, location_type, location_name)
-        return self.cache.get(cache_key, None)
-
-    def has(self, location_code, location_type, location_name):
-        cache_key = self._cache_key(location_code, location_type, location_name)
-        return cache_key in self.cache
-
-    def set(self, location_obj):
-        cache_key = self._cache_key(
-            location_obj.code or "", location_obj.location_type.name or "", location_obj.name or ""
-        )
-        self.cache[cache_key] = location_obj
-
-    def set_by_dict(self, **data):
-        cache_key = self._cache_key(data.get("code", ""), data.get("loc_type_name", ""), data.get("name", ""))
-        self.cache[cache_key] = data.get("id")
-
-
-def update_locations(connection, data_frame, header_mapping, location_set, task):
-    """Add or update location data in the database as required."""
-    cache = LocationCache()
-    mapped_locales = [k.rsplit("_", 1)[-1] for k in header_mapping.keys() if "name" in k]
-
-    total_records = data_frame.shape[0]
-    processed_records = 0
-    error_records = 0
-    warning_records = 0
-    total_locations = 0
-    error_log = []
 
-    mapped_location_type_ids = [int(k[:-5]) for k in header_mapping.keys() if k.endswith("_code")]
-
-    group_mappings = header_mapping.pop("groups", {})
-    new_groups_map = {}
-    group_columns = list(chain.from_iterable(group_mappings.values()))
-    if group_columns:
-        LocationGroup.query.filter_by(location_set=location_set).delete()
-
-        for loc_type_id, group_names in group_mappings.items():
-            insert_statements = [
-                LocationGroup.__table__.insert().values(location_set_id=location_set.id, name=name)
-                for name in group_names
-            ]
-
-            insert_results = [connection.execute(stmt) for stmt in insert_statements]
-            new_groups_map[int(loc_type_id)] = {
-                name: result.inserted_primary_key[0] for name, result in zip(group_names, insert_results)
-            }
+def _log(progress, row_labels, label, message):
+    """Records an error or warning, counting each row at most once per label."""
+    if label not in row_labels:
+        row_labels.add(label)
+        if label == "ERROR":
+            progress.error_records += 1
+        else:
+            progress.warning_records += 1
 
-    location_types = (
-        LocationType.query.filter(
-            LocationType.location_set == location_set, LocationType.id.in_(mapped_location_type_ids)
-        )
-        .join(LocationTypePath, LocationType.id == LocationTypePath.ancestor_id)
-        .order_by(func.count(LocationType.ancestor_paths).desc())
-        .group_by("id")
-        .all()
-    )
+    progress.error_log.append({"label": label, "message": message})
 
-    all_loc_type_paths = (
-        LocationTypePath.query.filter_by(location_set_id=location_set.id)
-        .with_entities(LocationTypePath.ancestor_id, LocationTypePath.descendant_id, LocationTypePath.depth)
-        .all()
-    )
 
-    extra_field_cache = {fi.id: fi.name for fi in location_set.extra_fields} if location_set.extra_fields else {}
+def _parse_location_records(
+    data_frame, header_mapping, location_types, mapped_locales, extra_field_cache, groups_map, progress
+):
+    """Validates the rows of a location import.
 
-    location_table = Location.__table__
-    location_path_table = LocationPath.__table__
+    Returns the locations to upsert keyed by their code, so that the last
+    row for a location takes effect, and the distinct combinations of
+    locations found on the same row, as lists of (location type id, code)
+    pairs, from which the location paths are built.
+    """
+    records = {}
+    rows = {}
 
     # due to the way the reports are presented, one only wants to report
     # (counts of) errors/warnings once per row of data, even if multiple
     # issues arise per row, since there's no way to enforce a specific
     # spreadsheet structure
-
-    for idx in data_frame.index:
-        current_row = data_frame.iloc[idx]
-        location_path_helper_map = {}
-        error_this_row = False
-        warning_this_row = False
+    for idx, current_row in zip(data_frame.index, data_frame.to_dict("records")):
+        row_labels = set()
+        row_locations = {}
 
         for loc_type in location_types:
             name_column_keys = [f"{loc_type.id}_name_{locale}" for locale in mapped_locales]
             code_column_key = f"{loc_type.id}_code"
 
             if header_mapping.get(name_column_keys[0]) is None or header_mapping.get(code_column_key) is None:
-                warning_records += 0 if warning_this_row else 1
-                error_log.append(
-                    {
-                        "label": "WARNING",
-                        "message": gettext(
-                            "No code or name present for row %(row)d for %(level)s",
-                            row=(idx + 1),
-                            level=loc_type.name,
-                        ),
-                    }
+                _log(
+                    progress,
+                    row_labels,
+                    "WARNING",
+                    gettext(
+                        "No code or name present for row %(row)d for %(level)s", row=(idx + 1), level=loc_type.name
+                    ),
                 )
-                warning_this_row = True
                 continue
 
             lat_column_key = f"{loc_type.id}_lat" if loc_type.has_coordinates else None
             lon_column_key = f"{loc_type.id}_lon" if loc_type.has_coordinates else None
             reg_voters_column_key = f"{loc_type.id}_rv" if loc_type.has_registered_voters else None
 
-            name_columns = [header_mapping.get(col) for col in name_column_keys]
-            code_column = header_mapping.get(code_column_key)
-            lat_column = header_mapping.get(lat_column_key)
-            lon_column = header_mapping.get(lon_column_key)
-            reg_voters_column = header_mapping.get(reg_voters_column_key)
-
-            location_names = [current_row.get(col) for col in name_columns]
-            location_code = current_row.get(code_column)
+            location_names = [current_row.get(header_mapping.get(col)) for col in name_column_keys]
+            location_code = current_row.get(header_mapping.get(code_column_key))
 
             # sanity check because numeric 0 is (probably) a valid code
             # but is a falsy value
@@ -177,46 +114,31 @@ def update_locations(connection, data_frame, header_mapping, location_set, task)
             try:
                 location_code = str(int(location_code))
             except (TypeError, ValueError):
-                error_records += 0 if error_this_row else 1
                 message = gettext("Invalid (non-numeric) location code (%(loc_code)s)", loc_code=location_code)
-                error_log.append({"label": "ERROR", "message": message})
-                error_this_row = True
+                _log(progress, row_labels, "ERROR", message)
                 continue
 
             # it's an issue if either is missing, too
             if not location_names[0] or not location_code:
-                warning_records += 0 if warning_this_row else 1
-                error_log.append(
-                    {"label": "WARNING", "message": gettext("Missing name or code for row %(row)d", row=(idx + 1))}
-                )
-                warning_this_row = True
+                _log(progress, row_labels, "WARNING", gettext("Missing name or code for row %(row)d", row=(idx + 1)))
                 continue
 
-            # if we have the location in the cache, then continue
-            if cache.has(location_code, loc_type.name, location_names[0]):
-                location_path_helper_map[loc_type.id] = cache.get(location_code, loc_type.name, location_names[0])
-                continue
-
-            location_lat = current_row.get(lat_column)
-            location_lon = current_row.get(lon_column)
-            location_rv = current_row.get(reg_voters_column)
+            location_lat = current_row.get(header_mapping.get(lat_column_key))
+            location_lon = current_row.get(header_mapping.get(lon_column_key))
+            location_rv = current_row.get(header_mapping.get(reg_voters_column_key))
 
             if loc_type.has_coordinates:
                 try:
                     location_lat = float(location_lat)
                     location_lon = float(location_lon)
                 except (TypeError, ValueError):
-                    warning_records += 0 if warning_this_row else 1
-                    error_log.append(
-                        {
-                            "label": "WARNING",
-                            "message": gettext(
-                                "Invalid coordinate data for row %(row)d. Data will not be used.", row=(idx + 1)
-                            ),
-                        }
+                    _log(
+                        progress,
+                        row_labels,
+                        "WARNING",
+                        gettext("Invalid coordinate data for row %(row)d. Data will not be used.", row=(idx + 1)),
                     )
                     location_lat = location_lon = None
-                    warning_this_row = True
             else:
                 location_lat = location_lon = None
 
@@ -224,34 +146,29 @@ def update_locations(connection, data_frame, header_mapping, location_set, task)
                 try:
                     location_rv = int(location_rv)
                 except (TypeError, ValueError):
-                    warning_records += 0 if warning_this_row else 1
-                    error_log.append(
-                        {
-                            "label": "WARNING",
-                            "message": gettext(
-                                "Invalid number of registered voters for row %(row)d. Data will not be used.",
-                                row=(idx + 1),
-                            ),
-                        }
+                    _log(
+                        progress,
+                        row_labels,
+                        "WARNING",
+                        gettext(
+                            "Invalid number of registered voters for row %(row)d. Data will not be used.",
+                            row=(idx + 1),
+                        ),
                     )
                     location_rv = None
-                    warning_this_row = True
             else:
-                location_rv = 0
+                location_rv = None
 
             # set GPS data if we have valid data
             if location_lat is not None and location_lon is not None:
-                geom_spec = "SRID=4326; POINT({longitude:f} {latitude:f})".format(
-                    longitude=location_lon, latitude=location_lat
-                )
+                geom_spec = f"SRID=4326;POINT({location_lon:f} {location_lat:f})"
             else:
                 geom_spec = None
 
             # each level should have its own extra data column
             extra_data = {}
             for field_id in extra_field_cache.keys():
-                column_key = "{}:{}".format(loc_type.id, field_id)
-                column = header_mapping.get(column_key)
+                column = header_mapping.get(f"{loc_type.id}:{field_id}")
                 if column:
                     value = current_row.get(column)
                     if isnull(value):
@@ -265,132 +182,220 @@ def update_locations(connection, data_frame, header_mapping, location_set, task)
                         value = str(value)
                     extra_data[extra_field_cache[field_id]] = value
 
-            # collate all fields
-            kwargs = {
-                "location_type_id": loc_type.id,
-                "location_set_id": location_set.id,
-                "geom": geom_spec,
+            # group memberships are added by every row for a location
+            groups = set(records[location_code]["group_ids"]) if location_code in records else set()
+            for group_col, group_id in groups_map.get(loc_type.id, {}).items():
+                group_flag = to_numeric(current_row.get(group_col), errors="coerce")
+                if not isnull(group_flag) and group_flag:
+                    groups.add(group_id)
+
+            # codes are unique within a location set, so the location keeps
+            # the type of the first row it's found in
+            records[location_code] = {
                 "code": location_code,
+                "location_type_id": (
+                    records[location_code]["location_type_id"] if location_code in records else loc_type.id
+                ),
                 "name_translations": {
                     locale: str(name).strip()
                     for locale, name in zip(mapped_locales, location_names)
                     if name and not isnull(name)
                 },
+                "geom": geom_spec,
+                "registered_voters": location_rv or None,
+                "extra_data": extra_data or None,
+                "group_ids": sorted(groups),
             }
-            if location_rv:
-                kwargs.update({"registered_voters": location_rv})
-            if extra_data:
-                kwargs.update({"extra_data": extra_data})
-
-            # is this location in the database?
-            s = select(location_table.c.id).where(
-                and_(location_table.c.location_set_id == location_set.id, location_table.c.code == kwargs["code"])
-            )
-            result = connection.execute(s)
-            location_data = result.first()
-
-            # create it if it isn't
-            if location_data is None:
-                stmt = location_table.insert().values(**kwargs)
-                result = connection.execute(stmt)
-                location_id = result.inserted_primary_key[0]
-                result.close()
-
-                # add the self-referential path
-                stmt = location_path_table.insert().values(
-                    ancestor_id=location_id, descendant_id=location_id, location_set_id=location_set.id, depth=0
-                )
-                result = connection.execute(stmt)
-                result.close()
-            else:
-                # update it if it is
-                location_id = location_data[0]
-                update_kwargs = {
-                    "registered_voters": kwargs.get("registered_voters"),
-                    "name_translations": kwargs.get("name_translations"),
-                    "geom": kwargs.get("geom"),
-                }
-                if extra_data:
-                    update_kwargs["extra_data"] = extra_data
+            row_locations[loc_type.id] = location_code
 
-                stmt = location_table.update().where(location_table.c.id == location_id).values(**update_kwargs)
+        if row_locations:
+            rows.setdefault(tuple(sorted(row_locations.items())), len(rows))
 
-                connection.execute(stmt)
+        progress.processed_records += 1
+        progress.update()
 
-            total_locations += 1
-            cache.set_by_dict(loc_type_name=loc_type.name, code=location_code, name=location_names[0], id=location_id)
+    return records, list(rows)
 
-            # update location path info for this row
-            location_path_helper_map[loc_type.id] = location_id
 
-            # update group info
-            if loc_type.id not in new_groups_map:
-                continue
+def _copy_rows(connection, table, columns, rows):
+    """Loads rows into a staging table with COPY."""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerows(rows)
+    buffer.seek(0)
 
-            for group_col in group_columns:
-                group_flag = to_numeric(current_row[group_col], errors="coerce")
-                if not isnull(group_flag) and group_flag:
-                    group_id = new_groups_map[loc_type.id][group_col]
-                    result = None
-
-                    stmt = (
-                        exists()
-                        .where(
-                            and_(
-                                locations_groups.c.location_id == location_id,
-                                locations_groups.c.location_group_id == group_id,
-                            )
-                        )
-                        .select()
-                    )
-                    result = connection.execute(stmt).scalar()
+    cursor = connection.connection.cursor()
+    cursor.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    connection.execute(sa.text(f"ANALYZE {table}"))
 
-                    if not result:
-                        stmt = locations_groups.insert().values(location_id=location_id, location_group_id=group_id)
-                        result = connection.execute(stmt)
-                        result.close()
 
-        for ans_type_id, des_type_id, depth in all_loc_type_paths:
-            ancestor_id = location_path_helper_map.get(ans_type_id)
-            descendant_id = location_path_helper_map.get(des_type_id)
-            path_result = None
+def _load_staging_tables(connection, records, rows):
+    """Loads the locations and the locations found on each row into staging tables."""
+    connection.execute(
+        sa.text(
+            f"""
+            CREATE TEMPORARY TABLE location_import (
+                {", ".join(f"{name} {column_type}" for name, column_type in STAGING_COLUMNS.items())}
+            ) ON COMMIT DROP
+            """
+        )
+    )
+    connection.execute(
+        sa.text(
+            """
+            CREATE TEMPORARY TABLE location_import_row (
+                row_id INTEGER, location_type_id INTEGER, code VARCHAR
+            ) ON COMMIT DROP
+            """
+        )
+    )
 
-            if ancestor_id is None or descendant_id is None:
-                continue
+    _copy_rows(
+        connection,
+        "location_import",
+        STAGING_COLUMNS,
+        (
+            [
+                json.dumps(record[name])
+                if STAGING_COLUMNS[name] == "JSONB" and record[name] is not None
+                else record[name]
+                for name in STAGING_COLUMNS
+            ]
+            for record in records
+        ),
+    )
+    _copy_rows(
+        connection,
+        "location_import_row",
+        ("row_id", "location_type_id", "code"),
+        (
+            (row_id, location_type_id, code)
+            for row_id, row_locations in enumerate(rows)
+            for location_type_id, code in row_locations
+        ),
+    )
 
-            stmt = (
-                exists()
-                .where(
-                    and_(
-                        location_path_table.c.ancestor_id == ancestor_id,
-                        location_path_table.c.descendant_id == descendant_id,
-                        location_path_table.c.location_set_id == location_set.id,
-                    )
-                )
-                .select()
-            )
-            path_result = connection.execute(stmt).scalar()
 
-            if not path_result:
-                stmt = location_path_table.insert().values(
-                    ancestor_id=ancestor_id, descendant_id=descendant_id, location_set_id=location_set.id, depth=depth
+def _upsert_locations(connection, location_types, location_set):
+    """Creates or updates the staged locations, one location level at a time."""
+    for loc_type in location_types:
+        connection.execute(
+            sa.text(
+                """
+                INSERT INTO location (
+                    location_set_id, location_type_id, code, name_translations, geom, registered_voters, extra_data
                 )
-                result = connection.execute(stmt)
-                result.close()
-
-        processed_records += 1
-        task.update_state(
-            state="PROGRESS",
-            meta={
-                "total_records": total_records,
-                "processed_records": processed_records,
-                "error_records": error_records,
-                "warning_records": warning_records,
-                "error_log": error_log,
-            },
+                SELECT
+                    :location_set_id, s.location_type_id, s.code, s.name_translations, ST_GeomFromEWKT(s.geom),
+                    COALESCE(s.registered_voters, 0), s.extra_data
+                FROM location_import s WHERE s.location_type_id = :location_type_id
+                ON CONFLICT (location_set_id, code) DO UPDATE SET
+                    name_translations = EXCLUDED.name_translations,
+                    geom = EXCLUDED.geom,
+                    registered_voters = NULLIF(EXCLUDED.registered_voters, 0),
+                    extra_data = COALESCE(EXCLUDED.extra_data, location.extra_data)
+                """
+            ),
+            {"location_set_id": location_set.id, "location_type_id": loc_type.id},
         )
 
 
+def _update_location_paths(connection, location_set):
+    """Adds the paths between the locations found on the same row.
+
+    The paths, including the paths of the locations to themselves, follow
+    the paths between their location types.
+    """
+    connection.execute(
+        sa.text(
+            """
+            INSERT INTO location_path (location_set_id, ancestor_id, descendant_id, depth)
+            SELECT DISTINCT :location_set_id, ancestor.id, descendant.id, ltp.depth
+            FROM location_import_row ra
+            JOIN location_import_row rd ON rd.row_id = ra.row_id
+            JOIN location_type_path ltp
+                ON ltp.ancestor_id = ra.location_type_id AND ltp.descendant_id = rd.location_type_id
+            JOIN location ancestor ON ancestor.location_set_id = :location_set_id AND ancestor.code = ra.code
+            JOIN location descendant ON descendant.location_set_id = :location_set_id AND descendant.code = rd.code
+            ON CONFLICT DO NOTHING
+            """
+        ),
+        {"location_set_id": location_set.id},
+    )
+
+
+def _update_location_groups(connection, location_set):
+    """Adds the group memberships of the staged locations."""
+    connection.execute(
+        sa.text(
+            """
+            INSERT INTO locations_groups (location_id, location_group_id)
+            SELECT location.id, group_id::integer
+            FROM location_import s
+            CROSS JOIN jsonb_array_elements_text(s.group_ids) AS group_id
+            JOIN location ON location.location_set_id = :location_set_id AND location.code = s.code
+            ON CONFLICT DO NOTHING
+            """
+        ),
+        {"location_set_id": location_set.id},
+    )
+
+
+def update_locations(connection, data_frame, header_mapping, location_set, task):
+    """Add or update location data in the database as required.
+
+    The rows are validated first, then the valid locations are copied into
+    staging tables from which the locations are upserted a level at a time,
+    and the location paths and group memberships are added in bulk.
+    """
+    progress = TaskProgress(task, data_frame.shape[0])
+    progress.update(force=True)
+
+    mapped_locales = [k.rsplit("_", 1)[-1] for k in header_mapping.keys() if "name" in k]
+    mapped_location_type_ids = [int(k[:-5]) for k in header_mapping.keys() if k.endswith("_code")]
+
+    group_mappings = header_mapping.pop("groups", {})
+    groups_map = {}
+    if list(chain.from_iterable(group_mappings.values())):
+        LocationGroup.query.filter_by(location_set=location_set).delete()
+
+        for loc_type_id, group_names in group_mappings.items():
+            insert_statements = [
+                LocationGroup.__table__.insert().values(location_set_id=location_set.id, name=name)
+                for name in group_names
+            ]
+
+            insert_results = [connection.execute(stmt) for stmt in insert_statements]
+            groups_map[int(loc_type_id)] = {
+                name: result.inserted_primary_key[0] for name, result in zip(group_names, insert_results)
+            }
+
+    # location types from the root down
+    location_types = (
+        LocationType.query.filter(
+            LocationType.location_set == location_set, LocationType.id.in_(mapped_location_type_ids)
+        )
+        .join(LocationTypePath, LocationType.id == LocationTypePath.ancestor_id)
+        .order_by(func.count(LocationType.ancestor_paths).desc())
+        .group_by("id")
+        .all()
+    )
+
+    extra_field_cache = {fi.id: fi.name for fi in location_set.extra_fields} if location_set.extra_fields else {}
+
+    records, rows = _parse_location_records(
+        data_frame, header_mapping, location_types, mapped_locales, extra_field_cache, groups_map, progress
+    )
+
+    if records:
+        _load_staging_tables(connection, records.values(), rows)
+        _upsert_locations(connection, location_types, location_set)
+        _update_location_paths(connection, location_set)
+        _update_location_groups(connection, location_set)
+
+    progress.update(force=True)
+
+
 @shared_task(bind=True)
 def import_locations(self, upload_id, mappings, location_set_id, channel=None):
     """Celery task to import locations."""
@@ -414,6 +419,8 @@ def import_locations(self, upload_id, mappings, location_set_id, channel=None):
     engine = db.get_engine()
     with engine.begin() as connection:
         update_locations(connection, dataframe, mappings, location_set, self)
+    invalidate_ancestry(location_set.id)
+    ResultAggregate.invalidate(location_set.id)
 
     os.remove(filepath)
     upload.delete()
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+import pandas as pd
+
+from apollo.core import db
+from apollo.deployments.models import Deployment
+from apollo.locations.ancestry import LocationAncestry
+from apollo.locations.models import Location, LocationPath, LocationSet, LocationType, LocationTypePath
+from apollo.locations.tasks import _parse_location_records, update_locations
+from apollo.testutils.imports import parse_records
+
+LOCATION_TYPES = [
+    LocationType(id=1, name_translations={"en": "Region"}),
+    LocationType(id=2, name_translations={"en": "Station"}, has_registered_voters=True, has_coordinates=True),
+]
+HEADER_MAPPING = {
+    "1_name_en": "REGION",
+    "1_code": "REGION CODE",
+    "2_name_en": "STATION",
+    "2_code": "STATION CODE",
+    "2_rv": "RV",
+    "2_lat": "LAT",
+    "2_lon": "LON",
+}
+
+
+def _parse(data_frame, groups_map=None):
+    return parse_records(
+        _parse_location_records, data_frame, HEADER_MAPPING, LOCATION_TYPES, ["en"], {}, groups_map or {}
+    )
+
+
+def test_location_import_records():
+    """Tests the locations and rows loaded for valid rows."""
+    data_frame = pd.DataFrame(
+        {
+            "REGION": ["North", "North", "South"],
+            "REGION CODE": ["1", "1", "2"],
+            "STATION": ["School", "Church", "Hall"],
+            "STATION CODE": ["101", "102", "201"],
+            "RV": ["500", "", "300"],
+            "LAT": ["9.5", "", "8.25"],
+            "LON": ["7.5", "", "6"],
+            "OPEN": ["1", "0", "1"],
+        }
+    )
+    records, rows, progress = _parse(data_frame, {2: {"OPEN": 10}})
+
+    assert sorted(records) == ["1", "101", "102", "2", "201"]
+    assert records["1"]["location_type_id"] == 1
+    assert records["1"]["name_translations"] == {"en": "North"}
+    assert records["1"]["registered_voters"] is None
+    assert records["101"]["registered_voters"] == 500
+    assert records["101"]["geom"] == "SRID=4326;POINT(7.500000 9.500000)"
+    assert records["101"]["group_ids"] == [10]
+    assert records["102"]["geom"] is None
+    assert records["102"]["group_ids"] == []
+    assert rows == [((1, "1"), (2, "101")), ((1, "1"), (2, "102")), ((1, "2"), (2, "201"))]
+
+    # one warning per row for the invalid coordinates and registered voters
+    assert progress.warning_records == 1
+    assert [entry["label"] for entry in progress.error_log] == ["WARNING", "WARNING"]
+    assert progress.processed_records == 3
+
+
+def test_location_import_errors():
+    """Tests that invalid locations are reported and skipped."""
+    data_frame = pd.DataFrame(
+        {
+            "REGION": ["North", "", "South"],
+            "REGION CODE": ["x", "", "2"],
+            "STATION": ["School", "Church", ""],
+            "STATION CODE": ["y", "102", "201"],
+            "RV": ["500", "0", "300"],
+            "LAT": ["9.5", "1", "8.25"],
+            "LON": ["7.5", "1", "6"],
+        }
+    )
+    records, rows, progress = _parse(data_frame)
+
+    assert sorted(records) == ["102", "2"]
+    assert rows == [((2, "102"),), ((1, "2"),)]
+    assert progress.error_records == 1
+    assert progress.warning_records == 1
+    assert progress.error_log[0]["message"] == "Invalid (non-numeric) location code (x)"
+    assert progress.error_log[2]["message"] == "Missing name or code for row 3"
+
+
+def test_location_import_update(app):
+    """Tests that an import updates the existing locations in place and adds the missing paths."""
+    deployment = Deployment(name="Locations", hostnames=["locations"], primary_locale="en")
+    location_set = LocationSet(name="Locations", deployment=deployment)
+    region_type = LocationType(name_translations={"en": "Region"}, location_set=location_set)
+    station_type = LocationType(
+        name_translations={"en": "Station"}, has_registered_voters=True, location_set=location_set
+    )
+    region = Location(name_translations={"en": "North"}, code="1", location_type=region_type, location_set=location_set)
+    station = Location(
+        name_translations={"en": "School"},
+        code="101",
+        registered_voters=100,
+        extra_data={"WARD": "7"},
+        location_type=station_type,
+        location_set=location_set,
+    )
+    db.session.add_all([region, station])
+    db.session.flush()
+    db.session.add_all(
+        [
+            LocationTypePath(
+                location_set=location_set, ancestor_id=ancestor.id, descendant_id=descendant.id, depth=depth
+            )
+            for ancestor, descendant, depth in (
+                (region_type, region_type, 0),
+                (region_type, station_type, 1),
+                (station_type, station_type, 0),
+            )
+        ]
+        + [
+            LocationPath(location_set=location_set, ancestor_id=ancestor.id, descendant_id=descendant.id, depth=depth)
+            for ancestor, descendant, depth in ((region, region, 0), (region, station, 1), (station, station, 0))
+        ]
+    )
+    db.session.commit()
+    region_id, station_id = region.id, station.id
+
+    data_frame = pd.DataFrame(
+        {
+            "REGION": ["Northern", "Northern"],
+            "REGION CODE": ["1", "1"],
+            "STATION": ["High School", "Church"],
+            "STATION CODE": ["101", "102"],
+            "RV": ["500", "300"],
+        }
+    )
+    header_mapping = {
+        f"{region_type.id}_name_en": "REGION",
+        f"{region_type.id}_code": "REGION CODE",
+        f"{station_type.id}_name_en": "STATION",
+        f"{station_type.id}_code": "STATION CODE",
+        f"{station_type.id}_rv": "RV",
+    }
+    with db.engine.begin() as connection:
+        update_locations(connection, data_frame, header_mapping, location_set, None)
+    db.session.expire_all()
+
+    locations = {location.code: location for location in Location.query.filter_by(location_set_id=location_set.id)}
+    assert sorted(locations) == ["1", "101", "102"]
+
+    # the existing locations are updated rather than duplicated, and keep
+    # their extra data when the import has none
+    assert locations["1"].id == region_id
+    assert locations["1"].name_translations == {"en": "Northern"}
+    assert locations["101"].id == station_id
+    assert locations["101"].name_translations == {"en": "High School"}
+    assert locations["101"].registered_voters == 500
+    assert locations["101"].extra_data == {"WARD": "7"}
+    assert locations["102"].registered_voters == 300
+
+    paths = {
+        (path.ancestor_id, path.descendant_id, path.depth)
+        for path in LocationPath.query.filter_by(location_set_id=location_set.id)
+    }
+    assert paths == {
+        (region_id, region_id, 0),
+        (region_id, station_id, 1),
+        (station_id, station_id, 0),
+        (region_id, locations["102"].id, 1),
+        (locations["102"].id, locations["102"].id, 0),
+    }
+
+
+def test_location_ancestry():
+    """Tests the paths resolved by the location ancestry index."""
+    ancestry = LocationAncestry(
+        1,
+        [(1, {"en": "Region"}), (2, {"en": "District"}), (3, {"en": "Station", "fr": "Bureau"})],
+        [
+            (10, 1, {"en": "North"}, [10]),
+            (20, 2, {"en": "Hills"}, [10, 20]),
+            (30, 3, {"fr": "Ecole"}, [10, 20, 30]),
+            (40, 3, {"en": "Church"}, [None]),
+        ],
+    )
+
+    assert 30 in ancestry and 50 not in ancestry
+    assert ancestry.ancestor_ids(30) == (10, 20)
+    assert ancestry.ancestor_ids(40) == ()
+    assert ancestry.path(30) == {1: 10, 2: 20, 3: 30}
+    assert list(ancestry.path(30)) == [1, 2, 3]
+    assert ancestry.path(50) == {}
+    assert ancestry.paths([20, 40]) == {20: {1: 10, 2: 20}, 40: {3: 40}}
+
+    assert ancestry.name_path(30) == {"Region": "North", "District": "Hills", "Station": "Ecole"}
+    assert ancestry.name_paths([40, 50]) == {40: {"Station": "Church"}, 50: None}
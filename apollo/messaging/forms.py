@@ -1,11 +1,21 @@
 # -*- coding: utf-8 -*-
 import time
+from collections import defaultdict
 
 import flask_wtf as wtf
+import sqlalchemy as sa
 import wtforms
 from flask import g
+from sqlalchemy.orm import Session
 
 from apollo import models, services
+from apollo.core import db, red
+from apollo.formsframework.models import events_forms
+
+FORM_INDEX_GENERATION_KEY = "messaging:form-index:generation"
+
+# the forms of every event indexed by their lowercase prefix
+_form_index = {}
 
 
 class MessagesFilterForm(wtf.FlaskForm):
@@ -82,16 +92,63 @@ def retrieve_form(prefix, exclamation=False):
     :returns: a Form instance or None
     """
     current_events = services.events.overlapping_events(g.event)
+    current_event_ids = {event_id for (event_id,) in current_events.with_entities(models.Event.id)}
 
     # find the first form that matches the prefix and optionally form type
     # for the current events
-    query = models.Form.query.join(models.Form.events).filter(
-        models.Event.id.in_(current_events.with_entities(models.Event.id)), models.Form.prefix.ilike(prefix)
+    form_id = next(
+        (
+            form_id
+            for form_id, form_type, event_id in get_form_index().get(prefix.lower(), [])
+            if event_id in current_event_ids and (not exclamation or form_type == "INCIDENT")
+        ),
+        None,
     )
 
-    if exclamation:
-        query = query.filter(models.Form.form_type == "INCIDENT")
+    return db.session.get(models.Form, form_id) if form_id is not None else None
+
+
+def get_form_index():
+    """Returns the forms of every event indexed by their lowercase prefix.
+
+    The index is kept in memory and is rebuilt once forms are saved in any
+    of the processes, which is tracked with a counter in Redis.
+    """
+    generation = int(red.get(FORM_INDEX_GENERATION_KEY) or 0)
+    if _form_index.get("generation") != generation:
+        query = (
+            models.Form.query.join(events_forms, events_forms.c.form_id == models.Form.id)
+            .with_entities(models.Form.id, models.Form.prefix, models.Form.form_type, events_forms.c.event_id)
+            .order_by(models.Form.id)
+        )
+
+        prefixes = defaultdict(list)
+        for form_id, prefix, form_type, event_id in query:
+            if prefix:
+                prefixes[prefix.lower()].append((form_id, form_type, event_id))
+
+        _form_index.update(prefixes=dict(prefixes), generation=generation)
+
+    return _form_index["prefixes"]
+
+
+def invalidate_form_index():
+    """Forces the form index to be rebuilt in every process."""
+    red.incr(FORM_INDEX_GENERATION_KEY)
+
+
+def _form_modified(mapper, connection, target):
+    Session.object_session(target).info["invalidate_form_index"] = True
+
+
+def _after_commit(session):
+    """Invalidates the form index once changes to forms are committed."""
+    if session.info.pop("invalidate_form_index", False):
+        invalidate_form_index()
 
-    form = query.with_entities(models.Form).first()
 
-    return form
+# the forms of an event can be changed from either side of the relationship
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    sa.event.listen(models.Form, _event_name, _form_modified)
+    sa.event.listen(models.Event, _event_name, _form_modified)
+sa.event.listen(Session, "after_commit", _after_commit)
@@ -6,6 +6,7 @@ from flask_babel import force_locale, gettext
 from werkzeug.datastructures import MultiDict
 
 from apollo import services
+from apollo.core import db
 from apollo.deployments.models import Event
 from apollo.formsframework.forms import build_questionnaire
 from apollo.messaging.forms import retrieve_form
@@ -205,3 +206,32 @@ def lookup_participant(message: str, sender: str, event: Event = None) -> Partic
         )
 
     return participant
+
+
+def update_datastore(inbound, outbound, submission, had_errors):
+    """Utility method to update inbound and outbound message objects."""
+    outbound.originating_message_id = inbound.id
+    models_to_save = [outbound]
+
+    if submission:
+        participant = submission.participant
+    else:
+        event = g.event
+        participant = lookup_participant(inbound.text, inbound.sender, event)
+
+    if participant:
+        inbound.submission = submission
+        inbound.participant = participant
+
+        outbound.participant = participant
+        outbound.submission = submission
+
+        if not had_errors:
+            participant.accurate_message_count += 1
+
+        participant.message_count += 1
+        models_to_save.append(participant)
+        models_to_save.append(inbound)
+
+    db.session.add_all(models_to_save)
+    db.session.commit()
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Queued processing of incoming text messages.
+
+When `MESSAGING_QUEUE_ENABLED` is set, the gateway views only append the
+incoming message to a Redis list and return, and Celery tasks process the
+queued messages and send the replies through the configured gateway.
+
+Messages are spread over several queues by participant id (or by sender
+number if the message doesn't contain one) and each queue is processed by
+a single task at a time, so the messages of a participant are processed in
+the order in which they were received.
+"""
+
+import json
+import logging
+import re
+import time
+import zlib
+
+from flask import current_app, g
+from prometheus_client import Gauge
+from redis.exceptions import LockError
+from sentry_sdk import capture_exception
+from unidecode import unidecode
+
+from apollo import services, settings
+from apollo.core import db, red
+from apollo.deployments.models import Event
+from apollo.messaging.utils import parse_text
+
+QUEUE_KEY = "messaging:inbound:{}"
+LOCK_KEY = "messaging:inbound:{}:lock"
+SCHEDULED_KEY = "messaging:inbound:{}:scheduled"
+
+logger = logging.getLogger(__name__)
+
+
+class QueuedMessage:
+    """Provides a queued message to `parse_message` in place of a gateway form."""
+
+    def __init__(self, message):
+        """Initializer."""
+        self.message = message
+
+    def get_message(self):
+        return self.message
+
+
+def queue_for(text, sender):
+    """Returns the queue an incoming message is added to."""
+    participant_id = parse_text(text)[1]
+    key = participant_id or re.sub(r"[^\d]", "", sender or "")
+
+    return zlib.crc32(key.encode("utf-8")) % settings.MESSAGING_QUEUE_COUNT
+
+
+def enqueue_message(message, event):
+    """Adds an incoming message to its queue and schedules its processing.
+
+    Args:
+        message: the message as returned by the `get_message` method of the
+            gateway forms.
+        event: the event that was current when the message was received.
+    """
+    queue = queue_for(message["text"], message["sender"])
+    payload = {
+        "sender": message["sender"],
+        "text": message["text"],
+        "timestamp": message["timestamp"],
+        "event": event.id,
+        "enqueued": time.time(),
+    }
+
+    red.rpush(QUEUE_KEY.format(queue), json.dumps(payload))
+    schedule_processing(queue)
+
+
+def schedule_processing(queue):
+    """Starts a task to process a queue unless one is already waiting to start."""
+    from apollo.messaging.tasks import process_queued_messages  # local to avoid circular import
+
+    if red.set(SCHEDULED_KEY.format(queue), 1, nx=True, ex=settings.MESSAGING_QUEUE_LOCK_TTL):
+        process_queued_messages.delay(queue)
+
+
+def process_queue(queue):
+    """Processes a batch of messages from the head of a queue.
+
+    Messages are only removed from the queue once they have been processed,
+    so the messages being processed when a worker stops are processed again.
+    """
+    # messages queued from now on need another task
+    red.delete(SCHEDULED_KEY.format(queue))
+
+    key = QUEUE_KEY.format(queue)
+    # the lock is released with its token, so that a task whose lock expired
+    # doesn't release the lock since taken by another task
+    lock = red.lock(LOCK_KEY.format(queue), timeout=settings.MESSAGING_QUEUE_LOCK_TTL)
+    if not lock.acquire(blocking=False):
+        # the task holding the lock checks the queue again once done
+        return 0
+
+    processed = 0
+    try:
+        while processed < settings.MESSAGING_QUEUE_BATCH_SIZE:
+            payload = red.lindex(key, 0)
+            if payload is None:
+                break
+
+            try:
+                process_message(json.loads(payload))
+            except Exception:
+                # drop the message instead of blocking the queue
+                db.session.rollback()
+                logger.exception("Error processing queued message")
+                capture_exception()
+
+            red.lpop(key)
+            processed += 1
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning("Lock of message queue %s expired before the batch was processed", queue)
+
+    if red.llen(key):
+        schedule_processing(queue)
+
+    return processed
+
+
+def process_message(payload):
+    """Processes a queued message the way the gateway views used to."""
+    from apollo.messaging.helpers import parse_message, update_datastore  # local to avoid circular import
+    from apollo.messaging.tasks import send_message  # local to avoid circular import
+
+    g.event = db.session.get(Event, payload["event"])
+    g.deployment = g.event.deployment
+    message = {key: payload[key] for key in ("sender", "text", "timestamp")}
+
+    reply, submission, had_errors = parse_message(QueuedMessage(message))
+    event = submission.event if submission else g.event
+
+    incoming = services.messages.log_message(
+        event=event,
+        sender=message["sender"],
+        text=message["text"],
+        direction="IN",
+        timestamp=message["timestamp"],
+    )
+    outgoing = services.messages.log_message(event=event, recipient=message["sender"], text=reply, direction="OUT")
+
+    update_datastore(incoming, outgoing, submission, had_errors)
+
+    if current_app.config.get("TRANSLITERATE_OUTPUT"):
+        reply = unidecode(reply)
+
+    # the reply was logged along with the incoming message
+    send_message.delay(event.id, reply, message["sender"], log=False)
+
+
+def queue_depth():
+    """Returns the number of queued messages."""
+    pipeline = red.pipeline()
+    for queue in range(settings.MESSAGING_QUEUE_COUNT):
+        pipeline.llen(QUEUE_KEY.format(queue))
+
+    return sum(pipeline.execute())
+
+
+def queue_lag():
+    """Returns the time in seconds the oldest queued message has been waiting."""
+    pipeline = red.pipeline()
+    for queue in range(settings.MESSAGING_QUEUE_COUNT):
+        pipeline.lindex(QUEUE_KEY.format(queue), 0)
+
+    enqueued = [json.loads(payload)["enqueued"] for payload in pipeline.execute() if payload is not None]
+    return time.time() - min(enqueued) if enqueued else 0
+
+
+Gauge("sms_queue_depth", "Number of incoming text messages waiting to be processed.").set_function(queue_depth)
+Gauge("sms_queue_lag_seconds", "Age of the oldest incoming text message waiting to be processed.").set_function(
+    queue_lag
+)
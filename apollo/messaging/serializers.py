@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import calendar
 import json
+from functools import partial
+from uuid import uuid4
 
-from apollo.dal.serializers import ArchiveSerializer
+from sqlalchemy.orm import selectinload
+
+from apollo.dal.serializers import YIELD_PER, ArchiveSerializer, from_timestamp
 from apollo.messaging.models import Message
 from apollo.participants.models import Participant
 from apollo.submissions.models import Submission
@@ -40,6 +44,7 @@ class MessageSerializer(object):
             raise TypeError('Object is not of type Message')
 
         return {
+            'uuid': obj.uuid.hex,
             'direction': obj.direction.code,
             'recipient': obj.recipient,
             'sender': obj.sender,
@@ -58,14 +63,43 @@ class MessageSerializer(object):
 
 
 class MessageArchiveSerializer(ArchiveSerializer):
-    def deserialize(self, zip_file):
-        return super().deserialize(zip_file)
+    def deserialize(self, zip_file, restore):
+        restore.load(
+            zip_file, 'messages.ndjson', 'message',
+            ('id', 'uuid', 'direction', 'recipient', 'sender', 'text',
+             'message_type', 'received', 'delivered', 'deployment_id',
+             'event_id', 'submission_id', 'participant_id',
+             'originating_message_id'),
+            partial(self.deserialize_message, restore), name='message')
+
+    def deserialize_message(self, restore, data, record_id):
+        # archives written before the uuids of messages were archived
+        # can't link replies to the messages they answer
+        return (
+            record_id, uuid4(), data['direction'], data['recipient'],
+            data['sender'], data['text'], data['message_type'],
+            from_timestamp(data['received']),
+            from_timestamp(data['delivered']), restore.deployment.id,
+            restore.event.id, restore.remap('submission', data['submission']),
+            restore.remap('participant', data['participant']),
+            restore.remap('message', data['originating_message']))
 
-    def serialize(self, event, zip_file):
-        with zip_file.open('messages.ndjson', 'w') as f:
+    def serialize(self, event, zip_file, progress=None):
+        # the related records are loaded for every batch of messages
+        query = Message.query.filter_by(event_id=event.id).options(
+            selectinload(Message.submission).load_only(Submission.uuid),
+            selectinload(Message.participant).load_only(Participant.uuid),
+            selectinload(Message.originating_message)).order_by(
+                Message.id).yield_per(YIELD_PER)
+
+        with zip_file.open('messages.ndjson', 'w', force_zip64=True) as f:
             serializer = MessageSerializer()
 
-            for message in event.messages:
+            for message in query:
                 data = serializer.serialize_one(message)
                 line = f'{json.dumps(data)}\n'
                 f.write(line.encode('utf-8'))
+
+                if progress is not None:
+                    progress.processed_records += 1
+                    progress.update()
@@ -5,26 +5,29 @@ from sentry_sdk import capture_exception, capture_message
 
 from apollo import models, services, settings
 from apollo.core import mail
+from apollo.messaging import ingestion
 from apollo.messaging.outgoing import gateway_factory
 
 
 @shared_task()
-def send_message(event, message, recipient, sender=""):
+def send_message(event, message, recipient, sender="", log=True):
     """Task for sending outgoing messages using the configured gateway.
 
     :param message: The string for the contents of the message to be sent
     :param recipient: The recipient of the text message
     :param sender: (Optional) The sender to set
+    :param log: (Optional) Whether to log the outgoing message
     """
     gateway = gateway_factory()
     if gateway:
-        services.messages.log_message(
-            event=models.Event.query.filter_by(id=event).one(),
-            recipient=recipient,
-            sender=sender,
-            text=message,
-            direction="OUT",
-        )
+        if log:
+            services.messages.log_message(
+                event=models.Event.query.filter_by(id=event).one(),
+                recipient=recipient,
+                sender=sender,
+                text=message,
+                direction="OUT",
+            )
         return gateway.send(message, recipient, sender)
 
 
@@ -39,6 +42,12 @@ def send_messages(event, message, recipients, sender=""):
         send_message.delay(event, message, recipients, sender)
 
 
+@shared_task()
+def process_queued_messages(queue):
+    """Process a batch of queued incoming messages."""
+    return ingestion.process_queue(queue)
+
+
 @shared_task()
 def send_email(subject, body, recipients, sender=None):
     """Send an outgoing email."""
@@ -7,9 +7,11 @@ import pytest
 from flask_babel import force_locale
 from mimesis import Generic
 from mimesis.locales import Locale
+from redis.exceptions import LockNotOwnedError
 
-from apollo import services
+from apollo import services, settings
 from apollo.formsframework.models import Form
+from apollo.messaging import ingestion, utils
 from apollo.messaging.helpers import lookup_participant
 from apollo.messaging.utils import get_unsent_codes, parse_responses, parse_text
 from apollo.testutils import fixtures
@@ -61,6 +63,71 @@ def test_leftover_processing(form):
     assert parse_responses("ZX1CV2EA135DBAAA3 THIS IS A TEST ", form)[1] == "ZX1CV2DBA THIS IS A TEST"
 
 
+def test_response_patterns_cache(form):
+    """Tests that response patterns are reused until the form changes."""
+    form.id = 1
+    form.version_identifier = "1"
+    patterns = utils._get_response_patterns(form)
+    assert utils._get_response_patterns(form) is patterns
+    assert parse_responses("AA1BA2", form)[0] == {"AA": "1", "BA": "2"}
+
+    form.version_identifier = "2"
+    form.data["groups"][0].fields.append(AttributeDict(tag="C", type="boolean"))
+    assert utils._get_response_patterns(form) is not patterns
+    assert parse_responses("AA1CBA2", form)[0] == {"AA": "1", "BA": "2", "C": 1}
+    assert (1, "1") not in utils._response_patterns
+
+
+def test_queue_for_participant():
+    """Tests that the messages of a participant are added to the same queue."""
+    assert ingestion.queue_for("XA123AA1", "+111") == ingestion.queue_for("XA123AB2@comment", "+222")
+    assert ingestion.queue_for("invalid", "+1 (111)") == ingestion.queue_for("message", "1111")
+    assert 0 <= ingestion.queue_for("XA123AA1", "+111") < settings.MESSAGING_QUEUE_COUNT
+
+
+def test_process_queue(mocker):
+    """Tests that a queue is processed under a lock released with its token."""
+    red = mocker.patch.object(ingestion, "red")
+    process_message = mocker.patch.object(ingestion, "process_message")
+    red.lindex.side_effect = ['{"text": "1"}', '{"text": "2"}', None]
+    red.llen.return_value = 0
+    lock = red.lock.return_value
+    lock.acquire.return_value = True
+
+    assert ingestion.process_queue(1) == 2
+    red.lock.assert_called_once_with(ingestion.LOCK_KEY.format(1), timeout=settings.MESSAGING_QUEUE_LOCK_TTL)
+    assert [call.args[0] for call in process_message.call_args_list] == [{"text": "1"}, {"text": "2"}]
+    assert red.lpop.call_count == 2
+    lock.release.assert_called_once_with()
+    red.delete.assert_called_once_with(ingestion.SCHEDULED_KEY.format(1))
+
+
+def test_process_locked_queue(mocker):
+    """Tests that a queue locked by another task is left alone."""
+    red = mocker.patch.object(ingestion, "red")
+    process_message = mocker.patch.object(ingestion, "process_message")
+    red.lock.return_value.acquire.return_value = False
+
+    assert ingestion.process_queue(1) == 0
+    process_message.assert_not_called()
+    red.lock.return_value.release.assert_not_called()
+
+
+def test_process_queue_expired_lock(mocker):
+    """Tests that a lock taken over by another task once expired is left to it."""
+    red = mocker.patch.object(ingestion, "red")
+    mocker.patch.object(ingestion, "process_message")
+    red.lindex.side_effect = ['{"text": "1"}', None]
+    red.llen.return_value = 0
+    lock = red.lock.return_value
+    lock.acquire.return_value = True
+    lock.release.side_effect = LockNotOwnedError
+
+    assert ingestion.process_queue(1) == 1
+    # the lock is only ever released through its token
+    red.delete.assert_called_once_with(ingestion.SCHEDULED_KEY.format(1))
+
+
 def test_partial_response(form):
     """Test partial response generation."""
     assert get_unsent_codes(form, ["AA", "BA"]) == ["Comment1"]
@@ -4,6 +4,18 @@ import re
 
 from unidecode import unidecode
 
+# regular expression for a valid text message
+MESSAGE_PATTERN = re.compile(
+    r'^(?P<prefix>[A-Z]+)(?P<participant_id>\d+)'
+    r'(?P<exclamation>!?)(?:X(?P<form_serial>\d+))?(?P<responses>[A-Z0-9\s]*)$',  # noqa
+    re.I | re.M)
+LINE_BREAK_PATTERN = re.compile(r'(\n|\r|\r\n)')
+DEFAULT_RESPONSE_PATTERN = re.compile(
+    r'(?P<tag>[A-Z]+)(?P<answer>\d+)', flags=re.I)
+
+# compiled response patterns keyed by form id and version
+_response_patterns = {}
+
 
 def parse_text(text):
     '''
@@ -34,11 +46,6 @@ def parse_text(text):
 
     prefix = participant_id = exclamation = form_serial = responses = comment = None  # noqa
     text = str(text)
-    # regular expression for a valid text message
-    pattern = re.compile(
-        r'^(?P<prefix>[A-Z]+)(?P<participant_id>\d+)'
-        r'(?P<exclamation>!?)(?:X(?P<form_serial>\d+))?(?P<responses>[A-Z0-9\s]*)$',  # noqa
-        re.I | re.M)
 
     at_position = text.find("@")
 
@@ -73,7 +80,7 @@ def parse_text(text):
     text = data_section_translated + comment_section
 
     at_position = text.find("@")
-    match = pattern.match(text[:at_position] if at_position != -1 else text)
+    match = MESSAGE_PATTERN.match(text[:at_position] if at_position != -1 else text)
 
     # if there's a match, then extract the required features
     if match:
@@ -101,48 +108,75 @@ def parse_responses(responses_text, form):
     defined in `form`: numeric fields are first matched, then boolean
     fields are.
     '''
-    fields = [fi for group in form.data['groups'] for fi in group['fields']
-              if fi['type'] != 'comment']
-    numeric_fields = [f['tag'] for f in fields if f['type'] != 'boolean']
-    boolean_fields = [f['tag'] for f in fields if f['type'] == 'boolean']
+    numeric_pattern, boolean_pattern = _get_response_patterns(form)
 
-    substrate = re.sub(r'(\n|\r|\r\n)', '', responses_text)
+    substrate = LINE_BREAK_PATTERN.sub('', responses_text)
     responses = OrderedDict()
     # process numeric fields first
-    pattern = re.compile(r'(?P<tag>{})(?P<answer>\d+)'.format(
-        '|'.join(numeric_fields)), flags=re.I)
     responses.update(
         ((r.group('tag').upper(), r.group('answer')) for r in
-            pattern.finditer(substrate)))
+            numeric_pattern.finditer(substrate)))
 
     # remove the found data
-    substrate = pattern.sub('', substrate)
+    substrate = numeric_pattern.sub('', substrate)
 
     # fix for bug where boolean_fields is an empty iterable
-    if not boolean_fields:
+    if boolean_pattern is None:
         return responses, substrate.strip()
 
     # next, process boolean fields
-    pattern2 = re.compile(r'(?P<tag>{})'.format('|'.join(boolean_fields)),
-                          flags=re.I)
     responses.update(
-        ((r.group('tag').upper(), 1) for r in pattern2.finditer(substrate)))
+        ((r.group('tag').upper(), 1) for r in
+            boolean_pattern.finditer(substrate)))
 
     # remove the found data
-    substrate = pattern2.sub('', substrate)
+    substrate = boolean_pattern.sub('', substrate)
 
     # finally, get any unknown tags
-    default_pattern = re.compile(r'(?P<tag>[A-Z]+)(?P<answer>\d+)', flags=re.I)
     responses.update(
         (r.group('tag').upper(), r.group('answer')) for r in
-        default_pattern.finditer(substrate))
+        DEFAULT_RESPONSE_PATTERN.finditer(substrate))
 
     # remove all assumed tags
-    substrate = default_pattern.sub('', substrate)
+    substrate = DEFAULT_RESPONSE_PATTERN.sub('', substrate)
 
     return responses, substrate.strip()
 
 
+def _compile_response_patterns(form):
+    fields = [fi for group in form.data['groups'] for fi in group['fields']
+              if fi['type'] != 'comment']
+    numeric_fields = [f['tag'] for f in fields if f['type'] != 'boolean']
+    boolean_fields = [f['tag'] for f in fields if f['type'] == 'boolean']
+
+    numeric_pattern = re.compile(r'(?P<tag>{})(?P<answer>\d+)'.format(
+        '|'.join(numeric_fields)), flags=re.I)
+    boolean_pattern = re.compile(r'(?P<tag>{})'.format(
+        '|'.join(boolean_fields)), flags=re.I) if boolean_fields else None
+
+    return numeric_pattern, boolean_pattern
+
+
+def _get_response_patterns(form):
+    '''
+    Returns the compiled numeric and boolean response patterns of a form.
+    The patterns are cached until the form version changes, except for
+    forms that have not been saved.
+    '''
+    if form.id is None:
+        return _compile_response_patterns(form)
+
+    key = (form.id, form.version_identifier)
+    patterns = _response_patterns.get(key)
+    if patterns is None:
+        patterns = _compile_response_patterns(form)
+        for stale_key in [k for k in _response_patterns if k[0] == form.id]:
+            _response_patterns.pop(stale_key, None)
+        _response_patterns[key] = patterns
+
+    return patterns
+
+
 def get_unsent_codes(form, response_keys):
     groups = [
         g.get('name') for g in form.data.get('groups')
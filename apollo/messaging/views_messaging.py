@@ -9,44 +9,16 @@ from werkzeug.datastructures import MultiDict
 
 from apollo import services
 
-from ..core import csrf, db
+from ..core import csrf
 from ..frontend import route
 from ..frontend.helpers import get_event
+from ..messaging import ingestion
 from ..messaging.forms import KannelForm, TelerivetForm
-from ..messaging.helpers import lookup_participant, parse_message
+from ..messaging.helpers import parse_message, update_datastore
 
 bp = Blueprint("messaging", __name__)
 
 
-def update_datastore(inbound, outbound, submission, had_errors):
-    """Utility method to update inbound and outbound message objects."""
-    outbound.originating_message_id = inbound.id
-    models_to_save = [outbound]
-
-    if submission:
-        participant = submission.participant
-    else:
-        event = g.event
-        participant = lookup_participant(inbound.text, inbound.sender, event)
-
-    if participant:
-        inbound.submission = submission
-        inbound.participant = participant
-
-        outbound.participant = participant
-        outbound.submission = submission
-
-        if not had_errors:
-            participant.accurate_message_count += 1
-
-        participant.message_count += 1
-        models_to_save.append(participant)
-        models_to_save.append(inbound)
-
-    db.session.add_all(models_to_save)
-    db.session.commit()
-
-
 @route(bp, "/messaging/kannel", methods=["GET"])
 def kannel_view():
     """View for handling inbound messages from Kannel."""
@@ -62,6 +34,13 @@ def kannel_view():
     if form.validate():
         msg = form.get_message()
 
+        if current_app.config.get("MESSAGING_QUEUE_ENABLED"):
+            # the reply is sent by the task that processes the message
+            ingestion.enqueue_message(msg, g.event)
+            response = make_response("")
+            response.mimetype = "text/plain"
+            return response
+
         reply, submission, had_errors = parse_message(form)
         event = submission.event if submission else get_event()
 
@@ -100,6 +79,13 @@ def telerivet_view():
     if form.validate():
         msg = form.get_message()
 
+        if current_app.config.get("MESSAGING_QUEUE_ENABLED"):
+            # the reply is sent by the task that processes the message
+            ingestion.enqueue_message(msg, g.event)
+            http_response = make_response(json.dumps({"messages": []}))
+            http_response.headers["Content-Type"] = "application/json; charset=utf-8"
+            return http_response
+
         response_text, submission, had_errors = parse_message(form)
         event = submission.event if submission else get_event()
 
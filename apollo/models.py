@@ -5,14 +5,18 @@ from apollo.formsframework.models import Form, events_forms # noqa
 from apollo.locations.models import (  # noqa
     LocationSet, LocationDataField, Location, LocationPath, LocationType,
     LocationTypePath, LocationGroup, locations_groups)
+from apollo.locations.ancestry import LocationAncestry  # noqa
 from apollo.messaging.models import Message  # noqa
 from apollo.participants.models import (  # noqa
     ParticipantSet, ParticipantDataField,
     Participant, ParticipantPartner, ParticipantRole, PhoneContact,
     ContactHistory, Sample, samples_participants)
+from apollo.participants.generation import participants_generation  # noqa
+from apollo.result_analysis.models import ResultAggregate  # noqa
 from apollo.submissions.models import (  # noqa
     Submission, SubmissionComment, SubmissionImageAttachment,
     SubmissionVersion)
+from apollo.submissions.generation import submissions_generation  # noqa
 from apollo.users.models import (  # noqa
     Role, User, UserUpload, role_resource_permissions, roles_permissions,
     roles_users, user_resource_permissions, users_permissions)
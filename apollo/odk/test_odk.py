@@ -1 +1,33 @@
 # -*- coding: utf-8 -*-
+from io import BytesIO
+
+import pytest
+from lxml import etree
+
+from apollo.odk.utils import read_submission
+
+
+def test_read_submission():
+    """Tests the fields and form version read from an ODK submission."""
+    source = BytesIO(
+        b'<?xml version="1.0"?>'
+        b'<data xmlns:orx="http://openrosa.org/xforms" orx:version="abc123">'
+        b"<form_id>4</form_id><AA>5</AA><AB/><AC>1 3</AC>"
+        b"<group><AA>9</AA></group><AA>7</AA>"
+        b"</data>"
+    )
+    version, fields = read_submission(source)
+
+    assert version == "abc123"
+    # only the first of repeated fields is read and nested fields are skipped
+    assert fields == {"form_id": "4", "AA": "5", "AB": None, "AC": "1 3", "group": None}
+
+
+def test_read_submission_errors():
+    """Tests that invalid submissions aren't read."""
+    version, fields = read_submission(BytesIO(b"<data><AA>5</AA></data>"))
+    assert version is None
+    assert "form_id" not in fields
+
+    with pytest.raises(etree.LxmlError):
+        read_submission(BytesIO(b"<data><AA>5</data>"))
@@ -7,8 +7,36 @@ from urllib.parse import urljoin
 
 import qrcode
 from flask import url_for
+from lxml import etree
 from PIL import Image
 
+ORX_VERSION = "{http://openrosa.org/xforms}version"
+
+
+def read_submission(source_file):
+    """Reads the fields of an ODK submission in a single pass.
+
+    Returns the form version the submission was made with and the text of
+    the fields of the submission by their tag. The elements are discarded
+    as they are read, so the whole document is never kept in memory.
+    """
+    version = None
+    fields = {}
+    path = []
+    for event, element in etree.iterparse(source_file, events=("start", "end"), resolve_entities=False):
+        if event == "start":
+            path.append(element.tag)
+            if element.tag == "data" and version is None:
+                version = element.get(ORX_VERSION)
+            continue
+
+        path.pop()
+        if path and path[-1] == "data":
+            fields.setdefault(etree.QName(element).localname, element.text)
+            element.clear()
+
+    return version, fields
+
 
 def make_message_text(form, participant, data, serial: str = None) -> str:
     """Generate message text from form data."""
@@ -3,6 +3,7 @@ from datetime import datetime
 from uuid import uuid4
 
 import pytz
+from depot.manager import DepotManager
 from flask import Blueprint, g, make_response, render_template, request
 from flask_babel import gettext as _
 from flask_httpauth import HTTPDigestAuth
@@ -17,6 +18,7 @@ from apollo.frontend import route
 from apollo.frontend.helpers import DictDiffer
 from apollo.odk import utils
 from apollo.services import messages
+from apollo.submissions.tasks import save_image_attachments
 from apollo.utils import current_timestamp
 
 HTTP_OPEN_ROSA_VERSION_HEADER = "HTTP_X_OPENROSA_VERSION"
@@ -84,7 +86,11 @@ def get_form_download_list():
     response = make_response(render_template(template_name, forms=forms))
     response.headers["Content-Type"] = "text/xml; charset=utf-8"
     response.headers.extend(make_open_rosa_headers())
-    return response
+
+    # the form hashes depend on the locale
+    response.vary.add("Accept-Language")
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @route(bp, "/xforms/xformsManifest/<form_id>")
@@ -96,20 +102,23 @@ def get_form_manifest(form_id):
     response = make_response(render_template(template_name))
     response.headers["Content-Type"] = "text/xml; charset=utf-8"
     response.headers.extend(make_open_rosa_headers())
-    return response
+    response.add_etag()
+    return response.make_conditional(request)
 
 
 @route(bp, "/xforms/forms/<form_id>/form.xml")
 def get_form(form_id):
     """Retrieve the form data."""
     form = services.forms.fget_or_404(id=form_id)
-    xform_data = etree.tostring(form.to_xml(), encoding="UTF-8", xml_declaration=True)
-    response = make_response(xform_data)
+    response = make_response(form.odk_xform())
     response.headers.extend(make_open_rosa_headers())
     response.headers["Content-Type"] = "text/xml; charset=utf-8"
     response.headers["Content-Disposition"] = "attachment; filename={}.xml".format(slugify(form.name))
 
-    return response
+    # the XForm labels depend on the locale
+    response.vary.add("Accept-Language")
+    response.set_etag(form.odk_digest())
+    return response.make_conditional(request)
 
 
 @csrf.exempt
@@ -127,10 +136,9 @@ def submission():
     source_file = request.files.get("xml_submission_file")
     form_serial = None
     try:
-        parser = etree.XMLParser(resolve_entities=False)
-        document = etree.parse(source_file, parser)
+        submitted_version_id, fields = utils.read_submission(source_file)
 
-        form_id = document.xpath("//data/form_id")[0].text
+        form_id = fields["form_id"]
         form = models.Form.query.filter_by(id=form_id).one()
 
         participant = filter_participants(form, participant_auth.username())
@@ -139,7 +147,7 @@ def submission():
 
         if not participant:
             return open_rosa_default_response(content=_("Invalid Participant ID"), status_code=404)
-    except (IndexError, etree.LxmlError, NoResultFound):
+    except (KeyError, etree.LxmlError, NoResultFound):
         return open_rosa_default_response(status_code=400)
 
     submission = None
@@ -149,8 +157,8 @@ def submission():
             participant=participant, form=form, submission_type="O", deployment=form.deployment
         ).first()
     elif form.form_type == "SURVEY":
-        try:
-            form_serial = document.xpath("//data/form_serial")[0].text
+        if "form_serial" in fields:
+            form_serial = fields["form_serial"]
             submission = models.Submission.query.filter_by(
                 participant=participant,
                 serial_no=form_serial,
@@ -158,7 +166,7 @@ def submission():
                 submission_type="O",
                 deployment=form.deployment,
             ).first()
-        except IndexError:
+        else:
             submission = None
     else:
         event = (
@@ -183,76 +191,58 @@ def submission():
         # no existing submission for that form and participant
         return open_rosa_default_response(content=_("Checklist Not Found"), status_code=404)
 
-    form_modified = False
-    submitted_version_id = None
+    form_modified = form.version_identifier != submitted_version_id
 
-    try:
-        submitted_version_id = document.xpath("//data/@orx:version", namespaces={"orx": "http://openrosa.org/xforms"})[
-            0
-        ]
-    except (IndexError, etree.LxmlError):
-        pass
-
-    if form.version_identifier != submitted_version_id:
-        form_modified = True
-
-    tag_finder = etree.XPath("//data/*[local-name() = $tag]")
     data = {}
     attachments = []
-    deleted_attachments = []
     geopoint_lat = None
     geopoint_lon = None
     for tag in form.tags:
         field = form.get_field_by_tag(tag)
         field_type = field.get("type")
-        try:
-            element = tag_finder(document, tag=tag)[0]
-        except IndexError:
+        if tag not in fields:
             # normally shouldn't happen, but the form might have been
             # modified
             form_modified = True
             continue
 
-        if element.text:
+        text = fields[tag]
+        if text:
             if field_type in ("comment", "string"):
-                data[tag] = element.text
+                data[tag] = text
             elif field_type == "multiselect":
                 try:
-                    data[tag] = sorted(int(i) for i in element.text.split())
+                    data[tag] = sorted(int(i) for i in text.split())
                 except ValueError:
                     continue
             elif field_type == "image":
-                original_field_data = submission.data.get(tag)
-                file_wrapper = request.files.get(element.text)
-                identifier = uuid4()
-
-                if file_wrapper.mimetype.startswith("image/"):
-                    if original_field_data is not None:
-                        original_attachment = models.SubmissionImageAttachment.query.filter_by(  # noqa
-                            uuid=original_field_data
-                        ).first()
-                        if original_attachment:
-                            deleted_attachments.append(original_attachment)
-                    if file_wrapper and file_wrapper.filename != "":
+                file_wrapper = request.files.get(text)
+
+                if file_wrapper and file_wrapper.mimetype.startswith("image/"):
+                    # the image is stored as it is and the attachment, along
+                    # with its thumbnail, is created in the background
+                    attachment = {"tag": tag, "replaces": submission.data.get(tag)}
+                    if file_wrapper.filename != "":
+                        identifier = uuid4()
                         data[tag] = identifier.hex
-                        attachments.append(
-                            models.SubmissionImageAttachment(photo=file_wrapper, submission=submission, uuid=identifier)
+                        attachment.update(
+                            uuid=identifier.hex,
+                            file_id=DepotManager.get().create(
+                                file_wrapper, file_wrapper.filename, file_wrapper.mimetype
+                            ),
                         )
+                    attachments.append(attachment)
             else:
                 try:
-                    data[tag] = int(element.text)
+                    data[tag] = int(text)
                 except ValueError:
                     continue
+
+    geodata = fields["location"].split() if fields.get("location") else []
     try:
-        element = tag_finder(document, tag="location")[0]
-        geodata = element.text.split() if element.text else []
-
-        try:
-            geopoint_lat = float(geodata[0])
-            geopoint_lon = float(geodata[1])
-        except (IndexError, ValueError):
-            pass
-    except IndexError:
+        geopoint_lat = float(geodata[0])
+        geopoint_lon = float(geodata[1])
+    except (IndexError, ValueError):
         pass
 
     submission.update_group_timestamps(data)
@@ -288,10 +278,9 @@ def submission():
         submission.extra_data = extra_data
 
     db.session.add(submission)
-    db.session.add_all(attachments)
-    for attachment in deleted_attachments:
-        db.session.delete(attachment)
     db.session.commit()
+    if attachments:
+        save_image_attachments.delay(submission.id, attachments)
     models.Submission.update_related(submission, data)
     update_submission_version(submission)
 
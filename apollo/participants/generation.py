@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Generation counter of the participants.
+
+Submission exports render the names, phone numbers and samples of the
+participants, which change without any of the exported submissions being
+updated. The counter in Redis is incremented once changes to participants,
+phone numbers or samples are committed, so that the exports rendered
+before are not served anymore. Imports that write the participants with
+SQL increment it themselves.
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from apollo.core import red
+from apollo.participants.models import Participant, PhoneContact, Sample
+
+PARTICIPANTS_GENERATION_KEY = "participants:generation"
+
+
+def participants_generation():
+    """Returns the current generation of the participants."""
+    return int(red.get(PARTICIPANTS_GENERATION_KEY) or 0)
+
+
+def invalidate_participants():
+    """Marks the participants as changed in every process."""
+    red.incr(PARTICIPANTS_GENERATION_KEY)
+
+
+def _participant_modified(mapper, connection, target):
+    Session.object_session(target).info["invalidate_participants"] = True
+
+
+def _after_commit(session):
+    """Invalidates the participants once changes to them are committed."""
+    if session.info.pop("invalidate_participants", False):
+        invalidate_participants()
+
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    sa.event.listen(Participant, _event_name, _participant_modified)
+    sa.event.listen(PhoneContact, _event_name, _participant_modified)
+    sa.event.listen(Sample, _event_name, _participant_modified)
+sa.event.listen(Session, "after_commit", _after_commit)
@@ -1,13 +1,17 @@
 # -*- coding: utf-8 -*-
 import json
+from functools import partial
+from uuid import UUID, uuid4
 
-from sqlalchemy import String, cast, func
+from sqlalchemy import Float, String, bindparam, cast, func
+from sqlalchemy.orm import lazyload, selectinload
 
-from apollo.dal.serializers import ArchiveSerializer
+from apollo.core import db
+from apollo.dal.serializers import YIELD_PER, ArchiveSerializer, from_timestamp, json_value
 from apollo.locations.models import Location, LocationSet
 from apollo.participants.models import (
     Participant, ParticipantDataField, ParticipantPartner, ParticipantRole,
-    ParticipantSet, PhoneContact)
+    ParticipantSet, PhoneContact, Sample, samples_participants)
 
 
 class ParticipantSerializer(object):
@@ -77,7 +81,9 @@ class ParticipantSerializer(object):
             'completion_rating': obj.completion_rating,
             'device_id': obj.device_id,
             'password': obj.password,
-            'extra_data': obj.extra_data
+            'extra_data': obj.extra_data,
+            'supervisor': obj.supervisor.uuid.hex if obj.supervisor else None,
+            'samples': [sample.name for sample in obj.samples],
         }
 
 
@@ -183,8 +189,137 @@ class ParticipantRoleSerializer(object):
 
 
 class ParticipantSetArchiveSerializer(ArchiveSerializer):
-    def deserialize(self, zip_file):
-        pass
+    def deserialize(self, zip_file, restore):
+        participant_sets = restore.add(
+            zip_file, 'participant_set.ndjson', 'participant_set',
+            partial(self.deserialize_participant_set, restore))
+        if not participant_sets:
+            return
+
+        # the participants are archived without their participant set
+        participant_set_id = participant_sets[0].id
+
+        restore.add(
+            zip_file, 'participant_data_fields.ndjson',
+            'participant_data_field',
+            partial(self.deserialize_extra_field, restore))
+        restore.add(
+            zip_file, 'participant_partners.ndjson', 'participant_partner',
+            partial(self.deserialize_partner, restore))
+        restore.add(
+            zip_file, 'participant_roles.ndjson', 'participant_role',
+            partial(self.deserialize_role, restore))
+        # the supervisors and samples refer to participants that may only
+        # be copied in a later batch, so they're added once all are copied
+        supervisors = []
+        samples = []
+        restore.load(
+            zip_file, 'participants.ndjson', 'participant',
+            ('id', 'uuid', 'full_name_translations', 'first_name_translations',
+             'other_names_translations', 'last_name_translations',
+             'participant_id', 'email', 'role_id', 'location_id',
+             'partner_id', 'gender', 'locale', 'message_count',
+             'accurate_message_count', 'completion_rating', 'device_id',
+             'password', 'extra_data', 'participant_set_id'),
+            partial(
+                self.deserialize_participant, restore, participant_set_id,
+                supervisors, samples),
+            name='participant')
+        self.restore_supervisors(restore, supervisors)
+        self.restore_samples(participant_set_id, samples)
+        restore.load(
+            zip_file, 'phone-contacts.ndjson', 'phone_contact',
+            ('uuid', 'participant_id', 'number', 'created', 'updated',
+             'verified'),
+            partial(self.deserialize_participant_phone, restore))
+
+    def deserialize_participant_set(self, restore, data):
+        return ParticipantSet(
+            name=data['name'], slug=data['slug'],
+            location_set_id=restore.remap(
+                'location_set', data['location_set']),
+            deployment_id=restore.deployment.id)
+
+    def deserialize_extra_field(self, restore, data):
+        return ParticipantDataField(
+            name=data['name'], label=data['label'],
+            visible_in_lists=data['visible_in_lists'],
+            participant_set_id=restore.remap(
+                'participant_set', data['participant_set']),
+            deployment_id=restore.deployment.id)
+
+    def deserialize_partner(self, restore, data):
+        return ParticipantPartner(
+            name=data['name'],
+            participant_set_id=restore.remap(
+                'participant_set', data['participant_set']))
+
+    def deserialize_role(self, restore, data):
+        return ParticipantRole(
+            name=data['name'],
+            participant_set_id=restore.remap(
+                'participant_set', data['participant_set']))
+
+    def deserialize_participant(
+            self, restore, participant_set_id, supervisors, samples, data,
+            record_id):
+        # archives written before supervisors and samples were archived
+        # have neither
+        if data.get('supervisor'):
+            supervisors.append((record_id, data['supervisor']))
+        samples.extend((record_id, name) for name in data.get('samples', []))
+
+        return (
+            record_id, uuid4(), json_value(data['full_name']),
+            json_value(data['first_name']), json_value(data['other_names']),
+            json_value(data['last_name']), data['participant_id'],
+            data['email'], restore.remap('participant_role', data['role']),
+            restore.remap('location', data['location']),
+            restore.remap('participant_partner', data['partner']),
+            data['gender'], data['locale'] or None, data['message_count'],
+            data['accurate_message_count'], data['completion_rating'],
+            data['device_id'], data['password'],
+            json_value(data['extra_data']), participant_set_id)
+
+    def restore_supervisors(self, restore, supervisors):
+        table = Participant.__table__
+        params = [
+            {'pk': record_id, 'supervisor': restore.remap('participant', uuid)}
+            for record_id, uuid in supervisors
+        ]
+        params = [param for param in params if param['supervisor']]
+        if params:
+            db.session.execute(
+                table.update().where(table.c.id == bindparam('pk')).values(
+                    supervisor_id=bindparam('supervisor')),
+                params)
+
+    def restore_samples(self, participant_set_id, samples):
+        if not samples:
+            return
+
+        names = sorted({name for record_id, name in samples})
+        sample_ids = dict(zip(names, db.session.execute(
+            Sample.__table__.insert().returning(
+                Sample.__table__.c.id, sort_by_parameter_order=True),
+            [
+                {'name': name, 'participant_set_id': participant_set_id}
+                for name in names
+            ]).scalars()))
+        db.session.execute(samples_participants.insert(), [
+            {'sample_id': sample_ids[name], 'participant_id': record_id}
+            for record_id, name in samples
+        ])
+
+    def deserialize_participant_phone(self, restore, data, record_id):
+        # the participant uuids of the phone numbers aren't hex encoded
+        participant_uuid, number, created, updated, verified = data
+
+        return (
+            uuid4(),
+            restore.remap('participant', UUID(participant_uuid).hex),
+            number, from_timestamp(created), from_timestamp(updated),
+            verified)
 
     def serialize(self, event, zip_file):
         participant_set = event.participant_set
@@ -195,7 +330,17 @@ class ParticipantSetArchiveSerializer(ArchiveSerializer):
             self.serialize_partners(participant_set.participant_partners,
                                     zip_file)
             self.serialize_roles(participant_set.participant_roles, zip_file)
-            self.serialize_participants(participant_set.participants, zip_file)
+
+            # phone numbers are exported separately and only the uuid of
+            # the location is exported
+            participants = participant_set.participants.options(
+                lazyload(Participant.phone_contacts),
+                selectinload(Participant.location).load_only(Location.uuid),
+                selectinload(Participant.supervisor).load_only(
+                    Participant.uuid),
+                selectinload(Participant.samples).load_only(Sample.name)
+            ).order_by(Participant.id).yield_per(YIELD_PER)
+            self.serialize_participants(participants, zip_file)
             self.serialize_participant_phones(participant_set, zip_file)
 
     def serialize_participant_set(self, obj, zip_file):
@@ -245,8 +390,8 @@ class ParticipantSetArchiveSerializer(ArchiveSerializer):
         query = participant_set.participants.join(
             PhoneContact).with_entities(
                 cast(Participant.uuid, String), PhoneContact.number,
-                func.extract('epoch', PhoneContact.created),
-                func.extract('epoch', PhoneContact.updated),
+                cast(func.extract('epoch', PhoneContact.created), Float),
+                cast(func.extract('epoch', PhoneContact.updated), Float),
                 PhoneContact.verified)
 
         with zip_file.open('phone-contacts.ndjson', 'w') as f:
@@ -7,6 +7,7 @@ from flask_babel import gettext as _
 
 from apollo import constants
 from apollo.dal.service import Service
+from apollo.locations.ancestry import get_ancestry
 from apollo.participants.models import Participant, ParticipantPartner, ParticipantRole, ParticipantSet, PhoneContact
 
 number_regex = re.compile("[^0-9]")
@@ -59,6 +60,7 @@ class ParticipantService(Service):
         yield output_buffer.getvalue()
         output_buffer.close()
 
+        ancestry = get_ancestry(location_set.id)
         for participant in query:
             phones = participant.phones
             if phones:
@@ -78,7 +80,7 @@ class ParticipantService(Service):
                 participant.location.code if participant.location else "",
             ]
 
-            name_path = participant.location.make_path() if participant.location else {}
+            name_path = ancestry.name_path(participant.location_id) or {}
             record.extend(name_path.get(lt.name, "") for lt in location_types)
 
             record.extend(
@@ -1,24 +1,55 @@
 # -*- coding: utf-8 -*-
+import csv
+import json
 import logging
 import numbers
 import os
 import random
 import string
+from datetime import timedelta
+from io import StringIO
 
 import pandas as pd
+import sqlalchemy as sa
 from celery import shared_task
 from flask import render_template_string
 from flask_babel import gettext as _
-from sqlalchemy.orm.exc import MultipleResultsFound, NoResultFound
 
 from apollo import helpers, services
 from apollo.core import db, uploads
+from apollo.helpers import TaskProgress
+from apollo.locations.models import Location
 from apollo.messaging.tasks import send_email
+from apollo.participants.generation import invalidate_participants
 from apollo.participants.models import Participant, Sample
+from apollo.result_analysis.models import ResultAggregate
+from apollo.utils import current_timestamp
 
 APPLICABLE_GENDERS = [s[0] for s in Participant.GENDER]
 logger = logging.getLogger(__name__)
 
+# the columns of the participant import staging table that are loaded
+# from the validated rows
+STAGING_COLUMNS = {
+    "participant_id": "VARCHAR",
+    "full_name": "JSONB",
+    "first_name": "JSONB",
+    "other_names": "JSONB",
+    "last_name": "JSONB",
+    "role": "VARCHAR",
+    "partner": "VARCHAR",
+    "location_id": "INTEGER",
+    "supervisor_id": "VARCHAR",
+    "supervisor_key": "VARCHAR",
+    "gender": "VARCHAR",
+    "email": "VARCHAR",
+    "password": "VARCHAR",
+    "locale": "VARCHAR",
+    "extra_data": "JSONB",
+    "phones": "JSONB",
+    "samples": "JSONB",
+}
+
 email_template = """
 Of {{ count }} records:
 - {{ successful_imports }} were successfully imported,
@@ -48,16 +79,6 @@ def _is_valid(item):
     return not pd.isnull(item) and item
 
 
-def create_partner(name, participant_set):
-    """Creates a participant partner."""
-    return services.participant_partners.create(name=name, participant_set_id=participant_set.id)
-
-
-def create_role(name, participant_set):
-    """Creates a participant role."""
-    return services.participant_roles.create(name=name, participant_set_id=participant_set.id)
-
-
 def generate_password(length):
     """Random password generation."""
     return "".join(
@@ -65,46 +86,22 @@ def generate_password(length):
     )
 
 
-def update_participants(dataframe, header_map, participant_set, task):
-    """Upserts participant information.
-
-    Given a Pandas `class`DataFrame that has participant information loaded,
-    create or update the participant database with the info contained therein.
+def _parse_participant_records(dataframe, header_map, participant_set, locales, location_map, progress):
+    """Validates the rows of a participant import.
 
-    The dataframe columns will have to be mapped to the data model attributes
-    via the `param header_map` argument, a dictionary with the following keys:
-        participant_id - the participant ID,
-        name - the participant's name
-        role - the participant's role. created if missing.
-        partner_org - the partner organization. created if missing.
-        location_id - the location code. if missing or not found,
-            is not set/updated.
-        supervisor_id - the participant's supervisor's ID. if not found on
-            loading the participant setting it is deferred.
-        gender - the participant's gender.
-        email - the participant's email.
-        password - the participant's password.
-        phone - a prefix for columns starting with this string that contain
-                numbers
+    Rows are checked in order and the errors and warnings are reported the
+    same way as when every row was saved separately. Valid rows are returned
+    as records ready to be loaded into the staging table, keyed by the
+    participant ID so that the last row for a participant takes effect.
     """
-    index = dataframe.index
-
-    unresolved_supervisors = set()
     errors = set()
     warnings = set()
+    records = {}
 
-    total_records = dataframe.shape[0]
-    processed_records = 0
-    error_records = 0
-    warning_records = 0
-    error_log = []
-
-    location_set = participant_set.location_set
-    locales = location_set.deployment.locale_codes
-    full_name_column_keys = [f"full_name_{locale}" for locale in locales]
-    first_name_column_keys = [f"first_name_{locale}" for locale in locales]
-    other_names_column_keys = [f"other_names_{locale}" for locale in locales]
-    last_name_column_keys = [f"last_name_{locale}" for locale in locales]
+    full_name_columns = [header_map.get(f"full_name_{locale}") for locale in locales]
+    first_name_columns = [header_map.get(f"first_name_{locale}") for locale in locales]
+    other_names_columns = [header_map.get(f"other_names_{locale}") for locale in locales]
+    last_name_columns = [header_map.get(f"last_name_{locale}") for locale in locales]
 
     # set up mappings
     PARTICIPANT_ID_COL = header_map["id"]
@@ -118,185 +115,114 @@ def update_participants(dataframe, header_map, participant_set, task):
     LOCALE_COL = header_map.get("locale")
     phone_columns = header_map.get("phone", [])
     sample_columns = header_map.get("sample", [])
-    full_name_columns = [header_map.get(col) for col in full_name_column_keys]
-    first_name_columns = [header_map.get(col) for col in first_name_column_keys]
-    other_names_columns = [header_map.get(col) for col in other_names_column_keys]
-    last_name_columns = [header_map.get(col) for col in last_name_column_keys]
 
     extra_field_names = [f.name for f in participant_set.extra_fields] if participant_set.extra_fields else []
+    timestamp = current_timestamp()
 
-    sample_map = {}
-    # clear existing samples
-    Sample.query.filter_by(participant_set_id=participant_set.id).delete()
-    db.session.commit()
+    def _translations(record, columns):
+        return {
+            locale: str(name).strip()
+            for locale, name in zip(locales, (record.get(c) for c in columns))
+            if _is_valid(name)
+        }
 
-    # and create new ones
-    if sample_columns:
-        sample_map.update({n: Sample(name=n, participant_set=participant_set) for n in sample_columns if _is_valid(n)})
-        db.session.add_all(sample_map.values())
-        db.session.commit()
-
-    for idx in index:
-        record = dataframe.iloc[idx]
+    for idx, record in zip(dataframe.index, dataframe.to_dict("records")):
         participant_id = record[PARTICIPANT_ID_COL]
         try:
             participant_id = int(participant_id)
         except (TypeError, ValueError):
             message = _("Invalid (non-numeric) participant ID (%(p_id)s)", p_id=participant_id)
             errors.add((participant_id, message))
-            error_records += 1
-            error_log.append({"label": "ERROR", "message": message})
+            progress.error(message)
             continue
         participant_id = str(participant_id)
 
-        participant = services.participants.find(participant_id=participant_id, participant_set=participant_set).first()
-
-        if participant is None:
-            participant = services.participants.new(
-                participant_id=participant_id, participant_set_id=participant_set.id
-            )
-
-        participant_full_names = [record.get(col) for col in full_name_columns]
-        if participant_full_names:
-            participant.full_name_translations = {
-                locale: str(name).strip() for locale, name in zip(locales, participant_full_names) if _is_valid(name)
-            }
-
-        participant_first_names = [record.get(col) for col in first_name_columns]
-        if participant_first_names:
-            participant.first_name_translations = {
-                locale: str(name).strip() for locale, name in zip(locales, participant_first_names) if _is_valid(name)
-            }
-
-        participant_other_names = [record.get(col) for col in other_names_columns]
-        if participant_other_names:
-            participant.other_names_translations = {
-                locale: str(name).strip() for locale, name in zip(locales, participant_other_names) if _is_valid(name)
-            }
-
-        participant_last_names = [record.get(col) for col in last_name_columns]
-        if participant_last_names:
-            participant.last_name_translations = {
-                locale: str(name).strip() for locale, name in zip(locales, participant_last_names) if _is_valid(name)
-            }
-
-        role = None
-        if ROLE_COL:
-            role_name = record[ROLE_COL]
-            if _is_valid(role_name):
-                role = services.participant_roles.find(name=role_name, participant_set=participant_set).first()
-                if role is None:
-                    role = create_role(role_name, participant_set)
-            participant.role = role
-
-        partner = None
-        if PARTNER_COL:
-            partner_name = record[PARTNER_COL]
-            if _is_valid(partner_name):
-                partner = services.participant_partners.find(name=partner_name, participant_set=participant_set).first()
-                if partner is None:
-                    partner = create_partner(partner_name, participant_set)
-                participant.partner = partner
-
-        location = None
-        try:
-            if LOCATION_ID_COL:
-                loc_code = record[LOCATION_ID_COL]
-                try:
-                    loc_code = int(loc_code)
-                except (TypeError, ValueError):
-                    message = _("Invalid (non-numeric) location ID (%(loc_id)s)", loc_id=loc_code)
-                    errors.add((participant_id, message))
-                    error_records += 1
-                    error_log.append({"label": "ERROR", "message": message})
-                    continue
-
-                location = services.locations.find(code=str(loc_code), location_set=location_set).one()
-        except MultipleResultsFound:
-            errors.add((participant_id, _("Invalid location id (%(loc_id)s)", loc_id=record[LOCATION_ID_COL])))
-            error_records += 1
-            error_log.append(
-                {
-                    "label": "ERROR",
-                    "message": _(
+        location_id = None
+        if LOCATION_ID_COL:
+            loc_code = record[LOCATION_ID_COL]
+            try:
+                loc_code = int(loc_code)
+            except (TypeError, ValueError):
+                message = _("Invalid (non-numeric) location ID (%(loc_id)s)", loc_id=loc_code)
+                errors.add((participant_id, message))
+                progress.error(message)
+                continue
+
+            location_count, location_id = location_map.get(str(loc_code), (0, None))
+            if location_count > 1:
+                errors.add((participant_id, _("Invalid location id (%(loc_id)s)", loc_id=record[LOCATION_ID_COL])))
+                progress.error(
+                    _(
                         "Location code %(loc_id)s for row %(row)d is not unique",
                         loc_id=record[LOCATION_ID_COL],
                         row=(idx + 1),
-                    ),
-                }
-            )
-            continue
-        except NoResultFound:
-            warnings.add((participant_id, _("Location with id %(loc_id)s not found", loc_id=record[LOCATION_ID_COL])))
-            warning_records += 1
-            error_log.append(
-                {
-                    "label": "WARNING",
-                    "message": _(
+                    )
+                )
+                continue
+            elif location_count == 0:
+                warnings.add(
+                    (participant_id, _("Location with id %(loc_id)s not found", loc_id=record[LOCATION_ID_COL]))
+                )
+                progress.warning(
+                    _(
                         "Location code %(loc_id)s for row %(row)d with " "participant ID %(part_id)s not found",
                         loc_id=record[LOCATION_ID_COL],
                         row=(idx + 1),
                         part_id=record[PARTICIPANT_ID_COL],
-                    ),
-                }
-            )
+                    )
+                )
 
-        if location:
-            participant.location = location
-
-        supervisor = None
-        if SUPERVISOR_ID_COL:
-            if _is_valid(record[SUPERVISOR_ID_COL]):
-                if record[SUPERVISOR_ID_COL] != participant_id:
-                    # ignore cases where participant is own supervisor
-                    supervisor_id = record[SUPERVISOR_ID_COL]
-                    if isinstance(supervisor_id, numbers.Number):
-                        supervisor_id = str(int(supervisor_id))
-                    supervisor = services.participants.find(
-                        participant_id=supervisor_id,
-                        participant_set=participant_set,
-                    ).first()
-                    if supervisor is None:
-                        # perhaps supervisor exists further along.
-                        # cache the refs
-                        unresolved_supervisors.add((participant_id, supervisor_id))
-                    else:
-                        participant.supervisor_id = supervisor.id
+        role = None
+        if ROLE_COL and _is_valid(record[ROLE_COL]):
+            role = str(record[ROLE_COL])
 
+        partner = None
+        if PARTNER_COL and _is_valid(record[PARTNER_COL]):
+            partner = str(record[PARTNER_COL])
+
+        supervisor_id = supervisor_key = None
+        if SUPERVISOR_ID_COL and _is_valid(record[SUPERVISOR_ID_COL]):
+            if record[SUPERVISOR_ID_COL] != participant_id:
+                # ignore cases where participant is own supervisor
+                supervisor_id = record[SUPERVISOR_ID_COL]
+                if isinstance(supervisor_id, numbers.Number):
+                    supervisor_id = str(int(supervisor_id))
+                supervisor_id = str(supervisor_id)
+
+                # the normalized ID is used if the supervisor isn't found
+                # with the ID as specified
+                try:
+                    supervisor_key = str(int(supervisor_id))
+                except (TypeError, ValueError):
+                    supervisor_key = None
+
+        gender = None
         if GENDER_COL:
             gender_spec = record[GENDER_COL]
-            if _is_valid(gender_spec) and gender_spec[:1].upper() in APPLICABLE_GENDERS:
-                participant.gender = gender_spec[:1].upper()
+            if _is_valid(gender_spec) and str(gender_spec)[:1].upper() in APPLICABLE_GENDERS:
+                gender = str(gender_spec)[:1].upper()
             else:
-                participant.gender = APPLICABLE_GENDERS[0]
+                gender = APPLICABLE_GENDERS[0]
 
-        if EMAIL_COL:
-            participant.email = record[EMAIL_COL] if _is_valid(record[EMAIL_COL]) else None
+        email = None
+        if EMAIL_COL and _is_valid(record[EMAIL_COL]):
+            email = str(record[EMAIL_COL])
 
-        if PASSWORD_COL:
-            participant.password = record[PASSWORD_COL] if _is_valid(record[PASSWORD_COL]) else generate_password(6)
+        if PASSWORD_COL and _is_valid(record[PASSWORD_COL]):
+            password = str(record[PASSWORD_COL])
         else:
-            participant.password = generate_password(6)
+            password = generate_password(6)
 
+        locale = None
         if LOCALE_COL:
-            locale = record[LOCALE_COL]
-            if _is_valid(locale) and str(locale).lower() in locales:
-                participant.locale = locale
-
-        # save if this is a new participant - we need an id for lookup
-        if not participant.id:
-            participant.save()
+            if _is_valid(record[LOCALE_COL]) and str(record[LOCALE_COL]).lower() in locales:
+                locale = record[LOCALE_COL]
 
+        phones = None
         if phone_columns:
-            # If this is an update for the participant, we should clear
-            # the current list of phone numbers and then recreate them
-            if participant.id:
-                participant.phone_contacts = []
-                db.session.commit()
-
-            # check if the phone number is on record
-            # import phone numbers in reverse order so the first is the latest
-            for column in reversed(phone_columns):
+            # the first phone number is the latest
+            phones = []
+            for column in phone_columns:
                 if not _is_valid(record[column]):
                     continue
 
@@ -305,28 +231,22 @@ def update_participants(dataframe, header_map, participant_set, task):
                     mobile = int(mobile)
                 mobile_num = str(mobile)
 
-                phone = services.phone_contacts.lookup(mobile_num, participant)
-                if not phone:
-                    phone = services.phone_contacts.create(
-                        number=mobile_num, participant_id=participant.id, verified=True
-                    )
+                if mobile_num not in (phone["number"] for phone in phones):
+                    updated = timestamp - timedelta(microseconds=len(phones))
+                    phones.append({"number": mobile_num, "updated": updated.isoformat()})
 
-        if sample_columns:
-            for column in sample_columns:
-                if not _is_valid(record[column]):
-                    continue
+        samples = []
+        for column in sample_columns:
+            if not _is_valid(record[column]):
+                continue
 
-                sample = sample_map.get(column)
-                if sample is None:
+            try:
+                value = int(record[column])
+                if value == 0:
                     continue
-
-                try:
-                    value = int(record[column])
-                    if value == 0:
-                        continue
-                except ValueError:
-                    continue
-                participant.samples.append(sample)
+            except (TypeError, ValueError):
+                continue
+            samples.append(column)
 
         # sort out any extra fields
         extra_data = {}
@@ -339,67 +259,340 @@ def update_participants(dataframe, header_map, participant_set, task):
                         value = int(value)
                     extra_data[field_name] = value
 
-        # finally done with first pass
-        participant.save()
-        processed_records += 1
-
-        # if we have extra data, update the participant
-        if extra_data:
-            services.participants.find(id=participant.id).update({"extra_data": extra_data}, synchronize_session=False)
-
-        task.update_state(
-            state="PROGRESS",
-            meta={
-                "total_records": total_records,
-                "error_records": error_records,
-                "processed_records": processed_records,
-                "warning_records": warning_records,
-                "error_log": error_log,
-            },
+        records[participant_id] = {
+            "participant_id": participant_id,
+            "full_name": _translations(record, full_name_columns),
+            "first_name": _translations(record, first_name_columns),
+            "other_names": _translations(record, other_names_columns),
+            "last_name": _translations(record, last_name_columns),
+            "role": role,
+            "partner": partner,
+            "location_id": location_id,
+            "supervisor_id": supervisor_id,
+            "supervisor_key": supervisor_key,
+            "gender": gender,
+            "email": email,
+            "password": password,
+            "locale": locale,
+            "extra_data": extra_data or None,
+            "phones": phones,
+            "samples": samples,
+        }
+
+        progress.processed_records += 1
+        progress.update()
+
+    return records, errors, warnings
+
+
+def _load_staging_table(records):
+    """Loads the participant records into the import staging table with COPY."""
+    columns = list(STAGING_COLUMNS)
+    db.session.execute(
+        sa.text(
+            f"""
+            CREATE TEMPORARY TABLE participant_import (
+                {", ".join(f"{name} {column_type}" for name, column_type in STAGING_COLUMNS.items())},
+                id INTEGER,
+                role_id INTEGER,
+                partner_id INTEGER,
+                supervisor INTEGER
+            ) ON COMMIT DROP
+            """
+        )
+    )
+
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for record in records:
+        writer.writerow(
+            [
+                json.dumps(record[name], default=str)
+                if STAGING_COLUMNS[name] == "JSONB" and record[name] is not None
+                else record[name]
+                for name in columns
+            ]
         )
+    buffer.seek(0)
 
-    # second pass - resolve missing supervisor references
-    for participant_id, supervisor_id in unresolved_supervisors:
-        try:
-            participant_id = str(int(participant_id))
-            supervisor_id = str(int(supervisor_id))
-        except (TypeError, ValueError):
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert(f"COPY participant_import ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer)
+    db.session.execute(sa.text("ANALYZE participant_import"))
+
+
+def _upsert_participants(header_map, participant_set):
+    """Creates or updates the participants in the staging table."""
+    params = {"participant_set_id": participant_set.id}
+
+    # create the missing roles and partners, and look them up
+    for column, table in (("role", "participant_role"), ("partner", "participant_partner")):
+        if not header_map.get(column):
             continue
 
-        participant = services.participants.find(participant_id=participant_id, participant_set=participant_set).first()
-        supervisor = services.participants.find(
-            participant_id=supervisor_id,
-            participant_set=participant_set,
-        ).first()
-
-        if supervisor is None:
-            participant.delete()
-            errors.add((participant_id, _("Supervisor with ID %(id)s not found", id=supervisor_id)))
-            processed_records -= 1
-            error_records += 1
-            error_log.append(
-                {
-                    "label": "ERROR",
-                    "message": _(
+        db.session.execute(
+            sa.text(
+                f"""
+                INSERT INTO {table} (name, participant_set_id)
+                SELECT DISTINCT s.{column}, :participant_set_id FROM participant_import s
+                WHERE s.{column} IS NOT NULL AND NOT EXISTS (
+                    SELECT 1 FROM {table} t
+                    WHERE t.participant_set_id = :participant_set_id AND t.name = s.{column}
+                )
+                """
+            ),
+            params,
+        )
+        db.session.execute(
+            sa.text(
+                f"""
+                UPDATE participant_import s SET {column}_id = t.id
+                FROM (
+                    SELECT name, min(id) AS id FROM {table}
+                    WHERE participant_set_id = :participant_set_id GROUP BY name
+                ) t
+                WHERE t.name = s.{column}
+                """
+            ),
+            params,
+        )
+
+    # the columns that are updated, with the values for existing participants
+    # and new participants respectively
+    values = {
+        "full_name_translations": ("s.full_name", "s.full_name"),
+        "first_name_translations": ("s.first_name", "s.first_name"),
+        "other_names_translations": ("s.other_names", "s.other_names"),
+        "last_name_translations": ("s.last_name", "s.last_name"),
+        "password": ("s.password", "s.password"),
+        "location_id": ("COALESCE(s.location_id, p.location_id)", "s.location_id"),
+        "locale": ("COALESCE(s.locale, p.locale)", "s.locale"),
+        "extra_data": ("COALESCE(s.extra_data, p.extra_data)", "s.extra_data"),
+    }
+    if header_map.get("role"):
+        values["role_id"] = ("s.role_id", "s.role_id")
+    if header_map.get("partner"):
+        values["partner_id"] = ("COALESCE(s.partner_id, p.partner_id)", "s.partner_id")
+    if header_map.get("gender"):
+        values["gender"] = ("s.gender", "s.gender")
+    if header_map.get("email"):
+        values["email"] = ("s.email", "s.email")
+
+    _resolve_participants(params)
+    db.session.execute(
+        sa.text(
+            f"""
+            UPDATE participant p SET {", ".join(f"{name} = {existing}" for name, (existing, new) in values.items())}
+            FROM participant_import s WHERE p.id = s.id
+            """
+        ),
+        params,
+    )
+    db.session.execute(
+        sa.text(
+            f"""
+            INSERT INTO participant (
+                participant_set_id, participant_id, message_count, accurate_message_count, completion_rating,
+                {", ".join(values)}
+            )
+            SELECT :participant_set_id, s.participant_id, 0, 0, 1, {", ".join(new for existing, new in values.values())}
+            FROM participant_import s WHERE s.id IS NULL
+            """
+        ),
+        params,
+    )
+    _resolve_participants(params)
+
+
+def _resolve_participants(params):
+    db.session.execute(
+        sa.text(
+            """
+            UPDATE participant_import s SET id = p.id
+            FROM (
+                SELECT participant_id, min(id) AS id FROM participant
+                WHERE participant_set_id = :participant_set_id GROUP BY participant_id
+            ) p
+            WHERE s.id IS NULL AND p.participant_id = s.participant_id
+            """
+        ),
+        params,
+    )
+
+
+def _update_supervisors(participant_set):
+    """Sets the supervisors of the imported participants.
+
+    Returns the participant and supervisor IDs of the participants whose
+    supervisor could not be found. These participants are deleted.
+    """
+    params = {"participant_set_id": participant_set.id}
+    for column in ("supervisor_id", "supervisor_key"):
+        db.session.execute(
+            sa.text(
+                f"""
+                UPDATE participant_import s SET supervisor = p.id
+                FROM (
+                    SELECT participant_id, min(id) AS id FROM participant
+                    WHERE participant_set_id = :participant_set_id GROUP BY participant_id
+                ) p
+                WHERE s.supervisor IS NULL AND p.participant_id = s.{column}
+                """
+            ),
+            params,
+        )
+
+    db.session.execute(
+        sa.text(
+            """
+            UPDATE participant p SET supervisor_id = s.supervisor
+            FROM participant_import s WHERE p.id = s.id AND s.supervisor IS NOT NULL
+            """
+        )
+    )
+    missing = db.session.execute(
+        sa.text(
+            """
+            DELETE FROM participant_import s
+            WHERE s.supervisor IS NULL AND s.supervisor_key IS NOT NULL
+            RETURNING s.id, s.participant_id, s.supervisor_key
+            """
+        )
+    ).all()
+    if missing:
+        Participant.query.filter(Participant.id.in_([pk for pk, participant_id, supervisor_id in missing])).delete(
+            synchronize_session=False
+        )
+
+    return [(participant_id, supervisor_id) for pk, participant_id, supervisor_id in missing]
+
+
+def _update_phones_and_samples(header_map, participant_set):
+    """Replaces the phone numbers and adds the sample memberships of the imported participants."""
+    if header_map.get("phone"):
+        # phone numbers are replaced by the ones in the import
+        db.session.execute(
+            sa.text(
+                """
+                DELETE FROM phone_contact
+                WHERE participant_id IN (SELECT id FROM participant_import WHERE phones IS NOT NULL)
+                """
+            )
+        )
+        db.session.execute(
+            sa.text(
+                """
+                INSERT INTO phone_contact (participant_id, number, created, updated, verified)
+                SELECT s.id, phone->>'number', (phone->>'updated')::timestamp, (phone->>'updated')::timestamp, true
+                FROM participant_import s CROSS JOIN jsonb_array_elements(s.phones) AS phone
+                """
+            )
+        )
+
+    if header_map.get("sample"):
+        db.session.execute(
+            sa.text(
+                """
+                INSERT INTO samples_participants (sample_id, participant_id)
+                SELECT sample.id, s.id
+                FROM participant_import s
+                CROSS JOIN jsonb_array_elements_text(s.samples) AS sample_name
+                JOIN sample ON sample.name = sample_name AND sample.participant_set_id = :participant_set_id
+                ON CONFLICT DO NOTHING
+                """
+            ),
+            {"participant_set_id": participant_set.id},
+        )
+
+
+def update_participants(dataframe, header_map, participant_set, task):
+    """Upserts participant information.
+
+    Given a Pandas `class`DataFrame that has participant information loaded,
+    create or update the participant database with the info contained therein.
+
+    The dataframe columns will have to be mapped to the data model attributes
+    via the `param header_map` argument, a dictionary with the following keys:
+        participant_id - the participant ID,
+        name - the participant's name
+        role - the participant's role. created if missing.
+        partner_org - the partner organization. created if missing.
+        location_id - the location code. if missing or not found,
+            is not set/updated.
+        supervisor_id - the participant's supervisor's ID. if not found on
+            loading the participant setting it is deferred.
+        gender - the participant's gender.
+        email - the participant's email.
+        password - the participant's password.
+        phone - a prefix for columns starting with this string that contain
+                numbers
+
+    The rows are validated first, then the valid rows are copied into a
+    staging table from which the participants, phone numbers and samples
+    are updated with a few set-based statements in a single transaction.
+    """
+    progress = TaskProgress(task, dataframe.shape[0])
+    progress.update(force=True)
+
+    location_set = participant_set.location_set
+    locales = location_set.deployment.locale_codes
+    sample_columns = header_map.get("sample", [])
+
+    # clear existing samples
+    Sample.query.filter_by(participant_set_id=participant_set.id).delete()
+
+    # and create new ones
+    if sample_columns:
+        db.session.add_all([Sample(name=n, participant_set=participant_set) for n in sample_columns if _is_valid(n)])
+    db.session.commit()
+
+    # look up all the location codes in the import at once
+    location_map = {}
+    LOCATION_ID_COL = header_map.get("location")
+    if LOCATION_ID_COL:
+        location_codes = set()
+        for loc_code in dataframe[LOCATION_ID_COL]:
+            try:
+                location_codes.add(str(int(loc_code)))
+            except (TypeError, ValueError):
+                continue
+
+        location_map = {
+            code: (count, location_id)
+            for code, count, location_id in db.session.query(
+                Location.code, sa.func.count(Location.id), sa.func.min(Location.id)
+            )
+            .filter(Location.location_set_id == location_set.id, Location.code.in_(location_codes))
+            .group_by(Location.code)
+        }
+
+    records, errors, warnings = _parse_participant_records(
+        dataframe, header_map, participant_set, locales, location_map, progress
+    )
+
+    if records:
+        _load_staging_table(records.values())
+        _upsert_participants(header_map, participant_set)
+
+        if header_map.get("supervisor"):
+            for participant_id, supervisor_id in _update_supervisors(participant_set):
+                errors.add((participant_id, _("Supervisor with ID %(id)s not found", id=supervisor_id)))
+                progress.processed_records -= 1
+                progress.error(
+                    _(
                         "Supervisor ID %(sup_id)s specified for " "participant ID %(part_id)s not found",
                         sup_id=supervisor_id,
                         part_id=participant_id,
-                    ),
-                }
-            )
-            task.update_state(
-                state="PROGRESS",
-                meta={
-                    "total_records": total_records,
-                    "error_records": error_records,
-                    "processed_records": processed_records,
-                    "warning_records": warning_records,
-                    "error_log": error_log,
-                },
-            )
-        else:
-            participant.supervisor_id = supervisor.id
-            participant.save()
+                    )
+                )
+
+        _update_phones_and_samples(header_map, participant_set)
+        db.session.commit()
+        invalidate_participants()
+
+        # removed participants take their checklists with them
+        ResultAggregate.invalidate(participant_set.location_set_id)
+
+    progress.update(force=True)
 
     return dataframe.shape[0], errors, warnings
 
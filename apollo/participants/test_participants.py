@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pandas as pd
+
+from apollo.core import db
+from apollo.deployments.models import Deployment
+from apollo.locations.models import Location, LocationSet, LocationType
+from apollo.participants.models import Participant, ParticipantSet, PhoneContact
+from apollo.participants.tasks import _parse_participant_records, update_participants
+from apollo.testutils.imports import parse_records
+
+HEADER_MAP = {
+    "id": "ID",
+    "full_name_en": "NAME",
+    "location": "LOCATION",
+    "supervisor": "SUPERVISOR",
+    "gender": "GENDER",
+    "phone": ["PHONE1", "PHONE2"],
+    "sample": ["SAMPLE"],
+}
+
+
+def _parse(dataframe):
+    location_map = {"100": (1, 1), "200": (2, 2)}
+
+    return parse_records(_parse_participant_records, dataframe, HEADER_MAP, ParticipantSet(), ["en"], location_map)
+
+
+def test_participant_import_errors():
+    """Tests that invalid rows are reported and skipped."""
+    dataframe = pd.DataFrame(
+        {
+            "ID": ["1001", "abc", "1002", "1003", "1004"],
+            "NAME": ["One", "Two", "Three", "Four", "Five"],
+            "LOCATION": [100, 100, "xyz", 200, 300],
+            "SUPERVISOR": [np.nan] * 5,
+            "GENDER": ["f", "M", "F", "M", np.nan],
+            "PHONE1": [np.nan] * 5,
+            "PHONE2": [np.nan] * 5,
+            "SAMPLE": [0] * 5,
+        }
+    )
+    records, errors, warnings, progress = _parse(dataframe)
+
+    assert sorted(records) == ["1001", "1004"]
+    assert records["1001"]["location_id"] == 1
+    assert records["1001"]["gender"] == "F"
+    assert records["1004"]["location_id"] is None
+    assert records["1004"]["gender"] == ""
+    assert len(errors) == 3
+    assert len(warnings) == 1
+    assert [entry["label"] for entry in progress.error_log] == ["ERROR", "ERROR", "ERROR", "WARNING"]
+    assert progress.error_log[2]["message"] == "Location code 200 for row 4 is not unique"
+    assert progress.processed_records == 2
+
+
+def test_participant_import_records():
+    """Tests the records loaded for valid rows."""
+    dataframe = pd.DataFrame(
+        {
+            "ID": [1001, 1002, 1001],
+            "NAME": [" One ", "Two", "Three"],
+            "LOCATION": [100, 100, 100],
+            "SUPERVISOR": [1002.0, "007", np.nan],
+            "GENDER": ["F", "M", "M"],
+            "PHONE1": [5551234.0, "555-0000", np.nan],
+            "PHONE2": [5559999.0, "555-0000", 5557777],
+            "SAMPLE": [1, 0, 1],
+        }
+    )
+    records, errors, warnings, progress = _parse(dataframe)
+
+    # the last row for a participant takes effect
+    assert records["1001"]["full_name"] == {"en": "Three"}
+    assert records["1001"]["supervisor_id"] is None
+    assert [phone["number"] for phone in records["1001"]["phones"]] == ["5557777"]
+    assert records["1001"]["samples"] == ["SAMPLE"]
+
+    assert records["1002"]["supervisor_id"] == "007"
+    assert records["1002"]["supervisor_key"] == "7"
+    assert [phone["number"] for phone in records["1002"]["phones"]] == ["555-0000"]
+    assert records["1002"]["samples"] == []
+    assert not errors and not warnings
+    assert progress.processed_records == 3
+
+    # the first phone number is the most recently updated
+    phones, _, _, _ = _parse(dataframe.iloc[:1])
+    assert [phone["number"] for phone in phones["1001"]["phones"]] == ["5551234", "5559999"]
+    assert phones["1001"]["phones"][0]["updated"] > phones["1001"]["phones"][1]["updated"]
+
+
+def test_participant_import_update(app):
+    """Tests that an import updates the existing participants and resolves the supervisors after the upsert."""
+    deployment = Deployment(name="Participants", hostnames=["participants"], primary_locale="en")
+    location_set = LocationSet(name="Locations", deployment=deployment)
+    location = Location(
+        name_translations={"en": "Station"},
+        code="100",
+        location_type=LocationType(name_translations={"en": "Station"}, location_set=location_set),
+        location_set=location_set,
+    )
+    participant_set = ParticipantSet(name="Observers", deployment=deployment, location_set=location_set)
+    existing = Participant(
+        participant_id="1001",
+        full_name_translations={"en": "Old"},
+        location=location,
+        participant_set=participant_set,
+        phone_contacts=[PhoneContact(number="5550000", verified=True)],
+    )
+    supervisor = Participant(
+        participant_id="1005", full_name_translations={"en": "Five"}, participant_set=participant_set
+    )
+    db.session.add_all([existing, supervisor])
+    db.session.commit()
+    existing_id = existing.id
+
+    dataframe = pd.DataFrame(
+        {
+            "ID": ["1001", "1002", "1003"],
+            "NAME": ["One", "Two", "Three"],
+            "LOCATION": [300, 100, 100],
+            # the supervisor of 1001 is only created by the import itself
+            "SUPERVISOR": ["1003", "9999", 1005.0],
+            "GENDER": ["F", "M", "M"],
+            "PHONE1": [5551111, 5552222, 5553333],
+            "PHONE2": [np.nan, np.nan, 5553333],
+            "SAMPLE": [1, 1, 0],
+        }
+    )
+    count, errors, warnings = update_participants(dataframe, HEADER_MAP, participant_set, None)
+    db.session.expire_all()
+
+    participants = {
+        participant.participant_id: participant
+        for participant in Participant.query.filter_by(participant_set_id=participant_set.id)
+    }
+    assert sorted(participants) == ["1001", "1003", "1005"]
+    assert count == 3
+    assert [participant_id for participant_id, message in errors] == ["1002"]
+    assert [participant_id for participant_id, message in warnings] == ["1001"]
+
+    # the existing participant is updated in place and keeps its location
+    # when the location in the import is not found
+    assert participants["1001"].id == existing_id
+    assert participants["1001"].full_name_translations == {"en": "One"}
+    assert participants["1001"].location_id == location.id
+    assert participants["1001"].supervisor_id == participants["1003"].id
+    assert participants["1003"].supervisor_id == participants["1005"].id
+
+    # the phone numbers are replaced and the sample memberships are added
+    assert [contact.number for contact in participants["1001"].phone_contacts] == ["5551111"]
+    assert [contact.number for contact in participants["1003"].phone_contacts] == ["5553333"]
+    assert [sample.name for sample in participants["1001"].samples] == ["SAMPLE"]
+    assert participants["1003"].samples == []
+    assert participants["1005"].phone_contacts == []
@@ -25,7 +25,178 @@ def percent_of(a, b):
     return float(100 * float(a) / b)
 
 
-def generate_mean_stats(tag, dataset, null_value=None):
+def _percent(a, b):
+    '''Vectorized version of `percent_of` for arrays of counts'''
+    a = np.asarray(a, dtype=np.float64)
+    b = np.asarray(b, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        result = 100 * a / b
+    return np.where((b == 0) | np.isnan(a), 0.0, result)
+
+
+def _group_keys(dataset):
+    '''Returns the column a grouped dataset is grouped by'''
+    return dataset.obj[dataset.keys]
+
+
+def _grouped_values(dataset, tag):
+    '''Returns the values of a tag in every row that belongs to a group'''
+    return dataset.obj[tag][_group_keys(dataset).notna()]
+
+
+def _histogram_options(values, options):
+    '''Returns the options of a histogram, which are the configured
+    options together with every value that was reported'''
+    options_generated = set(options)
+    options_generated.update(values.dropna().unique().astype(int))
+    return options_generated
+
+
+def _grouped_location_stats(specs, dataset):
+    '''Computes the per-group statistics of several form fields at once.
+
+    Instead of computing the statistics separately for each group and each
+    field, the counts for all fields are computed in a single grouped
+    aggregation and the histograms for all fields in a single grouped count
+    over the stacked values, so the cost no longer grows with the number
+    of groups times the number of fields.
+
+    Parameters
+    - specs: an iterable of dictionaries describing the statistics for a
+    field, with the keys `tag`, `kind` (one of "mean", "count", "histogram",
+    "multiselect" or "bucket"), `null_value` and, depending on the kind,
+    `options` or `target`
+    - dataset: a pandas group series with the submission data
+
+    Returns
+    - a dictionary mapping each tag to a dictionary of the statistics for
+    every group, in the same structure as the `locations` entry of the
+    individual statistics functions'''
+    specs = list(specs)
+    frame = dataset.obj
+    keys = _group_keys(dataset)
+    totals = dataset.size()
+
+    values = {}
+    not_available = {}
+    histogram_values = []
+    histogram_tags = set()
+    for spec in specs:
+        tag = spec['tag']
+        null_value = spec.get('null_value')
+        column = frame[tag]
+
+        if spec['kind'] == 'multiselect':
+            column = column.apply(_replace_empty_lists)
+            histogram_values.append((tag, column.dropna().explode()))
+            null_value = None
+        elif spec['kind'] == 'histogram':
+            subset = column if null_value is None else \
+                column[column != null_value]
+            histogram_values.append((tag, subset.dropna().astype(int)))
+        elif spec['kind'] == 'bucket':
+            subset = column if null_value is None else \
+                column[column != null_value]
+            histogram_values.append(
+                (tag, np.sign(subset.dropna() - spec['target']).astype(int)))
+
+        values[tag] = column.notna()
+        not_available[tag] = column.eq(null_value) \
+            if null_value is not None else False
+
+    counts = pd.concat({
+        'reported': pd.DataFrame(values, index=frame.index),
+        'not_available': pd.DataFrame(not_available, index=frame.index),
+    }, axis=1).groupby(keys).sum().reindex(totals.index, fill_value=0)
+
+    mean_tags = [spec['tag'] for spec in specs if spec['kind'] == 'mean']
+    if mean_tags:
+        means = pd.DataFrame({
+            spec['tag']: frame[spec['tag']]
+            if spec.get('null_value') is None
+            else frame[spec['tag']].where(
+                frame[spec['tag']] != spec['null_value'])
+            for spec in specs if spec['kind'] == 'mean'
+        }, index=frame.index).groupby(keys).mean().reindex(
+            totals.index).fillna(0.0)
+
+    if histogram_values:
+        stacked = pd.concat([
+            pd.DataFrame({
+                'tag': tag,
+                'group': keys.loc[series.index].to_numpy(),
+                'value': series.to_numpy(dtype=object),
+            })
+            for tag, series in histogram_values
+        ])
+        histogram_counts = stacked.groupby(
+            ['tag', 'group', 'value']).size()
+        histogram_tags = set(
+            histogram_counts.index.get_level_values('tag'))
+
+    total = totals.to_numpy()
+    group_names = totals.index.tolist()
+    field_stats = {}
+    for spec in specs:
+        tag = spec['tag']
+        kind = spec['kind']
+        reported = counts[('reported', tag)].to_numpy()
+        missing = total - reported
+        columns = {
+            'missing': missing.tolist(),
+            'reported': reported.tolist(),
+            'percent_reported': _percent(reported, total).tolist(),
+            'percent_missing': _percent(missing, total).tolist(),
+        }
+        if kind != 'multiselect':
+            na = counts[('not_available', tag)].to_numpy()
+            available = reported - na
+            columns.update({
+                'available': available.tolist(),
+                'not_available': na.tolist(),
+                'percent_available': _percent(available, reported).tolist(),
+                'percent_not_available': _percent(na, reported).tolist(),
+            })
+        if kind in ('count', 'histogram', 'bucket'):
+            columns['total'] = total.tolist()
+        if kind == 'mean':
+            columns['mean'] = means[tag].tolist()
+
+        column_names = list(columns)
+        location_stats = {
+            group_name: dict(zip(column_names, row))
+            for group_name, row in zip(group_names, zip(*columns.values()))
+        }
+
+        if kind in ('histogram', 'multiselect', 'bucket'):
+            options = list(spec['options'])
+            if tag in histogram_tags:
+                frequencies = histogram_counts.loc[tag].unstack(
+                    fill_value=0)
+                frequencies = frequencies.reindex(
+                    index=totals.index, columns=options, fill_value=0)
+                frequencies = frequencies.to_numpy(dtype=np.int64)
+            else:
+                frequencies = np.zeros(
+                    (len(group_names), len(options)), dtype=np.int64)
+
+            if kind == 'histogram' and spec.get('null_value') is not None:
+                denominator = reported - na
+            else:
+                denominator = reported
+            percentages = _percent(frequencies, denominator[:, None])
+
+            for group_name, counts_row, percentages_row in zip(
+                    group_names, frequencies.tolist(), percentages.tolist()):
+                location_stats[group_name]['histogram'] = dict(
+                    zip(options, zip(counts_row, percentages_row)))
+
+        field_stats[tag] = location_stats
+
+    return field_stats
+
+
+def generate_mean_stats(tag, dataset, null_value=None, locations=None):
     '''Returns statistics (mean, standard deviation, number/percentage
     of actual reports, number/percentage of missing reports) for a
     single form field tag in a set of submissions.
@@ -34,6 +205,8 @@ def generate_mean_stats(tag, dataset, null_value=None):
     Parameters:
     - tag: a form field tag.
     - dataset: a pandas DataFrame or group series with the submission data
+    - locations: precomputed per-group statistics, used instead of
+    computing them when the dataset is grouped
 
     Returns
     - a dictionary of the requested statistics. if the dataset is a series
@@ -43,49 +216,12 @@ def generate_mean_stats(tag, dataset, null_value=None):
 
     if hasattr(dataset, 'groups'):
         # generate the per-group statistics
-        # the transpose and to_dict ensures that the output looks similar to
-        # ['item']['mean'] for every item in the group
-        # location_stats = dataset[tag].agg({
-        #     'mean': np.mean,
-        #     'std': lambda x: np.std(x)
-        # }).replace(np.nan, 0).transpose().to_dict()
-        location_stats = {}
-
-        for group_name in dataset.groups:
-            temp = dataset[tag].get_group(group_name)
-            total = temp.size
-            reported = temp.count()
-            if null_value is None:
-                available = reported
-                not_available = 0
-                mean = temp.mean()
-            else:
-                not_available = temp.where(temp == null_value).count()
-                available = reported - not_available
-                mean = temp[temp != null_value].mean()
-            missing = total - reported
-            percent_reported = percent_of(reported, total)
-            percent_available = percent_of(available, reported)
-            percent_not_available = percent_of(not_available, reported)
-            percent_missing = percent_of(missing, total)
-
-            location_stats[group_name] = {}
-            location_stats[group_name]['reported'] = reported
-            location_stats[group_name]['missing'] = missing
-            location_stats[group_name]['available'] = available
-            location_stats[group_name]['not_available'] = not_available
-            location_stats[group_name]['percent_reported'] = \
-                percent_reported
-            location_stats[group_name]['percent_missing'] = \
-                percent_missing
-            location_stats[group_name]['percent_available'] = \
-                percent_available
-            location_stats[group_name]['percent_not_available'] = \
-                percent_not_available
-            location_stats[group_name]['mean'] = \
-                mean if not pd.isnull(mean) else 0.0
-
-        field_stats['locations'] = location_stats
+        if locations is None:
+            locations = _grouped_location_stats([{
+                'tag': tag, 'kind': 'mean', 'null_value': null_value,
+            }], dataset)[tag]
+
+        field_stats['locations'] = locations
     else:
         # generate the statistics over the entire data set
         # this means there will be one set of statistics for the entire
@@ -126,7 +262,7 @@ def generate_mean_stats(tag, dataset, null_value=None):
 
 
 def generate_histogram_stats(tag, dataset, options=[], labels=None,
-                             null_value=None):
+                             null_value=None, locations=None):
     '''Returns statistics (frequency histogram, number/percentage of actual
     reports, number/percentage of missing reports) for a specified form field
     tag. The associated form field takes one value of several options.
@@ -136,24 +272,19 @@ def generate_histogram_stats(tag, dataset, options=[], labels=None,
     - tag: a form field tag
     - dataset: a pandas DataFrame or group series with the submission data
     - options: an iterable (queryset or no) of form field options
+    - locations: precomputed per-group statistics, used instead of
+    computing them when the dataset is grouped
 
     Returns
     - a dictionary (or nested dictionary, if data set is grouped) with the
     above statistics, as well as the labels for each of the options. Both the
     histogram and the labels are generated as lists, so they are ordered.'''
 
-    options_generated = set(options)
-    if len(options_generated) == 0:
-        if hasattr(dataset, 'groups'):
-            dataset_slice = pd.concat([subset[tag] for _, subset in dataset])
-        else:
-            dataset_slice = dataset[tag]
+    if hasattr(dataset, 'groups'):
+        dataset_slice = _grouped_values(dataset, tag)
     else:
-        if hasattr(dataset, 'groups'):
-            dataset_slice = pd.concat([subset[tag] for _, subset in dataset])
-        else:
-            dataset_slice = dataset[tag]
-    options_generated.update(dataset_slice.dropna().unique().astype(int))
+        dataset_slice = dataset[tag]
+    options_generated = _histogram_options(dataset_slice, options)
     option_labels = sorted(options_generated)
 
     field_stats = {'type': 'histogram', 'labels': labels}
@@ -166,52 +297,13 @@ def generate_histogram_stats(tag, dataset, options=[], labels=None,
 
     if hasattr(dataset, 'groups'):
         # the data is grouped, so per-group statistics will be generated
-        location_stats = {}
-
-        for group_name in dataset.groups:
-            temp = dataset.get_group(group_name).get(tag)
+        if locations is None:
+            locations = _grouped_location_stats([{
+                'tag': tag, 'kind': 'histogram', 'null_value': null_value,
+                'options': options_generated,
+            }], dataset)[tag]
 
-            reported = temp.count()
-            if null_value is None:
-                not_available = 0
-            else:
-                not_available = temp.where(temp == null_value).count()
-            available = reported - not_available
-            total = temp.size
-            missing = total - reported
-            percent_reported = percent_of(reported, total)
-            percent_available = percent_of(available, reported)
-            percent_not_available = percent_of(not_available, reported)
-            percent_missing = percent_of(missing, total)
-
-            location_stats[group_name] = {}
-            location_stats[group_name]['missing'] = missing
-            location_stats[group_name]['reported'] = reported
-            location_stats[group_name]['available'] = available
-            location_stats[group_name]['not_available'] = not_available
-            location_stats[group_name]['total'] = reported + missing
-            location_stats[group_name]['percent_reported'] = percent_reported
-            location_stats[group_name]['percent_missing'] = percent_missing
-            location_stats[group_name]['percent_available'] = percent_available
-            location_stats[group_name]['percent_not_available'] = \
-                percent_not_available
-
-            subset = temp if null_value is None else temp[temp != null_value]
-            value_counts = subset.dropna().astype(int).value_counts().to_dict()
-
-            histogram = defaultdict(lambda: (0, 0.0))
-            denominator = reported if null_value is None else available
-            histogram = {
-                opt: (
-                    value_counts.get(opt, 0),
-                    percent_of(value_counts.get(opt, 0), denominator)
-                )
-                for opt in options_generated
-            }
-
-            location_stats[group_name]['histogram'] = histogram
-
-        field_stats['locations'] = location_stats
+        field_stats['locations'] = locations
     else:
         # ungrouped data, statistics for the entire data set will be generated
         temp = dataset[tag]
@@ -260,7 +352,8 @@ def generate_histogram_stats(tag, dataset, options=[], labels=None,
     return field_stats
 
 
-def generate_multiselect_histogram_stats(tag, dataset, options, labels=None):
+def generate_multiselect_histogram_stats(tag, dataset, options, labels=None,
+                                         locations=None):
     '''Returns statistics for a form field which can take more than one
     option of several. Statistics returned are frequency histogram,
     number/percentage of actual reports, number/percentage of missing
@@ -270,6 +363,8 @@ def generate_multiselect_histogram_stats(tag, dataset, options, labels=None):
     - tag: a form field tag
     - dataset: a pandas DataFrame or group series
     - field_options: an iterable of form field options
+    - locations: precomputed per-group statistics, used instead of
+    computing them when the dataset is grouped
 
     Returns
     - a dictionary (nested in the case of dataset being a group series)
@@ -277,37 +372,12 @@ def generate_multiselect_histogram_stats(tag, dataset, options, labels=None):
     field_stats = {'type': 'histogram', 'labels': labels}
 
     if hasattr(dataset, 'groups'):
-        location_stats = {}
-
-        for group_name in dataset.groups:
-            temp = dataset.get_group(group_name).get(tag).apply(
-                _replace_empty_lists)
-            flattened_data = pd.Series(list(chain(*temp.dropna().values)))
-            reported = temp.count()
-            total = temp.size
-            missing = total - reported
-            percent_missing = percent_of(missing, total)
-            percent_reported = percent_of(reported, total)
-
-            location_stats[group_name] = {}
-            location_stats[group_name]['missing'] = missing
-            location_stats[group_name]['reported'] = reported
-            location_stats[group_name]['percent_reported'] = percent_reported
-            location_stats[group_name]['percent_missing'] = percent_missing
-
-            value_counts = flattened_data.value_counts()
-            histogram = defaultdict(lambda: (0, 0.0))
-            histogram = {
-                opt: (
-                    value_counts.get(opt, 0),
-                    percent_of(value_counts.get(opt, 0), reported)
-                )
-                for opt in options
-            }
-
-            location_stats[group_name]['histogram'] = histogram
-
-        field_stats['locations'] = location_stats
+        if locations is None:
+            locations = _grouped_location_stats([{
+                'tag': tag, 'kind': 'multiselect', 'options': options,
+            }], dataset)[tag]
+
+        field_stats['locations'] = locations
     else:
         column_data = dataset[tag].apply(_replace_empty_lists)
         flattened_column_data = pd.Series(
@@ -341,7 +411,7 @@ def generate_multiselect_histogram_stats(tag, dataset, options, labels=None):
     return field_stats
 
 
-def generate_count_stats(tag, dataset, null_value=None):
+def generate_count_stats(tag, dataset, null_value=None, locations=None):
     '''Returns statistics (frequency histogram, number/percentage of actual
     reports, number/percentage of missing reports) for a specified form field
     tag. The associated form field takes one value of several options.
@@ -350,6 +420,8 @@ def generate_count_stats(tag, dataset, null_value=None):
     Parameters
     - tag: a form field tag
     - dataset: a pandas DataFrame or group series with the submission data
+    - locations: precomputed per-group statistics, used instead of
+    computing them when the dataset is grouped
 
     Returns
     - a dictionary (or nested dictionary, if data set is grouped) with the
@@ -360,37 +432,12 @@ def generate_count_stats(tag, dataset, null_value=None):
 
     if hasattr(dataset, 'groups'):
         # the data is grouped, so per-group statistics will be generated
-        location_stats = {}
+        if locations is None:
+            locations = _grouped_location_stats([{
+                'tag': tag, 'kind': 'count', 'null_value': null_value,
+            }], dataset)[tag]
 
-        for group_name in dataset.groups:
-            subset = dataset.get_group(group_name).get(tag)
-            reported = subset.count()
-            if null_value is None:
-                not_available = 0
-            else:
-                not_available = subset.where(subset == null_value).count()
-            total = subset.size
-            missing = total - reported
-            available = reported - not_available
-
-            percent_reported = percent_of(reported, total)
-            percent_missing = percent_of(missing, total)
-            percent_available = percent_of(available, reported)
-            percent_not_available = percent_of(not_available, reported)
-
-            location_stats[group_name] = {}
-            location_stats[group_name]['missing'] = missing
-            location_stats[group_name]['reported'] = reported
-            location_stats[group_name]['available'] = available
-            location_stats[group_name]['not_available'] = not_available
-            location_stats[group_name]['total'] = total
-            location_stats[group_name]['percent_reported'] = percent_reported
-            location_stats[group_name]['percent_missing'] = percent_missing
-            location_stats[group_name]['percent_available'] = percent_available
-            location_stats[group_name]['percent_not_available'] = \
-                percent_not_available
-
-        field_stats['locations'] = location_stats
+        field_stats['locations'] = locations
     else:
         # ungrouped data, statistics for the entire data set will be generated
         subset = dataset[tag]
@@ -425,56 +472,20 @@ def generate_count_stats(tag, dataset, null_value=None):
     return field_stats
 
 
-def generate_bucket_stats(tag, dataset, target, null_value=None):
+def generate_bucket_stats(tag, dataset, target, null_value=None,
+                          locations=None):
     _cmp = partial(_fake_cmp, target)
     field_stats = {'type': 'bucket', 'target': target}
     options = [-1, 0, 1]
 
     if hasattr(dataset, 'groups'):
-        location_stats = {}
+        if locations is None:
+            locations = _grouped_location_stats([{
+                'tag': tag, 'kind': 'bucket', 'null_value': null_value,
+                'target': target, 'options': options,
+            }], dataset)[tag]
 
-        for group_name in dataset.groups:
-            column_data = dataset.get_group(group_name)[tag]
-            if null_value is None:
-                transformed_data = column_data.dropna().apply(_cmp)
-                not_available = 0
-            else:
-                transformed_data = column_data[
-                    column_data != null_value].dropna().apply(_cmp)
-                not_available = column_data.where(
-                    column_data == null_value).count()
-            value_counts = transformed_data.value_counts().to_dict()
-            reported = column_data.count()
-            total = column_data.size
-            missing = total - reported
-            available = reported - not_available
-            percent_reported = percent_of(reported, total)
-            percent_missing = percent_of(missing, total)
-            percent_available = percent_of(available, reported)
-            percent_not_available = percent_of(not_available, reported)
-            histogram = defaultdict(lambda: (0, 0.0))
-            histogram = {
-                opt: (
-                    value_counts.get(opt, 0),
-                    percent_of(value_counts.get(opt, 0), reported)
-                )
-                for opt in options
-            }
-
-            location_stats[group_name] = {}
-            location_stats[group_name]['missing'] = missing
-            location_stats[group_name]['reported'] = reported
-            location_stats[group_name]['available'] = available
-            location_stats[group_name]['not_available'] = not_available
-            location_stats[group_name]['total'] = total
-            location_stats[group_name]['percent_reported'] = percent_reported
-            location_stats[group_name]['percent_available'] = percent_available
-            location_stats[group_name]['percent_not_available'] = \
-                percent_not_available
-            location_stats[group_name]['percent_missing'] = percent_missing
-            location_stats[group_name]['histogram'] = histogram
-
-        field_stats['locations'] = location_stats
+        field_stats['locations'] = locations
     else:
         column_data = dataset[tag]
         if null_value is None:
@@ -516,46 +527,105 @@ def generate_bucket_stats(tag, dataset, target, null_value=None):
     return field_stats
 
 
-def generate_field_stats(field, dataset):
-    ''' In order to simplify the choice on what analysis to perform
-    this method will check a few conditions and return the appropriate
-    analysis for the field'''
-    summary_type = field.get('analysis_type')
+def _field_parameters(field):
+    '''Returns the null value, options and option labels of a field'''
     try:
         null_value = int(field.get('null_value'))
     except (TypeError, ValueError):
         null_value = None
+
+    field_options = field.get('options')
+    if field_options:
+        sorted_options = sorted(field_options.items(), key=itemgetter(1))
+        options = [i[1] for i in sorted_options]
+        labels = [i[0] for i in sorted_options]
+    else:
+        options = []
+        labels = None
+
+    return null_value, options, labels
+
+
+def _field_spec(field, dataset):
+    '''Describes the per-group statistics for a field, in the format used
+    by `_grouped_location_stats`'''
+    summary_type = field.get('analysis_type')
+    null_value, options, _ = _field_parameters(field)
+    spec = {'tag': field['tag'], 'null_value': null_value}
+
+    if summary_type in ('count', 'mean'):
+        spec['kind'] = summary_type
+    elif summary_type == 'histogram' and field['type'] == 'multiselect':
+        spec.update(kind='multiselect', options=options, null_value=None)
+    elif summary_type == 'histogram':
+        options_generated = _histogram_options(
+            _grouped_values(dataset, field['tag']), options)
+        options_generated.discard(null_value)
+        spec.update(kind='histogram', options=options_generated)
+    elif summary_type == 'bucket':
+        spec.update(
+            kind='bucket', target=field.get('expected', 0),
+            options=[-1, 0, 1])
+    else:
+        return None
+
+    return spec
+
+
+def generate_field_stats(field, dataset, locations=None):
+    ''' In order to simplify the choice on what analysis to perform
+    this method will check a few conditions and return the appropriate
+    analysis for the field'''
+    summary_type = field.get('analysis_type')
+    null_value, options, labels = _field_parameters(field)
     if summary_type == 'count':
-        return generate_count_stats(field['tag'], dataset, null_value)
+        return generate_count_stats(
+            field['tag'], dataset, null_value, locations=locations)
 
     if summary_type == 'histogram':
-        field_options = field.get('options')
-        if field_options:
-            sorted_options = sorted(field_options.items(), key=itemgetter(1))
-            options = [i[1] for i in sorted_options]
-            labels = [i[0] for i in sorted_options]
-        else:
-            options = []
-            labels = None
-
         if field['type'] == 'multiselect':
             return generate_multiselect_histogram_stats(
                 field['tag'], dataset, options=options, labels=labels,
+                locations=locations,
             )
         else:
             return generate_histogram_stats(
                 field['tag'], dataset, options=options, labels=labels,
-                null_value=null_value,
+                null_value=null_value, locations=locations,
             )
 
     if summary_type == 'mean':
         return generate_mean_stats(
-            field['tag'], dataset, null_value=null_value)
+            field['tag'], dataset, null_value=null_value,
+            locations=locations)
 
     if summary_type == 'bucket':
         return generate_bucket_stats(
             field['tag'], dataset, field.get('expected', 0),
-            null_value=null_value)
+            null_value=null_value, locations=locations)
+
+
+def generate_grouped_field_stats(fields, dataset):
+    '''Returns the statistics for several form fields over a grouped
+    dataset. The per-group statistics for all the fields are computed
+    together, which is much faster than computing them field by field.
+
+    Parameters
+    - fields: an iterable of form fields
+    - dataset: a pandas group series with the submission data
+
+    Returns
+    - a list with the statistics for each of the fields, in the same format
+    as `generate_field_stats`'''
+    fields = list(fields)
+    specs = [_field_spec(field, dataset) for field in fields]
+    locations = _grouped_location_stats(
+        [spec for spec in specs if spec], dataset)
+
+    return [
+        generate_field_stats(field, dataset, locations.get(field['tag']))
+        for field in fields
+    ]
 
 
 def generate_incidents_data(data_frame, form, location_root, grouped=True,
@@ -620,21 +690,19 @@ def generate_incidents_data(data_frame, form, location_root, grouped=True,
                 continue
             location_stats = {}
 
-            for tag in tags:
-                if tag not in data_frame:
-                    continue
-                field = form.get_field_by_tag(tag)
-                field_stats = generate_field_stats(field, data_group)
-
+            fields = [
+                form.get_field_by_tag(tag) for tag in tags
+                if tag in data_frame
+            ]
+            for field, field_stats in zip(
+                    fields, generate_grouped_field_stats(fields, data_group)):
                 incidents_summary['locations'] = \
                     list(field_stats['locations'].keys())
 
                 for location in field_stats['locations']:
-                    field = form.get_field_by_tag(tag)
-
                     location_stats.setdefault(location, {}).update({
-                        tag: (field['description'],
-                              field_stats['locations'][location])})
+                        field['tag']: (field['description'],
+                                       field_stats['locations'][location])})
 
             group_location_stats = [
                 (location, location_stats[location])
@@ -726,17 +794,15 @@ def generate_process_data(data_frame, form, location_root, grouped=True,
                 data_group = data_frame.groupby(location_type)
             except KeyError:
                 continue
-            location_type_summary = []
-
-            for tag in tags:
-                if tag not in data_frame:
-                    continue
-                field = form.get_field_by_tag(tag)
-                field_stats = generate_field_stats(field, data_group)
-
-                location_type_summary.append((
-                    tag, field['description'], field_stats
-                ))
+            fields = [
+                form.get_field_by_tag(tag) for tag in tags
+                if tag in data_frame
+            ]
+            location_type_summary = [
+                (field['tag'], field['description'], field_stats)
+                for field, field_stats in zip(
+                    fields, generate_grouped_field_stats(fields, data_group))
+            ]
 
             process_summary['groups'].append(
                 (location_type, location_type_summary)
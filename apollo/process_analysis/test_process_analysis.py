@@ -9,6 +9,7 @@ from apollo.process_analysis.common import (
     generate_multiselect_histogram_stats,
     generate_count_stats,
     generate_field_stats,
+    generate_grouped_field_stats,
 )
 
 
@@ -635,3 +636,41 @@ class ProcessAnalysisTest(TestCase):
                 "total": 5,
             },
         )
+
+    def test_generate_grouped_field_stats(self):
+        fields = [
+            {"type": "integer", "tag": "AA", "analysis_type": "count"},
+            {"type": "integer", "tag": "AB", "analysis_type": "mean", "null_value": 6},
+            {
+                "type": "multiselect",
+                "tag": "AC",
+                "analysis_type": "histogram",
+                "options": {str(i): i for i in range(1, 7)},
+            },
+            {
+                "type": "select",
+                "tag": "AD",
+                "analysis_type": "histogram",
+                "options": {"Two": 2, "Three": 3, "Four": 4},
+                "null_value": 4,
+            },
+        ]
+        grouped = self.df.groupby("location")
+        grouped_stats = generate_grouped_field_stats(fields, grouped)
+
+        self.assertEqual(grouped_stats, [generate_field_stats(field, grouped) for field in fields])
+
+        # the per-group statistics match the statistics of each group on its own
+        for field, field_stats in zip(fields, grouped_stats):
+            for name, group in self.df.groupby("location"):
+                expected = generate_field_stats(field, group)
+                for key, value in field_stats["locations"][name].items():
+                    self.assertEqual(value, expected[key], (field["tag"], name, key))
+
+    def test_generate_bucket_stats(self):
+        field = {"type": "integer", "tag": "AB", "analysis_type": "bucket", "expected": 3}
+        stats = generate_field_stats(field, self.df.groupby("location"))
+
+        self.assertEqual(stats["locations"]["B"]["histogram"], {-1: (0, 0.0), 0: (1, 50.0), 1: (1, 50.0)})
+        self.assertEqual(stats["locations"]["A"]["histogram"], {-1: (1, 100.0), 0: (0, 0.0), 1: (0, 0.0)})
+        self.assertEqual(stats["locations"]["A"]["total"], 1)
@@ -1,35 +1,14 @@
 # -*- coding: utf-8 -*-
-from flask import current_app
+from apollo.result_analysis import estimators
 
 
 def proportion(df, options, param):
-    m = df.loc[:, options].sum(axis=1)
-    mbar = m.sum(axis=0) / m.size
-    return df.loc[:, param].sum(axis=0).sum(axis=0) / (mbar * m.size)
+    """Estimates the ratio of the `param` columns to the `options` columns."""
+    statistics = estimators.ratio_statistics(df, {'p': (param, options)})
+    return estimators.point_estimate(statistics['p'])
 
 
 def variance(df, options, param):
-    p = proportion(df, options, param)
-    psquared = p * p
-
-    m = df.loc[:, options].sum(axis=1)
-    msquared = m * m
-
-    a = df.loc[:, param].sum(axis=1)
-    asquared = a * a
-
-    mbar = m.sum(axis=0) / m.size
-    mbarsquared = mbar * mbar
-
-    f = m.sum(axis=0) / current_app.config.get('BIG_N')
-    k = m.size
-    am = a * m
-    sigma_asquared = asquared.sum(axis=0)
-    sigma_msquared = msquared.sum(axis=0)
-    sigma_am = am.sum(axis=0)
-
-    return (
-        (1 - f) / (k * mbarsquared)) * ((sigma_asquared -
-                                        2 * p * sigma_am +
-                                        psquared *
-                                        sigma_msquared) / (k - 1))
+    """Computes the variance of the ratio estimated by `proportion`."""
+    statistics = estimators.ratio_statistics(df, {'p': (param, options)})
+    return estimators.variance(statistics['p'])
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+"""Ratio estimators of the results, turnout and process analyses.
+
+The analyses estimate ratios such as the share of a candidate, Σa / Σm,
+from a sample of polling stations. The estimate, its variance and margins
+of error only depend on the sufficient statistics of the ratio over the
+sample: the count, Σa, Σm, Σa², Σm² and Σam. The contributions of every
+row of a dataframe to the statistics of every estimator are computed once,
+so the statistics of all the locations of a level are a single grouped
+sum, and the estimates of all the locations are computed together.
+
+The estimator functions accept the statistics as a tuple, a series
+indexed by the statistic names or a dataframe with a column for every
+statistic, in which case the estimates of all its rows are returned.
+"""
+
+import numpy as np
+import pandas as pd
+from flask import current_app
+
+# the order of the statistics in a contribution
+STATISTICS = ("count", "sum_a", "sum_m", "sum_aa", "sum_mm", "sum_am")
+
+
+def _columns(fields):
+    return fields if isinstance(fields, list) else [fields]
+
+
+def ratio_contributions(dataframe, estimators):
+    """Computes the contributions of every row to the statistics of ratio estimators.
+
+    Args:
+        dataframe: the rows of the sample.
+        estimators: the numerator and denominator columns (a column or a
+            list of columns that are added up) of every estimator, by name.
+
+    Returns:
+        a dataframe with the same index and an (estimator, statistic)
+        column for every statistic of every estimator.
+    """
+    contributions = {}
+    for name, (numerator, denominator) in estimators.items():
+        a = dataframe[_columns(numerator)].sum(axis=1)
+        m = dataframe[_columns(denominator)].sum(axis=1)
+        for statistic, values in zip(STATISTICS, (1, a, m, a * a, m * m, a * m)):
+            contributions[(name, statistic)] = values
+
+    return pd.DataFrame(contributions, index=dataframe.index)
+
+
+def ratio_statistics(dataframe, estimators, by=None):
+    """Computes the statistics of ratio estimators over a sample.
+
+    Without `by`, the statistics of the whole sample are returned as a
+    series. Otherwise the rows are grouped by `by` (anything accepted by
+    `DataFrame.groupby`) and the statistics of every group are returned.
+    """
+    contributions = ratio_contributions(dataframe, estimators)
+    if by is None:
+        return contributions.sum()
+
+    return contributions.groupby(by).sum()
+
+
+def _unpack(statistics):
+    if isinstance(statistics, pd.DataFrame):
+        return [statistics[statistic].astype(np.float64) for statistic in STATISTICS]
+    if isinstance(statistics, pd.Series):
+        statistics = [statistics[statistic] for statistic in STATISTICS]
+
+    return [np.float64(value) for value in statistics]
+
+
+def point_estimate(statistics):
+    """Computes the ratio estimate from its sufficient statistics."""
+    _count, sum_a, sum_m = _unpack(statistics)[:3]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return sum_a / sum_m
+
+
+def variance(statistics):
+    """Computes the variance of the ratio estimate from its sufficient statistics."""
+    k, sum_a, sum_m, sum_aa, sum_mm, sum_am = _unpack(statistics)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        p = sum_a / sum_m
+        mbar = sum_m / k
+        f = sum_m / current_app.config.get("BIG_N")
+        result = ((1 - f) / (k * mbar * mbar)) * ((sum_aa - (2 * p * sum_am) + (p * p * sum_mm)) / (k - 1))
+
+    # the variance of a single observation is undefined
+    if isinstance(result, pd.Series):
+        return result.where(k != 1)
+    return np.nan if k == 1 else result
+
+
+def margin_of_error(statistics, cv=1.96):
+    """Computes the margin of error of the ratio estimate from its sufficient statistics.
+
+    Undefined margins of error are reported as 0.
+    """
+    error = np.sqrt(np.abs(variance(statistics))) * cv * 100
+
+    if isinstance(error, pd.Series):
+        error = error.round(3)
+        return error.where(np.isfinite(error), 0)
+
+    moe = round(float(error), 3)
+    return moe if np.isfinite(moe) else 0
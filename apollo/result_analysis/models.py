@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+"""Incrementally maintained aggregates for the results analysis.
+
+For every event, form and location the aggregates hold the sufficient
+statistics (count, Σa, Σm, Σa², Σm² and Σam) of the ratio estimators
+computed by the results analysis, summed over all submissions at the
+location or any of its descendants. Whenever a submission included in the
+results analysis is modified, the difference between its old and new
+contributions is added to the aggregates of its location and all of its
+ancestors, so that estimates and margins of error can be computed from a
+handful of rows instead of every submission.
+
+Changes made through the session are picked up by its flush listeners.
+Bulk updates bypass the session, so they are made in `ResultAggregate.track`
+instead. The aggregates are rebuilt once rows are written with SQL by the
+imports and the checklist generation, for the events of the location set
+whose rows were written.
+"""
+
+import hashlib
+import json
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from apollo.core import db, red
+from apollo.formsframework.models import Form
+from apollo.locations.models import Location, LocationPath
+from apollo.result_analysis.estimators import STATISTICS
+from apollo.submissions.models import FLAG_STATUSES, Submission
+
+GENERATION_KEY = "result-aggregates:{}:generation"
+
+
+class ResultAggregate(db.Model):
+    __tablename__ = "result_aggregate"
+
+    event_id = db.Column(db.Integer, db.ForeignKey("event.id", ondelete="CASCADE"), primary_key=True)
+    form_id = db.Column(db.Integer, db.ForeignKey("form.id", ondelete="CASCADE"), primary_key=True)
+    location_id = db.Column(db.Integer, db.ForeignKey("location.id", ondelete="CASCADE"), primary_key=True)
+    name = db.Column(db.String, primary_key=True)
+    count = db.Column(db.BigInteger, nullable=False, default=0)
+    sum_a = db.Column(db.BigInteger, nullable=False, default=0)
+    sum_m = db.Column(db.BigInteger, nullable=False, default=0)
+    sum_aa = db.Column(db.BigInteger, nullable=False, default=0)
+    sum_mm = db.Column(db.BigInteger, nullable=False, default=0)
+    sum_am = db.Column(db.BigInteger, nullable=False, default=0)
+
+    @staticmethod
+    def tracks(form):
+        """Returns whether aggregates are maintained for the given form."""
+        return form is not None and form.form_type == "CHECKLIST" and bool(form.vote_shares)
+
+    @staticmethod
+    def fingerprint(event, form):
+        """Identifies the form settings and location set generation the aggregates were computed with."""
+        tags = [
+            tag for tag in (form.vote_shares or []) + [form.registered_voters_tag] if tag and form.get_field_by_tag(tag)
+        ]
+        data = {
+            "vote_shares": form.vote_shares,
+            "registered_voters": form.registered_voters_tag,
+            "invalid_votes": form.invalid_votes_tag,
+            "blank_votes": form.blank_votes_tag,
+            "accredited_voters": form.accredited_voters_tag,
+            "untrack_data_conflicts": form.untrack_data_conflicts,
+            "null_values": {tag: form.get_field_by_tag(tag).get("null_value") for tag in tags},
+            "generation": int(red.get(GENERATION_KEY.format(event.location_set_id)) or 0),
+        }
+
+        return hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    @classmethod
+    def invalidate(cls, location_set_id):
+        """Forces the aggregates of the events of a location set to be rebuilt when next used."""
+        red.incr(GENERATION_KEY.format(location_set_id))
+
+    @classmethod
+    def snapshot(cls, submission_ids, lock=False, session=None):
+        """Loads the contributions of the given submissions from the database.
+
+        Args:
+            submission_ids: the identifiers of the submissions.
+            lock: if set, the submission rows are locked until the end of
+                the transaction so that concurrent updates to the same
+                submission are applied one after the other.
+            session: the session to query in, the scoped session if not given.
+        """
+        if not submission_ids:
+            return {}
+
+        session = session or db.session
+
+        query = (
+            sa.select(
+                Submission.id,
+                Submission.event_id,
+                Submission.form_id,
+                Submission.location_id,
+                Submission.submission_type,
+                Submission.verification_status,
+                Submission.quarantine_status,
+                Submission.data,
+                Location.registered_voters,
+            )
+            .join(Location, Submission.location_id == Location.id)
+            .where(Submission.id.in_(submission_ids))
+        )
+        if lock:
+            query = query.with_for_update(of=Submission)
+
+        snapshot = {}
+        for row in session.execute(query):
+            form = session.get(Form, row.form_id)
+            if not cls.tracks(form) or not included_in_results(form, row):
+                continue
+
+            contribution = result_contribution(form, row.data or {}, row.registered_voters)
+            snapshot[row.id] = (row.event_id, row.form_id, row.location_id, contribution)
+
+        return snapshot
+
+    @classmethod
+    def apply(cls, old_snapshot, new_snapshot, session=None):
+        """Adds the difference between two snapshots to the aggregates.
+
+        The differences are added to the aggregates for the location of
+        each submission and all its ancestors with a single upsert, in the
+        given session or the scoped session.
+        """
+        session = session or db.session
+        deltas = defaultdict(lambda: np.zeros(len(STATISTICS), dtype=np.int64))
+        for sign, snapshot in ((-1, old_snapshot), (1, new_snapshot)):
+            for event_id, form_id, location_id, contribution in snapshot.values():
+                for name, statistics in contribution.items():
+                    deltas[(event_id, form_id, location_id, name)] += sign * np.array(statistics, dtype=np.int64)
+
+        deltas = {key: value for key, value in deltas.items() if value.any()}
+        if not deltas:
+            return
+
+        location_ids = {key[2] for key in deltas}
+        paths = defaultdict(list)
+        for descendant_id, ancestor_id in session.execute(
+            sa.select(LocationPath.descendant_id, LocationPath.ancestor_id).where(
+                LocationPath.descendant_id.in_(location_ids)
+            )
+        ):
+            paths[descendant_id].append(ancestor_id)
+
+        rows = defaultdict(lambda: np.zeros(len(STATISTICS), dtype=np.int64))
+        for (event_id, form_id, location_id, name), delta in deltas.items():
+            for ancestor_id in paths[location_id]:
+                rows[(event_id, form_id, ancestor_id, name)] += delta
+
+        # rebuilds take this lock exclusively, so no updates are lost while
+        # the aggregates for a form are being recomputed
+        for event_id, form_id in {key[:2] for key in rows}:
+            session.execute(sa.select(sa.func.pg_advisory_xact_lock_shared(event_id, form_id)))
+
+        table = cls.__table__
+        statement = insert(table).values(
+            [
+                dict(
+                    zip(("event_id", "form_id", "location_id", "name"), key),
+                    **dict(zip(STATISTICS, (int(v) for v in value))),
+                )
+                for key, value in sorted(rows.items())
+            ]
+        )
+        statement = statement.on_conflict_do_update(
+            index_elements=[table.c.event_id, table.c.form_id, table.c.location_id, table.c.name],
+            set_={column: table.c[column] + statement.excluded[column] for column in STATISTICS},
+        )
+        session.execute(statement)
+
+    @classmethod
+    @contextmanager
+    def track(cls, submission_ids):
+        """Adjusts the aggregates for bulk updates to the given submissions.
+
+        The contributions of the submissions are loaded before and after
+        the statements of the block are run, and their difference is added
+        to the aggregates.
+        """
+        with db.session.no_autoflush:
+            snapshot = cls.snapshot(submission_ids, lock=True)
+            yield
+            cls.apply(snapshot, cls.snapshot(submission_ids))
+
+    @classmethod
+    def rebuild(cls, event, form):
+        """Recomputes the aggregates of a form from its submissions."""
+        db.session.execute(sa.select(sa.func.pg_advisory_xact_lock(event.id, form.id)))
+        db.session.execute(sa.delete(cls).where(cls.event_id == event.id, cls.form_id == form.id))
+
+        query = (
+            sa.select(
+                Submission.id,
+                Submission.location_id,
+                Submission.submission_type,
+                Submission.verification_status,
+                Submission.quarantine_status,
+                Submission.data,
+                Location.registered_voters,
+            )
+            .join(Location, Submission.location_id == Location.id)
+            .where(
+                Submission.event_id == event.id,
+                Submission.form_id == form.id,
+                Submission.submission_type == ("O" if form.untrack_data_conflicts else "M"),
+            )
+            .execution_options(yield_per=1000)
+        )
+
+        totals = defaultdict(lambda: np.zeros(len(STATISTICS), dtype=np.int64))
+        for row in db.session.execute(query):
+            if not included_in_results(form, row):
+                continue
+
+            contribution = result_contribution(form, row.data or {}, row.registered_voters)
+            for name, statistics in contribution.items():
+                totals[(row.location_id, name)] += np.array(statistics, dtype=np.int64)
+
+        if totals:
+            paths = defaultdict(list)
+            for descendant_id, ancestor_id in db.session.execute(
+                sa.select(LocationPath.descendant_id, LocationPath.ancestor_id).where(
+                    LocationPath.location_set_id == event.location_set_id
+                )
+            ):
+                paths[descendant_id].append(ancestor_id)
+
+            rows = defaultdict(lambda: np.zeros(len(STATISTICS), dtype=np.int64))
+            for (location_id, name), statistics in totals.items():
+                for ancestor_id in paths[location_id]:
+                    rows[(ancestor_id, name)] += statistics
+
+            records = [
+                dict(
+                    event_id=event.id,
+                    form_id=form.id,
+                    location_id=location_id,
+                    name=name,
+                    **dict(zip(STATISTICS, (int(v) for v in value))),
+                )
+                for (location_id, name), value in rows.items()
+            ]
+            for index in range(0, len(records), 1000):
+                db.session.execute(insert(cls.__table__).values(records[index : index + 1000]))
+
+        db.session.commit()
+
+    @classmethod
+    def ensure(cls, event, form):
+        """Rebuilds the aggregates of a form if they are missing or outdated."""
+        key = f"result-aggregates:{event.id}:{form.id}"
+        fingerprint = cls.fingerprint(event, form)
+        current = red.get(key)
+        if current is None or current.decode("utf-8") != fingerprint:
+            cls.rebuild(event, form)
+            red.set(key, fingerprint)
+
+    @classmethod
+    def load(cls, event, form, location_ids):
+        """Returns the aggregated statistics for the given locations."""
+        statistics = defaultdict(dict)
+        query = cls.query.filter(cls.event_id == event.id, cls.form_id == form.id, cls.location_id.in_(location_ids))
+        for aggregate in query:
+            statistics[aggregate.location_id][aggregate.name] = tuple(
+                getattr(aggregate, column) for column in STATISTICS
+            )
+
+        return statistics
+
+
+def _number(value):
+    """Converts a submitted value to an integer, or `None` if it is blank."""
+    if value is None or value == "":
+        return None
+
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _null_value(form, tag):
+    """Returns the configured null value of a form field, if any."""
+    field = form.get_field_by_tag(tag) or {}
+    try:
+        return int(field.get("null_value"))
+    except (TypeError, ValueError):
+        return None
+
+
+def included_in_results(form, submission):
+    """Returns whether a submission is part of the results analysis."""
+    submission_type = "O" if form.untrack_data_conflicts else "M"
+    return (
+        submission.submission_type == submission_type
+        and submission.verification_status != FLAG_STATUSES["rejected"][0]
+        and submission.quarantine_status not in ("A", "R")
+    )
+
+
+def _ratio(a, m):
+    """The sufficient statistics of a single observation of a ratio."""
+    return (1, a, m, a * a, m * m, a * m)
+
+
+def result_contribution(form, data, registered_voters):
+    """Computes the contribution of a submission to the result aggregates.
+
+    A submission is reported if all the result fields are filled in, the
+    registered voters are greater than zero and at least one vote was cast
+    for any of the vote shares. Reported submissions contribute to each of
+    the ratio estimators while unreported submissions are only counted as
+    missing.
+    """
+    vote_shares = form.vote_shares or []
+    rejected_tags = [form.invalid_votes_tag] if form.invalid_votes_tag else []
+    blank_tags = [form.blank_votes_tag] if form.blank_votes_tag else []
+    accredited_tags = [form.accredited_voters_tag] if form.accredited_voters_tag else []
+
+    values = {}
+    for tag in vote_shares + rejected_tags + blank_tags + accredited_tags:
+        values[tag] = _number(data.get(tag))
+
+    # the configured null values of the vote shares are treated as blank
+    for tag in vote_shares:
+        if values[tag] is not None and values[tag] == _null_value(form, tag):
+            values[tag] = None
+
+    if form.registered_voters_tag:
+        rv = _number(data.get(form.registered_voters_tag))
+        if rv is not None and rv == _null_value(form, form.registered_voters_tag):
+            rv = None
+    else:
+        rv = registered_voters
+
+    valid_votes = sum(values[tag] for tag in vote_shares if values[tag] is not None)
+    reported = all(value is not None for value in values.values()) and rv is not None and rv > 0 and valid_votes > 0
+    if not reported:
+        return {"missing": (1, 0, 0, 0, 0, 0)}
+
+    all_votes = valid_votes + sum(values[tag] for tag in rejected_tags + blank_tags)
+    contribution = {
+        "reported": (1, 0, 0, 0, 0, 0),
+        "turnout": _ratio(all_votes, rv),
+        "valid": _ratio(valid_votes, all_votes),
+    }
+    if rejected_tags:
+        contribution["rejected"] = _ratio(values[rejected_tags[0]], all_votes)
+    if blank_tags:
+        contribution["blank"] = _ratio(values[blank_tags[0]], all_votes)
+    for tag in vote_shares:
+        contribution[f"share:{tag}"] = _ratio(values[tag], valid_votes)
+
+    return contribution
+
+
+def _before_flush(session, flush_context, instances):
+    """Records the contributions of submissions before they are modified."""
+    submission_ids = []
+    for instance in session.dirty | session.deleted:
+        if isinstance(instance, Submission) and instance.id is not None:
+            if instance in session.deleted or _contribution_modified(session, instance):
+                submission_ids.append(instance.id)
+        elif isinstance(instance, Location) and instance in session.dirty:
+            if sa.inspect(instance).attrs.registered_voters.history.has_changes():
+                session.info.setdefault("invalidate_result_aggregates", set()).add(instance.location_set_id)
+
+    session.info["result_aggregates"] = ResultAggregate.snapshot(submission_ids, lock=True, session=session)
+
+
+def _after_flush(session, flush_context):
+    """Adds the changes in contributions of the flushed submissions to the aggregates."""
+    old_snapshot = session.info.pop("result_aggregates", {})
+    submission_ids = set(old_snapshot.keys())
+    submission_ids.update(instance.id for instance in session.new if isinstance(instance, Submission))
+    submission_ids.update(
+        instance.id
+        for instance in session.dirty
+        if isinstance(instance, Submission) and _contribution_modified(session, instance)
+    )
+    submission_ids.difference_update(instance.id for instance in session.deleted if isinstance(instance, Submission))
+
+    ResultAggregate.apply(
+        old_snapshot, ResultAggregate.snapshot(list(submission_ids), session=session), session=session
+    )
+
+
+def _after_commit(session):
+    """Invalidates the aggregates once changes to registered voters are committed."""
+    for location_set_id in session.info.pop("invalidate_result_aggregates", ()):
+        ResultAggregate.invalidate(location_set_id)
+
+
+def _contribution_modified(session, submission):
+    """Returns whether any attribute that affects the aggregates was modified."""
+    if not ResultAggregate.tracks(session.get(Form, submission.form_id)):
+        return False
+
+    attrs = sa.inspect(submission).attrs
+    return any(
+        getattr(attrs, attr).history.has_changes()
+        for attr in ("data", "location_id", "submission_type", "verification_status", "quarantine_status")
+    )
+
+
+sa.event.listen(Session, "before_flush", _before_flush)
+sa.event.listen(Session, "after_flush", _after_flush)
+sa.event.listen(Session, "after_commit", _after_commit)
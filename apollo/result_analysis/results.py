@@ -1,136 +1,80 @@
-import math
+from functools import partial
 from operator import attrgetter
 
 import numpy as np
 import pandas as pd
 from flask import abort, current_app, g, render_template, request, url_for
 from flask_babel import gettext as _
-from sqlalchemy import not_
+from sqlalchemy import TIMESTAMP, BigInteger, cast, func, not_
+from sqlalchemy.orm import aliased
 
 from apollo import models
 from apollo.formsframework.models import Form
 from apollo.frontend.helpers import analysis_breadcrumb_data
+from apollo.result_analysis.estimators import margin_of_error, ratio_contributions
+from apollo.result_analysis.models import ResultAggregate
 from apollo.services import forms, location_types, locations, submissions
+from apollo.submissions.analysis_cache import analysis_dataframe
 from apollo.submissions.filters import make_submission_analysis_filter
 from apollo.submissions.models import FLAG_STATUSES
-from apollo.submissions.utils import make_submission_dataframe
 
+# the report keys of the margins of error of the result estimators other
+# than the vote shares, which are reported under the tag of the share
+MARGIN_OF_ERROR_KEYS = {
+    "turnout": "turnout",
+    "valid": "all_valid_votes",
+    "rejected": "total_rejected",
+    "blank": "total_blanks",
+}
+CONFIDENCE_LEVELS = (("95", 1.96), ("99", 2.58))
+
+
+def _result_estimators(result_field_labels, registered_voters_field, rejected_votes_field, blank_votes_field):
+    """Returns the numerator and denominator fields of the result estimators.
+
+    The estimators are named like the result aggregates.
+    """
+    all_votes_fields = result_field_labels + rejected_votes_field + blank_votes_field
+    estimators = {
+        "turnout": (all_votes_fields, [registered_voters_field]),
+        "valid": (result_field_labels, all_votes_fields),
+    }
+    if rejected_votes_field:
+        estimators["rejected"] = (rejected_votes_field[0], all_votes_fields)
+    if blank_votes_field:
+        estimators["blank"] = (blank_votes_field[0], all_votes_fields)
+    for result_field_label in result_field_labels:
+        estimators["share:{}".format(result_field_label)] = (result_field_label, result_field_labels)
 
-def _point_estimate(dataframe, numerator, denominator):
-    if not isinstance(numerator, list):
-        numerator = [numerator]
-    m = dataframe.loc[:, denominator].sum(axis=1)
-    mbar = m.sum(axis=0) / m.size
-    return dataframe.loc[:, numerator].sum(axis=0).sum(axis=0) / (mbar * m.size)  # noqa
-
-
-def _variance(dataframe, numerator, denominator):
-    p = _point_estimate(dataframe, numerator, denominator)
-    psquared = p * p
-
-    m = dataframe.loc[:, denominator].sum(axis=1)
-    msquared = m * m
-
-    if isinstance(numerator, list):
-        a = dataframe.loc[:, numerator].sum(axis=1)
-    else:
-        a = dataframe.loc[:, [numerator]].sum(axis=1)
-    asquared = a * a
-
-    mbar = m.sum(axis=0) / m.size
-    mbarsquared = mbar * mbar
-
-    f = m.sum(axis=0) / current_app.config.get("BIG_N")
-    k = m.size
-    am = a * m
-    sigma_asquared = asquared.sum(axis=0)
-    sigma_msquared = msquared.sum(axis=0)
-    sigma_am = am.sum(axis=0)
-
-    return (
-        ((1 - f) / (k * mbarsquared)) * ((sigma_asquared - (2 * p * sigma_am) + (psquared * sigma_msquared)) / (k - 1))
-        if k != 1
-        else np.nan
-    )
-
-
-def _margin_of_error(dataframe, numerator, denominator, cv=1.96):
-    moe = round(math.sqrt(abs(_variance(dataframe, numerator, denominator))) * cv * 100, 3)
-    if pd.isna(moe) or np.isinf(moe):
-        moe = 0
-    return moe
-
-
-# TODO: use proper field terminology for the variable names in this function (field, field_label, etc.)
-def voting_results(form_id, location_id=None):
-    """Compute voting results."""
-    event = g.event
-    form = forms.filter(
-        Form.vote_shares != None,  # noqa
-        Form.vote_shares != [],
-        Form.id == form_id,
-        Form.form_type == "CHECKLIST",
-        Form.events.contains(event),
-    ).first()
-
-    if form is None:
-        abort(404)
-
-    if location_id is None:
-        location = locations.root(event.location_set_id)
-    else:
-        location = locations.fget_or_404(id=location_id)
+    return estimators
 
-    template_name = "result_analysis/results.html"
-    breadcrumbs = [_("Results Data"), form.name]
-    filter_on_locations = not form.untrack_data_conflicts
-    filter_class = make_submission_analysis_filter(event, form, filter_on_locations)
 
-    loc_types = [lt for lt in location_types.root(event.location_set_id).descendants() if lt.is_political is True]
+def _margins_of_error(statistics, names):
+    """Computes the report entries of the margins of error of the result estimators.
 
-    location_tree = {}
-    for lt in loc_types:
-        lt_locs = models.Location.query.filter_by(location_type_id=lt.id)
-        location_tree[lt.name] = sorted(lt_locs, key=attrgetter("name"))
+    The margins of error are computed for every row when `statistics` has
+    a row for every location. Estimators that aren't computed are reported
+    with a margin of error of 0.
+    """
+    margins = {
+        "{}_moe_{}".format(key, level): 0 for key in MARGIN_OF_ERROR_KEYS.values() for level, _cv in CONFIDENCE_LEVELS
+    }
+    for name in names:
+        key = name.split(":", 1)[1] if name.startswith("share:") else MARGIN_OF_ERROR_KEYS[name]
+        for level, cv in CONFIDENCE_LEVELS:
+            margins["{}_moe_{}".format(key, level)] = margin_of_error(statistics[name], cv)
 
-    # define the condition for which a submission should be included
-    result_fields = [form.get_field_by_tag(tag) for tag in form.vote_shares] if form.vote_shares else []
-    result_field_labels = form.vote_shares or []
-    result_field_descriptions = [field["description"] for field in result_fields]
+    return margins
 
-    query_kwargs = {"event": event, "form": form}
-    if not form.untrack_data_conflicts:
-        query_kwargs["submission_type"] = "M"
-    else:
-        query_kwargs["submission_type"] = "O"
 
-    queryset = submissions.find(**query_kwargs).filter(
-        models.Submission.verification_status != FLAG_STATUSES["rejected"][0],
-        not_(models.Submission.quarantine_status.in_(["A", "R"])),
-    )
-    filter_set = filter_class(queryset, request.args)
+def _mark_reported(dataset, form, non_null_fields, non_zero_fields):
+    """Replaces configured null values and computes the reporting status of each submission."""
+    if dataset.empty:
+        return
 
+    result_fields = [form.get_field_by_tag(tag) for tag in form.vote_shares]
     registered_voters_field = form.registered_voters_tag or "registered_voters"
-    if form.invalid_votes_tag:
-        rejected_votes_field = [form.invalid_votes_tag]
-    else:
-        rejected_votes_field = []
-    if form.blank_votes_tag:
-        blank_votes_field = [form.blank_votes_tag]
-    else:
-        blank_votes_field = []
-    if form.accredited_voters_tag:
-        accredited_voters_field = [form.accredited_voters_tag]
-    else:
-        accredited_voters_field = []
-
-    non_null_fields = rejected_votes_field + blank_votes_field + accredited_voters_field + result_field_labels
-    non_zero_fields = [registered_voters_field]
-    non_zero_sum_fields = result_field_labels
-
-    excluded_fields = set(form.tags).difference(non_null_fields + non_zero_fields)
-
-    dataset = make_submission_dataframe(filter_set.qs, form, excluded_tags=excluded_fields)
+    non_zero_sum_fields = form.vote_shares
 
     # Check to replace records that have the configured null value with nan
     for result_field in result_fields:
@@ -155,24 +99,46 @@ def voting_results(form_id, location_id=None):
         except (TypeError, ValueError):
             pass
 
-    if not dataset.empty:
-        # compute and store reporting status
-        dataset["reported"] = (
-            dataset[non_null_fields]
-            .where(lambda x: x != np.nan)
-            .join(dataset[non_zero_fields].where(lambda x: x > 0))
-            .assign(shares=(dataset[non_zero_sum_fields].sum(1) > 0).replace(False, np.nan))
-            .count(1)
-            == len(non_null_fields) + len(non_zero_fields) + 1
-        )  # noqa
-        dataset["missing"] = (
-            dataset[non_null_fields]
-            .where(lambda x: x != np.nan)
-            .join(dataset[non_zero_fields].where(lambda x: x > 0))
-            .assign(shares=(dataset[non_zero_sum_fields].sum(1) > 0).replace(False, np.nan))
-            .count(1)
-            != len(non_null_fields) + len(non_zero_fields) + 1
-        )  # noqa
+    # compute and store reporting status
+    dataset["reported"] = (
+        dataset[non_null_fields]
+        .where(lambda x: x != np.nan)
+        .join(dataset[non_zero_fields].where(lambda x: x > 0))
+        .assign(shares=(dataset[non_zero_sum_fields].sum(1) > 0).replace(False, np.nan))
+        .count(1)
+        == len(non_null_fields) + len(non_zero_fields) + 1
+    )  # noqa
+    dataset["missing"] = (
+        dataset[non_null_fields]
+        .where(lambda x: x != np.nan)
+        .join(dataset[non_zero_fields].where(lambda x: x > 0))
+        .assign(shares=(dataset[non_zero_sum_fields].sum(1) > 0).replace(False, np.nan))
+        .count(1)
+        != len(non_null_fields) + len(non_zero_fields) + 1
+    )  # noqa
+
+
+def _dataframe_analyses(
+    dataset,
+    form,
+    location,
+    location_tree,
+    result_field_labels,
+    registered_voters_field,
+    rejected_votes_field,
+    blank_votes_field,
+):
+    """Computes the result summaries from the submission dataframe.
+
+    The contributions of the reported submissions to the result estimators
+    are computed once, and the margins of error of all the locations of a
+    level are computed from their grouped sums.
+    """
+    calculate_moe = form.calculate_moe and current_app.config.get("ENABLE_MOE")
+    estimators = _result_estimators(
+        result_field_labels, registered_voters_field, rejected_votes_field, blank_votes_field
+    )
+    contributions = None
 
     try:
         overall_summation = (
@@ -182,7 +148,6 @@ def voting_results(form_id, location_id=None):
             .loc[location.name]
         )
         reported_subset = dataset[dataset.columns.difference(["updated"])][dataset.reported == True]  # noqa
-        valid_dataframe = reported_subset[reported_subset[location.location_type.name] == location.name]
         valid_summation = reported_subset.fillna(0).groupby(location.location_type.name).sum().loc[location.name]
         reporting = overall_summation[["missing", "reported"]]
         reporting["reported_pct"] = reporting["reported"] / (reporting["reported"] + reporting["missing"])
@@ -215,65 +180,10 @@ def voting_results(form_id, location_id=None):
             if blank_votes_field
             else 0,
         }
-        if form.calculate_moe and current_app.config.get("ENABLE_MOE"):
-            data_analyses["overall"]["turnout_moe_95"] = _margin_of_error(
-                valid_dataframe,
-                result_field_labels + rejected_votes_field + blank_votes_field,
-                [registered_voters_field],
-            )
-            data_analyses["overall"]["turnout_moe_99"] = _margin_of_error(
-                valid_dataframe,
-                result_field_labels + rejected_votes_field + blank_votes_field,
-                [registered_voters_field],
-                2.58,
-            )
-            data_analyses["overall"]["all_valid_votes_moe_95"] = _margin_of_error(
-                valid_dataframe, result_field_labels, result_field_labels + rejected_votes_field + blank_votes_field
-            )
-            data_analyses["overall"]["all_valid_votes_moe_99"] = _margin_of_error(
-                valid_dataframe,
-                result_field_labels,
-                result_field_labels + rejected_votes_field + blank_votes_field,
-                2.58,
-            )
-            data_analyses["overall"]["total_rejected_moe_95"] = (
-                _margin_of_error(
-                    valid_dataframe,
-                    rejected_votes_field[0],
-                    result_field_labels + rejected_votes_field + blank_votes_field,
-                )
-                if rejected_votes_field
-                else 0
-            )
-            data_analyses["overall"]["total_rejected_moe_99"] = (
-                _margin_of_error(
-                    valid_dataframe,
-                    rejected_votes_field[0],
-                    result_field_labels + rejected_votes_field + blank_votes_field,
-                    2.58,
-                )
-                if rejected_votes_field
-                else 0
-            )
-            data_analyses["overall"]["total_blanks_moe_95"] = (
-                _margin_of_error(
-                    valid_dataframe,
-                    blank_votes_field[0],
-                    result_field_labels + rejected_votes_field + blank_votes_field,
-                )
-                if blank_votes_field
-                else 0
-            )
-            data_analyses["overall"]["total_blanks_moe_99"] = (
-                _margin_of_error(
-                    valid_dataframe,
-                    blank_votes_field[0],
-                    result_field_labels + rejected_votes_field + blank_votes_field,
-                    2.58,
-                )
-                if blank_votes_field
-                else 0
-            )
+        if calculate_moe:
+            contributions = ratio_contributions(reported_subset, estimators)
+            overall_statistics = contributions[reported_subset[location.location_type.name] == location.name].sum()
+            data_analyses["overall"].update(_margins_of_error(overall_statistics, estimators))
         data_available = True
     except KeyError:
         data_analyses = {"overall": {}, "grouped": {}}
@@ -309,15 +219,9 @@ def voting_results(form_id, location_id=None):
             if data_available
             else 0
         )  # all_votes?
-        if form.calculate_moe and current_app.config.get("ENABLE_MOE"):
-            data_analyses["overall"]["{}_moe_95".format(result_field_label)] = (
-                _margin_of_error(valid_dataframe, result_field_label, result_field_labels) if data_available else 0
-            )
-            data_analyses["overall"]["{}_moe_99".format(result_field_label)] = (
-                _margin_of_error(valid_dataframe, result_field_label, result_field_labels, 2.58)
-                if data_available
-                else 0
-            )
+        if calculate_moe and not data_available:
+            data_analyses["overall"]["{}_moe_95".format(result_field_label)] = 0
+            data_analyses["overall"]["{}_moe_99".format(result_field_label)] = 0
 
     # grouped summaries
     for location_type in list(location_tree.keys()):
@@ -325,16 +229,21 @@ def voting_results(form_id, location_id=None):
 
         try:
             grouped_summation = dataset[dataset.columns.difference(["updated"])].groupby(location_type).sum()
-            grouped_valid_summation = (
-                dataset[dataset.columns.difference(["updated"])][dataset.reported == True].groupby(location_type).sum()  # noqa: E712
-            )  # noqa
+            reported_subset = dataset[dataset.columns.difference(["updated"])][dataset.reported == True]  # noqa: E712
+            grouped_valid_summation = reported_subset.groupby(location_type).sum().fillna(0)
+
+            if calculate_moe:
+                if contributions is None:
+                    contributions = ratio_contributions(reported_subset, estimators)
+                grouped_statistics = contributions.groupby(reported_subset[location_type]).sum()
+                grouped_margins = pd.DataFrame(
+                    _margins_of_error(grouped_statistics, estimators), index=grouped_statistics.index
+                )
 
             for sublocation in location_tree[location_type]:
                 try:
                     _overall = grouped_summation.loc[sublocation.name]
-                    _valid = grouped_valid_summation.fillna(0).loc[sublocation.name]
-                    _reported_subset = dataset[dataset.reported == True]  # noqa
-                    _valid_dataframe = _reported_subset[_reported_subset[location_type] == sublocation.name]
+                    _valid = grouped_valid_summation.loc[sublocation.name]
 
                     _reporting = _overall[["missing", "reported"]]
                     _reporting["reported_pct"] = _reporting["reported"] / (
@@ -371,67 +280,8 @@ def voting_results(form_id, location_id=None):
                         else 0,
                     }
 
-                    if form.calculate_moe and current_app.config.get("ENABLE_MOE"):
-                        _sublocation_report["turnout_moe_95"] = _margin_of_error(
-                            _valid_dataframe,
-                            result_field_labels + rejected_votes_field + blank_votes_field,
-                            [registered_voters_field],
-                        )
-                        _sublocation_report["turnout_moe_99"] = _margin_of_error(
-                            _valid_dataframe,
-                            result_field_labels + rejected_votes_field + blank_votes_field,
-                            [registered_voters_field],
-                            2.58,
-                        )
-                        _sublocation_report["all_valid_votes_moe_95"] = _margin_of_error(
-                            _valid_dataframe,
-                            result_field_labels,
-                            result_field_labels + rejected_votes_field + blank_votes_field,
-                        )
-                        _sublocation_report["all_valid_votes_moe_99"] = _margin_of_error(
-                            _valid_dataframe,
-                            result_field_labels,
-                            result_field_labels + rejected_votes_field + blank_votes_field,
-                            2.58,
-                        )
-                        _sublocation_report["total_rejected_moe_95"] = (
-                            _margin_of_error(
-                                _valid_dataframe,
-                                rejected_votes_field[0],
-                                result_field_labels + rejected_votes_field + blank_votes_field,
-                            )
-                            if rejected_votes_field
-                            else 0
-                        )
-                        _sublocation_report["total_rejected_moe_99"] = (
-                            _margin_of_error(
-                                _valid_dataframe,
-                                rejected_votes_field[0],
-                                result_field_labels + rejected_votes_field + blank_votes_field,
-                                2.58,
-                            )
-                            if rejected_votes_field
-                            else 0
-                        )
-                        _sublocation_report["total_blanks_moe_95"] = (
-                            _margin_of_error(
-                                _valid_dataframe,
-                                blank_votes_field[0],
-                                result_field_labels + rejected_votes_field + blank_votes_field,
-                            )
-                            if blank_votes_field
-                            else 0
-                        )
-                        _sublocation_report["total_blanks_moe_99"] = (
-                            _margin_of_error(
-                                _valid_dataframe,
-                                blank_votes_field[0],
-                                result_field_labels + rejected_votes_field + blank_votes_field,
-                                2.58,
-                            )
-                            if blank_votes_field
-                            else 0
-                        )
+                    if calculate_moe:
+                        _sublocation_report.update(grouped_margins.loc[sublocation.name].to_dict())
                     data_available = True
                 except KeyError:
                     data_available = False
@@ -469,21 +319,242 @@ def voting_results(form_id, location_id=None):
                         else 0
                     )
 
-                    if form.calculate_moe and current_app.config.get("ENABLE_MOE"):
-                        _sublocation_report["{}_moe_95".format(result_field_label)] = (
-                            _margin_of_error(_valid_dataframe, result_field_label, result_field_labels)
-                            if data_available
-                            else 0
-                        )
-                        _sublocation_report["{}_moe_99".format(result_field_label)] = (
-                            _margin_of_error(_valid_dataframe, result_field_label, result_field_labels, 2.58)
-                            if data_available
-                            else 0
-                        )
+                    if calculate_moe and not data_available:
+                        _sublocation_report["{}_moe_95".format(result_field_label)] = 0
+                        _sublocation_report["{}_moe_99".format(result_field_label)] = 0
                 data_analyses["grouped"][location_type].append(_sublocation_report)
         except (IndexError, KeyError):
             pass
 
+    return data_analyses
+
+
+def _convergence_dataframe(query, form, tags):
+    """Loads the result fields of the submissions without their location hierarchy."""
+    own_loc = aliased(models.Location, name="own_location")
+    integral_fields = [tag for tag in tags if form.get_field_by_tag(tag)]
+
+    columns = [
+        cast(func.nullif(models.Submission.data[tag].astext, ""), BigInteger).label(tag) for tag in integral_fields
+    ]
+    columns.append(
+        func.coalesce(
+            # casting to TIMESTAMP so as to lose the time zone
+            models.Submission.extra_data["voting_timestamp"].astext.cast(TIMESTAMP),
+            models.Submission.updated,
+        ).label("updated")
+    )
+    if "registered_voters" not in integral_fields:
+        columns.append(own_loc.registered_voters.label("registered_voters"))
+
+    dataframe_query = query.join(own_loc, models.Submission.location_id == own_loc.id).with_entities(*columns)
+
+    return pd.read_sql(dataframe_query.selectable, dataframe_query.session.get_bind()).astype(
+        {tag: np.float64 for tag in integral_fields}
+    )
+
+
+def _aggregate_report(form, statistics, result_field_labels, rejected_votes_field, blank_votes_field):
+    """Computes the result summary of a location from its result aggregates."""
+    calculate_moe = form.calculate_moe and current_app.config.get("ENABLE_MOE")
+    reported = statistics.get("reported", (0,))[0]
+
+    if not reported:
+        report = {
+            "reported_cnt": 0,
+            "missing_cnt": 0,
+            "reported_pct": 0,
+            "missing_pct": 0,
+            "rv": 0,
+            "all_votes": 0,
+            "turnout": 0,
+            "all_valid_votes": 0,
+            "all_valid_votes_pct": 0,
+            "total_rejected": 0,
+            "total_rejected_pct": 0,
+            "turnout_moe_95": 0,
+            "turnout_moe_99": 0,
+            "all_valid_votes_moe_95": 0,
+            "all_valid_votes_moe_99": 0,
+            "total_rejected_moe_95": 0,
+            "total_rejected_moe_99": 0,
+            "total_blanks_moe_95": 0,
+            "total_blanks_moe_99": 0,
+        }
+        for result_field_label in result_field_labels:
+            report["{}_cnt".format(result_field_label)] = 0
+            report["{}_pct".format(result_field_label)] = 0
+            if calculate_moe:
+                report["{}_moe_95".format(result_field_label)] = 0
+                report["{}_moe_99".format(result_field_label)] = 0
+        return report
+
+    missing = statistics.get("missing", (0,))[0]
+    all_votes, rv = statistics["turnout"][1:3]
+    all_valid_votes = statistics["valid"][1]
+    total_rejected = statistics["rejected"][1] if rejected_votes_field else 0
+    total_blanks = statistics["blank"][1] if blank_votes_field else 0
+
+    report = {
+        "reported_cnt": reported,
+        "missing_cnt": missing,
+        "reported_pct": reported / (reported + missing),
+        "missing_pct": missing / (reported + missing),
+        "rv": rv,
+        "all_votes": all_votes,
+        "turnout": all_votes / rv or np.inf,
+        "all_valid_votes": all_valid_votes,
+        "all_valid_votes_pct": all_valid_votes / all_votes,
+        "total_rejected": total_rejected,
+        "total_rejected_pct": total_rejected / all_votes if rejected_votes_field else 0,
+        "total_blanks": total_blanks,
+        "total_blanks_pct": total_blanks / all_votes if blank_votes_field else 0,
+    }
+    for result_field_label in result_field_labels:
+        share = statistics["share:{}".format(result_field_label)]
+        report["{}_cnt".format(result_field_label)] = share[1]
+        report["{}_pct".format(result_field_label)] = share[1] / float(all_valid_votes)
+
+    if calculate_moe:
+        names = ["turnout", "valid"] + [
+            "share:{}".format(result_field_label) for result_field_label in result_field_labels
+        ]
+        if rejected_votes_field:
+            names.append("rejected")
+        if blank_votes_field:
+            names.append("blank")
+        report.update(_margins_of_error(statistics, names))
+
+    return report
+
+
+def _aggregate_analyses(
+    event, form, location, location_tree, result_field_labels, rejected_votes_field, blank_votes_field
+):
+    """Computes the result summaries from the result aggregates."""
+    root = locations.root(event.location_set_id)
+    location_ids = {root.id, location.id}
+    location_ids.update(sublocation.id for sublocations in location_tree.values() for sublocation in sublocations)
+    statistics = ResultAggregate.load(event, form, location_ids)
+
+    summarize = partial(
+        _aggregate_report,
+        form,
+        result_field_labels=result_field_labels,
+        rejected_votes_field=rejected_votes_field,
+        blank_votes_field=blank_votes_field,
+    )
+    data_analyses = {"overall": summarize(statistics[location.id]), "grouped": {}}
+
+    # no location is summarized if the event has no submissions at all
+    has_submissions = bool(statistics[root.id])
+    for location_type, sublocations in location_tree.items():
+        data_analyses["grouped"][location_type] = [
+            dict(
+                summarize(statistics[sublocation.id]),
+                name=sublocation.name,
+                location_type=sublocation.location_type.name,
+            )
+            for sublocation in sublocations
+            if has_submissions
+        ]
+
+    return data_analyses
+
+
+# TODO: use proper field terminology for the variable names in this function (field, field_label, etc.)
+def voting_results(form_id, location_id=None):
+    """Compute voting results."""
+    event = g.event
+    form = forms.filter(
+        Form.vote_shares != None,  # noqa
+        Form.vote_shares != [],
+        Form.id == form_id,
+        Form.form_type == "CHECKLIST",
+        Form.events.contains(event),
+    ).first()
+
+    if form is None:
+        abort(404)
+
+    if location_id is None:
+        location = locations.root(event.location_set_id)
+    else:
+        location = locations.fget_or_404(id=location_id)
+
+    template_name = "result_analysis/results.html"
+    breadcrumbs = [_("Results Data"), form.name]
+    filter_on_locations = not form.untrack_data_conflicts
+    filter_class = make_submission_analysis_filter(event, form, filter_on_locations)
+
+    loc_types = [lt for lt in location_types.root(event.location_set_id).descendants() if lt.is_political is True]
+
+    location_tree = {}
+    for lt in loc_types:
+        lt_locs = models.Location.query.filter_by(location_type_id=lt.id)
+        location_tree[lt.name] = sorted(lt_locs, key=attrgetter("name"))
+
+    # define the condition for which a submission should be included
+    result_fields = [form.get_field_by_tag(tag) for tag in form.vote_shares] if form.vote_shares else []
+    result_field_labels = form.vote_shares or []
+    result_field_descriptions = [field["description"] for field in result_fields]
+
+    query_kwargs = {"event": event, "form": form}
+    if not form.untrack_data_conflicts:
+        query_kwargs["submission_type"] = "M"
+    else:
+        query_kwargs["submission_type"] = "O"
+
+    queryset = submissions.find(**query_kwargs).filter(
+        models.Submission.verification_status != FLAG_STATUSES["rejected"][0],
+        not_(models.Submission.quarantine_status.in_(["A", "R"])),
+    )
+    filter_set = filter_class(queryset, request.args)
+
+    registered_voters_field = form.registered_voters_tag or "registered_voters"
+    if form.invalid_votes_tag:
+        rejected_votes_field = [form.invalid_votes_tag]
+    else:
+        rejected_votes_field = []
+    if form.blank_votes_tag:
+        blank_votes_field = [form.blank_votes_tag]
+    else:
+        blank_votes_field = []
+    if form.accredited_voters_tag:
+        accredited_voters_field = [form.accredited_voters_tag]
+    else:
+        accredited_voters_field = []
+
+    non_null_fields = rejected_votes_field + blank_votes_field + accredited_voters_field + result_field_labels
+    non_zero_fields = [registered_voters_field]
+
+    excluded_fields = set(form.tags).difference(non_null_fields + non_zero_fields)
+
+    if any(request.args.get(name) for name in filter_set.declared_filters):
+        dataset = analysis_dataframe(
+            filter_set.qs, form, event, query_kwargs["submission_type"], excluded_tags=excluded_fields
+        )
+        _mark_reported(dataset, form, non_null_fields, non_zero_fields)
+        data_analyses = _dataframe_analyses(
+            dataset,
+            form,
+            location,
+            location_tree,
+            result_field_labels,
+            registered_voters_field,
+            rejected_votes_field,
+            blank_votes_field,
+        )
+    else:
+        # without filters, the summaries are computed from the result
+        # aggregates and the submissions are only read for the charts
+        ResultAggregate.ensure(event, form)
+        data_analyses = _aggregate_analyses(
+            event, form, location, location_tree, result_field_labels, rejected_votes_field, blank_votes_field
+        )
+        dataset = _convergence_dataframe(filter_set.qs, form, non_null_fields + non_zero_fields)
+        _mark_reported(dataset, form, non_null_fields, non_zero_fields)
+
     if not dataset.empty:
         convergence_dataset = dataset[dataset.reported == True].fillna(0)  # noqa
     else:
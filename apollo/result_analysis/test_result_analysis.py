@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+import math
+from types import SimpleNamespace
+from unittest import TestCase
+
+import numpy as np
+import pandas as pd
+import pytest
+from flask import current_app
+
+from apollo.core import db
+from apollo.deployments.models import Deployment, Event
+from apollo.formsframework.models import Form
+from apollo.locations.models import Location, LocationPath, LocationSet, LocationType
+from apollo.process_analysis import voting
+from apollo.result_analysis.estimators import (
+    STATISTICS,
+    margin_of_error,
+    point_estimate,
+    ratio_statistics,
+)
+from apollo.result_analysis.models import ResultAggregate, result_contribution
+from apollo.result_analysis.results import _aggregate_analyses, _dataframe_analyses, _mark_reported
+from apollo.submissions.models import FLAG_STATUSES, Submission
+from apollo.submissions.utils import make_submission_dataframe
+
+
+# the estimators the analyses computed separately from the submissions of
+# every location before they were computed from grouped statistics
+def _point_estimate(dataframe, numerator, denominator):
+    if not isinstance(numerator, list):
+        numerator = [numerator]
+    m = dataframe.loc[:, denominator].sum(axis=1)
+    mbar = m.sum(axis=0) / m.size
+    return dataframe.loc[:, numerator].sum(axis=0).sum(axis=0) / (mbar * m.size)  # noqa
+
+
+def _variance(dataframe, numerator, denominator):
+    p = _point_estimate(dataframe, numerator, denominator)
+    psquared = p * p
+
+    m = dataframe.loc[:, denominator].sum(axis=1)
+    msquared = m * m
+
+    if isinstance(numerator, list):
+        a = dataframe.loc[:, numerator].sum(axis=1)
+    else:
+        a = dataframe.loc[:, [numerator]].sum(axis=1)
+    asquared = a * a
+
+    mbar = m.sum(axis=0) / m.size
+    mbarsquared = mbar * mbar
+
+    f = m.sum(axis=0) / current_app.config.get("BIG_N")
+    k = m.size
+    am = a * m
+    sigma_asquared = asquared.sum(axis=0)
+    sigma_msquared = msquared.sum(axis=0)
+    sigma_am = am.sum(axis=0)
+
+    return (
+        ((1 - f) / (k * mbarsquared)) * ((sigma_asquared - (2 * p * sigma_am) + (psquared * sigma_msquared)) / (k - 1))
+        if k != 1
+        else np.nan
+    )
+
+
+def _margin_of_error(dataframe, numerator, denominator, cv=1.96):
+    moe = round(math.sqrt(abs(_variance(dataframe, numerator, denominator))) * cv * 100, 3)
+    if pd.isna(moe) or np.isinf(moe):
+        moe = 0
+    return moe
+
+
+ESTIMATORS = {
+    "turnout": (["P", "Q", "R", "B"], ["registered_voters"]),
+    "valid": (["P", "Q"], ["P", "Q", "R", "B"]),
+    "rejected": ("R", ["P", "Q", "R", "B"]),
+    "blank": ("B", ["P", "Q", "R", "B"]),
+    "share:P": ("P", ["P", "Q"]),
+    "share:Q": ("Q", ["P", "Q"]),
+}
+
+
+def _random_dataset(random, size):
+    dataset = pd.DataFrame(
+        {
+            "P": random.integers(0, 400, size),
+            "Q": random.integers(0, 400, size),
+            "R": random.integers(0, 20, size),
+            "B": random.integers(0, 20, size),
+            "A": random.integers(0, 900, size),
+            "registered_voters": random.integers(0, 1000, size),
+        }
+    ).astype(np.float64)
+    dataset.loc[random.choice(size, size // 10, replace=False), "Q"] = np.nan
+    dataset.loc[random.choice(size, size // 25, replace=False), "P"] = 9999
+
+    return dataset
+
+
+class ResultAggregateTest(TestCase):
+    def setUp(self):
+        self.form = Form(
+            name="Results",
+            form_type="CHECKLIST",
+            calculate_moe=True,
+            vote_shares=["P", "Q"],
+            invalid_votes_tag="R",
+            blank_votes_tag="B",
+            accredited_voters_tag="A",
+            data={
+                "groups": [
+                    {
+                        "name": "Results",
+                        "slug": "results",
+                        "fields": [
+                            {"tag": "P", "type": "integer", "null_value": 9999},
+                            {"tag": "Q", "type": "integer"},
+                            {"tag": "R", "type": "integer"},
+                            {"tag": "B", "type": "integer"},
+                            {"tag": "A", "type": "integer"},
+                        ],
+                    }
+                ]
+            },
+        )
+
+    def test_reported_contribution(self):
+        contribution = result_contribution(self.form, {"P": 60, "Q": 30, "R": 5, "B": 5, "A": 110}, 200)
+
+        self.assertEqual(contribution["reported"], (1, 0, 0, 0, 0, 0))
+        self.assertEqual(contribution["turnout"], (1, 100, 200, 10000, 40000, 20000))
+        self.assertEqual(contribution["valid"], (1, 90, 100, 8100, 10000, 9000))
+        self.assertEqual(contribution["rejected"], (1, 5, 100, 25, 10000, 500))
+        self.assertEqual(contribution["blank"], (1, 5, 100, 25, 10000, 500))
+        self.assertEqual(contribution["share:P"], (1, 60, 90, 3600, 8100, 5400))
+        self.assertEqual(contribution["share:Q"], (1, 30, 90, 900, 8100, 2700))
+        self.assertNotIn("missing", contribution)
+
+    def test_missing_contribution(self):
+        missing = {"missing": (1, 0, 0, 0, 0, 0)}
+
+        # the null value of a vote share is treated as blank
+        self.assertEqual(result_contribution(self.form, {"P": 9999, "Q": 30, "R": 5, "B": 5, "A": 110}, 200), missing)
+        self.assertEqual(result_contribution(self.form, {"P": 60, "Q": 30, "R": 5, "A": 110}, 200), missing)
+        self.assertEqual(result_contribution(self.form, {"P": 60, "Q": 30, "R": 5, "B": 5, "A": 110}, 0), missing)
+        self.assertEqual(result_contribution(self.form, {"P": 0, "Q": 0, "R": 5, "B": 5, "A": 110}, 200), missing)
+
+    def test_estimates_match_dataframe(self):
+        random = np.random.default_rng(42)
+        dataset = _random_dataset(random, 500)
+
+        statistics = {}
+        for row in dataset.to_dict("records"):
+            data = {tag: int(value) for tag, value in row.items() if not np.isnan(value)}
+            for name, values in result_contribution(self.form, data, data.get("registered_voters")).items():
+                statistics[name] = tuple(
+                    total + value for total, value in zip(statistics.get(name, (0,) * len(STATISTICS)), values)
+                )
+
+        _mark_reported(dataset, self.form, ["R", "B", "A", "P", "Q"], ["registered_voters"])
+        valid_dataframe = dataset[dataset.reported == True]  # noqa: E712
+
+        self.assertEqual(statistics["reported"][0], dataset.reported.sum())
+        self.assertEqual(statistics["missing"][0], dataset.missing.sum())
+
+        for name, (numerator, denominator) in ESTIMATORS.items():
+            self.assertAlmostEqual(
+                point_estimate(statistics[name]), _point_estimate(valid_dataframe, numerator, denominator)
+            )
+            for cv in (1.96, 2.58):
+                self.assertAlmostEqual(
+                    margin_of_error(statistics[name], cv), _margin_of_error(valid_dataframe, numerator, denominator, cv)
+                )
+
+    def test_single_location_margin_of_error(self):
+        self.assertEqual(margin_of_error((1, 60, 90, 3600, 8100, 5400)), 0)
+
+
+class RatioEstimatorTest(TestCase):
+    def setUp(self):
+        random = np.random.default_rng(7)
+        self.dataset = _random_dataset(random, 400)
+        self.dataset["Region"] = random.choice(["North", "South", "East", "West"], 400)
+        # a region with a single submission has no margin of error
+        self.dataset.loc[0, "Region"] = "Island"
+
+    def test_grouped_estimates_match_dataframe(self):
+        statistics = ratio_statistics(self.dataset, ESTIMATORS, by=self.dataset["Region"])
+        self.assertEqual(sorted(statistics.index), ["East", "Island", "North", "South", "West"])
+
+        for name, (numerator, denominator) in ESTIMATORS.items():
+            estimates = point_estimate(statistics[name])
+            margins = {cv: margin_of_error(statistics[name], cv) for cv in (1.96, 2.58)}
+
+            for region, subset in self.dataset.groupby("Region"):
+                self.assertAlmostEqual(estimates[region], _point_estimate(subset, numerator, denominator))
+                for cv, margin in margins.items():
+                    self.assertAlmostEqual(margin[region], _margin_of_error(subset, numerator, denominator, cv))
+
+        self.assertEqual(margin_of_error(statistics["turnout"])["Island"], 0)
+
+    def test_overall_estimates_match_dataframe(self):
+        statistics = ratio_statistics(self.dataset, ESTIMATORS)
+
+        for name, (numerator, denominator) in ESTIMATORS.items():
+            self.assertAlmostEqual(
+                point_estimate(statistics[name]), _point_estimate(self.dataset, numerator, denominator)
+            )
+            self.assertAlmostEqual(
+                margin_of_error(statistics[name], 2.58), _margin_of_error(self.dataset, numerator, denominator, 2.58)
+            )
+
+        self.assertEqual(margin_of_error(ratio_statistics(self.dataset.iloc[:0], ESTIMATORS)["turnout"]), 0)
+
+    def test_process_analysis_proportion(self):
+        self.assertAlmostEqual(
+            voting.proportion(self.dataset, ["P", "Q"], "P"), _point_estimate(self.dataset, "P", ["P", "Q"])
+        )
+        self.assertAlmostEqual(voting.variance(self.dataset, ["P", "Q"], "P"), _variance(self.dataset, "P", ["P", "Q"]))
+
+    def test_dataframe_analyses_margins_of_error(self):
+        form = Form(
+            name="Results",
+            form_type="CHECKLIST",
+            calculate_moe=True,
+            vote_shares=["P", "Q"],
+            invalid_votes_tag="R",
+            blank_votes_tag="B",
+            accredited_voters_tag="A",
+            data={"groups": [{"name": "Results", "fields": [{"tag": tag, "type": "integer"} for tag in "PQRBA"]}]},
+        )
+        dataset = self.dataset.assign(Country="Country", updated=pd.Timestamp("2024-01-01"))
+        _mark_reported(dataset, form, ["R", "B", "A", "P", "Q"], ["registered_voters"])
+
+        def _location(name, location_type):
+            return SimpleNamespace(name=name, location_type=SimpleNamespace(name=location_type))
+
+        regions = [_location(name, "Region") for name in ["East", "Island", "North", "South", "West", "Nowhere"]]
+        analyses = _dataframe_analyses(
+            dataset,
+            form,
+            _location("Country", "Country"),
+            {"Region": regions},
+            ["P", "Q"],
+            "registered_voters",
+            ["R"],
+            ["B"],
+        )
+
+        keys = {
+            "turnout": "turnout",
+            "valid": "all_valid_votes",
+            "rejected": "total_rejected",
+            "blank": "total_blanks",
+            "share:P": "P",
+            "share:Q": "Q",
+        }
+        reported = dataset[dataset.reported == True]  # noqa: E712
+        reports = [(analyses["overall"], reported)] + [
+            (report, reported[reported.Region == report["name"]]) for report in analyses["grouped"]["Region"]
+        ]
+        for report, subset in reports:
+            for name, (numerator, denominator) in ESTIMATORS.items():
+                for level, cv in (("95", 1.96), ("99", 2.58)):
+                    expected = _margin_of_error(subset, numerator, denominator, cv) if not subset.empty else 0
+                    self.assertAlmostEqual(report[f"{keys[name]}_moe_{level}"], expected)
+
+
+def test_aggregates_follow_bulk_updates(app, mocker):
+    """Tests that master checklists edited with bulk updates are applied to the result aggregates."""
+    deployment = Deployment(name="Default", hostnames=["localhost"], primary_locale="en")
+    location_set = LocationSet(name="Locations", deployment=deployment)
+    country_type = LocationType(name_translations={"en": "Country"}, location_set=location_set)
+    station_type = LocationType(name_translations={"en": "Station"}, location_set=location_set)
+    country = Location(
+        name_translations={"en": "Country"}, code="0", location_type=country_type, location_set=location_set
+    )
+    stations = [
+        Location(
+            name_translations={"en": f"Station {index}"},
+            code=str(index),
+            registered_voters=100 * index + 200,
+            location_type=station_type,
+            location_set=location_set,
+        )
+        for index in range(1, 5)
+    ]
+    event = Event(name="Election", deployment=deployment, location_set=location_set)
+    form = Form(
+        name="Results",
+        prefix="RES",
+        form_type="CHECKLIST",
+        deployment=deployment,
+        calculate_moe=True,
+        vote_shares=["P", "Q"],
+        invalid_votes_tag="R",
+        blank_votes_tag="B",
+        data={"groups": [{"name": "Results", "fields": [{"tag": tag, "type": "integer"} for tag in "PQRB"]}]},
+    )
+    db.session.add_all([country, *stations, event, form])
+    db.session.flush()
+
+    db.session.add_all(
+        [
+            LocationPath(
+                location_set_id=location_set.id, ancestor_id=ancestor.id, descendant_id=location.id, depth=depth
+            )
+            for location in [country, *stations]
+            for ancestor, depth in ([(location, 0)] if location is country else [(location, 0), (country, 1)])
+        ]
+    )
+    masters = [
+        Submission(deployment=deployment, event=event, form=form, location=station, submission_type="M", data=data)
+        for station, data in zip(
+            stations,
+            [
+                {"P": 60, "Q": 30, "R": 5, "B": 5},
+                {"P": 100, "Q": 80, "R": 10, "B": 0},
+                {"P": 40, "Q": 70, "R": 2, "B": 1},
+                {},
+            ],
+        )
+    ]
+    db.session.add_all(masters)
+    db.session.commit()
+    ResultAggregate.ensure(event, form)
+
+    # the masters are edited the way the checklist views edit them, and the
+    # aggregates are not rebuilt afterwards
+    rebuild = mocker.patch.object(ResultAggregate, "rebuild")
+    for master, update_params in (
+        (masters[3], {"data": {"P": 90, "Q": 120, "R": 3, "B": 2}}),
+        (masters[1], {"data": {"P": 110, "Q": 80, "R": 10, "B": 4}}),
+        (masters[0], {"quarantine_status": "A"}),
+    ):
+        with ResultAggregate.track([master.id]):
+            Submission.query.filter_by(id=master.id).update(update_params, synchronize_session=False)
+        db.session.commit()
+    ResultAggregate.ensure(event, form)
+    rebuild.assert_not_called()
+
+    aggregate_analyses = _aggregate_analyses(event, form, country, {}, ["P", "Q"], ["R"], ["B"])
+
+    queryset = Submission.query.filter(
+        Submission.event_id == event.id,
+        Submission.form_id == form.id,
+        Submission.submission_type == "M",
+        Submission.verification_status != FLAG_STATUSES["rejected"][0],
+        Submission.quarantine_status.notin_(["A", "R"]),
+    )
+    dataset = make_submission_dataframe(queryset, form)
+    _mark_reported(dataset, form, ["R", "B", "P", "Q"], ["registered_voters"])
+    dataframe_analyses = _dataframe_analyses(dataset, form, country, {}, ["P", "Q"], "registered_voters", ["R"], ["B"])
+
+    assert aggregate_analyses["overall"]["reported_cnt"] == 3
+    assert aggregate_analyses["overall"].keys() == dataframe_analyses["overall"].keys()
+    for key, value in dataframe_analyses["overall"].items():
+        assert aggregate_analyses["overall"][key] == pytest.approx(value), key
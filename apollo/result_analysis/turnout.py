@@ -1,62 +1,19 @@
-import math
 from operator import attrgetter
 
 import numpy as np
-from flask import abort, current_app, g, render_template, request, url_for
+from flask import abort, g, render_template, request, url_for
 from flask_babel import gettext as _
 from sqlalchemy import not_
 
 from apollo import models
 from apollo.formsframework.models import Form
 from apollo.frontend.helpers import analysis_breadcrumb_data, analysis_navigation_data
+from apollo.result_analysis.estimators import margin_of_error, ratio_statistics
 from apollo.services import forms, location_types, locations, submissions
+from apollo.submissions.analysis_cache import analysis_turnout_dataframe
 from apollo.submissions.filters import make_submission_analysis_filter
 from apollo.submissions.models import FLAG_STATUSES
-from apollo.submissions.utils import make_turnout_dataframe, valid_turnout_dataframe
-
-
-def _point_estimate(dataframe, numerator, denominator):
-    if not isinstance(numerator, list):
-        numerator = [numerator]
-    m = dataframe.loc[:, denominator].sum(axis=1)
-    mbar = m.sum(axis=0) / m.size
-    return dataframe.loc[:, numerator].sum(axis=0).sum(axis=0) / (mbar * m.size)  # noqa
-
-
-def _variance(dataframe, numerator, denominator):
-    p = _point_estimate(dataframe, numerator, denominator)
-    psquared = p * p
-
-    m = dataframe.loc[:, denominator].sum(axis=1)
-    msquared = m * m
-
-    if isinstance(numerator, list):
-        a = dataframe.loc[:, numerator].sum(axis=1)
-    else:
-        a = dataframe.loc[:, [numerator]].sum(axis=1)
-    asquared = a * a
-
-    mbar = m.sum(axis=0) / m.size
-    mbarsquared = mbar * mbar
-
-    f = m.sum(axis=0) / current_app.config.get("BIG_N")
-    k = m.size
-    am = a * m
-    sigma_asquared = asquared.sum(axis=0)
-    sigma_msquared = msquared.sum(axis=0)
-    sigma_am = am.sum(axis=0)
-
-    return ((1 - f) / (k * mbarsquared)) * (
-        (sigma_asquared - (2 * p * sigma_am) + (psquared * sigma_msquared)) / (k - 1)
-    )
-
-
-def _margin_of_error(dataframe, numerator, denominator, cv=1.96):
-    """Computes the margin of error."""
-    moe = round(math.sqrt(abs(_variance(dataframe, numerator, denominator))) * cv * 100, 3)
-    if np.isnan(moe) or np.isinf(moe):
-        moe = 0
-    return moe
+from apollo.submissions.utils import valid_turnout_dataframe
 
 
 def turnout_convergence(form_id, location_id=None):
@@ -107,7 +64,7 @@ def turnout_convergence(form_id, location_id=None):
         models.Submission.location_id.in_(location_ids),
     )
     filter_set = filter_class(queryset, request.args)
-    dataset = make_turnout_dataframe(filter_set.qs, form)
+    dataset = analysis_turnout_dataframe(filter_set.qs, form, event, query_kwargs["submission_type"])
 
     for turnout_field in turnout_fields:
         null_value_orig = turnout_field.get("null_value")
@@ -131,6 +88,9 @@ def turnout_convergence(form_id, location_id=None):
         turnouts_reported = valid_dataset.notna().sum()
         turnouts_missing = valid_dataset.isna().sum()
         turnouts_sum = valid_dataset.sum()
+        turnout_statistics = ratio_statistics(
+            valid_dataset, {"turnout": ([turnout_field_label], ["registered_voters"])}
+        )["turnout"]
 
         summary[turnout_field_label] = {
             "total_registered": turnouts_sum["registered_voters"],
@@ -139,8 +99,8 @@ def turnout_convergence(form_id, location_id=None):
             "missing_cnt": turnouts_missing[turnout_field_label],
             "missing_pct": turnouts_missing[turnout_field_label] / turnouts_count,  # noqa
             "turnout_cnt": turnouts_sum[turnout_field_label],
-            "turnout_moe_95": _margin_of_error(valid_dataset, [turnout_field_label], ["registered_voters"], 1.96),  # noqa
-            "turnout_moe_99": _margin_of_error(valid_dataset, [turnout_field_label], ["registered_voters"], 2.58),  # noqa
+            "turnout_moe_95": margin_of_error(turnout_statistics, 1.96),
+            "turnout_moe_99": margin_of_error(turnout_statistics, 2.58),
         }
         try:
             summary[turnout_field_label]["turnout_pct"] = (
@@ -149,6 +149,13 @@ TRANSLATE_CHARS = config("TRANSLATE_CHARS", cast=config.boolean, default=True)
 TRANSLITERATE_INPUT = config("TRANSLITERATE_INPUT", cast=config.boolean, default=False)
 TRANSLITERATE_OUTPUT = config("TRANSLITERATE_OUTPUT", cast=config.boolean, default=False)
 
+# queued processing of incoming text messages: when enabled, the gateway
+# webhooks only queue the message and background tasks process the queues
+MESSAGING_QUEUE_ENABLED = config("MESSAGING_QUEUE_ENABLED", cast=config.boolean, default=False)
+MESSAGING_QUEUE_COUNT = config("MESSAGING_QUEUE_COUNT", cast=int, default=16)
+MESSAGING_QUEUE_BATCH_SIZE = config("MESSAGING_QUEUE_BATCH_SIZE", cast=int, default=100)
+MESSAGING_QUEUE_LOCK_TTL = config("MESSAGING_QUEUE_LOCK_TTL", cast=int, default=300)  # in seconds
+
 # SQLAlchemy settings
 DATABASE_HOSTNAME = config("DATABASE_HOSTNAME", default="postgres")
 DATABASE_USERNAME = config("DATABASE_USERNAME", default="postgres")
@@ -184,6 +191,36 @@ KEEPALIVE_INTERVAL = 15  # in seconds
 
 TASK_STATUS_TTL = config("TASK_STATUS_TTL", cast=int, default=300)  # in seconds
 
+# background tasks report their progress after this many records have been
+# processed or after this many seconds have elapsed, whichever comes first
+TASK_PROGRESS_BATCH_SIZE = config("TASK_PROGRESS_BATCH_SIZE", cast=int, default=500)
+TASK_PROGRESS_INTERVAL = config("TASK_PROGRESS_INTERVAL", cast=float, default=2.0)  # in seconds
+
+# background exports: how long a running export blocks identical requests
+# from starting another task and how long export files are kept around
+EXPORT_TASK_TTL = config("EXPORT_TASK_TTL", cast=int, default=3600)  # in seconds
+EXPORT_FILE_TTL = config("EXPORT_FILE_TTL", cast=int, default=86400)  # in seconds
+
+# exports are written in chunks of about this many characters, and the
+# aggregated exports load as many submissions at a time as fit in this memory
+EXPORT_CHUNK_SIZE = config("EXPORT_CHUNK_SIZE", cast=int, default=65536)
+AGGREGATED_EXPORT_MEMORY_MB = config("AGGREGATED_EXPORT_MEMORY_MB", cast=int, default=256)
+
+# how long the quality assurance dashboard counts are cached for. the counts
+# are computed again as soon as any of the submissions are modified
+QA_COUNTS_CACHE_TTL = config("QA_COUNTS_CACHE_TTL", cast=int, default=86400)  # in seconds
+
+# how long the response rate dashboard coverage is cached for
+DASHBOARD_CACHE_TTL = config("DASHBOARD_CACHE_TTL", cast=int, default=60)  # in seconds
+
+# whether the submission dataframes of the analysis views are cached on disk.
+# the dataframes are loaded again as soon as any of the submissions change
+ANALYSIS_CACHE_ENABLED = config("ANALYSIS_CACHE_ENABLED", cast=config.boolean, default=True)
+
+# how long the rendered ODK XForms are kept. the forms are rendered again
+# as soon as they're modified
+XFORM_CACHE_TTL = config("XFORM_CACHE_TTL", cast=int, default=86400)  # in seconds
+
 # attachment settings
 BASE_UPLOAD_PATH = Path(config("DEFAULT_STORAGE_PATH", default=DEFAULT_UPLOAD_PATH))
 IMAGE_UPLOAD_PATH = Path(config("IMAGES_STORAGE_PATH", default=BASE_UPLOAD_PATH.joinpath("images")))
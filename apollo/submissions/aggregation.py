@@ -1,85 +1,337 @@
 # -*- coding: utf-8 -*-
-import codecs
 import collections
 import csv
-from functools import partial
-from io import StringIO
+import hashlib
+import json
 from itertools import chain
 
 import numpy as np
 import pandas as pd
+import sqlalchemy as sa
 from flask_babel import gettext as _
 
-from apollo.submissions.qa.query_builder import get_logical_check_stats
-from apollo.submissions.utils import make_submission_dataframe
+from apollo import settings
+from apollo.core import red
+from apollo.submissions.exports import csv_chunks
+from apollo.submissions.models import Submission
+from apollo.submissions.qa.query_builder import get_logical_checks_stats
+from apollo.submissions.utils import load_submission_dataframe
+
+# the labels of the statistics of the fields other than the option counts
+VALUE = "value"
+COUNT = "count"
+
+# the label of the number of submissions of every location
+TOTAL = ("", "total")
+
+# the number of statistics that are summed at a time
+SUM_COLUMNS = 64
+
+# the approximate memory taken up by a multiselect value, in bytes
+MULTISELECT_VALUE_SIZE = 120
+
+
+def option_indicators(column, options):
+    """One-hot encodes the options selected in a select or multiselect column.
+
+    Args:
+        column: the values of the field. Multiselect values are lists.
+        options: the option values.
+
+    Returns:
+        an array with a row for every value and a column for every option
+        that is set to one where the option was selected.
+    """
+    options = np.asarray(list(options))
+    if not len(options):
+        return np.zeros((len(column), 0), dtype=np.uint8)
+
+    values = column.to_numpy()
+    rows = np.arange(len(values))
+    if values.dtype == object:
+        # every option in a list of options is on a row of its own
+        exploded = pd.Series(values, copy=False).explode()
+        rows = exploded.index.to_numpy()
+        values = exploded.to_numpy()
+
+    try:
+        # numeric options are looked up in the sorted options
+        values = values.astype(np.float64)
+        order = np.argsort(options)
+        sorted_options = options[order].astype(np.float64)
+        positions = np.searchsorted(sorted_options, values).clip(max=len(options) - 1)
+        selected = sorted_options[positions] == values
+        codes = order[positions]
+    except (TypeError, ValueError):
+        codes = pd.Index(options).get_indexer(values)
+        selected = codes >= 0
+
+    indicators = np.zeros((len(column), len(options)), dtype=np.uint8)
+    indicators[rows[selected], codes[selected]] = 1
+
+    return indicators
+
+
+def field_statistics(dataframe, fields):
+    """Returns the statistics that are summed to aggregate form fields.
+
+    Every field has a (tag, "count") column that is set to one where the
+    field was reported. Integer fields also have their value under
+    (tag, "value"), and select and multiselect fields a (tag, option)
+    column for every option value, set to one where it was selected.
+    """
+    values = [field["tag"] for field in fields if field["type"] == "integer"]
+    options = {
+        field["tag"]: sorted(field["options"].values())
+        for field in fields
+        if field["type"] in ("select", "multiselect")
+    }
+    labels = [(tag, option) for tag, tag_options in options.items() for option in tag_options]
+    labels.extend((field["tag"], COUNT) for field in fields)
+
+    # the indicators of all the fields are kept in a single block
+    indicators = np.zeros((len(dataframe), len(labels)), dtype=np.uint8)
+    start = 0
+    for tag, tag_options in options.items():
+        indicators[:, start : start + len(tag_options)] = option_indicators(dataframe[tag], tag_options)
+        start += len(tag_options)
+    for index, field in enumerate(fields, start):
+        indicators[:, index] = dataframe[field["tag"]].notna().to_numpy()
+
+    return pd.concat(
+        [
+            pd.DataFrame(
+                dataframe[values].fillna(0).to_numpy(np.float64),
+                index=dataframe.index,
+                columns=pd.Index([(tag, VALUE) for tag in values], tupleize_cols=False),
+            ),
+            pd.DataFrame(indicators, index=dataframe.index, columns=pd.Index(labels, tupleize_cols=False)),
+        ],
+        axis=1,
+        copy=False,
+    )
+
+
+def location_sums(dataframe, levels, statistics):
+    """Sums statistics over the locations of the lowest level.
+
+    Args:
+        dataframe: the submission dataframe with the location name columns.
+        levels: the location type names to aggregate by, from the root down.
+        statistics: the values to sum, indexed like the submissions.
+
+    Returns:
+        the sums of the statistics and the number of submissions under
+        `TOTAL`, indexed by the location names of every level. Missing
+        location names are kept so the sums of the higher levels include
+        the submissions.
+    """
+    # the statistics are summed a few columns at a time, as the sums are
+    # computed on a widened copy of the columns
+    keys = [dataframe[name] for name in levels]
+    sums = [
+        statistics.iloc[:, start : start + SUM_COLUMNS].groupby(keys, dropna=False).sum()
+        for start in range(0, statistics.shape[1], SUM_COLUMNS)
+    ]
+    totals = dataframe.groupby(levels, dropna=False).size().to_frame(TOTAL)
+
+    return pd.concat(sums + [totals], axis=1)
+
+
+def roll_up(sums, levels):
+    """Computes the statistics of every level from the sums of the lowest level locations.
+
+    Returns:
+        the sums of the statistics and the number of submissions under
+        `TOTAL` for every location of every level, ordered by level and
+        location names. The index has the level and the name of the
+        location of every level, which is missing below the level.
+    """
+    frames = []
+    for index, level in enumerate(levels):
+        level_sums = sums.groupby(level=list(range(index + 1)), sort=True).sum()
+
+        locations = level_sums.index.to_frame(index=False).reindex(columns=levels)
+        locations.insert(0, "level", level)
+        level_sums.index = pd.MultiIndex.from_frame(locations)
+        frames.append(level_sums)
+
+    return pd.concat(frames)
+
+
+def level_statistics(dataframe, levels, statistics):
+    """Sums statistics over the locations of every level.
+
+    See `location_sums` and `roll_up`.
+    """
+    return roll_up(location_sums(dataframe, levels, statistics), levels)
+
+
+def _batch_size(fields, levels, memory_budget):
+    """Returns the number of submissions whose statistics fit in a memory budget.
+
+    The dataframe of a batch and its statistics are in memory together,
+    along with the copies made while they are computed.
+    """
+    # the location names, update time and registered voters of a submission
+    row_size = 8 * (len(levels) + 2)
+    for field in fields:
+        row_size += 8 + 1
+        if field["type"] == "integer":
+            row_size += 8
+        elif field["type"] == "select":
+            row_size += len(field["options"])
+        elif field["type"] == "multiselect":
+            row_size += len(field["options"]) + MULTISELECT_VALUE_SIZE
+
+    return max(memory_budget // (2 * row_size), 1)
+
+
+def aggregate_statistics(query, form, fields, levels, memory_budget=None, progress=None):
+    """Computes the statistics of form fields for every location of every level.
+
+    The submissions are loaded in batches that fit in the memory budget,
+    and only the sums of the lowest level locations are kept between the
+    batches.
+
+    Args:
+        query: the submission query.
+        form: the form of the submissions.
+        fields: the fields to compute the statistics of.
+        levels: the location type names to aggregate by, from the root down.
+        memory_budget: the memory the batches are loaded in, in bytes. The
+            configured budget is used if not given.
+        progress: an optional `TaskProgress` updated for every batch.
+
+    Returns:
+        the statistics as returned by `roll_up`, or None if the query has
+        no submissions.
+    """
+    if memory_budget is None:
+        memory_budget = settings.AGGREGATED_EXPORT_MEMORY_MB * 2**20
+
+    ids = np.sort(np.fromiter((pk for (pk,) in query.order_by(None).with_entities(Submission.id)), dtype=np.int64))
+    batch_size = _batch_size(fields, levels, memory_budget)
+    tags = [field["tag"] for field in fields]
+
+    sums = None
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start : start + batch_size]
+        dataframe = load_submission_dataframe(
+            query.filter(Submission.id.between(int(batch[0]), int(batch[-1]))), form, tags
+        )
+        if not dataframe.empty:
+            batch_sums = location_sums(dataframe, levels, field_statistics(dataframe, fields))
+            if sums is not None:
+                batch_sums = pd.concat([sums, batch_sums]).groupby(level=list(range(len(levels))), dropna=False).sum()
+            sums = batch_sums
+        del dataframe
+
+        if progress is not None:
+            progress.processed_records += len(batch)
+            progress.update()
+
+    if sums is None:
+        return None
+
+    return roll_up(sums, levels)
+
+
+def _location_levels(query):
+    """Returns the location type names of the ancestors of the submission locations, from the root down."""
+    submission = query.first()
+    if submission is None:
+        return []
+
+    return [ancestor.location_type.name for ancestor in submission.location.ancestors()]
 
 
 def aggregated_dataframe(queryset, form):
-    """Generate aggregated dataframe."""
-    agg_locations = [anc.location_type.name for anc in queryset.first().location.ancestors()]
-    # change order of locations so the largest is first
-    agg_locations.reverse()
-    df_submissions = make_submission_dataframe(queryset, form)
-    all_fields = []
-
-    # iterate through fields
-    tags = form.tags
-    for tag in tags:
-        field = form.get_field_by_tag(tag)
-        # multiselect options field
-        options = field.get("options")
-        if options:
+    """Generate aggregated dataframe.
+
+    Integer fields are summed, and the options of select and multiselect
+    fields are counted in "tag|option" columns, for every location of
+    every level.
+    """
+    levels = _location_levels(queryset)
+    fields = [
+        field
+        for field in map(form.get_field_by_tag, form.tags)
+        if field["type"] == "integer" or (field["type"] in ("select", "multiselect") and field.get("options"))
+    ]
+    statistics = aggregate_statistics(queryset, form, fields, levels)
+    if statistics is None:
+        return pd.DataFrame()
+
+    columns = {}
+    for field in fields:
+        tag = field["tag"]
+        if field["type"] == "integer":
+            columns[tag] = statistics[(tag, VALUE)].to_numpy(np.int64)
+        else:
             # column options are in the format tagname|option
             # e.g. (AB|1, AB|2, ...)
-            # initialize the default value counts for each option
-            default_options = {"{}|{}".format(tag, option): 0 for option in options.values()}
-            all_fields.extend(sorted(default_options.keys()))
-            col = df_submissions.pop(tag).tolist()
-            for i, r in enumerate(col):
-                options = default_options.copy()
-                # multivalued fields have a list of values
-                if isinstance(r, list):
-                    for o in r:
-                        if o in options.values():
-                            options["{}|{}".format(tag, o)] = 1
-                else:
-                    if r in options.values():
-                        options["{}|{}".format(tag, r)] = 1
-                col[i] = options
-            df = pd.DataFrame(col)
-            df_submissions = df_submissions.join(df)
-        else:
-            all_fields.append(tag)
+            options = {f"{tag}|{option}": option for option in field["options"].values()}
+            columns.update((name, statistics[(tag, options[name])].to_numpy(np.int64)) for name in sorted(options))
+
+    locations = statistics.index.to_frame(index=False)[levels]
+
+    return pd.concat([locations, pd.DataFrame(columns)], axis=1).fillna("")
 
-    # group and aggregate
-    df_agg = pd.DataFrame(columns=agg_locations + all_fields)
-    for idx in range(len(agg_locations)):
-        grouping = agg_locations[: idx + 1]
-        for group_name, group_df in df_submissions.groupby(grouping):
-            data_series = group_df.sum()[all_fields]
-            if len(grouping) == 1:
-                data_series[grouping[0]] = group_name
-            elif len(grouping) > 1:
-                for i, g in enumerate(grouping):
-                    data_series[g] = group_name[i]
-            df_agg = df_agg.append(data_series, ignore_index=True)
 
-    df_agg = df_agg.fillna("")
-    return df_agg
+def aggregated_export(queryset, form):
+    """Yields the CSV chunks of the aggregated dataframe."""
+    dataframe = aggregated_dataframe(queryset, form)
+    if dataframe.empty:
+        return
+
+    rows = chain([dataframe.columns.tolist()], map(list, zip(*(dataframe[name].tolist() for name in dataframe))))
+    yield from csv_chunks(rows, bom=False, quoting=csv.QUOTE_MINIMAL, lineterminator="\n")
+
+
+def _qa_counts_key(query, form):
+    """Computes the cache key of the QA counts of a query.
+
+    The key changes whenever the form checks or the filters change, or when
+    any of the submissions is updated, added or removed.
+    """
+    last_updated, count = (
+        query.order_by(None).with_entities(sa.func.max(Submission.updated), sa.func.count(Submission.id)).one()
+    )
+    statement = query.statement.compile()
+    data = {
+        "form": form.id,
+        "version": form.version_identifier,
+        "checks": form.quality_checks,
+        "statement": str(statement),
+        "params": sorted(statement.params.items()),
+        "updated": last_updated.isoformat() if last_updated else None,
+        "count": count,
+    }
+
+    digest = hashlib.sha256(json.dumps(data, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+    return f"qa-counts:{digest}"
 
 
 def _qa_counts(query, form):
     data = []
     if form.quality_checks:
-        for check in form.quality_checks:
+        key = _qa_counts_key(query, form)
+        cached = red.get(key)
+        if cached is not None:
+            return json.loads(cached)
+
+        results = get_logical_checks_stats(query, form, form.quality_checks)
+        for check, check_results in zip(form.quality_checks, results):
             d = {"name": check["name"], "description": check["description"]}
 
-            results = get_logical_check_stats(query, form, check)
-            for label, count in results:
+            for label, count in check_results:
                 d[label] = count
 
             data.append(d)
 
+        red.set(key, json.dumps(data), ex=settings.QA_COUNTS_CACHE_TTL)
+
     return data
 
 
@@ -99,18 +351,51 @@ def _multiselect_field_processor(options, column):
     return [value_counts.get(opt, 0) for opt in sorted(options)]
 
 
-def aggregate_dataset(query, form, stream=False):
-    """Export aggregated dataset."""
-    data_frame = make_submission_dataframe(query, form)
+def aggregate_rows(statistics, levels, fields):
+    """Yields the rows of the aggregated dataset from the statistics of every level."""
+    locations = statistics.index.to_frame(index=False).fillna("")
+    totals = statistics[TOTAL].to_numpy(np.int64)
+
+    columns = [locations["level"].tolist()]
+    columns.extend(locations[level].tolist() for level in levels)
+    columns.append(totals.tolist())
+    for field in fields:
+        tag = field["tag"]
+        if field["type"] == "integer":
+            columns.append(statistics[(tag, VALUE)].to_numpy(np.int64).tolist())
+        elif field["type"] in ("multiselect", "select"):
+            columns.extend(
+                statistics[(tag, option)].to_numpy(np.int64).tolist() for option in sorted(field["options"].values())
+            )
+
+        reported = statistics[(tag, COUNT)].to_numpy(np.int64)
+        columns.append(reported.tolist())
+        columns.append((totals - reported).tolist())
+        columns.append(
+            [
+                round(100.0 * (count / total), 2) if total else 0
+                for count, total in zip(reported.tolist(), totals.tolist())
+            ]
+        )
+
+    yield from map(list, zip(*columns))
 
-    if data_frame.empty:
-        yield None
-        return
 
-    location_type_names = [a.location_type.name for a in query.first().location.ancestors()]
+def aggregate_dataset(query, form, stream=False, progress=None):
+    """Export aggregated dataset.
+
+    The dataset has a row for every location of every level. When
+    streamed, it is written as CSV in chunks.
+    """
+    location_type_names = _location_levels(query)
 
     fields = [form.get_field_by_tag(tag) for tag in form.tags]
 
+    statistics = aggregate_statistics(query, form, fields, location_type_names, progress=progress)
+    if statistics is None:
+        yield None
+        return
+
     headers = [_("Level")] + location_type_names + [_("Total")]
     for field in fields:
         if field["type"] == "integer":
@@ -121,67 +406,10 @@ def aggregate_dataset(query, form, stream=False):
         headers.append(_("%(tag)s (Nulls)", tag=field["tag"]))
         headers.append(_("%(tag)s (Percentage)", tag=field["tag"]))
 
-    if stream:
-        output_stream = StringIO()
-        output_stream.write(codecs.BOM_UTF8.decode("utf-8"))
-        writer = csv.writer(output_stream, quoting=csv.QUOTE_NONNUMERIC)
-        writer.writerow(headers)
+    rows = aggregate_rows(statistics, location_type_names, fields)
 
-        yield output_stream.getvalue()
+    if stream:
+        yield from csv_chunks(chain([headers], rows))
     else:
         yield headers
-
-    for idx, level in enumerate(location_type_names):
-        group_subset = location_type_names[: idx + 1]
-
-        # the hard stuff comes here
-        grouped_dataframe = data_frame.groupby(group_subset)
-
-        # start with numeric fields. they're the easiest
-        for group_key, group in grouped_dataframe:
-            current_row = []
-
-            # add level info
-            current_row.append(level)
-
-            if idx == 0:
-                current_row.append(group_key)
-            else:
-                current_row.extend(group_key)
-
-            # add location info
-            padding_size = len(location_type_names) - len(group_subset)
-            current_row.extend([""] * padding_size)
-            current_row.append(group.shape[0])
-
-            for field in fields:
-                reported = group[field["tag"]].count()
-                total = group[field["tag"]].size
-                missing = total - reported
-                try:
-                    percent_reported = round(100.0 * (reported / total), 2)
-                except ZeroDivisionError:
-                    percent_reported = 0
-
-                if field["type"] == "integer":
-                    processor = _numeric_field_processor
-                    current_row.append(processor(group[field["tag"]]))
-                elif field["type"] == "select":
-                    processor = partial(_select_field_processor, field["options"].values())
-                    current_row.extend(processor(group[field["tag"]]))
-                elif field["type"] == "multiselect":
-                    processor = partial(_multiselect_field_processor, field["options"].values())
-                    current_row.extend(processor(group[field["tag"]]))
-
-                current_row.append(reported)
-                current_row.append(missing)
-                current_row.append(percent_reported)
-
-            if stream:
-                output_stream = StringIO()
-                writer = csv.writer(output_stream, quoting=csv.QUOTE_NONNUMERIC)
-                writer.writerow(current_row)
-
-                yield output_stream.getvalue()
-            else:
-                yield current_row
+        yield from rows
@@ -0,0 +1,193 @@
+# -*- coding: utf-8 -*-
+"""On-disk cache of the submission dataframes of the analysis views.
+
+The process, results, turnout and incidents views load the dataframe of
+the same submissions on every request, although the submissions rarely
+change between two requests. The dataframe of all the submissions of a
+form in an event is kept in a pickle file under the uploads storage, so
+that it is shared by all the worker processes, and the submissions
+selected by the filters of a request are taken from it by their ids.
+
+The file is named after the form, event, submission type, kind of
+dataframe, locale and loaded tags, and a digest of everything its content
+depends on: the form version, the number of submissions, the last one
+that was added and updated, the generation of the submissions of the form
+in the event and the ancestry generation of the location set.
+Once any of these changes, the file is written again and the previous one
+is removed. The hits and misses are counted in Redis and exported as
+Prometheus gauges.
+"""
+
+import hashlib
+import json
+import logging
+import os
+from glob import escape, glob
+from uuid import uuid4
+
+import numpy as np
+import pandas as pd
+import sqlalchemy as sa
+from flask_babel import get_locale
+from prometheus_client import Gauge
+
+from apollo import settings
+from apollo.core import red, uploads
+from apollo.locations.ancestry import ANCESTRY_GENERATION_KEY
+from apollo.submissions.generation import submissions_generation
+from apollo.submissions.models import Submission
+from apollo.submissions.utils import load_submission_dataframe, select_tags
+
+logger = logging.getLogger(__name__)
+
+# changing the layout of the cached dataframes requires a new version
+CACHE_VERSION = 1
+CACHE_FOLDER = "dataframes"
+STATS_KEY = "analysis:dataframes:stats"
+
+
+def _base_query(event, form, submission_type):
+    query = Submission.query.filter(Submission.event_id == event.id, Submission.form_id == form.id)
+    if submission_type:
+        query = query.filter(Submission.submission_type == submission_type)
+
+    return query
+
+
+def _cache_slot(kind, event, form, submission_type, tags):
+    """Returns the part of the file name of a dataframe that doesn't change."""
+    columns = hashlib.sha256(",".join(tags).encode("utf-8")).hexdigest()[:16]
+    return f"v{CACHE_VERSION}-{kind}-{event.id}-{form.id}-{submission_type or 'all'}-{get_locale()}-{columns}"
+
+
+def _cache_digest(base_query, event, form):
+    """Computes the digest of everything a cached dataframe depends on."""
+    count, last_id, last_updated = base_query.with_entities(
+        sa.func.count(Submission.id), sa.func.max(Submission.id), sa.func.max(Submission.updated)
+    ).one()
+    data = {
+        "version": form.version_identifier,
+        "count": count,
+        "last_id": last_id,
+        "updated": last_updated.isoformat() if last_updated else None,
+        # updates to older submissions don't change the aggregates above
+        "generation": submissions_generation(event.id, form.id),
+        "ancestry": int(red.get(ANCESTRY_GENERATION_KEY.format(event.location_set_id)) or 0),
+    }
+
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def cache_path(slot, digest):
+    """Returns the path of the file a dataframe is cached in."""
+    return uploads.path(f"{slot}.{digest}.pkl", folder=CACHE_FOLDER)
+
+
+def _write(path, slot, dataframe):
+    """Writes a dataframe to its file and removes the stale files of its slot."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # written to a temporary file first so a partial file is never read
+    temp_path = f"{path}.{uuid4().hex}.tmp"
+    try:
+        dataframe.to_pickle(temp_path)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    for stale_path in glob(os.path.join(escape(os.path.dirname(path)), f"{escape(slot)}.*.pkl")):
+        if stale_path != path:
+            try:
+                os.remove(stale_path)
+            except FileNotFoundError:
+                pass
+
+
+def _cached_dataframe(kind, event, form, submission_type, tags, registered_voters_tag=None):
+    """Returns the dataframe of all the submissions of a form, loading it if it isn't cached."""
+    base_query = _base_query(event, form, submission_type)
+    slot = _cache_slot(kind, event, form, submission_type, list(tags) + [registered_voters_tag or ""])
+    path = cache_path(slot, _cache_digest(base_query, event, form))
+
+    try:
+        dataframe = pd.read_pickle(path)
+    except (FileNotFoundError, EOFError):
+        dataframe = None
+
+    red.hincrby(STATS_KEY, "misses" if dataframe is None else "hits")
+    if dataframe is None:
+        logger.info("Loading the %s dataframe of form %s in event %s", kind, form.id, event.id)
+        dataframe = load_submission_dataframe(base_query, form, tags, registered_voters_tag)
+        _write(path, slot, dataframe)
+
+    return dataframe
+
+
+def _filtered(dataframe, query):
+    """Takes the submissions of a query from a cached dataframe."""
+    if dataframe.empty:
+        return pd.DataFrame()
+
+    ids = np.fromiter((pk for (pk,) in query.order_by(None).with_entities(Submission.id)), dtype=np.int64)
+    subset = dataframe[dataframe.index.isin(ids)]
+    if subset.empty:
+        return pd.DataFrame()
+
+    return subset.reset_index(drop=True)
+
+
+def analysis_dataframe(query, form, event, submission_type=None, selected_tags=None, excluded_tags=None):
+    """Returns the same dataframe as `make_submission_dataframe` from the cache.
+
+    Args:
+        query: the submission query, which only has submissions of the form
+            in the event of the given submission type.
+        form: the form of the submissions.
+        event: the event of the submissions.
+        submission_type: the submission type, or None for all types.
+        selected_tags: the tags to keep, all tags if not given.
+        excluded_tags: the tags to leave out.
+    """
+    tags = select_tags(form, selected_tags, excluded_tags)
+    if not settings.ANALYSIS_CACHE_ENABLED:
+        return load_submission_dataframe(query, form, tags).reset_index(drop=True)
+
+    dataframe = _cached_dataframe("submissions", event, form, submission_type, tags)
+
+    return _filtered(dataframe, query)
+
+
+def analysis_turnout_dataframe(query, form, event, submission_type=None):
+    """Returns the same dataframe as `make_turnout_dataframe` from the cache."""
+    tags = list(dict.fromkeys(form.turnout_fields))
+    if not settings.ANALYSIS_CACHE_ENABLED:
+        return load_submission_dataframe(query, form, tags, form.turnout_registered_voters_tag).reset_index(drop=True)
+
+    dataframe = _cached_dataframe("turnout", event, form, submission_type, tags, form.turnout_registered_voters_tag)
+
+    return _filtered(dataframe, query)
+
+
+def cache_stats():
+    """Returns the number of hits and misses of the cache."""
+    stats = red.hgetall(STATS_KEY)
+    return {name: int(stats.get(name.encode("utf-8"), 0)) for name in ("hits", "misses")}
+
+
+def hit_rate():
+    """Returns the share of the dataframes that were read from the cache."""
+    stats = cache_stats()
+    total = stats["hits"] + stats["misses"]
+    return stats["hits"] / total if total else 0
+
+
+Gauge("analysis_dataframe_cache_hits", "Number of analysis dataframes read from the cache.").set_function(
+    lambda: cache_stats()["hits"]
+)
+Gauge("analysis_dataframe_cache_misses", "Number of analysis dataframes loaded from the database.").set_function(
+    lambda: cache_stats()["misses"]
+)
+Gauge("analysis_dataframe_cache_hit_rate", "Share of the analysis dataframes read from the cache.").set_function(
+    hit_rate
+)
@@ -25,6 +25,7 @@ from apollo.frontend import permissions
 from apollo.frontend.helpers import DictDiffer
 from apollo.odk.utils import make_message_text
 from apollo.participants.models import Participant
+from apollo.result_analysis.models import ResultAggregate
 from apollo.services import messages
 from apollo.submissions.api.schema import SubmissionSchema
 from apollo.submissions.models import QUALITY_STATUSES, Submission, SubmissionImageAttachment, SubmissionVersion
@@ -343,7 +344,8 @@ def submission():
             if geopoint is not None:
                 update_params["geom"] = geopoint
             update_params["extra_data"] = submission.extra_data.copy()
-            query.update(update_params, synchronize_session="fetch")
+            with ResultAggregate.track([submission.id]):
+                query.update(update_params, synchronize_session="fetch")
             db.session.commit()
 
         submission.update_related(data)
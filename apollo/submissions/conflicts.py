@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+"""Conflict resolution for groups of related submissions.
+
+A submission group is made up of every observer submission that shares
+the deployment, event, form, location and serial number of a submission
+together with the master submission for that location. The group is
+loaded once and conflict tags, the master data merge and the trimmed
+conflict lists are all computed in memory before being written back.
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.orm.attributes import set_committed_value
+
+from apollo.core import db
+from apollo.result_analysis.models import ResultAggregate
+from apollo.submissions.models import Submission, trim_conflicts
+
+
+def jsonb_contains(container, contained) -> bool:
+    """Python implementation of the PostgreSQL JSONB containment operator.
+
+    Mirrors the semantics of `container @> contained` for values nested
+    inside a JSON object, which is how submission field values are
+    compared when checking for conflicts.
+    """
+    if isinstance(contained, dict):
+        return isinstance(container, dict) and all(
+            key in container and jsonb_contains(container[key], value) for key, value in contained.items()
+        )
+
+    if isinstance(contained, list):
+        return isinstance(container, list) and all(
+            any(jsonb_contains(item, value) for item in container) for value in contained
+        )
+
+    if isinstance(container, (dict, list)):
+        return False
+
+    # JSON booleans and numbers never compare equal to each other
+    if isinstance(container, bool) or isinstance(contained, bool):
+        return type(container) is type(contained) and container == contained
+
+    return container == contained
+
+
+class SubmissionGroup(object):
+    """A master submission and all its observer submissions."""
+
+    def __init__(self, submission, master, observers):
+        """Initializer."""
+        self.submission = submission
+        self.master = master
+        self.observers = observers
+
+    @classmethod
+    def load(cls, submission):
+        """Loads the group a submission belongs to with a single query."""
+        members = (
+            Submission.query.filter(
+                Submission.deployment_id == submission.deployment_id,
+                Submission.event_id == submission.event_id,
+                Submission.form_id == submission.form_id,
+                Submission.location_id == submission.location_id,
+                sa.or_(
+                    Submission.submission_type == "M",
+                    sa.and_(Submission.submission_type == "O", Submission.serial_no == submission.serial_no),
+                ),
+            )
+            .order_by(Submission.id)
+            .all()
+        )
+
+        observers = [member for member in members if member.submission_type == "O"]
+        masters = [member for member in members if member.submission_type == "M"]
+
+        # prefer the master with the same serial number, if any
+        master = next((m for m in masters if m.serial_no == submission.serial_no), masters[0] if masters else None)
+        if submission.submission_type == "M":
+            master = submission
+
+        if submission.submission_type == "O" and submission not in observers:
+            observers.append(submission)
+
+        return cls(submission, master, observers)
+
+    def siblings_of(self, member):
+        """Returns the observer submissions related to the given member."""
+        return [observer for observer in self.observers if observer is not member]
+
+    def conflict_tags(self, member, tags=None):
+        """Computes the tags of a member that conflict with its siblings.
+
+        This is the in-memory equivalent of running a `bool_or` aggregate
+        over the sibling set for each tag.
+        """
+        form = member.form
+
+        # don't compute if the 'track conflicts' flag is not set
+        # on the form or if the form is an incident form
+        if form.untrack_data_conflicts or form.form_type == "INCIDENT":
+            return set()
+
+        # check only a subset of the tags
+        tags_to_check = set(form.tags) - set(member.overridden_fields or [])
+        if tags:
+            tags_to_check = tags_to_check.intersection(set(tags))
+
+        vote_tags = set(form.vote_tags)
+        data = member.data or {}
+        siblings = self.siblings_of(member)
+
+        conflicts = set()
+        for tag in tags_to_check:
+            if tag not in data:
+                continue
+
+            for sibling in siblings:
+                # fully quarantined siblings never conflict and siblings
+                # with quarantined results only conflict on non-vote tags
+                if sibling.quarantine_status == "R":
+                    if tag in vote_tags:
+                        continue
+                elif sibling.quarantine_status != "":
+                    continue
+
+                sibling_data = sibling.data or {}
+                if tag in sibling_data and not jsonb_contains(sibling_data[tag], data[tag]):
+                    conflicts.add(tag)
+                    break
+
+        return conflicts
+
+    def resolve(self, data):
+        """Updates the conflicts of the group and merges data into the master.
+
+        Returns a mapping of each modified group member to the values
+        that should be written back for it.
+        """
+        submission = self.submission
+        form = submission.form
+        vote_tags = set(form.vote_tags)
+        master = self.master
+
+        combined_data = submission.data
+        combined_data.update(data)
+        data_keys = set(combined_data.keys())
+
+        if submission.quarantine_status == "A":
+            conflict_tags = []
+            subset = {}
+        elif submission.quarantine_status == "R":
+            conflict_tags = self.conflict_tags(submission, data_keys.difference(vote_tags))
+            subset = {k: v for k, v in combined_data.items() if k not in conflict_tags and k not in vote_tags}
+        else:
+            conflict_tags = self.conflict_tags(submission, data_keys)
+            subset = {k: v for k, v in combined_data.items() if k not in conflict_tags}
+
+        subset_keys = set(subset.keys())
+        changes = {}
+
+        def _set_conflicts(member, conflicts):
+            if conflicts != member.conflicts:
+                changes.setdefault(member, {})["conflicts"] = conflicts
+
+        _set_conflicts(submission, trim_conflicts(submission, conflict_tags, data_keys))
+        if master is not None:
+            master_conflicts = trim_conflicts(master, conflict_tags, data_keys)
+
+        for sibling in self.siblings_of(submission):
+            sibling_data = sibling.data or {}
+            sibling_data_keys = set(sibling_data.keys())
+
+            if sibling.quarantine_status == "A":
+                conflict_tags = []
+            elif sibling.quarantine_status == "R":
+                conflict_tags = self.conflict_tags(sibling, data_keys.difference(vote_tags))
+                subset.update(
+                    {
+                        k: sibling_data[k]
+                        for k in sibling_data_keys.difference(subset_keys)
+                        if k not in conflict_tags and k not in vote_tags
+                    }
+                )
+            else:
+                if submission.quarantine_status == "R":
+                    conflict_tags = self.conflict_tags(sibling, data_keys.difference(vote_tags))
+                else:
+                    conflict_tags = self.conflict_tags(sibling, data_keys)
+
+                subset.update(
+                    {k: sibling_data[k] for k in sibling_data_keys.difference(subset_keys) if k not in conflict_tags}
+                )
+
+            _set_conflicts(sibling, trim_conflicts(sibling, conflict_tags, data_keys))
+
+        if master is None:
+            return changes
+
+        master_data = master.data or {}
+        for key in master.overridden_fields or []:
+            if key in master_data:
+                subset[key] = master_data[key]
+            else:
+                subset.pop(key, None)
+
+        master.update_group_timestamps(subset)
+        master_changes = changes.setdefault(master, {})
+        master_changes.update(
+            {
+                "conflicts": master_conflicts,
+                "data": subset,
+                "extra_data": master.extra_data,
+                "participant_updated": submission.participant_updated,
+            }
+        )
+
+        # update the 'voting_timestamp' extra data attribute only if
+        # it has not been previously set and that it was defined in the
+        # submission
+        if not (master.extra_data or {}).get("voting_timestamp") and (submission.extra_data or {}).get(
+            "voting_timestamp"
+        ):
+            extra_data = master.extra_data or {}
+            extra_data["voting_timestamp"] = submission.extra_data.get("voting_timestamp")
+            master_changes["extra_data"] = extra_data
+
+        return changes
+
+    def save(self, changes):
+        """Writes the computed changes back to the database.
+
+        Rows are updated by primary key in batches, one statement per set
+        of modified columns, and the in-memory instances are synchronized
+        without being marked as modified. As the bulk update bypasses the
+        session, the result aggregates are adjusted explicitly.
+        """
+        # rows with the same set of columns have to be adjacent to be batched
+        rows = sorted(
+            (dict(values, id=member.id) for member, values in changes.items()),
+            key=lambda row: sorted(row.keys()),
+        )
+        if rows:
+            with ResultAggregate.track([row["id"] for row in rows]):
+                db.session.execute(sa.update(Submission), rows)
+
+        for member, values in changes.items():
+            for attr, value in values.items():
+                set_committed_value(member, attr, value)
+
+
+def update_submission_group(submission, data):
+    """Propagates a submission update to its group.
+
+    Recomputes the conflicts for the submission and its siblings and
+    merges the data that is not in conflict into the master submission.
+    """
+    group = SubmissionGroup.load(submission)
+    if submission.submission_type == "O":
+        submission._siblings = group.siblings_of(submission)
+        submission._master = group.master
+
+    changes = group.resolve(data)
+
+    db.session.begin(nested=True)
+    db.session.add(submission)
+    group.save(changes)
+    db.session.commit()
+
+    return group
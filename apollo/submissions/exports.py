@@ -0,0 +1,272 @@
+# -*- coding: utf-8 -*-
+"""Background submission exports.
+
+Exports are rendered to files under the uploads storage by a Celery task.
+Each file is named after a hash of everything that affects its contents
+(the form, event, export mode, filter arguments, locale and the state of
+the exported submissions, their comments, participants and locations) so
+that an export is only generated again once what it covers has changed.
+"""
+
+import codecs
+import csv
+import hashlib
+import json
+import os
+import re
+import time
+from io import StringIO
+from uuid import uuid4
+
+import sqlalchemy as sa
+from flask_babel import get_locale
+from sqlalchemy.orm import joinedload
+from sqlalchemy.sql import false
+
+from apollo import settings
+from apollo.core import red, uploads
+from apollo.dal import utils
+from apollo.locations.ancestry import ANCESTRY_GENERATION_KEY
+from apollo.locations.models import Location, LocationPath
+from apollo.participants.generation import participants_generation
+from apollo.participants.models import Participant
+from apollo.submissions import filters
+from apollo.submissions.models import Submission, SubmissionComment
+
+EXPORT_FOLDER = "exports"
+EXPORT_KEY_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def make_export_query(event, form, mode, args, location_id=None):
+    """Builds the submission query for an export.
+
+    Args:
+        event: the event to export submissions for.
+        form: the form to export submissions for.
+        mode: the export mode; one of "observer", "observer-ts", "master",
+            "aggregated" or "qa" for the quality assurance export.
+        args: the filter arguments as a `MultiDict`.
+        location_id: if specified, only submissions for this location or
+            its descendants are exported.
+    """
+    if mode == "qa":
+        filter_class = filters.generate_quality_assurance_filter(event, form)
+        if form.quality_checks:
+            queryset = (
+                Submission.query.filter(
+                    Submission.submission_type == "O",
+                    Submission.form == form,
+                    Submission.event == event,
+                )
+                .join(Submission.location)
+                .join(Submission.participant)
+                .order_by(Submission.location_id, Submission.participant_id)
+            )
+        else:
+            queryset = Submission.query.filter(false())
+
+        return filter_class(queryset, args).qs
+
+    filter_class = filters.make_submission_list_filter(event, form)
+    query = Submission.query.options(joinedload(Submission.form))
+
+    if location_id is not None:
+        location_query = (
+            Location.query.with_entities(Location.id)
+            .join(LocationPath, Location.id == LocationPath.descendant_id)
+            .filter(LocationPath.ancestor_id == location_id)
+        )
+        query = query.filter(Submission.location_id.in_(location_query))
+
+    if args.get("location"):
+        query = query.join(Submission.location)
+
+    query = filter_class(query, args).qs
+
+    if mode in ["master", "aggregated"]:
+        submission_type = "M"
+
+        # only change the submission type if we are aggregating data
+        # and are not tracking conflicts
+        if mode == "aggregated" and form.untrack_data_conflicts:
+            submission_type = "O"
+
+        queryset = query.filter(
+            Submission.submission_type == submission_type,
+            Submission.form == form,
+            Submission.event == event,
+        )
+        if utils.has_model(queryset, Location):
+            queryset = queryset.order_by(Location.code)
+        else:
+            queryset = queryset.join(Submission.location).order_by(Location.code)
+    else:
+        queryset = query.filter(
+            Submission.submission_type == "O",
+            Submission.form == form,
+            Submission.event == event,
+        )
+        if not utils.has_model(queryset, Location):
+            queryset = queryset.join(Submission.location)
+        queryset = queryset.join(Participant, Submission.participant_id == Participant.id).order_by(
+            Location.code, Participant.participant_id
+        )
+
+    return queryset
+
+
+def export_key(event, form, mode, args, location_id, queryset):
+    """Computes the cache key of an export.
+
+    The key changes whenever any of the exported submissions is updated,
+    when submissions are added to or removed from the export, and when
+    comments, participants or locations rendered in the export change.
+    """
+    last_updated, count = (
+        queryset.order_by(None).with_entities(sa.func.max(Submission.updated), sa.func.count(Submission.id)).one()
+    )
+    comments = SubmissionComment.query.join(Submission).filter(Submission.form_id == form.id)
+    if event:
+        comments = comments.filter(Submission.event_id == event.id)
+    last_comment, comment_count = comments.with_entities(
+        sa.func.max(SubmissionComment.id), sa.func.count(SubmissionComment.id)
+    ).one()
+    location_set_ids = sorted({event.location_set_id} if event else {e.location_set_id for e in form.events})
+
+    data = {
+        "event": event.id if event else None,
+        "form": form.id,
+        "version": form.version_identifier,
+        "mode": mode,
+        "args": sorted(
+            (key, sorted(values)) for key, values in args.lists() if key not in ("export", "page", "after", "before")
+        ),
+        "location": location_id,
+        "locale": str(get_locale()),
+        "updated": last_updated.isoformat() if last_updated else None,
+        "count": count,
+        "comments": [last_comment, comment_count],
+        "participants": participants_generation(),
+        "ancestry": [
+            int(red.get(ANCESTRY_GENERATION_KEY.format(location_set_id)) or 0) for location_set_id in location_set_ids
+        ],
+    }
+
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+def export_path(key):
+    """Returns the path of the file an export is written to."""
+    return uploads.path(f"{key}.csv", folder=EXPORT_FOLDER)
+
+
+def get_export(key):
+    """Returns the path of a completed export or `None` if it doesn't exist or has expired."""
+    if not EXPORT_KEY_PATTERN.match(key or ""):
+        return None
+
+    path = export_path(key)
+    try:
+        modified = os.path.getmtime(path)
+    except FileNotFoundError:
+        return None
+
+    return path if modified >= time.time() - settings.EXPORT_FILE_TTL else None
+
+
+def schedule_export(key, **kwargs):
+    """Starts a background export and returns the task identifier.
+
+    If an export for the same key is already running, the identifier of
+    that task is returned instead of starting another one.
+    """
+    from apollo.submissions.tasks import export_submissions  # local to avoid circular import
+
+    task_id = str(uuid4())
+    if red.set(f"exports:{key}", task_id, nx=True, ex=settings.EXPORT_TASK_TTL):
+        export_submissions.apply_async(kwargs=dict(kwargs, key=key), task_id=task_id)
+        return task_id
+
+    return red.get(f"exports:{key}").decode("utf-8")
+
+
+def release_export(key):
+    """Allows a new export task to be started for the key."""
+    red.delete(f"exports:{key}")
+
+
+def stream_export(key, chunks):
+    """Yields the chunks of an export while writing them to its file.
+
+    The export is first written to a temporary file that is moved into
+    place once complete, so a partially written export is never served,
+    even if the chunks stop being consumed.
+    """
+    path = export_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    temp_path = f"{path}.{uuid4().hex}.tmp"
+    try:
+        with open(temp_path, "w", encoding="utf-8", newline="") as f:
+            for chunk in chunks:
+                if chunk:
+                    f.write(chunk)
+                    yield chunk
+        os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def write_export(key, chunks):
+    """Writes the chunks of an export to its file."""
+    for _chunk in stream_export(key, chunks):
+        pass
+
+    return export_path(key)
+
+
+def csv_chunks(rows, chunk_size=None, bom=True, **fmtparams):
+    """Writes rows as CSV with a single writer and yields the output in chunks.
+
+    Args:
+        rows: the rows to write.
+        chunk_size: the number of characters after which a chunk is
+            yielded. The configured size is used if not given.
+        bom: whether the output starts with the UTF-8 byte order mark.
+        fmtparams: the formatting parameters of the writer. Non-numeric
+            values are quoted by default.
+    """
+    if chunk_size is None:
+        chunk_size = settings.EXPORT_CHUNK_SIZE
+
+    output = StringIO()
+    if bom:
+        output.write(codecs.BOM_UTF8.decode("utf-8"))
+    writer = csv.writer(output, **dict({"quoting": csv.QUOTE_NONNUMERIC}, **fmtparams))
+
+    for row in rows:
+        writer.writerow(row)
+        if output.tell() >= chunk_size:
+            yield output.getvalue()
+            output.seek(0)
+            output.truncate()
+
+    if output.tell():
+        yield output.getvalue()
+
+
+def remove_expired_exports(folder=EXPORT_FOLDER):
+    """Deletes export files older than the configured time to live."""
+    folder = uploads.path("", folder=folder)
+    if not os.path.isdir(folder):
+        return
+
+    cutoff = time.time() - settings.EXPORT_FILE_TTL
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
@@ -700,12 +700,10 @@ def make_dashboard_filter(event, filter_on_locations=False):
 
 def make_submission_list_filter(event, form, filter_on_locations=False):
     attributes = {}
-    form._populate_field_cache()
-
     if form.data and form.data.get('groups'):
         if form.form_type == 'INCIDENT':
             option_fields = [
-                f for f in form._field_cache.values()
+                f for f in form.response_fields
                 if f['type'] == 'select']
             if len(option_fields) >= 1:
                 option_fields = option_fields[:1]
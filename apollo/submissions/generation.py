@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Generation counters of the submissions of a form in an event.
+
+The analysis views cache the dataframe of all the submissions of a form in
+an event, which has to be loaded again once any of them is modified. The
+counter of the event and form in Redis is incremented once changes to their
+submissions are committed. The forms and events of the submissions modified
+with bulk UPDATE and DELETE statements, which bypass the mapper listeners,
+are looked up before the statements are executed.
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.orm import Session
+
+from apollo.core import red
+from apollo.submissions.models import Submission
+
+SUBMISSIONS_GENERATION_KEY = "submissions:{}:{}:generation"
+
+
+def submissions_generation(event_id, form_id):
+    """Returns the current generation of the submissions of a form in an event."""
+    return int(red.get(SUBMISSIONS_GENERATION_KEY.format(event_id, form_id)) or 0)
+
+
+def invalidate_submissions(event_id, form_id):
+    """Marks the submissions of a form in an event as changed in every process."""
+    red.incr(SUBMISSIONS_GENERATION_KEY.format(event_id, form_id))
+
+
+def _mark_modified(session, event_id, form_id):
+    session.info.setdefault("invalidate_submissions", set()).add((event_id, form_id))
+
+
+def _submission_modified(mapper, connection, target):
+    _mark_modified(Session.object_session(target), target.event_id, target.form_id)
+
+
+def _do_orm_execute(orm_execute_state):
+    """Marks the submissions about to be modified by a bulk statement."""
+    if not (orm_execute_state.is_update or orm_execute_state.is_delete):
+        return
+    if getattr(orm_execute_state.bind_mapper, "class_", None) is not Submission:
+        return
+
+    query = sa.select(Submission.event_id, Submission.form_id).distinct()
+    whereclause = orm_execute_state.statement.whereclause
+    if whereclause is not None:
+        query = query.where(whereclause)
+    elif isinstance(orm_execute_state.parameters, list):
+        # bulk updates by primary key have a row of parameters per submission
+        query = query.where(Submission.id.in_([row["id"] for row in orm_execute_state.parameters]))
+
+    for event_id, form_id in orm_execute_state.session.execute(query):
+        _mark_modified(orm_execute_state.session, event_id, form_id)
+
+
+def _after_commit(session):
+    """Invalidates the submissions modified in the committed transaction."""
+    for event_id, form_id in session.info.pop("invalidate_submissions", ()):
+        invalidate_submissions(event_id, form_id)
+
+
+for _event_name in ("after_insert", "after_update", "after_delete"):
+    sa.event.listen(Submission, _event_name, _submission_modified)
+sa.event.listen(Session, "do_orm_execute", _do_orm_execute)
+sa.event.listen(Session, "after_commit", _after_commit)
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""Queries for the pages of the submission lists.
+
+The lists used to be paginated with an offset, which makes the database
+sort and skip every row of the preceding pages, and to load the location,
+participant and phone numbers of every row separately while rendering.
+
+Pages are found from the sort keys of the row the previous page ended on
+(or the next page started on when paging backwards) instead, the columns
+rendered for every row are loaded along with the page, and the quality
+assurance statuses of a page are computed with a single query.
+"""
+
+import sqlalchemy as sa
+from sqlalchemy.orm import contains_eager, lazyload
+
+from apollo.locations.models import Location
+from apollo.participants.models import Participant, PhoneContact
+from apollo.submissions.models import Submission
+from apollo.submissions.qa.query_builder import generate_qa_queries
+
+
+class SortKey:
+    """An expression the rows of a list are sorted by.
+
+    Nulls are sorted the way Postgres sorts them unless `nulls_last` is
+    given: last in ascending order and first in descending order. Keys
+    that can't be null, such as primary keys, are compared without
+    handling nulls.
+    """
+
+    def __init__(self, expression, descending=False, nulls_last=None, nullable=True):
+        """Initializer."""
+        self.expression = expression
+        self.descending = descending
+        self.nulls_last = not descending if nulls_last is None else nulls_last
+        self.nullable = nullable
+
+    def order_by(self):
+        """Returns the ORDER BY term of the key."""
+        term = self.expression.desc() if self.descending else self.expression.asc()
+        return term.nulls_last() if self.nulls_last else term.nulls_first()
+
+    def reverse(self):
+        """Returns the key sorting rows the other way round."""
+        return SortKey(self.expression, not self.descending, not self.nulls_last, self.nullable)
+
+    def equals(self, value):
+        """Returns the condition for rows with the same key as `value`."""
+        if value is None:
+            return self.expression.is_(None)
+
+        return self.expression == value
+
+    def follows(self, value):
+        """Returns the condition for rows sorted after a row with the key `value`."""
+        if value is None:
+            # nulls sorted first are only followed by the other values
+            return sa.false() if self.nulls_last else self.expression.is_not(None)
+
+        comparison = self.expression < value if self.descending else self.expression > value
+        if self.nullable and self.nulls_last:
+            return sa.or_(comparison, self.expression.is_(None))
+
+        return comparison
+
+
+def keyset_condition(sort_keys, values):
+    """Returns the condition for rows sorted after the row with the given keys."""
+    return sa.or_(
+        *[
+            sa.and_(*[key.equals(value) for key, value in zip(sort_keys[:index], values)], key.follows(values[index]))
+            for index, key in enumerate(sort_keys)
+        ]
+    )
+
+
+class KeysetPagination:
+    """A page of a query paginated by the sort keys of its rows.
+
+    The pager has the attributes of the Flask-SQLAlchemy pagination the
+    pager macros use. Links to the previous and next pages carry the id of
+    the row on the page they start from (`before` and `after`); without it,
+    or when that row is no longer listed, the page is found with an offset.
+    """
+
+    def __init__(self, query, sort_keys, key, page=1, per_page=20, after=None, before=None):
+        """Initializer.
+
+        Args:
+            query: the query for the rows of the list.
+            sort_keys: the `SortKey`s of the list.
+            key: the primary key column of the rows, used to break ties.
+            page: the number of the page.
+            per_page: the number of rows per page.
+            after: the id of the last row of the previous page.
+            before: the id of the first row of the next page.
+        """
+        query = query.order_by(None)
+        sort_keys = list(sort_keys) + [SortKey(key, nullable=False)]
+        cursor = after if after is not None else before
+
+        self.key = key
+        self.page = page
+        self.per_page = per_page
+        self.total = query.count()
+
+        values = None
+        if cursor is not None:
+            values = query.filter(key == cursor).with_entities(*[sort_key.expression for sort_key in sort_keys]).first()
+
+        backwards = values is not None and after is None
+        if backwards:
+            sort_keys = [sort_key.reverse() for sort_key in sort_keys]
+
+        page_query = query.order_by(*[sort_key.order_by() for sort_key in sort_keys])
+        if values is not None:
+            page_query = page_query.filter(keyset_condition(sort_keys, values))
+        else:
+            page_query = page_query.offset((page - 1) * per_page)
+
+        # the extra row tells whether there's another page
+        items = page_query.limit(per_page + 1).all()
+        more = len(items) > per_page
+        self.items = items[:per_page]
+
+        if backwards:
+            self.items.reverse()
+            self.has_prev = more
+            self.has_next = True
+        else:
+            self.has_prev = page > 1
+            self.has_next = more
+
+    @property
+    def prev_num(self):
+        return self.page - 1 if self.has_prev else None
+
+    @property
+    def next_num(self):
+        return self.page + 1 if self.has_next else None
+
+    def prev_args(self, args):
+        """Returns the URL arguments of the previous page."""
+        if not self.items:
+            return dict(args, page=self.prev_num)
+
+        return dict(args, page=self.prev_num, before=getattr(self.items[0], self.key.key))
+
+    def next_args(self, args):
+        """Returns the URL arguments of the next page."""
+        if not self.items:
+            return dict(args, page=self.next_num)
+
+        return dict(args, page=self.next_num, after=getattr(self.items[-1], self.key.key))
+
+
+def submission_list_options():
+    """Returns the loader options for the columns the submission lists render.
+
+    The query must be joined to the location and the participant. The
+    form is the one the list is for, which is already loaded.
+    """
+    return (
+        lazyload(Submission.form),
+        contains_eager(Submission.participant)
+        .load_only(
+            Participant.participant_id,
+            Participant.full_name_translations,
+            Participant.first_name_translations,
+            Participant.other_names_translations,
+            Participant.last_name_translations,
+        )
+        .selectinload(Participant.phone_contacts)
+        .load_only(PhoneContact.participant_id, PhoneContact.number, PhoneContact.verified, PhoneContact.updated),
+        contains_eager(Submission.location).load_only(
+            Location.location_set_id, Location.location_type_id, Location.code, Location.name_translations
+        ),
+    )
+
+
+def page_qa_statuses(form, submissions):
+    """Returns the status of every quality check of a page of submissions.
+
+    The statuses are returned by submission id and check name.
+    """
+    if not form.quality_checks or not submissions:
+        return {}
+
+    rows = (
+        Submission.query.outerjoin(Location, Location.id == Submission.location_id)
+        .outerjoin(Participant, Participant.id == Submission.participant_id)
+        .filter(Submission.id.in_([submission.id for submission in submissions]))
+        .with_entities(Submission.id.label("submission_id"), *generate_qa_queries(form)[0])
+    )
+
+    return {
+        row.submission_id: {check["name"]: row._mapping[check["name"]] for check in form.quality_checks} for row in rows
+    }
@@ -5,7 +5,8 @@ from depot.fields.sqlalchemy import UploadedFileField
 from flask_babel import gettext
 from flask_babel import lazy_gettext as _
 from geoalchemy2 import Geometry
-from sqlalchemy.dialects.postgresql import ARRAY, JSONB
+from sqlalchemy.dialects.postgresql import ARRAY, JSONB, insert
+from sqlalchemy.orm import aliased
 from sqlalchemy_utils import ChoiceType
 
 from apollo.core import db
@@ -118,8 +119,18 @@ class Submission(BaseModel):
     verified_fields = db.Column(JSONB, default=[])
 
     @classmethod
-    def init_submissions(cls, event, form, role, location_type, task=None):
+    def init_submissions(cls, event, form, role, location_type, task=None, batch_size=1000):
+        """Creates the observer and master checklists for participants in a role.
+
+        Target locations are resolved through the location closure table
+        and existing submissions are detected with a single query, so the
+        missing submissions can be created with batched multi-row inserts.
+        """
+        # local to avoid circular import
+        from apollo.helpers import TaskProgress
+        from apollo.locations.models import Location, LocationPath
         from apollo.participants.models import Participant
+        from apollo.result_analysis.models import ResultAggregate
 
         if form.form_type != "CHECKLIST":
             return
@@ -135,124 +146,100 @@ class Submission(BaseModel):
 
         deployment_id = event.deployment_id
 
-        participants = Participant.query.filter_by(role_id=role.id)
-        total_records = participants.count()
-        processed_records = 0
-        error_records = 0
-        warning_records = 0
-        error_log = []
-
-        for participant in participants:
-            if not participant.location_id:
-                error_records += 1
-                error_log.append(
-                    {
-                        "label": "ERROR",
-                        "message": gettext(
-                            "Participant ID %(part_id)s has no location", part_id=participant.participant_id
-                        ),
-                    }
-                )
-                continue
-
-            if location_type.id == participant.location.location_type.id:
-                location = participant.location
-            else:
-                try:
-                    location = next(
-                        a for a in participant.location.ancestors() if a.location_type.id == location_type.id
-                    )
-                    if not location:
-                        error_records = total_records - processed_records
-                        if task:
-                            task.update_state(
-                                state="PROGRESS",
-                                meta={
-                                    "total_records": total_records,
-                                    "processed_records": processed_records,
-                                    "error_records": error_records,
-                                    "warning_records": warning_records,
-                                    "error_log": error_log,
-                                },
-                            )
-                        return
-                except StopIteration:
-                    error_records = total_records - processed_records
-                    if task:
-                        task.update_state(
-                            state="PROGRESS",
-                            meta={
-                                "total_records": total_records,
-                                "processed_records": processed_records,
-                                "error_records": error_records,
-                                "warning_records": warning_records,
-                                "error_log": error_log,
-                            },
+        # the location of the requested type for each participant location,
+        # which could be the participant location itself
+        target = (
+            db.session.query(LocationPath.descendant_id, LocationPath.ancestor_id)
+            .join(Location, Location.id == LocationPath.ancestor_id)
+            .filter(Location.location_type_id == location_type.id)
+            .subquery()
+        )
+        observer_submission = aliased(cls)
+        master_submission = aliased(cls)
+        has_observer_submission = sa.exists().where(
+            observer_submission.form_id == form.id,
+            observer_submission.participant_id == Participant.id,
+            observer_submission.location_id == target.c.ancestor_id,
+            observer_submission.deployment_id == deployment_id,
+            observer_submission.event_id == event.id,
+            observer_submission.submission_type == "O",
+        )
+        has_master_submission = sa.exists().where(
+            master_submission.form_id == form.id,
+            master_submission.participant_id == None,  # noqa
+            master_submission.location_id == target.c.ancestor_id,
+            master_submission.deployment_id == deployment_id,
+            master_submission.event_id == event.id,
+            master_submission.submission_type == "M",
+        )
+
+        records = (
+            db.session.query(
+                Participant.id,
+                Participant.participant_id,
+                Participant.location_id,
+                target.c.ancestor_id,
+                has_observer_submission,
+                has_master_submission,
+            )
+            .outerjoin(target, target.c.descendant_id == Participant.location_id)
+            .filter(Participant.role_id == role.id)
+            .order_by(Participant.id)
+            .all()
+        )
+
+        progress = TaskProgress(task, len(records))
+        submission_params = {"form_id": form.id, "deployment_id": deployment_id, "event_id": event.id, "data": {}}
+        pending_masters = set()
+
+        for offset in range(0, len(records), batch_size):
+            rows = []
+            for pk, participant_id, participant_location_id, location_id, has_observer, has_master in records[
+                offset : offset + batch_size
+            ]:
+                if not participant_location_id:
+                    progress.error(gettext("Participant ID %(part_id)s has no location", part_id=participant_id))
+                    continue
+
+                if not location_id:
+                    progress.error(
+                        gettext(
+                            "Participant ID %(part_id)s has no location of type %(location_type)s",
+                            part_id=participant_id,
+                            location_type=location_type.name,
                         )
-                    return
-
-            obs_submission = cls.query.filter_by(
-                form_id=form.id,
-                participant_id=participant.id,
-                location_id=location.id,
-                deployment_id=deployment_id,
-                event_id=event.id,
-                submission_type="O",
-            ).first()
+                    )
+                    continue
 
-            if not obs_submission:
-                obs_submission = cls(
-                    form_id=form.id,
-                    participant_id=participant.id,
-                    location_id=location.id,
-                    deployment_id=deployment_id,
-                    event_id=event.id,
-                    submission_type="O",
-                    data={},
-                )
-                obs_submission.save()
-
-            master_submission = cls.query.filter_by(
-                form_id=form.id,
-                participant_id=None,
-                location_id=location.id,
-                deployment_id=deployment_id,
-                event_id=event.id,
-                submission_type="M",
-            ).first()
+                if not has_observer:
+                    rows.append(
+                        dict(submission_params, participant_id=pk, location_id=location_id, submission_type="O")
+                    )
+
+                if not has_master and location_id not in pending_masters:
+                    pending_masters.add(location_id)
+                    rows.append(
+                        dict(submission_params, participant_id=None, location_id=location_id, submission_type="M")
+                    )
+
+                progress.processed_records += 1
 
-            if not master_submission:
-                master_submission = cls(
-                    form_id=form.id,
-                    participant_id=None,
-                    location_id=location.id,
-                    deployment_id=deployment_id,
-                    event_id=event.id,
-                    submission_type="M",
-                    data={},
-                )
-                master_submission.save()
-
-            processed_records += 1
-            if task:
-                task.update_state(
-                    state="PROGRESS",
-                    meta={
-                        "total_records": total_records,
-                        "processed_records": processed_records,
-                        "error_records": error_records,
-                        "warning_records": warning_records,
-                        "error_log": error_log,
-                    },
-                )
+            if rows:
+                db.session.execute(insert(cls).values(rows).on_conflict_do_nothing())
+                db.session.commit()
+
+            progress.update()
+
+        # the inserted checklists are counted as missing in the results
+        ResultAggregate.invalidate(event.location_set_id)
+        progress.update(force=True)
 
     def update_group_timestamps(self, data: dict) -> None:
         # local to avoid circular import
         from apollo.frontend.helpers import DictDiffer
 
         form = self.form
-        form._populate_group_cache()
-        group_names = form._group_cache.keys()
+        group_names = form.get_group_names()
         original_data = (self.data or {}).copy()
         diff = DictDiffer(data, original_data)
         modified_tags = diff.added().union(diff.removed()).union(diff.changed())
@@ -276,84 +263,16 @@ class Submission(BaseModel):
         and update all related submissions with the
         conflict data
         """
+        # local to avoid circular import
+        from apollo.submissions.conflicts import update_submission_group
+
         if self.form.form_type == "INCIDENT":
             return
 
         if self.form.untrack_data_conflicts:
             return
 
-        combined_data = self.data
-        combined_data.update(data)
-
-        if self.quarantine_status == "A":
-            conflict_tags = []
-            subset = {}
-        elif self.quarantine_status == "R":
-            conflict_tags = self.compute_conflict_tags(set(combined_data.keys()).difference(set(self.form.vote_tags)))
-            subset = {k: v for k, v in combined_data.items() if k not in conflict_tags and k not in self.form.vote_tags}
-        else:
-            conflict_tags = self.compute_conflict_tags(combined_data.keys())
-            subset = {k: v for k, v in combined_data.items() if k not in conflict_tags}
-
-        subset_keys = set(subset.keys())
-
-        master = self.master
-
-        siblings = self.siblings
-        self.conflicts = trim_conflicts(self, conflict_tags, combined_data.keys())
-        master.conflicts = trim_conflicts(master, conflict_tags, combined_data.keys())
-        for sibling in siblings:
-            sibling_data_keys = set(sibling.data.keys())
-
-            if sibling.quarantine_status == "A":
-                conflict_tags = []
-            elif sibling.quarantine_status == "R":
-                conflict_tags = sibling.compute_conflict_tags(
-                    set(combined_data.keys()).difference(set(self.form.vote_tags))
-                )
-                subset.update(
-                    {
-                        k: sibling.data[k]
-                        for k in sibling_data_keys.difference(subset_keys)
-                        if k not in conflict_tags and k not in self.form.vote_tags
-                    }
-                )
-            else:
-                if self.quarantine_status == "R":
-                    conflict_tags = sibling.compute_conflict_tags(
-                        set(combined_data.keys()).difference(set(self.form.vote_tags))
-                    )
-                else:
-                    conflict_tags = sibling.compute_conflict_tags(combined_data.keys())
-
-                subset.update(
-                    {k: sibling.data[k] for k in sibling_data_keys.difference(subset_keys) if k not in conflict_tags}
-                )
-
-            sibling.conflicts = trim_conflicts(sibling, conflict_tags, combined_data.keys())
-
-        for key in master.overridden_fields:
-            if key in master.data:
-                subset[key] = master.data[key]
-            else:
-                subset.pop(key, None)
-
-        master.update_group_timestamps(subset)
-        master.data = subset
-        master.participant_updated = self.participant_updated
-
-        # update the 'voting_timestamp' extra data attribute only if
-        # it has not been previously set and that it was defined in the
-        # submission
-        if not (master.extra_data or {}).get("voting_timestamp") and (self.extra_data or {}).get("voting_timestamp"):
-            extra_data = master.extra_data or {}
-            extra_data["voting_timestamp"] = self.extra_data.get("voting_timestamp")
-            master.extra_data = extra_data
-
-        db.session.begin(nested=True)
-        db.session.add_all([self, master])
-        db.session.add_all(siblings)
-        db.session.commit()
+        update_submission_group(self, data)
 
     def update_master_offline_status(self):
         if self.master is None:
@@ -375,56 +294,10 @@ class Submission(BaseModel):
             db.session.add(self.master)
 
     def compute_conflict_tags(self, tags=None):
-        # don't compute if the 'track conflicts' flag is not set
-        # on the form
-        if self.form.untrack_data_conflicts:
-            return []
-
-        # or if the form is an incident form
-        if self.form.form_type == "INCIDENT":
-            return []
-
-        # check only a subset of the tags
-        tags_to_check = set(self.form.tags) - set(self.overridden_fields)
-        if tags:
-            tags_to_check = tags_to_check.intersection(set(tags))
-
-        tags_to_check_non_votes = tags_to_check.difference(set(self.form.vote_tags))
-
-        # conflict query
-        any_conflict_query = [
-            sa.func.bool_or(
-                sa.and_(
-                    Submission.data.has_key(tag),
-                    sa.not_(Submission.data.contains({tag: self.data[tag]})),
-                )
-            ).label(tag)
-            for tag in tags_to_check
-            if tag in self.data
-        ]
-        non_vote_conflict_query = [
-            sa.func.bool_or(
-                sa.and_(
-                    Submission.data.has_key(tag),
-                    sa.not_(Submission.data.contains({tag: self.data[tag]})),
-                )
-            ).label(tag)
-            for tag in tags_to_check_non_votes
-            if tag in self.data
-        ]
-
-        if not any_conflict_query:
-            return []
-        siblings_no_quarantine = self.__siblings().filter(Submission.quarantine_status == "")
-        siblings_with_results_quarantine = self.__siblings().filter(Submission.quarantine_status == "R")
-
-        results_conflict = siblings_no_quarantine.with_entities(*any_conflict_query)
-        results_vote_conflict = siblings_with_results_quarantine.with_entities(*non_vote_conflict_query)
-
-        any_conflict = {k for result in results_conflict for k, v in result._asdict().items() if v}
-        vote_conflict = {k for result in results_vote_conflict for k, v in result._asdict().items() if v}
+        # local to avoid circular import
+        from apollo.submissions.conflicts import SubmissionGroup
 
-        return any_conflict.union(vote_conflict)
+        return SubmissionGroup.load(self).conflict_tags(self, tags)
 
     def get_incident_status_display(self):
         d = dict(self.INCIDENT_STATUSES)
@@ -543,16 +416,20 @@ class Submission(BaseModel):
         if not attachment:
             return False
 
+        # local to avoid circular import
+        from apollo.result_analysis.models import ResultAggregate
+
         data = self.data.copy()
         data.pop(tag)
         self.update_group_timestamps(data)
         extra_data = self.extra_data.copy()
-        self.__class__.query.filter_by(id=self.id).update(
-            {
-                "data": data,
-                "extra_data": extra_data,
-            }
-        )
+        with ResultAggregate.track([self.id]):
+            self.__class__.query.filter_by(id=self.id).update(
+                {
+                    "data": data,
+                    "extra_data": extra_data,
+                }
+            )
         db.session.delete(attachment)
         db.session.commit()
 
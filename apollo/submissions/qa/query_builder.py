@@ -2,13 +2,16 @@
 """Query builder module for checklist QA."""
 
 import operator as op
+import threading
+from collections import namedtuple
 
-from arpeggio import PTNodeVisitor, visit_parse_tree
+from arpeggio import NonTerminal, PTNodeVisitor, visit_parse_tree
 from arpeggio.cleanpeg import ParserPEG
 from sqlalchemy import BigInteger, Integer, String, and_, case, cast, false, func, null, or_
 from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.sql.operators import concat_op
 
+from apollo.dal import utils
 from apollo.models import Location, Participant, Submission
 from apollo.submissions.models import QUALITY_STATUSES
 
@@ -57,6 +60,18 @@ OPERATIONS = {
     "||": op.or_,
 }
 
+# a QA check compiled for inline evaluation: `evaluate` takes a submission
+# and returns the result of the check expression, and `tags` holds the form
+# tags used by the expression
+CompiledCheck = namedtuple("CompiledCheck", ["expression", "evaluate", "tags"])
+
+# the statuses a QA check can have, in the order they are tested for
+QA_STATUS_LABELS = ("Flagged", "Verified", "OK", "Missing")
+
+_parser = None
+_parser_lock = threading.Lock()
+_compiled_checks = {}
+
 FIELD_TYPE_CASTS = {
     "select": Integer,
     "string": String,
@@ -76,6 +91,21 @@ def _get_cast_type(field):
     return null()
 
 
+def parse_expression(expression):
+    """Parses a QA expression.
+
+    The grammar is compiled into a parser only once per process. Parsers
+    keep their state while parsing, so access to the parser is serialized.
+    """
+    global _parser
+
+    with _parser_lock:
+        if _parser is None:
+            _parser = ParserPEG(GRAMMAR, "qa")
+
+        return _parser.parse(expression)
+
+
 class BaseVisitor(PTNodeVisitor):
     def __init__(self, defaults=True, **kwargs):
         """Constructor for BaseVisitor."""
@@ -280,8 +310,7 @@ def generate_qa_query(expression, form):
     if expression == "" or expression == "=":
         return null(), set()
 
-    parser = ParserPEG(GRAMMAR, "qa")
-    tree = parser.parse(expression)
+    tree = parse_expression(expression)
 
     visitor = QATreeVisitor(form=form)
 
@@ -331,22 +360,10 @@ def generate_qa_queries(form):
     return subqueries, tag_groups
 
 
-def get_logical_check_stats(query, form, condition):
-    """Compute QA metrics."""
-    complete_expression = build_expression(condition)
-    # short-circuit for empty QA
-    if complete_expression == "":
-        return [("Missing", query.count())]
-
+def _logical_check_case(form, complete_expression):
+    """Builds the expression that computes the QA status of a check."""
     qa_query, question_codes = generate_qa_query(complete_expression, form)
 
-    # add joins as necessary
-    if "$location" in complete_expression:
-        query = query.join(Location, Location.id == Submission.location_id)
-
-    if "$participant" in complete_expression:
-        query = query.join(Participant, Participant.id == Submission.participant_id)
-
     if "null" in complete_expression.lower():
         null_query = (
             or_(
@@ -380,9 +397,73 @@ def get_logical_check_stats(query, form, condition):
             (qa_query == False, "OK"),  # noqa
         )
 
+    return qa_case_query
+
+
+def _join_lookups(query, expressions):
+    """Joins the models referenced by lookups in QA expressions."""
+    if any("$location" in expression for expression in expressions) and not utils.has_model(query, Location):
+        query = query.join(Location, Location.id == Submission.location_id)
+
+    if any("$participant" in expression for expression in expressions) and not utils.has_model(query, Participant):
+        query = query.join(Participant, Participant.id == Submission.participant_id)
+
+    return query
+
+
+def get_logical_check_stats(query, form, condition):
+    """Compute QA metrics."""
+    complete_expression = build_expression(condition)
+    # short-circuit for empty QA
+    if complete_expression == "":
+        return [("Missing", query.count())]
+
+    qa_case_query = _logical_check_case(form, complete_expression)
+
+    # add joins as necessary
+    query = _join_lookups(query, [complete_expression])
+
     return query.with_entities(qa_case_query.label("status"), func.count(qa_case_query)).group_by("status").all()
 
 
+def get_logical_checks_stats(query, form, conditions):
+    """Compute QA metrics for several checks in a single query.
+
+    Returns a list with the (status, count) pairs for each of the checks,
+    in the same format as `get_logical_check_stats`, but computes them with
+    conditional aggregates over a single scan of the submissions.
+    """
+    expressions = [build_expression(condition) for condition in conditions]
+    query = _join_lookups(query, expressions)
+
+    # the status of every check is computed once per submission
+    statuses = [
+        _logical_check_case(form, expression).label(f"check_{index}")
+        for index, expression in enumerate(expressions)
+        if expression != ""
+    ]
+    subquery = query.order_by(None).with_entities(Submission.id, *statuses).subquery()
+
+    columns = [func.count()]
+    for status_column in statuses:
+        column = subquery.c[status_column.name]
+        columns.extend(func.count().filter(column == status) for status in QA_STATUS_LABELS)
+
+    counts = list(query.session.query(*columns).select_from(subquery).one())
+    total = counts.pop(0)
+
+    results = []
+    for expression in expressions:
+        if expression == "":
+            results.append([("Missing", total)])
+            continue
+
+        check_counts = [counts.pop(0) for _ in QA_STATUS_LABELS]
+        results.append([(status, count) for status, count in zip(QA_STATUS_LABELS, check_counts) if count])
+
+    return results
+
+
 class TagVisitor(PTNodeVisitor):
     def __init__(self, *args, **kwargs):
         """Constructor for TagVisitor."""
@@ -393,32 +474,92 @@ class TagVisitor(PTNodeVisitor):
         self.variables.add(node.value)
 
 
-def get_inline_qa_status(submission, condition):
-    """QA status for inline rendering."""
-    control_expression = build_expression(condition)
+def _compile_node(node):
+    """Compiles a parse tree node into a function of an inline QA visitor.
 
-    # short-circuit for empty expression
-    if control_expression == "":
-        return None, set()
+    The compiled function produces the same result as visiting the node
+    with the visitor, but the tree is only traversed once at compile time.
+    """
+    visit_name = "visit_%s" % node.rule_name
+    has_visit = hasattr(InlineQATreeVisitor, visit_name)
+
+    if not isinstance(node, NonTerminal):
+        if has_visit:
+            return lambda visitor: getattr(visitor, visit_name)(node, [])
+
+        value = None if node.suppress else str(node)
+        return lambda visitor: value
+
+    children = [_compile_node(child) for child in node]
+    if not has_visit and len(children) == 1:
+        # a rule that wraps a single node evaluates to the value of the node
+        return children[0]
 
-    parser = ParserPEG(GRAMMAR, "qa")
-    tree = parser.parse(control_expression)
+    def evaluate(visitor):
+        results = [result for result in (child(visitor) for child in children) if result is not None]
+        if has_visit:
+            return getattr(visitor, visit_name)(node, results)
+        return visitor.visit__default__(node, results)
+
+    return evaluate
+
+
+def _compile_expression(expression, form):
+    if expression == "":
+        return CompiledCheck(expression, lambda submission: None, frozenset())
+
+    tree = parse_expression(expression)
 
     var_visitor = TagVisitor()
     visit_parse_tree(tree, var_visitor)
 
-    used_tags = var_visitor.variables.intersection(submission.form.tags)
+    root = _compile_node(tree)
+
+    def evaluate(submission):
+        return root(InlineQATreeVisitor(form=submission.form, submission=submission))
+
+    return CompiledCheck(expression, evaluate, frozenset(var_visitor.variables.intersection(form.tags)))
+
+
+def compile_check(form, check):
+    """Returns the compiled version of a form QA check.
+
+    Compiled checks are cached by form, form version and check name, and
+    are compiled again when the form is modified.
+    """
+    expression = build_expression(check)
+    if form.id is None:
+        return _compile_expression(expression, form)
 
-    visitor = InlineQATreeVisitor(form=submission.form, submission=submission)
+    key = (form.id, form.version_identifier, check.get("name"))
+    compiled = _compiled_checks.get(key)
+    if compiled is None or compiled.expression != expression:
+        compiled = _compile_expression(expression, form)
+
+        # discard the checks compiled for previous versions of the form
+        for stale_key in [k for k in _compiled_checks if k[0] == form.id and k[1] != form.version_identifier]:
+            _compiled_checks.pop(stale_key, None)
+        _compiled_checks[key] = compiled
+
+    return compiled
+
+
+def get_inline_qa_status(submission, condition):
+    """QA status for inline rendering."""
+    compiled = compile_check(submission.form, condition)
+
+    # short-circuit for empty expression
+    if compiled.expression == "":
+        return None, set()
 
     try:
-        result = visit_parse_tree(tree, visitor)
+        result = compiled.evaluate(submission)
     except TypeError:
         # tried to perform a math operation combining None and a number,
         # most likely
         return None, set()
 
-    return result, used_tags
+    return result, set(compiled.tags)
 
 
 def build_expression(logical_check):
@@ -1,11 +1,19 @@
 # -*- coding: utf-8 -*-
 import calendar
 import json
+from functools import partial
+from uuid import uuid4
 
-from apollo.dal.serializers import ArchiveSerializer
+from geoalchemy2.shape import to_shape
+from sqlalchemy import exists
+from sqlalchemy.orm import aliased, contains_eager
+
+from apollo.core import db
+from apollo.dal.serializers import YIELD_PER, ArchiveSerializer, array_literal, from_timestamp, json_value
 from apollo.formsframework.models import Form
 from apollo.locations.models import Location
 from apollo.participants.models import Participant
+from apollo.submissions.conflicts import SubmissionGroup
 from apollo.submissions.models import Submission
 
 
@@ -40,20 +48,113 @@ class SubmissionSerializer(object):
             'incident_status': obj.incident_status.code
             if obj.incident_status else None,
             'overridden_fields': obj.overridden_fields,
+            'serial_no': obj.serial_no,
+            'participant_updated': calendar.timegm(
+                obj.participant_updated.timetuple())
+            if obj.participant_updated else None,
+            'conflicts': obj.conflicts,
+            'unreachable': obj.unreachable,
+            'verified_fields': obj.verified_fields,
+            'last_phone_number': obj.last_phone_number,
+            'lat': to_shape(obj.geom).y if hasattr(obj.geom, 'desc') else None,
+            'lon': to_shape(obj.geom).x if hasattr(obj.geom, 'desc') else None,
         }
 
 
 class SubmissionArchiveSerializer(ArchiveSerializer):
-    def deserialize(self, zip_file):
-        return super().deserialize(zip_file)
+    def deserialize(self, zip_file, restore):
+        restore.load(
+            zip_file, 'submissions.ndjson', 'submission',
+            ('id', 'uuid', 'deployment_id', 'event_id', 'form_id',
+             'participant_id', 'location_id', 'data', 'extra_data',
+             'submission_type', 'created', 'updated', 'sender_verified',
+             'quarantine_status', 'verification_status',
+             'incident_description', 'incident_status', 'overridden_fields',
+             'serial_no', 'participant_updated', 'conflicts', 'unreachable',
+             'verified_fields', 'last_phone_number', 'geom'),
+            partial(self.deserialize_submission, restore), name='submission')
+        self.restore_masters(restore)
+
+    def restore_masters(self, restore):
+        # archives written before the master submissions were archived only
+        # have the observer submissions, so the masters are created and
+        # their data merged from one observer submission of each group
+        master = aliased(Submission)
+        observers = Submission.query.join(Form).filter(
+            Submission.event_id == restore.event.id,
+            Submission.submission_type == 'O',
+            Form.form_type == 'CHECKLIST',
+            ~exists().where(
+                master.event_id == Submission.event_id,
+                master.form_id == Submission.form_id,
+                master.location_id == Submission.location_id,
+                master.submission_type == 'M')).distinct(
+                    Submission.form_id, Submission.location_id).order_by(
+                        Submission.form_id, Submission.location_id,
+                        Submission.id).all()
+        if not observers:
+            return
+
+        db.session.add_all([
+            Submission(
+                deployment_id=restore.deployment.id,
+                event_id=restore.event.id, form_id=observer.form_id,
+                location_id=observer.location_id, submission_type='M',
+                data={})
+            for observer in observers
+        ])
+        db.session.flush()
+
+        for observer in observers:
+            if not observer.form.untrack_data_conflicts:
+                group = SubmissionGroup.load(observer)
+                group.save(group.resolve({}))
 
-    def serialize(self, event, zip_file):
+    def deserialize_submission(self, restore, data, record_id):
+        # the columns after the overridden fields are missing from the
+        # archives written before they were archived
+        if data.get('lat') is not None and data.get('lon') is not None:
+            geom = f'SRID=4326;POINT({data["lon"]} {data["lat"]})'
+        else:
+            geom = None
+
+        return (
+            record_id, uuid4(), restore.deployment.id, restore.event.id,
+            restore.remap('form', data['form']),
+            restore.remap('participant', data['participant']),
+            restore.remap('location', data['location']),
+            json_value(data['data']), json_value(data['extra_data']),
+            data['submission_type'], from_timestamp(data['created']),
+            from_timestamp(data['updated']), data['sender_verified'],
+            data['quarantine_status'], data['verification_status'],
+            data['incident_description'], data['incident_status'],
+            array_literal(data['overridden_fields']), data.get('serial_no'),
+            from_timestamp(data.get('participant_updated')),
+            json_value(data.get('conflicts')), data.get('unreachable', False),
+            json_value(data.get('verified_fields', [])),
+            data.get('last_phone_number'), geom)
+
+    def serialize(self, event, zip_file, progress=None):
+        # only the uuids of the form, participant and location are exported,
+        # and the master submissions have no participant
         query = Submission.query.filter_by(
-            event_id=event.id).join(Form).join(Location).join(Participant)
+            event_id=event.id).join(Form).join(Location).outerjoin(
+                Participant).options(
+                    contains_eager(Submission.form).load_only(Form.uuid),
+                    contains_eager(Submission.location).load_only(
+                        Location.uuid),
+                    contains_eager(Submission.participant).load_only(
+                        Participant.uuid)).order_by(
+                            Submission.id).yield_per(YIELD_PER)
         serializer = SubmissionSerializer()
 
-        with zip_file.open('submissions.ndjson', 'w') as f:
+        with zip_file.open(
+                'submissions.ndjson', 'w', force_zip64=True) as f:
             for sub in query:
                 data = serializer.serialize_one(sub)
                 line = f'{json.dumps(data)}\n'
                 f.write(line.encode('utf-8'))
+
+                if progress is not None:
+                    progress.processed_records += 1
+                    progress.update()
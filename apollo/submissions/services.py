@@ -1,16 +1,20 @@
 # -*- coding: utf-8 -*-
 import csv
 from io import StringIO
+from itertools import islice
 
 import sqlalchemy as sa
 from dateutil.parser import isoparse
 from flask_babel import gettext as _
 from geoalchemy2.shape import to_shape
+from sqlalchemy.orm import selectinload
 
 from apollo import constants
+from apollo.core import db
 from apollo.dal.service import Service
+from apollo.locations.ancestry import get_ancestry
 from apollo.locations.models import LocationType, LocationTypePath
-from apollo.participants.models import Sample
+from apollo.participants.models import Sample, samples_participants
 from apollo.submissions.models import Submission, SubmissionComment, SubmissionVersion
 from apollo.submissions.qa.query_builder import generate_qa_queries
 
@@ -45,7 +49,50 @@ def export_timestamp(ts_string: str) -> str:
 class SubmissionService(Service):
     __model__ = Submission
 
-    def export_list(self, query, include_qa=False, include_group_timestamps=False):
+    def _export_lookups(self, submissions):
+        """Loads the sibling, sample membership and comment lookups needed to export a chunk of submissions."""
+        # first observer submission for each master submission
+        siblings = {}
+        masters = [submission for submission in submissions if submission.submission_type != "O"]
+        if masters:
+            sample = masters[0]
+            observers = (
+                Submission.query.filter(
+                    Submission.deployment_id == sample.deployment_id,
+                    Submission.event_id == sample.event_id,
+                    Submission.form_id == sample.form_id,
+                    Submission.location_id.in_({master.location_id for master in masters}),
+                    Submission.submission_type == "O",
+                )
+                .options(selectinload(Submission.participant))
+                .order_by(Submission.id)
+            )
+            for observer in observers:
+                siblings.setdefault((observer.location_id, observer.serial_no), observer)
+
+        participant_ids = {submission.participant_id for submission in submissions}
+        participant_ids.update(sibling.participant_id for sibling in siblings.values())
+        participant_ids.discard(None)
+        sample_memberships = set(
+            db.session.query(samples_participants.c.participant_id, samples_participants.c.sample_id).filter(
+                samples_participants.c.participant_id.in_(participant_ids)
+            )
+        )
+
+        comments = {}
+        observer_ids = [submission.id for submission in submissions if submission.submission_type == "O"]
+        if observer_ids:
+            submission_comments = (
+                SubmissionComment.query.with_entities(SubmissionComment.submission_id, SubmissionComment.comment)
+                .filter(SubmissionComment.submission_id.in_(observer_ids))
+                .order_by(SubmissionComment.submission_id, SubmissionComment.id)
+            )
+            for submission_id, comment in submission_comments:
+                comments.setdefault(submission_id, comment)
+
+        return siblings, sample_memberships, comments
+
+    def export_list(self, query, include_qa=False, include_group_timestamps=False, chunk_size=1000, progress=None):
         if query.count() == 0:
             yield ""
             return
@@ -63,8 +110,7 @@ class SubmissionService(Service):
             .all()
         )
         samples = Sample.query.filter_by(participant_set_id=event.participant_set_id).all()
-        form._populate_group_cache()
-        form_groups = form._group_cache.keys()
+        form_groups = form.get_group_names()
         group_tags = {group: form.get_group_tags(group) for group in form_groups}
 
         extra_field_headers = [fi.label for fi in extra_fields]
@@ -116,109 +162,131 @@ class SubmissionService(Service):
         writer = csv.writer(output, quoting=csv.QUOTE_NONNUMERIC)
         writer.writerow(dataset_headers)
         yield output.getvalue()
-        output.close()
+        output.seek(0)
+        output.truncate()
+
+        ancestry = get_ancestry(event.location_set_id)
+        rows = query.options(selectinload(Submission.location), selectinload(Submission.participant)).yield_per(
+            chunk_size
+        )
+        rows = iter(rows)
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
 
-        for item in query:
             if export_qa:
-                row_dict = item._asdict()
-                submission = row_dict["Submission"]
+                chunk = [(item[0], item._asdict()) for item in chunk]
             else:
-                submission = item
-                row_dict = {}
-            location_path = submission.location.make_path()
-            group_timestamps = (submission.extra_data or {}).get("group_timestamps", {})
-            if submission.submission_type == "O":
-                if submission.location.extra_data:
-                    extra_data_columns = [submission.location.extra_data.get(ef.name) for ef in extra_fields]
-                else:
-                    extra_data_columns = [""] * len(extra_fields)
+                chunk = [(item, {}) for item in chunk]
 
-                record = [submission.serial_no] if form.form_type == "SURVEY" else []  # noqa
+            siblings, sample_memberships, comments = self._export_lookups([submission for submission, _row in chunk])
 
-                record.extend(
-                    [
-                        submission.participant.participant_id if submission.participant else "",
-                        submission.participant.name if submission.participant else "",
-                        submission.participant.primary_phone if submission.participant else "",
-                        submission.last_phone_number if submission.last_phone_number else "",  # noqa
-                    ]
-                    + [location_path.get(loc_type.name, "") for loc_type in location_types]
-                    + [
-                        submission.location.name,
-                        submission.location.code,
-                        to_shape(submission.geom).y if hasattr(submission.geom, "desc") else "",  # noqa
-                        to_shape(submission.geom).x if hasattr(submission.geom, "desc") else "",  # noqa
-                    ]
-                    + extra_data_columns
-                    + [submission.location.registered_voters]
-                )
+            for submission, row_dict in chunk:
+                location = submission.location
+                location_path = ancestry.name_path(submission.location_id) or {}
+                group_timestamps = (submission.extra_data or {}).get("group_timestamps", {})
+                if location.extra_data:
+                    extra_data_columns = [location.extra_data.get(ef.name) for ef in extra_fields]
+                else:
+                    extra_data_columns = [""] * len(extra_fields)
 
-                for group_name in form_groups:
-                    if include_group_timestamps:
-                        record.append(export_timestamp(group_timestamps.get(group_name, "")))
-                    record.extend([export_field_value(form, submission, tag) for tag in group_tags.get(group_name)])
+                if submission.submission_type == "O":
+                    point = to_shape(submission.geom) if hasattr(submission.geom, "desc") else None
+                    record = [submission.serial_no] if form.form_type == "SURVEY" else []  # noqa
 
-                record += (
-                    [
-                        submission.updated.strftime("%Y-%m-%d %H:%M:%S") if submission.updated else "",
-                        submission.incident_status.value if submission.incident_status else "",
-                        submission.incident_description,
-                    ]
-                    if form.form_type == "INCIDENT"
-                    else (
-                        [submission.updated.strftime("%Y-%m-%d %H:%M:%S") if submission.updated else ""]
-                        + [1 if sample in submission.participant.samples else 0 for sample in samples]
+                    record.extend(
+                        [
+                            submission.participant.participant_id if submission.participant else "",
+                            submission.participant.name if submission.participant else "",
+                            submission.participant.primary_phone if submission.participant else "",
+                            submission.last_phone_number if submission.last_phone_number else "",  # noqa
+                        ]
+                        + [location_path.get(loc_type.name, "") for loc_type in location_types]
                         + [
-                            submission.comments[0].comment.replace("\n", "")  # noqa
-                            if submission.comments
-                            else "",
-                            submission.quarantine_status.value if submission.quarantine_status else "",
+                            location.name,
+                            location.code,
+                            point.y if point is not None else "",
+                            point.x if point is not None else "",
                         ]
+                        + extra_data_columns
+                        + [location.registered_voters]
                     )
-                )
 
-                if export_qa:
-                    record.extend([row_dict[qc["name"]] for qc in quality_checks])
-            else:
-                sib = submission.siblings[0]
-                if submission.location.extra_data:
-                    extra_data_columns = [submission.location.extra_data.get(ef.name) for ef in extra_fields]
+                    for group_name in form_groups:
+                        if include_group_timestamps:
+                            record.append(export_timestamp(group_timestamps.get(group_name, "")))
+                        record.extend(
+                            [export_field_value(form, submission, tag) for tag in group_tags.get(group_name)]
+                        )
+
+                    record += (
+                        [
+                            submission.updated.strftime("%Y-%m-%d %H:%M:%S") if submission.updated else "",
+                            submission.incident_status.value if submission.incident_status else "",
+                            submission.incident_description,
+                        ]
+                        if form.form_type == "INCIDENT"
+                        else (
+                            [submission.updated.strftime("%Y-%m-%d %H:%M:%S") if submission.updated else ""]
+                            + [
+                                1 if (submission.participant.id, sample.id) in sample_memberships else 0
+                                for sample in samples
+                            ]
+                            + [
+                                comments[submission.id].replace("\n", "") if submission.id in comments else "",
+                                submission.quarantine_status.value if submission.quarantine_status else "",
+                            ]
+                        )
+                    )
+
+                    if export_qa:
+                        record.extend([row_dict[qc["name"]] for qc in quality_checks])
                 else:
-                    extra_data_columns = [""] * len(extra_fields)
+                    sib = siblings[(submission.location_id, submission.serial_no)]
+                    point = to_shape(sib.geom) if hasattr(sib.geom, "desc") else None
 
-                record = [sib.serial_no] if form.form_type == "SURVEY" else []
+                    record = [sib.serial_no] if form.form_type == "SURVEY" else []
 
-                record.extend(
-                    [
-                        sib.participant.participant_id if sib.participant else "",
-                        sib.participant.name if sib.participant else "",
-                        sib.participant.primary_phone if sib.participant else "",
-                        sib.last_phone_number if sib.last_phone_number else "",
-                    ]
-                    + [location_path.get(loc_type.name, "") for loc_type in location_types]
-                    + [
-                        submission.location.name,
-                        submission.location.code,
-                        to_shape(sib.geom).y if hasattr(sib.geom, "desc") else "",  # noqa
-                        to_shape(sib.geom).x if hasattr(sib.geom, "desc") else "",  # noqa
+                    record.extend(
+                        [
+                            sib.participant.participant_id if sib.participant else "",
+                            sib.participant.name if sib.participant else "",
+                            sib.participant.primary_phone if sib.participant else "",
+                            sib.last_phone_number if sib.last_phone_number else "",
+                        ]
+                        + [location_path.get(loc_type.name, "") for loc_type in location_types]
+                        + [
+                            location.name,
+                            location.code,
+                            point.y if point is not None else "",
+                            point.x if point is not None else "",
+                        ]
+                        + extra_data_columns
+                        + [location.registered_voters]
+                    )
+
+                    for group_name in form_groups:
+                        record.append(export_timestamp(group_timestamps.get(group_name, "")))
+                        record.extend(
+                            [export_field_value(form, submission, tag) for tag in group_tags.get(group_name)]
+                        )
+
+                    record += [submission.updated.strftime("%Y-%m-%d %H:%M:%S") if submission.updated else ""] + [
+                        1 if (sib.participant.id, sample.id) in sample_memberships else 0 for sample in samples
                     ]
-                    + extra_data_columns
-                    + [submission.location.registered_voters]
-                )
 
-                for group_name in form_groups:
-                    record.append(export_timestamp(group_timestamps.get(group_name, "")))
-                    record.extend([export_field_value(form, submission, tag) for tag in group_tags.get(group_name)])
+                writer.writerow(record)
 
-                record += [submission.updated.strftime("%Y-%m-%d %H:%M:%S") if submission.updated else ""] + [
-                    1 if sample in sib.participant.samples else 0 for sample in samples
-                ]
+            if progress is not None:
+                progress.processed_records += len(chunk)
+                progress.update()
 
-            output = StringIO()
-            writer = csv.writer(output, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(record)
             yield output.getvalue()
-            output.close()
+            output.seek(0)
+            output.truncate()
+
+        output.close()
 
 
 class SubmissionCommentService(Service):
@@ -1,16 +1,22 @@
 # -*- coding: utf-8 -*-
 import logging
 import os
+from contextlib import nullcontext
+from uuid import UUID
 
 from celery import shared_task
-from flask_babel import gettext
+from depot.manager import DepotManager
+from flask_babel import force_locale, gettext
+from werkzeug.datastructures import MultiDict
 
-from apollo import helpers, models
-from apollo.core import uploads
+from apollo import helpers, models, services
+from apollo.core import db, uploads
 from apollo.participants.models import Participant
 
 from ..models import Submission
 from ..users.models import UserUpload
+from . import exports
+from .aggregation import aggregate_dataset
 
 logger = logging.getLogger(__name__)
 
@@ -164,3 +170,72 @@ def init_survey_submissions(self, event_id, form_id, upload_id):
                     "error_log": error_log,
                 },
             )
+
+
+@shared_task(bind=True)
+def export_submissions(self, key, event_id, form_id, mode, args, location_id=None, locale=None):
+    """Render a submission export to a file in the uploads storage."""
+    event = models.Event.query.filter_by(id=event_id).first()
+    form = models.Form.query.filter_by(id=form_id).first()
+
+    try:
+        if not (event and form):
+            return
+
+        with force_locale(locale) if locale else nullcontext():
+            queryset = exports.make_export_query(event, form, mode, MultiDict(args), location_id)
+            progress = helpers.TaskProgress(self, queryset.count())
+            progress.update(force=True)
+
+            if mode == "aggregated":
+                chunks = aggregate_dataset(queryset.order_by(None), form, True, progress=progress)
+            else:
+                chunks = services.submissions.export_list(
+                    queryset,
+                    include_qa=mode == "qa",
+                    include_group_timestamps=mode == "observer-ts",
+                    progress=progress,
+                )
+
+            exports.write_export(key, chunks)
+            progress.processed_records = progress.total_records
+            progress.update(force=True)
+
+        exports.remove_expired_exports()
+    finally:
+        exports.release_export(key)
+
+    return {"key": key}
+
+
+@shared_task
+def save_image_attachments(submission_id, attachments):
+    """Create the image attachments of an ODK submission.
+
+    The images are staged in the default storage by the submission view and
+    are moved to the image storage here, where their thumbnails are created.
+    Attachments replaced by the new images are removed.
+    """
+    storage = DepotManager.get()
+    submission = models.Submission.query.filter_by(id=submission_id).first()
+
+    for attachment in attachments:
+        if attachment.get("replaces"):
+            # deleted through the session so that the image and its
+            # thumbnail are removed from the image storage
+            replaced = models.SubmissionImageAttachment.query.filter_by(uuid=attachment["replaces"]).first()
+            if replaced:
+                db.session.delete(replaced)
+
+        if submission and attachment.get("file_id"):
+            db.session.add(
+                models.SubmissionImageAttachment(
+                    photo=storage.get(attachment["file_id"]), submission=submission, uuid=UUID(attachment["uuid"])
+                )
+            )
+
+    db.session.commit()
+
+    for attachment in attachments:
+        if attachment.get("file_id"):
+            storage.delete(attachment["file_id"])
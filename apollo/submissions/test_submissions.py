@@ -1,15 +1,38 @@
-from unittest import TestCase
+import csv
+import os
+import tempfile
+import time
+from datetime import datetime
+from unittest import TestCase, mock
 
 import numpy as np
 import pandas as pd
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Session
+from werkzeug.datastructures import MultiDict
 
+from apollo import settings
+from apollo.formsframework.models import Form, invalidate_form_metadata
+from apollo.locations.ancestry import LocationAncestry
+from apollo.submissions import analysis_cache, exports, generation, tasks
 from apollo.submissions.aggregation import (
+    TOTAL,
     _multiselect_field_processor,
     _numeric_field_processor,
     _select_field_processor,
+    aggregate_rows,
+    aggregate_statistics,
+    field_statistics,
+    level_statistics,
+    option_indicators,
 )
+from apollo.submissions.conflicts import SubmissionGroup, jsonb_contains
 from apollo.submissions.incidents import incidents_csv
+from apollo.submissions.listing import SortKey, keyset_condition
+from apollo.submissions.models import Submission
+from apollo.submissions.qa import query_builder
 from apollo.submissions.qa.query_builder import build_expression
+from apollo.submissions.utils import make_submission_dataframe, make_turnout_dataframe
 
 
 class IncidentsTest(TestCase):
@@ -60,6 +83,68 @@ class AggregationTest(TestCase):
         result = _multiselect_field_processor(options, column)
         self.assertEqual(result, [4, 4, 5, 4, 4])
 
+    def test_option_indicators(self):
+        column = pd.Series([[1, 3], None, [2], [], [1, 9]])
+        self.assertEqual(
+            option_indicators(column, [1, 2, 3]).tolist(),
+            [[1, 0, 1], [0, 0, 0], [0, 1, 0], [0, 0, 0], [1, 0, 0]])
+
+        column = pd.Series([2.0, np.nan, 1.0])
+        self.assertEqual(option_indicators(column, [1, 2]).tolist(), [[0, 1], [0, 0], [1, 0]])
+        self.assertEqual(option_indicators(pd.Series([1.0, np.nan]), []).shape, (2, 0))
+        self.assertEqual(option_indicators(pd.Series([[1], None]), {}.values()).shape, (2, 0))
+
+    def test_level_statistics(self):
+        fields = [
+            {'tag': 'AA', 'type': 'integer'},
+            {'tag': 'AB', 'type': 'select', 'options': {'Yes': 1, 'No': 2}},
+            {'tag': 'AC', 'type': 'string'},
+        ]
+        df = pd.DataFrame({
+            'AA': [1, 2, np.nan, 4],
+            'AB': [1, 2, 2, np.nan],
+            'AC': ['a', None, None, None],
+            'Region': ['North', 'North', 'South', 'South'],
+            'District': ['N1', 'N2', 'S1', 'S1'],
+        })
+
+        statistics = level_statistics(df, ['Region', 'District'], field_statistics(df, fields))
+        self.assertEqual(statistics[TOTAL].tolist(), [2, 2, 1, 1, 2])
+        self.assertEqual(statistics[('AB', 2)].tolist(), [1, 1, 0, 1, 1])
+
+        rows = list(aggregate_rows(statistics, ['Region', 'District'], fields))
+        self.assertEqual(rows[0], ['Region', 'North', '', 2, 3, 2, 0, 100.0, 1, 1, 2, 0, 100.0, 1, 1, 50.0])
+        self.assertEqual(rows[4], ['District', 'South', 'S1', 2, 4, 1, 1, 50.0, 0, 1, 1, 1, 50.0, 0, 2, 0.0])
+
+    def test_batched_statistics(self):
+        fields = [
+            {'tag': 'AA', 'type': 'integer'},
+            {'tag': 'AB', 'type': 'multiselect', 'options': {'Yes': 1, 'No': 2}},
+        ]
+        levels = ['Region', 'District']
+        df = pd.DataFrame({
+            'AA': [1, 2, np.nan, 4, 5],
+            'AB': [[1], [1, 2], None, [2], []],
+            'Region': ['North', 'North', 'South', 'South', None],
+            'District': ['N1', 'N2', 'S1', 'S1', None],
+        }, index=[3, 5, 8, 13, 21])
+
+        query = mock.MagicMock()
+        query.order_by.return_value.with_entities.return_value = [(pk,) for pk in df.index[::-1]]
+        batches = iter([df.iloc[0:2], df.iloc[2:4], df.iloc[4:5]])
+        progress = mock.Mock(processed_records=0)
+
+        with mock.patch('apollo.submissions.aggregation._batch_size', return_value=2), \
+                mock.patch('apollo.submissions.aggregation.load_submission_dataframe',
+                           side_effect=lambda *args: next(batches)) as loader:
+            statistics = aggregate_statistics(query, None, fields, levels, progress=progress)
+
+        self.assertEqual(loader.call_count, 3)
+        self.assertEqual(progress.processed_records, 5)
+        expected = level_statistics(df, levels, field_statistics(df, fields))
+        pd.testing.assert_frame_equal(statistics, expected, check_dtype=False)
+        self.assertEqual(statistics[TOTAL].tolist(), [2, 2, 1, 1, 2])
+
 
 class ExpressionBuilderTestCase(TestCase):
     def test_single_control(self):
@@ -92,3 +177,484 @@ class ExpressionBuilderTestCase(TestCase):
 
         expression = build_expression(valid_controls)
         self.assertEqual(expression, 'AA = 1 && BA = 1 || BH = EJ')
+
+
+class ConflictEngineTest(TestCase):
+    def setUp(self):
+        self.form = Form(
+            form_type='CHECKLIST',
+            untrack_data_conflicts=False,
+            data={
+                'groups': [
+                    {
+                        'name': 'Group',
+                        'fields': [
+                            {'tag': 'AA', 'type': 'integer',
+                             'analysis_type': 'N/A'},
+                            {'tag': 'AB', 'type': 'multiselect',
+                             'analysis_type': 'N/A'},
+                            {'tag': 'AC', 'type': 'integer',
+                             'analysis_type': 'RESULT'},
+                        ]
+                    }
+                ]
+            })
+
+    def _submission(self, data, quarantine_status='', **kwargs):
+        return Submission(
+            form=self.form, submission_type='O', data=data,
+            quarantine_status=quarantine_status, overridden_fields=[],
+            **kwargs)
+
+    def test_jsonb_contains(self):
+        self.assertTrue(jsonb_contains(1, 1))
+        self.assertTrue(jsonb_contains(1, 1.0))
+        self.assertFalse(jsonb_contains(1, '1'))
+        self.assertFalse(jsonb_contains(1, True))
+        self.assertTrue(jsonb_contains([1, 2, 3], [3, 1]))
+        self.assertFalse(jsonb_contains([1, 2], [1, 4]))
+        self.assertFalse(jsonb_contains([1, 2], 1))
+        self.assertTrue(jsonb_contains({'a': [1, 2]}, {'a': [2]}))
+        self.assertTrue(jsonb_contains(None, None))
+
+    def test_conflict_tags(self):
+        submission = self._submission({'AA': 1, 'AB': [1], 'AC': 5})
+        sibling = self._submission({'AA': 2, 'AB': [1, 2], 'AC': 6})
+        group = SubmissionGroup(submission, None, [submission, sibling])
+
+        self.assertEqual(group.conflict_tags(submission), {'AA', 'AC'})
+        self.assertEqual(group.conflict_tags(sibling), {'AA', 'AB', 'AC'})
+        self.assertEqual(group.conflict_tags(submission, ['AB']), set())
+
+    def test_conflict_tags_quarantine(self):
+        submission = self._submission({'AA': 1, 'AC': 5})
+        results_quarantined = self._submission({'AA': 1, 'AC': 6}, 'R')
+        fully_quarantined = self._submission({'AA': 2, 'AC': 7}, 'A')
+        group = SubmissionGroup(
+            submission, None,
+            [submission, results_quarantined, fully_quarantined])
+
+        self.assertEqual(group.conflict_tags(submission), set())
+
+        submission.overridden_fields = ['AA']
+        fully_quarantined.quarantine_status = ''
+        self.assertEqual(group.conflict_tags(submission), {'AC'})
+
+    def test_resolve(self):
+        submission = self._submission({'AA': 1})
+        sibling = self._submission({'AA': 2, 'AB': [1]})
+        master = Submission(
+            form=self.form, submission_type='M', data={},
+            overridden_fields=[], conflicts=None)
+        group = SubmissionGroup(submission, master, [submission, sibling])
+
+        changes = group.resolve({'AC': 10})
+
+        self.assertEqual(changes[submission]['conflicts'], ['AA'])
+        self.assertEqual(changes[sibling]['conflicts'], ['AA'])
+        self.assertEqual(changes[master]['conflicts'], ['AA'])
+        self.assertEqual(changes[master]['data'], {'AB': [1], 'AC': 10})
+
+
+class ExportFileTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.key = 'a' * 64
+        self.path = os.path.join(self.directory.name, 'exports', f'{self.key}.csv')
+        patcher = mock.patch.object(exports, 'export_path', return_value=self.path)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.directory.cleanup)
+
+    def test_write_export(self):
+        self.assertIsNone(exports.get_export(self.key))
+
+        exports.write_export(self.key, ['a,b\r\n', None, '1,2\r\n'])
+        self.assertEqual(exports.get_export(self.key), self.path)
+        with open(self.path, encoding='utf-8', newline='') as f:
+            self.assertEqual(f.read(), 'a,b\r\n1,2\r\n')
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [f'{self.key}.csv'])
+
+    def test_write_export_failure(self):
+        def chunks():
+            yield 'a,b\r\n'
+            raise RuntimeError
+
+        with self.assertRaises(RuntimeError):
+            exports.write_export(self.key, chunks())
+        self.assertIsNone(exports.get_export(self.key))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_stream_export(self):
+        chunks = exports.stream_export(self.key, ['a,b\r\n', '', '1,2\r\n'])
+        self.assertEqual(next(chunks), 'a,b\r\n')
+        self.assertIsNone(exports.get_export(self.key))
+
+        self.assertEqual(list(chunks), ['1,2\r\n'])
+        with open(self.path, encoding='utf-8', newline='') as f:
+            self.assertEqual(f.read(), 'a,b\r\n1,2\r\n')
+
+    def test_stream_export_closed(self):
+        chunks = exports.stream_export(self.key, ['a,b\r\n', '1,2\r\n'])
+        next(chunks)
+        chunks.close()
+        self.assertIsNone(exports.get_export(self.key))
+        self.assertEqual(os.listdir(os.path.dirname(self.path)), [])
+
+    def test_csv_chunks(self):
+        rows = [['Level', 'Total'], ['Region', 2], ['District', 1]]
+        chunks = list(exports.csv_chunks(rows, chunk_size=20))
+        self.assertEqual(chunks, ['\ufeff"Level","Total"\r\n"Region",2\r\n', '"District",1\r\n'])
+
+        chunks = list(exports.csv_chunks(
+            rows, chunk_size=1000, bom=False, quoting=csv.QUOTE_MINIMAL, lineterminator='\n'))
+        self.assertEqual(chunks, ['Level,Total\nRegion,2\nDistrict,1\n'])
+        self.assertEqual(list(exports.csv_chunks([], bom=False)), [])
+
+    def test_expired_export(self):
+        exports.write_export(self.key, ['a,b\r\n'])
+        expired = time.time() - settings.EXPORT_FILE_TTL - 1
+        os.utime(self.path, (expired, expired))
+        self.assertIsNone(exports.get_export(self.key))
+
+    def test_invalid_key(self):
+        self.assertIsNone(exports.get_export('../../settings'))
+
+
+class ExportKeyTest(TestCase):
+    def setUp(self):
+        self.form = Form(id=1, data={})
+        self.addCleanup(invalidate_form_metadata, self.form)
+        self.event = mock.MagicMock(id=2, location_set_id=3)
+        self.queryset = mock.MagicMock()
+        self.queryset.order_by.return_value.with_entities.return_value.one.return_value = (None, 5)
+        self.comments = (None, 0)
+        self.generations = {'participants': 0, 'ancestry': b'1'}
+
+        comment_query = mock.MagicMock()
+        comment_query.join.return_value.filter.return_value.filter.return_value.with_entities.return_value.one \
+            .side_effect = lambda: self.comments
+        for target, kwargs in (
+            ('SubmissionComment', {'query': comment_query}),
+            ('participants_generation', {'side_effect': lambda: self.generations['participants']}),
+            ('red', {}),
+        ):
+            patcher = mock.patch.object(exports, target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        exports.red.get.side_effect = lambda key: self.generations['ancestry']
+
+    def _key(self, **args):
+        return exports.export_key(
+            self.event, self.form, 'observer', MultiDict(args), None, self.queryset)
+
+    def test_export_key(self):
+        key = self._key(page='2')
+        self.assertEqual(self._key(), key)
+        self.assertEqual(self._key(after='abc'), key)
+        self.assertEqual(self._key(before='abc'), key)
+        self.assertNotEqual(self._key(sample='1'), key)
+
+        self.comments = (7, 1)
+        key, previous = self._key(), key
+        self.assertNotEqual(key, previous)
+
+        self.generations['participants'] = 1
+        key, previous = self._key(), key
+        self.assertNotEqual(key, previous)
+
+        self.generations['ancestry'] = b'2'
+        self.assertNotEqual(self._key(), key)
+
+
+class AnalysisCacheTest(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.form = Form(id=1, data={'groups': [{'name': 'Group', 'fields': [
+            {'tag': 'AA', 'type': 'integer'}, {'tag': 'AB', 'type': 'integer'}]}]})
+        self.addCleanup(invalidate_form_metadata, self.form)
+        self.event = mock.MagicMock(id=2)
+        self.dataframe = pd.DataFrame(
+            {'AA': [1.0, 2.0, 3.0], 'Station': ['A', 'B', 'C']}, index=pd.Index([10, 20, 30], name='id'))
+
+        folder = os.path.join(self.directory.name, 'dataframes')
+        for target, kwargs in (
+            ('cache_path', {'side_effect': lambda slot, digest: os.path.join(folder, f'{slot}.{digest}.pkl')}),
+            ('_base_query', {}),
+            ('red', {}),
+        ):
+            patcher = mock.patch.object(analysis_cache, target, **kwargs)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _load(self, digest, ids, **kwargs):
+        query = mock.MagicMock()
+        query.order_by.return_value.with_entities.return_value = [(pk,) for pk in ids]
+        with mock.patch.object(analysis_cache, '_cache_digest', return_value=digest), \
+                mock.patch.object(analysis_cache, 'load_submission_dataframe', return_value=self.dataframe) as load:
+            return analysis_cache.analysis_dataframe(query, self.form, self.event, 'O', **kwargs), load
+
+    def test_cached_dataframe(self):
+        df, load = self._load('a', [10, 30], selected_tags=['AA'])
+        self.assertEqual(load.call_args.args[2], ['AA'])
+        self.assertEqual(df['Station'].tolist(), ['A', 'C'])
+        self.assertEqual(df.index.tolist(), [0, 1])
+
+        # the file is shared until the submissions change
+        df, load = self._load('a', [20], selected_tags=['AA'])
+        load.assert_not_called()
+        self.assertEqual(df['AA'].tolist(), [2.0])
+        self.assertEqual(
+            [call.args[1] for call in analysis_cache.red.hincrby.call_args_list], ['misses', 'hits'])
+
+        # the other tags and the stale files are loaded and written separately
+        self._load('a', [])[1].assert_called_once()
+        self._load('b', [], selected_tags=['AA'])[1].assert_called_once()
+        self.assertEqual(len(os.listdir(os.path.join(self.directory.name, 'dataframes'))), 2)
+
+    def test_digest_follows_updates(self):
+        generations = {}
+        red = mock.MagicMock()
+        red.get.side_effect = generations.get
+        red.incr.side_effect = lambda key: generations.__setitem__(key, generations.get(key, 0) + 1)
+        analysis_cache.red.get.return_value = None
+        base_query = mock.MagicMock()
+        base_query.with_entities.return_value.one.return_value = (3, 30, datetime(2024, 1, 1))
+
+        with mock.patch.object(generation, 'red', red):
+            digest = analysis_cache._cache_digest(base_query, self.event, self.form)
+
+            # the data of an older submission is updated, which leaves the
+            # number of submissions and the last ones added and updated as is
+            session = Session()
+            submission = Submission(id=10, event_id=self.event.id, form_id=self.form.id, data={'AA': 2})
+            session.add(submission)
+            generation._submission_modified(None, None, submission)
+            self.assertEqual(analysis_cache._cache_digest(base_query, self.event, self.form), digest)
+
+            generation._after_commit(session)
+            updated_digest = analysis_cache._cache_digest(base_query, self.event, self.form)
+            self.assertNotEqual(updated_digest, digest)
+
+            # the submissions of the other forms are left alone
+            other_form = Form(id=2, data={})
+            self.addCleanup(invalidate_form_metadata, other_form)
+            other_digest = analysis_cache._cache_digest(base_query, self.event, other_form)
+            generation.invalidate_submissions(self.event.id, self.form.id)
+            self.assertEqual(analysis_cache._cache_digest(base_query, self.event, other_form), other_digest)
+
+    def test_hit_rate(self):
+        analysis_cache.red.hgetall.return_value = {b'hits': b'3', b'misses': b'1'}
+        self.assertEqual(analysis_cache.cache_stats(), {'hits': 3, 'misses': 1})
+        self.assertEqual(analysis_cache.hit_rate(), 0.75)
+
+
+class InlineQATest(TestCase):
+    def setUp(self):
+        self.form = Form(
+            id=1,
+            version_identifier='v1',
+            form_type='CHECKLIST',
+            data={
+                'groups': [
+                    {
+                        'name': 'Group',
+                        'fields': [
+                            {'tag': 'AA', 'type': 'integer', 'min': 0, 'max': 100},
+                            {'tag': 'AB', 'type': 'integer', 'min': 0, 'max': 100},
+                            {'tag': 'AC', 'type': 'select', 'options': {'A': 1, 'B': 2}},
+                            {'tag': 'AD', 'type': 'multiselect', 'options': {'A': 1, 'B': 2}},
+                        ]
+                    }
+                ]
+            })
+        self.addCleanup(invalidate_form_metadata, self.form)
+        self.addCleanup(query_builder._compiled_checks.clear)
+
+    def _visit(self, expression, submission):
+        tree = query_builder.parse_expression(expression)
+        visitor = query_builder.InlineQATreeVisitor(form=self.form, submission=submission)
+        try:
+            return query_builder.visit_parse_tree(tree, visitor)
+        except TypeError:
+            return None
+
+    def test_compiled_check_matches_visitor(self):
+        expressions = [
+            'AA > 5', 'AA + AB = 10', 'AA > 1 && AB < 3 || AC = NULL',
+            '(AA + 2) * 3 >= AB ^ 2', '-AA < AB', 'ZZ = 1', 'AD = 1',
+            'AA = NULL', 'AA - AB * 2 / 4 <> 3', 'NULL = NULL',
+        ]
+        submissions = [
+            Submission(form=self.form, data=data)
+            for data in ({'AA': 5, 'AB': 5, 'AC': 1, 'AD': [1]}, {'AB': 2}, {}, {'AA': 12, 'AB': 3})
+        ]
+
+        for expression in expressions:
+            check = {'name': expression, 'lvalue': expression, 'comparator': '', 'rvalue': ''}
+            for submission in submissions:
+                result, _ = query_builder.get_inline_qa_status(submission, check)
+                self.assertEqual(result, self._visit(expression, submission), expression)
+
+    def test_compiled_check_tags(self):
+        check = {'name': 'check', 'lvalue': 'AA + ZZ', 'comparator': '>', 'rvalue': 'AB'}
+        compiled = query_builder.compile_check(self.form, check)
+
+        self.assertEqual(compiled.tags, {'AA', 'AB'})
+
+        # unknown tags evaluate to NULL, which can't be added to a number
+        submission = Submission(form=self.form, data={'AA': 1, 'ZZ': 1, 'AB': 0})
+        self.assertEqual(query_builder.get_inline_qa_status(submission, check), (None, set()))
+
+    def test_compiled_check_cache(self):
+        check = {'name': 'check', 'lvalue': 'AA', 'comparator': '>', 'rvalue': '5'}
+        compiled = query_builder.compile_check(self.form, check)
+        self.assertIs(query_builder.compile_check(self.form, check), compiled)
+
+        # modified checks and new form versions are compiled again
+        modified = dict(check, rvalue='6')
+        self.assertEqual(query_builder.compile_check(self.form, modified).expression, 'AA > 6')
+
+        self.form.version_identifier = 'v2'
+        self.assertIsNot(query_builder.compile_check(self.form, check), compiled)
+        self.assertEqual(list(query_builder._compiled_checks), [(1, 'v2', 'check')])
+
+    def test_logical_checks_stats(self):
+        checks = [
+            {'name': 'check', 'lvalue': 'AA', 'comparator': '>', 'rvalue': '1'},
+            {'name': 'empty', 'lvalue': '', 'comparator': '', 'rvalue': ''},
+        ]
+        query = mock.MagicMock()
+        counts = query.session.query.return_value.select_from.return_value.one
+        counts.return_value = (10, 3, 0, 5, 2)
+
+        results = query_builder.get_logical_checks_stats(query, self.form, checks)
+
+        # one total count and a count per status for the non-empty check
+        self.assertEqual(len(query.session.query.call_args.args), 5)
+        self.assertEqual(results, [[('Flagged', 3), ('OK', 5), ('Missing', 2)], [('Missing', 10)]])
+
+
+class ImageAttachmentTaskTest(TestCase):
+    def test_replaced_attachment_deleted(self):
+        replaced = mock.Mock()
+        with mock.patch.object(tasks, 'models') as models, mock.patch.object(tasks, 'db') as db, \
+                mock.patch.object(tasks, 'DepotManager'):
+            query = models.SubmissionImageAttachment.query
+            query.filter_by.return_value.first.return_value = replaced
+            tasks.save_image_attachments(1, [{'replaces': 'old'}])
+
+        query.filter_by.assert_called_once_with(uuid='old')
+        query.filter_by.return_value.delete.assert_not_called()
+        db.session.delete.assert_called_once_with(replaced)
+        db.session.commit.assert_called_once_with()
+
+
+class KeysetPaginationTest(TestCase):
+    def _compile(self, clause):
+        return str(clause.compile(dialect=postgresql.dialect(), compile_kwargs={'literal_binds': True}))
+
+    def test_sort_key_order(self):
+        self.assertEqual(
+            self._compile(SortKey(Submission.serial_no).order_by()),
+            'submission.serial_no ASC NULLS LAST')
+        self.assertEqual(
+            self._compile(SortKey(Submission.serial_no, True).reverse().order_by()),
+            'submission.serial_no ASC NULLS LAST')
+        self.assertEqual(
+            self._compile(SortKey(Submission.participant_updated, True, nulls_last=True).reverse().order_by()),
+            'submission.participant_updated ASC NULLS FIRST')
+
+    def test_keyset_condition(self):
+        sort_keys = [SortKey(Submission.serial_no, True), SortKey(Submission.id, nullable=False)]
+        self.assertEqual(
+            self._compile(keyset_condition(sort_keys, ('12', 5))),
+            "submission.serial_no < '12' OR "
+            "submission.serial_no = '12' AND submission.id > 5")
+
+        # nulls are sorted last in ascending order
+        sort_keys = [SortKey(Submission.serial_no), SortKey(Submission.id, nullable=False)]
+        self.assertEqual(
+            self._compile(keyset_condition(sort_keys, (None, 5))),
+            'false OR submission.serial_no IS NULL AND submission.id > 5')
+        self.assertEqual(
+            self._compile(keyset_condition(sort_keys, ('12', 5))),
+            "submission.serial_no > '12' OR submission.serial_no IS NULL OR "
+            "submission.serial_no = '12' AND submission.id > 5")
+
+
+class SubmissionDataframeTest(TestCase):
+    def setUp(self):
+        self.form = Form(
+            id=1,
+            form_type='CHECKLIST',
+            data={
+                'groups': [
+                    {
+                        'name': 'Group',
+                        'fields': [
+                            {'tag': 'AA', 'type': 'integer', 'min': 0, 'max': 100},
+                            {'tag': 'AB', 'type': 'select', 'options': {'A': 1, 'B': 2}},
+                            {'tag': 'AC', 'type': 'multiselect', 'options': {'A': 1, 'B': 2}},
+                        ]
+                    }
+                ]
+            })
+        self.addCleanup(invalidate_form_metadata, self.form)
+        self.ancestry = LocationAncestry(
+            1,
+            [(1, {'en': 'Region'}), (2, {'en': 'Station'})],
+            [
+                (10, 1, {'en': 'North'}, [10]),
+                (20, 2, {'en': 'School'}, [10, 20]),
+                (30, 2, {'en': 'Church'}, [10, 30]),
+            ],
+        )
+
+    def _load(self, load, rows, count, locations, **kwargs):
+        query = mock.MagicMock()
+        query.order_by.return_value.count.return_value = count
+
+        with mock.patch('apollo.submissions.utils.db') as db, \
+                mock.patch('apollo.submissions.utils.Location') as location, \
+                mock.patch('apollo.submissions.utils.get_ancestry', return_value=self.ancestry):
+            db.session.execute.return_value.partitions.return_value = [rows[:2], rows[2:]]
+            location.query.filter.return_value.with_entities.return_value.all.return_value = locations
+            return load(query, self.form, **kwargs)
+
+    def test_submission_dataframe(self):
+        updated = pd.Timestamp('2024-01-01 10:00').to_pydatetime()
+        rows = [
+            (1, 20, 5, 1, [1, 2], updated),
+            (2, 30, None, None, [2], updated),
+            (3, 20, 7, 2, None, None),
+        ]
+        locations = [(20, 1, 300), (30, 1, 400)]
+
+        # more rows than were counted are kept
+        df = self._load(make_submission_dataframe, rows, 2, locations)
+
+        self.assertEqual(
+            list(df.columns), ['AA', 'AB', 'AC', 'updated', 'registered_voters', 'Region', 'Station'])
+        self.assertEqual(df['AA'].dtype, np.float64)
+        self.assertTrue(np.isnan(df['AB'][1]))
+        self.assertEqual(df['AC'].tolist(), [[1, 2], [2], None])
+        self.assertTrue(pd.isna(df['updated'][2]))
+        self.assertEqual(df['registered_voters'].tolist(), [300, 400, 300])
+        self.assertEqual(df['Region'].tolist(), ['North'] * 3)
+        self.assertEqual(df['Station'].tolist(), ['School', 'Church', 'School'])
+
+        df = self._load(make_submission_dataframe, [], 0, [], excluded_tags=['AC'])
+        self.assertTrue(df.empty)
+
+    def test_turnout_dataframe(self):
+        self.form.turnout_fields = ['AA']
+        self.form.turnout_registered_voters_tag = 'AB'
+        rows = [(1, 20, 5, None, 150), (2, 30, 6, None, None)]
+
+        df = self._load(make_turnout_dataframe, rows, 2, [(20, 1, 300), (30, 1, 400)])
+
+        self.assertEqual(list(df.columns), ['AA', 'updated', 'registered_voters', 'Region', 'Station'])
+        self.assertEqual(df['registered_voters'].tolist()[0], 150)
+        self.assertTrue(np.isnan(df['registered_voters'][1]))
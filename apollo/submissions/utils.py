@@ -1,195 +1,167 @@
 # -*- coding: utf-8 -*-
+"""Dataframes of the submissions of a form for the analyses and exports.
+
+The dataframes have a column for every selected tag, the time the
+submission was updated, the registered voters and, for every location type
+on the path of the location of the submission, the name of the location of
+that type. Only the id, location and the typed tag values of the
+submissions are fetched. They are streamed from a server-side cursor into
+arrays allocated for the number of submissions, and the location columns
+are taken from a table of the locations of the submissions built from the
+location ancestry index.
+"""
+
 import numpy as np
 import pandas as pd
-from sqlalchemy import TIMESTAMP, BigInteger, String, cast, func
-from sqlalchemy.dialects.postgresql import array_agg
-from sqlalchemy.orm import aliased
+from sqlalchemy import TIMESTAMP, BigInteger, cast, func
 
 from apollo.core import db
-from apollo.locations.models import Location, LocationPath, LocationType
+from apollo.locations.ancestry import get_ancestry
+from apollo.locations.models import Location
 from apollo.submissions.models import Submission
 
+# number of rows fetched from the server-side cursor at a time
+DATAFRAME_YIELD_PER = 10000
 
-def make_submission_dataframe(query, form, selected_tags=None, excluded_tags=None):
-    """Create a pandas data frame from the given query."""
-    if not db.session.query(query.exists()).scalar():
-        return pd.DataFrame()
 
-    # excluded tags have higher priority than selected tags
-    fields = set(form.tags)
-    if selected_tags:
-        fields = fields.intersection(selected_tags)
-    if excluded_tags:
-        fields = fields.difference(excluded_tags)
+def _tag_column(form, tag, label=None):
+    """Returns the column of a tag and the dtype of its values.
 
-    integral_fields = [
-        tag
-        for tag in fields
-        if form.get_field_by_tag(tag)["type"] == "integer" or form.get_field_by_tag(tag)["type"] == "select"
-    ]
+    Integer and select values are fetched as integers and kept as floats,
+    so that missing values are NaNs and the statistics of the column can be
+    computed. Other values are kept as they are stored.
+    """
+    if tag in form.integral_tags:
+        return cast(func.nullif(Submission.data[tag].astext, ""), BigInteger).label(label or tag), np.float64
 
-    columns = [cast(func.nullif(Submission.data[tag].astext, ""), BigInteger).label(tag) for tag in integral_fields]
-    other_fields = fields.difference(integral_fields)
+    return Submission.data[tag].label(label or tag), object
 
-    # the 'updated' field is required for results analysis
-    columns.extend(
-        [Submission.data[tag].label(tag) for tag in other_fields]
-        + [
-            func.coalesce(
-                # casting to TIMESTAMP so as to lose the time zone
-                Submission.extra_data["voting_timestamp"].astext.cast(TIMESTAMP),  # noqa
-                Submission.updated,
-            ).label("updated")
-        ]
-    )
 
-    # alias just in case the query is already joined to the tables below
-    ancestor_loc = aliased(Location, name="ancestor")
-    ancestor_loc_type = aliased(LocationType, name="ancestor_type")
-    ancestor_loc_path = aliased(LocationPath, name="ancestor_path")
-    own_loc = aliased(Location, name="own_location")
-
-    sub_query = (
-        Submission.query.join(own_loc, Submission.location_id == own_loc.id)
-        .join(ancestor_loc_path, Submission.location_id == ancestor_loc_path.descendant_id)
-        .join(ancestor_loc, ancestor_loc.id == ancestor_loc_path.ancestor_id)
-        .join(ancestor_loc_type, ancestor_loc.location_type_id == ancestor_loc_type.id)
-        .with_entities(
-            cast(ancestor_loc.name, String).label("ancestor_name"),
-            cast(ancestor_loc_type.name, String).label("ancestor_type"),
-            Submission.id.label("submission_id"),
-        )
-        .subquery()
-    )
+def _fill(array, start, values):
+    """Copies a column of a batch of rows into an array from `start`."""
+    if array.dtype == object:
+        # lists would otherwise be broadcast into the array
+        values = np.fromiter(values, dtype=object, count=len(values))
+    array[start : start + len(values)] = values
 
-    # add registered voters and path extraction to the columns
-    columns.append(own_loc.registered_voters.label("registered_voters"))
-    columns.append(
-        func.jsonb_object(
-            array_agg(sub_query.c.ancestor_type),
-            array_agg(sub_query.c.ancestor_name),
-        ).label("location_data")
-    )
 
-    # type coercion is necessary for numeric columns
-    # if we allow Pandas to infer the column type for these,
-    # there's a risk that it will guess wrong, then it might
-    # raise exceptions when we're calculating the mean and
-    # standard deviation on those columns
-    type_coercions = {
-        tag: np.float64
-        for tag in fields
-        if form.get_field_by_tag(tag)["type"] == "integer" or form.get_field_by_tag(tag)["type"] == "select"
-    }
-
-    dataframe_query = (
-        query.filter(Submission.location_id == own_loc.id)
-        .join(sub_query, Submission.id == sub_query.c.submission_id)
-        .group_by(Submission.id, own_loc.registered_voters)
-        .with_entities(*columns)
-    )
+def _location_table(locations):
+    """Returns the location columns of locations.
 
-    df = pd.read_sql(
-        dataframe_query.selectable,
-        dataframe_query.session.get_bind(),
-    ).astype(type_coercions)
+    Args:
+        locations: the location set and registered voters of the locations,
+            indexed by the location ids.
 
-    loc_data_df = pd.json_normalize(df["location_data"]).replace('(^"|"$)', "", regex=True)
-    loc_data_df.columns = loc_data_df.columns.str.strip('"')
+    Returns:
+        a dataframe with the same index, the registered voters of the
+        locations and a column with the names of the locations on their
+        paths for every location type.
+    """
+    name_paths = {}
+    for location_set_id, ids in locations.groupby("location_set_id").groups.items():
+        name_paths.update(get_ancestry(location_set_id).name_paths(ids))
 
-    df_summary = pd.concat([df.drop("location_data", axis=1), loc_data_df], axis=1).reindex(df.index)
+    names = pd.DataFrame.from_dict(
+        {location_id: path or {} for location_id, path in name_paths.items()}, orient="index"
+    ).reindex(locations.index)
 
-    return df_summary
+    return pd.concat([locations[["registered_voters"]], names], axis=1)
 
 
-def make_turnout_dataframe(query, form):  # noqa
-    if not db.session.query(query.exists()).scalar():
-        return pd.DataFrame()
+def load_submission_dataframe(query, form, tags, registered_voters_tag=None):
+    """Loads the values of tags in the submissions of a query into a dataframe.
 
-    fields = set(form.turnout_fields)  # noqa
+    The dataframe is indexed by the submission ids.
 
-    integral_fields = [
-        tag
-        for tag in fields
-        if form.get_field_by_tag(tag)["type"] == "integer" or form.get_field_by_tag(tag)["type"] == "select"
-    ]
+    Args:
+        query: the submission query.
+        form: the form of the submissions.
+        tags: the tags to load the values of.
+        registered_voters_tag: the tag the registered voters are read from
+            instead of the locations of the submissions.
+    """
+    total = query.order_by(None).count()
+    if not total:
+        return pd.DataFrame()
 
-    columns = [cast(func.nullif(Submission.data[tag].astext, ""), BigInteger).label(tag) for tag in integral_fields]
-    other_fields = fields.difference(integral_fields)
+    columns = [Submission.id, Submission.location_id]
+    dtypes = [np.int64, np.int64]
+    for tag in tags:
+        column, dtype = _tag_column(form, tag)
+        columns.append(column)
+        dtypes.append(dtype)
 
     # the 'updated' field is required for results analysis
-    columns.extend(
-        [Submission.data[tag].label(tag) for tag in other_fields]
-        + [
-            func.coalesce(
-                # casting to TIMESTAMP so as to lose the time zone
-                Submission.extra_data["voting_timestamp"].astext.cast(TIMESTAMP),  # noqa
-                Submission.updated,
-            ).label("updated")
-        ]
+    columns.append(
+        func.coalesce(
+            # casting to TIMESTAMP so as to lose the time zone
+            Submission.extra_data["voting_timestamp"].astext.cast(TIMESTAMP),  # noqa
+            Submission.updated,
+        ).label("updated")
     )
+    dtypes.append("datetime64[ns]")
+    if registered_voters_tag:
+        column, dtype = _tag_column(form, registered_voters_tag, "registered_voters")
+        columns.append(column)
+        dtypes.append(dtype)
+
+    arrays = [np.empty(total, dtype=dtype) for dtype in dtypes]
+    statement = query.with_entities(*columns).statement.execution_options(yield_per=DATAFRAME_YIELD_PER)
+    count = 0
+    for rows in db.session.execute(statement).partitions():
+        if count + len(rows) > len(arrays[0]):
+            # submissions were added since they were counted
+            arrays = [np.concatenate([array, np.empty(len(rows), dtype=array.dtype)]) for array in arrays]
+
+        for array, values in zip(arrays, zip(*rows)):
+            _fill(array, count, values)
+        count += len(rows)
+
+    names = ["id", "location_id"] + list(tags) + [column.name for column in columns[len(tags) + 2 :]]
+    dataframe = pd.DataFrame({name: array[:count] for name, array in zip(names, arrays)})
+    if dataframe.empty:
+        return pd.DataFrame()
 
-    # alias just in case the query is already joined to the tables below
-    ancestor_loc = aliased(Location, name="ancestor")
-    ancestor_loc_type = aliased(LocationType, name="ancestor_type")
-    ancestor_loc_path = aliased(LocationPath, name="ancestor_path")
-    own_loc = aliased(Location, name="own_location")
-
-    sub_query = (
-        Submission.query.join(own_loc, Submission.location_id == own_loc.id)
-        .join(ancestor_loc_path, Submission.location_id == ancestor_loc_path.descendant_id)
-        .join(ancestor_loc, ancestor_loc.id == ancestor_loc_path.ancestor_id)
-        .join(ancestor_loc_type, ancestor_loc.location_type_id == ancestor_loc_type.id)
-        .with_entities(
-            cast(ancestor_loc.name, String).label("ancestor_name"),
-            cast(ancestor_loc_type.name, String).label("ancestor_type"),
-            Submission.id.label("submission_id"),
-        )
-        .subquery()
+    location_ids = dataframe["location_id"].unique()
+    locations = _location_table(
+        pd.DataFrame(
+            Location.query.filter(Location.id.in_(location_ids.tolist()))
+            .with_entities(Location.id, Location.location_set_id, Location.registered_voters)
+            .all(),
+            columns=["id", "location_set_id", "registered_voters"],
+        ).set_index("id")
     )
+    if registered_voters_tag:
+        locations = locations.drop(columns="registered_voters")
+    location_columns = locations.reindex(dataframe["location_id"].to_numpy())
+    location_columns.index = dataframe.index
 
-    # add registered voters and path extraction to the columns
-    columns.append(
-        own_loc.registered_voters.label("registered_voters")
-        if not form.turnout_registered_voters_tag
-        else Submission.data[form.turnout_registered_voters_tag].label("registered_voters")
-    )
-    columns.append(
-        func.jsonb_object(
-            array_agg(sub_query.c.ancestor_type),
-            array_agg(sub_query.c.ancestor_name),
-        ).label("location_data")
-    )
+    return pd.concat([dataframe.drop(columns="location_id"), location_columns], axis=1).set_index("id")
 
-    # type coercion is necessary for numeric columns
-    # if we allow Pandas to infer the column type for these,
-    # there's a risk that it will guess wrong, then it might
-    # raise exceptions when we're calculating the mean and
-    # standard deviation on those columns
-    type_coercions = {
-        tag: np.float64
-        for tag in form.turnout_fields
-        if form.get_field_by_tag(tag)["type"] == "integer" or form.get_field_by_tag(tag)["type"] == "select"
-    }
-
-    dataframe_query = (
-        query.filter(Submission.location_id == own_loc.id)
-        .join(sub_query, Submission.id == sub_query.c.submission_id)
-        .group_by(Submission.id, own_loc.registered_voters)
-        .with_entities(*columns)
-    )
 
-    df = pd.read_sql(
-        dataframe_query.selectable,
-        dataframe_query.session.get_bind(),
-    ).astype(type_coercions)
+def select_tags(form, selected_tags=None, excluded_tags=None):
+    """Returns the tags of a form that are selected and not excluded, in form order."""
+    # excluded tags have higher priority than selected tags
+    fields = set(form.tags)
+    if selected_tags:
+        fields = fields.intersection(selected_tags)
+    if excluded_tags:
+        fields = fields.difference(excluded_tags)
+
+    return [tag for tag in form.tags if tag in fields]
+
 
-    loc_data_df = pd.json_normalize(df["location_data"]).replace('(^"|"$)', "", regex=True)
-    loc_data_df.columns = loc_data_df.columns.str.strip('"')
+def make_submission_dataframe(query, form, selected_tags=None, excluded_tags=None):
+    """Create a pandas data frame from the given query."""
+    tags = select_tags(form, selected_tags, excluded_tags)
+
+    return load_submission_dataframe(query, form, tags).reset_index(drop=True)
 
-    df_summary = pd.concat([df.drop("location_data", axis=1), loc_data_df], axis=1).reindex(df.index)
 
-    return df_summary
+def make_turnout_dataframe(query, form):  # noqa
+    tags = list(dict.fromkeys(form.turnout_fields))
+
+    return load_submission_dataframe(query, form, tags, form.turnout_registered_voters_tag).reset_index(drop=True)
 
 
 def valid_turnout_dataframe(dataframe: pd.DataFrame, form: object, turnout_field_label: str, rv_field_label: str):  # noqa
@@ -18,6 +18,7 @@ from flask import (
     redirect,
     render_template,
     request,
+    send_file,
     session,
     stream_with_context,
     url_for,
@@ -30,7 +31,7 @@ from flask_security import current_user, login_required
 from flask_security.utils import verify_and_update_password
 from geoalchemy2.shape import to_shape
 from slugify import slugify
-from sqlalchemy import BigInteger, case, desc, func, nullslast
+from sqlalchemy import BigInteger, case, desc, func
 from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.orm import joinedload
 from sqlalchemy.sql import false
@@ -40,7 +41,6 @@ from werkzeug.datastructures import MultiDict
 from apollo import models, services
 from apollo import utils as autils
 from apollo.core import db, docs
-from apollo.dal import utils
 from apollo.frontend import permissions, route
 from apollo.frontend.helpers import (
     DictDiffer,
@@ -52,13 +52,16 @@ from apollo.frontend.helpers import (
 )
 from apollo.frontend.template_filters import mkunixtimestamp
 from apollo.messaging.tasks import send_messages
-from apollo.submissions import filters, forms
-from apollo.submissions.aggregation import _qa_counts, aggregate_dataset, aggregated_dataframe
+from apollo.result_analysis.models import ResultAggregate
+from apollo.submissions import exports, filters, forms
+from apollo.submissions.aggregation import _qa_counts, aggregated_export
+from apollo.submissions.analysis_cache import analysis_dataframe
 from apollo.submissions.api import views as api_views
 from apollo.submissions.incidents import incidents_csv
+from apollo.submissions.listing import KeysetPagination, SortKey, page_qa_statuses, submission_list_options
 from apollo.submissions.models import QUALITY_STATUSES, Submission
 from apollo.submissions.qa.query_builder import generate_qa_queries
-from apollo.submissions.utils import make_submission_dataframe
+from apollo.submissions.tasks import export_submissions
 
 auth = HTTPBasicAuth()
 bp = Blueprint("submissions", __name__, template_folder="templates", static_folder="static")
@@ -156,6 +159,10 @@ def submission_list(form_id):
     data = request.args.to_dict(flat=False)
     data["form_id"] = str(form.id)
     page = int(data.pop("page", [1])[0])
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    data.pop("after", None)
+    data.pop("before", None)
     loc_types = displayable_location_types(is_administrative=True, location_set_id=event.location_set_id)
     query = models.Submission.query.options(joinedload(models.Submission.form))
     _location_query = None
@@ -206,57 +213,8 @@ def submission_list(form_id):
         query = query.join(models.Submission.location)
 
     if request.args.get("export") and permissions.export_submissions.can():
-        query = filter_class(query, request.args).qs
-        include_group_timestamps = False
-
-        mode = request.args.get("export")
-        if mode in ["master", "aggregated"]:
-            submission_type = "M"
-
-            # only change the submission type if we are aggregating data
-            # and are not tracking conflicts
-            if mode == "aggregated" and form.untrack_data_conflicts == True:  # noqa
-                submission_type = "O"
-
-            queryset = query.filter(
-                models.Submission.submission_type == submission_type,
-                models.Submission.form == form,
-                models.Submission.event == event,
-            )
-            if utils.has_model(queryset, models.Location):
-                queryset = queryset.order_by(models.Location.code)
-            else:
-                queryset = queryset.join(models.Submission.location).order_by(models.Location.code)
-        else:
-            include_group_timestamps = True if mode == "observer-ts" else False
-            queryset = query.filter(
-                models.Submission.submission_type == "O",
-                models.Submission.form == form,
-                models.Submission.event == event,
-            )
-            if not utils.has_model(queryset, models.Location):
-                queryset = queryset.join(models.Submission.location)
-            queryset = queryset.join(
-                models.Participant,
-                models.Submission.participant_id == models.Participant.id,
-            ).order_by(models.Location.code, models.Participant.participant_id)
-
-        # TODO: fix this. no exports yet. nor aggregation
-        # query_filterset = filter_class(queryset, request.args)
-        basename = slugify(
-            "%s %s %s %s"
-            % (g.event.name.lower(), form.name.lower(), datetime.utcnow().strftime("%Y %m %d %H%M%S"), mode)
-        )
-        content_disposition = "attachment; filename=%s.csv" % basename
-        if mode == "aggregated":
-            # TODO: you want to change the float format or even remove it
-            # if you have columns that have float values
-            dataset = aggregate_dataset(queryset.order_by(None), form, True)
-        else:
-            dataset = services.submissions.export_list(queryset, include_group_timestamps=include_group_timestamps)
-
-        return Response(
-            stream_with_context(dataset), headers={"Content-Disposition": content_disposition}, mimetype="text/csv"
+        return export_response(
+            event, form, request.args.get("export"), participant.location_id if _location_query is not None else None
         )
 
     # the following section defines the queryset for the submissions
@@ -331,40 +289,22 @@ def submission_list(form_id):
     if _location_query:
         queryset = queryset.filter(models.Submission.location_id.in_(_location_query))
 
+    descending = request.args.get("sort_direction") == "desc"
     if request.args.get("sort_by") == "pid":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(
-                desc(models.Participant.participant_id.cast(BigInteger)),
-                models.Submission.serial_no.cast(BigInteger),
-                models.Location.code.cast(BigInteger),
-            )
-        else:
-            queryset = queryset.order_by(
-                models.Participant.participant_id.cast(BigInteger),
-                models.Submission.serial_no.cast(BigInteger),
-                models.Location.code.cast(BigInteger),
-            )
+        sort_keys = [
+            SortKey(models.Participant.participant_id.cast(BigInteger), descending),
+            SortKey(models.Submission.serial_no.cast(BigInteger)),
+            SortKey(models.Location.code.cast(BigInteger)),
+        ]
     elif request.args.get("sort_by") == "fsn":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(desc(models.Submission.serial_no.cast(BigInteger)))
-        else:
-            queryset = queryset.order_by(models.Submission.serial_no.cast(BigInteger))
+        sort_keys = [SortKey(models.Submission.serial_no.cast(BigInteger), descending)]
     elif request.args.get("sort_by") == "id":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(desc(models.Submission.id.cast(BigInteger)))
-        else:
-            queryset = queryset.order_by(models.Submission.id.cast(BigInteger))
+        sort_keys = [SortKey(models.Submission.id.cast(BigInteger), descending)]
     elif request.args.get("sort_by") == "location":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(
-                desc(descendants.c.name_translations.op("->>")(user_locale)),
-                desc(descendants.c.name_translations.op("->>")(deployment_locale)),
-            )
-        else:
-            queryset = queryset.order_by(
-                descendants.c.name_translations.op("->>")(user_locale),
-                descendants.c.name_translations.op("->>")(deployment_locale),
-            )
+        sort_keys = [
+            SortKey(descendants.c.name_translations.op("->>")(user_locale), descending),
+            SortKey(descendants.c.name_translations.op("->>")(deployment_locale), descending),
+        ]
     elif request.args.get("sort_by") == "participant":
         # specify the conditions for the order term
         condition1 = full_name_term == None  # noqa
@@ -381,26 +321,17 @@ def submission_list(form_id):
         # if the full name is empty, order by the concatenated
         # name, else order by the full name
         order_term = case((condition1, full_name_concat), (condition2, full_name_term))
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(desc(order_term))
-        else:
-            queryset = queryset.order_by(order_term)
+        sort_keys = [SortKey(order_term, descending)]
     elif request.args.get("sort_by") == "phone":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(desc(models.PhoneContact.number))
-        else:
-            queryset = queryset.order_by(models.PhoneContact.number)
+        sort_keys = [SortKey(models.PhoneContact.number, descending)]
     elif request.args.get("sort_by") == "moment":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(nullslast(desc(models.Submission.participant_updated)))
-        else:
-            queryset = queryset.order_by(models.Submission.participant_updated)
+        sort_keys = [SortKey(models.Submission.participant_updated, descending, nulls_last=True)]
     else:
-        queryset = queryset.order_by(
-            models.Participant.participant_id.cast(BigInteger),
-            models.Submission.serial_no.cast(BigInteger),
-            models.Location.code.cast(BigInteger),
-        )
+        sort_keys = [
+            SortKey(models.Participant.participant_id.cast(BigInteger)),
+            SortKey(models.Submission.serial_no.cast(BigInteger)),
+            SortKey(models.Location.code.cast(BigInteger)),
+        ]
 
     query_filterset = filter_class(queryset, request.args)
     filter_form = query_filterset.form
@@ -471,7 +402,15 @@ def submission_list(form_id):
         location_types=loc_types,
         location=location,
         breadcrumbs=breadcrumbs,
-        pager=query_filterset.qs.paginate(page=page, per_page=current_app.config.get("PAGE_SIZE")),
+        pager=KeysetPagination(
+            query_filterset.qs.options(*submission_list_options()),
+            sort_keys,
+            models.Submission.id,
+            page=page,
+            per_page=current_app.config.get("PAGE_SIZE"),
+            after=after,
+            before=before,
+        ),
         submissions=query_filterset.qs,
     )
 
@@ -792,7 +731,8 @@ def submission_edit(submission_id):
                     for attachment in deleted_attachments:
                         db.session.delete(attachment)
 
-                    services.submissions.find(id=submission_id).update(update_params, synchronize_session=False)
+                    with ResultAggregate.track([submission.id]):
+                        services.submissions.find(id=submission_id).update(update_params, synchronize_session=False)
                     db.session.commit()
                     update_submission_version(submission)
 
@@ -931,9 +871,10 @@ def submission_edit(submission_id):
                         if extra_data:
                             update_params["extra_data"] = extra_data
 
-                        services.submissions.find(id=master_submission.id).update(
-                            update_params, synchronize_session=False
-                        )
+                        with ResultAggregate.track([master_submission.id]):
+                            services.submissions.find(id=master_submission.id).update(
+                                update_params, synchronize_session=False
+                            )
                         db.session.commit()
 
                 else:
@@ -1058,7 +999,8 @@ def submission_edit(submission_id):
                         if extra_data:
                             update_params["extra_data"] = extra_data
 
-                        services.submissions.find(id=submission.id).update(update_params)
+                        with ResultAggregate.track([submission.id]):
+                            services.submissions.find(id=submission.id).update(update_params)
 
                         submission.update_related(data)
 
@@ -1167,7 +1109,7 @@ def _incident_csv(form_id, location_type_id, location_id=None):
         models.Submission.created <= event.end, models.Submission.created >= event.start
     )
 
-    df = make_submission_dataframe(submission_query, form)
+    df = analysis_dataframe(submission_query, form, event, "O")
     ds = Dataset()
     ds.headers = ["LOC"] + tags + ["TOT"]
 
@@ -1309,6 +1251,10 @@ def quality_assurance_list(form_id):
     data = request.args.to_dict(flat=False)
     data["form_id"] = str(form.id)
     page = int(data.pop("page", [1])[0])
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int)
+    data.pop("after", None)
+    data.pop("before", None)
     loc_types = displayable_location_types(is_administrative=True, location_set_id=g.event.location_set_id)
 
     user_locale = get_locale().language
@@ -1336,32 +1282,7 @@ def quality_assurance_list(form_id):
         location = services.locations.find(id=request.args.get("location")).first()
 
     if request.args.get("export") and permissions.export_submissions.can():
-        mode = request.args.get("export")
-        if form.quality_checks:
-            queryset = (
-                models.Submission.query.filter(
-                    models.Submission.submission_type == "O",
-                    models.Submission.form == form,
-                    models.Submission.event == event,
-                )
-                .join(models.Submission.location)
-                .join(models.Submission.participant)
-                .order_by(models.Submission.location_id, models.Submission.participant_id)
-            )
-        else:
-            queryset = models.Submission.query.filter(false())
-
-        query_filterset = filter_class(queryset, request.args)
-        dataset = services.submissions.export_list(query_filterset.qs, include_qa=True)
-        basename = slugify(
-            "%s %s %s %s"
-            % (g.event.name.lower(), form.name.lower(), datetime.utcnow().strftime("%Y %m %d %H%M%S"), mode)
-        )
-        content_disposition = "attachment; filename=%s.csv" % basename
-
-        return Response(
-            stream_with_context(dataset), headers={"Content-Disposition": content_disposition}, mimetype="text/csv"
-        )
+        return export_response(event, form, "qa")
 
     # the following section defines the queryset for the submissions
     # to be retrieved. due to the fact that we do specialized sorting
@@ -1441,35 +1362,20 @@ def quality_assurance_list(form_id):
             .join(models.Participant, models.Submission.participant_id == models.Participant.id)
         )
 
+    descending = request.args.get("sort_direction") == "desc"
     if request.args.get("sort_by") == "pid":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(
-                desc(models.Participant.participant_id.cast(BigInteger)),
-                models.Submission.serial_no.cast(BigInteger),
-                models.Location.code.cast(BigInteger),
-            )
-        else:
-            queryset = queryset.order_by(
-                models.Participant.participant_id.cast(BigInteger),
-                models.Submission.serial_no.cast(BigInteger),
-                models.Location.code.cast(BigInteger),
-            )
+        sort_keys = [
+            SortKey(models.Participant.participant_id.cast(BigInteger), descending),
+            SortKey(models.Submission.serial_no.cast(BigInteger)),
+            SortKey(models.Location.code.cast(BigInteger)),
+        ]
     elif request.args.get("sort_by") == "fsn":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(desc(models.Submission.serial_no.cast(BigInteger)))
-        else:
-            queryset = queryset.order_by(models.Submission.serial_no.cast(BigInteger))
+        sort_keys = [SortKey(models.Submission.serial_no.cast(BigInteger), descending)]
     elif request.args.get("sort_by") == "location":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(
-                desc(descendants.c.name_translations.op("->>")(user_locale)),
-                desc(descendants.c.name_translations.op("->>")(deployment_locale)),
-            )
-        else:
-            queryset = queryset.order_by(
-                descendants.c.name_translations.op("->>")(user_locale),
-                descendants.c.name_translations.op("->>")(deployment_locale),
-            )
+        sort_keys = [
+            SortKey(descendants.c.name_translations.op("->>")(user_locale), descending),
+            SortKey(descendants.c.name_translations.op("->>")(deployment_locale), descending),
+        ]
     elif request.args.get("sort_by") == "participant":
         # specify the conditions for the order term
         condition1 = full_name_term == None  # noqa
@@ -1486,31 +1392,20 @@ def quality_assurance_list(form_id):
         # if the full name is empty, order by the concatenated
         # name, else order by the full name
         order_term = case((condition1, full_name_concat), (condition2, full_name_term))
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(desc(order_term))
-        else:
-            queryset = queryset.order_by(order_term)
+        sort_keys = [SortKey(order_term, descending)]
     elif request.args.get("sort_by") == "phone":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(desc(participant_phones.c.number))
-        else:
-            queryset = queryset.order_by(participant_phones.c.number)
+        sort_keys = [SortKey(participant_phones.c.number, descending)]
     elif request.args.get("sort_by") == "moment":
-        if request.args.get("sort_direction") == "desc":
-            queryset = queryset.order_by(nullslast(desc(models.Submission.participant_updated)))
-        else:
-            queryset = queryset.order_by(models.Submission.participant_updated)
+        sort_keys = [SortKey(models.Submission.participant_updated, descending, nulls_last=True)]
     else:
-        queryset = queryset.order_by(
-            models.Participant.participant_id.cast(BigInteger),
-            models.Submission.serial_no.cast(BigInteger),
-            models.Location.code.cast(BigInteger),
-        )
+        sort_keys = [
+            SortKey(models.Participant.participant_id.cast(BigInteger)),
+            SortKey(models.Submission.serial_no.cast(BigInteger)),
+            SortKey(models.Location.code.cast(BigInteger)),
+        ]
 
     if not form.quality_checks:
-        queryset = models.Submission.query.filter(false())
-    else:
-        queryset = queryset.with_entities(models.Submission, *generate_qa_queries(form)[0])
+        queryset = queryset.filter(false())
 
     query_filterset = filter_class(queryset, request.args)
     filter_form = query_filterset.form
@@ -1521,8 +1416,10 @@ def quality_assurance_list(form_id):
         recipients = [
             x
             for x in [
-                res[0].participant.primary_phone if res[0].participant and res[0].participant.primary_phone else ""
-                for res in query_filterset.qs
+                submission.participant.primary_phone
+                if submission.participant and submission.participant.primary_phone
+                else ""
+                for submission in query_filterset.qs
             ]
             if x != ""
         ]
@@ -1534,6 +1431,15 @@ def quality_assurance_list(form_id):
         else:
             abort(400)
 
+    pager = KeysetPagination(
+        query_filterset.qs.options(*submission_list_options()),
+        sort_keys,
+        models.Submission.id,
+        page=page,
+        per_page=current_app.config.get("PAGE_SIZE"),
+        after=after,
+        before=before,
+    )
     context = {
         "form": form,
         "args": data,
@@ -1541,7 +1447,8 @@ def quality_assurance_list(form_id):
         "breadcrumbs": breadcrumbs,
         "location_types": loc_types,
         "location": location,
-        "pager": query_filterset.qs.paginate(page=page, per_page=current_app.config.get("PAGE_SIZE")),
+        "pager": pager,
+        "qa_statuses": page_qa_statuses(form, pager.items),
         "submissions": queryset,
         "quality_statuses": QUALITY_STATUSES,
         "verification_statuses": VERIFICATION_OPTIONS,
@@ -1608,11 +1515,82 @@ def submission_export(form_id):
         submission_type = "M"
 
     queryset = services.submissions.find(form=form, submission_type=submission_type).order_by("location")
-    dataset = aggregated_dataframe(queryset, form).to_csv(encoding="utf-8", index=False, float_format="%d")
+    key = exports.export_key(None, form, "aggregated-api", MultiDict(), None, queryset)
+    path = exports.get_export(key)
+    if path is not None:
+        return send_file(path, mimetype="text/csv")
+
+    # the export is streamed while it is written, and served from its file
+    # until the submissions change
+    chunks = exports.stream_export(key, aggregated_export(queryset, form))
+    return Response(stream_with_context(chunks), mimetype="text/csv")
+
+
+def export_response(event, form, mode, location_id=None):
+    """Serves a cached export or starts generating it in the background."""
+    timestamp = datetime.utcnow().strftime("%Y %m %d %H%M%S")
+    basename = slugify("%s %s %s %s" % (event.name.lower(), form.name.lower(), timestamp, request.args.get("export")))
+    queryset = exports.make_export_query(event, form, mode, request.args, location_id)
+    key = exports.export_key(event, form, mode, request.args, location_id, queryset)
+
+    path = exports.get_export(key)
+    if path is not None:
+        return send_file(path, mimetype="text/csv", as_attachment=True, download_name=f"{basename}.csv")
+
+    task_id = exports.schedule_export(
+        key,
+        event_id=event.id,
+        form_id=form.id,
+        mode=mode,
+        args=request.args.to_dict(flat=False),
+        location_id=location_id,
+        locale=str(get_locale()),
+    )
+    status_url = url_for("submissions.export_status", task_id=task_id, filename=basename)
+
+    if request.accept_mimetypes.best == "application/json":
+        return jsonify({"id": task_id, "status_url": status_url}), HTTPStatus.ACCEPTED
+
+    context = {
+        "breadcrumbs": [_("Export"), form.name],
+        "status_url": status_url,
+    }
+
+    return render_template("frontend/export_status.html", **context), HTTPStatus.ACCEPTED
 
-    # TODO: any other way to control/stream the output?
-    # currently it just takes the name of the form ID
-    return Response(dataset, mimetype="text/csv")
+
+@route(bp, "/submissions/exports/<task_id>")
+@login_required
+@permissions.export_submissions.require(403)
+def export_status(task_id):
+    """Export task status view."""
+    result = export_submissions.AsyncResult(task_id)
+    data = {
+        "id": task_id,
+        "description": str(_("Export")),
+        "status": result.state,
+        "progress": result.info if result.state == "PROGRESS" else {},
+    }
+
+    if result.successful() and result.result:
+        data["download_url"] = url_for(
+            "submissions.export_download", key=result.result["key"], filename=request.args.get("filename")
+        )
+
+    return jsonify(data)
+
+
+@route(bp, "/submissions/exports/<key>/download")
+@login_required
+@permissions.export_submissions.require(403)
+def export_download(key):
+    """Export download view."""
+    path = exports.get_export(key)
+    if path is None:
+        abort(404)
+
+    filename = slugify(request.args.get("filename") or key)
+    return send_file(path, mimetype="text/csv", as_attachment=True, download_name=f"{filename}.csv")
 
 
 @route(bp, "/submissions/<int:submission_id>/image/delete", methods=["POST"])
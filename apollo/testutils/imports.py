@@ -0,0 +1,13 @@
+# -*- coding: utf-8 -*-
+from apollo.helpers import TaskProgress
+
+
+def parse_records(parser, dataframe, *args):
+    """Validates the rows of an import with the row parser of its task.
+
+    Returns the results of the parser followed by the progress the errors
+    and warnings were reported to.
+    """
+    progress = TaskProgress(None, dataframe.shape[0])
+
+    return (*parser(dataframe, *args, progress), progress)
@@ -0,0 +1,42 @@
+"""Added the result aggregates.
+
+Revision ID: 3c9b5e1f2a7d
+Revises: 087e5e5941ec
+Create Date: 2026-10-18 10:12:41.518204
+
+"""
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "3c9b5e1f2a7d"
+down_revision = "087e5e5941ec"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    """Database upgrade migration."""
+    op.create_table(
+        "result_aggregate",
+        sa.Column("event_id", sa.Integer(), nullable=False),
+        sa.Column("form_id", sa.Integer(), nullable=False),
+        sa.Column("location_id", sa.Integer(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.Column("count", sa.BigInteger(), nullable=False),
+        sa.Column("sum_a", sa.BigInteger(), nullable=False),
+        sa.Column("sum_m", sa.BigInteger(), nullable=False),
+        sa.Column("sum_aa", sa.BigInteger(), nullable=False),
+        sa.Column("sum_mm", sa.BigInteger(), nullable=False),
+        sa.Column("sum_am", sa.BigInteger(), nullable=False),
+        sa.ForeignKeyConstraint(["event_id"], ["event.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["form_id"], ["form.id"], ondelete="CASCADE"),
+        sa.ForeignKeyConstraint(["location_id"], ["location.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("event_id", "form_id", "location_id", "name"),
+    )
+
+
+def downgrade():
+    """Database downgrade migration."""
+    op.drop_table("result_aggregate")